@@ -0,0 +1,692 @@
+# -*- coding: utf-8 -*-
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing an asyncio IMAP client implementing the subset of IMAP used by gmvault
+(LOGIN, AUTHENTICATE XOAUTH2, COMPRESS, SELECT, UID SEARCH, X-GM-RAW, UID FETCH, APPEND,
+UID STORE, XLIST and IDLE).
+
+AsyncIMAPClient sends the commands without waiting for the previous ones to complete
+(pipelining): a reader task attributes the untagged responses to the oldest pending command
+and completes the commands on their tagged response. One event loop can drive many
+connections.
+
+BlockingIMAPClient exposes the MonkeyIMAPClient API over an AsyncIMAPClient running in the
+event loop thread shared by all the blocking clients. GIMAPFetcher uses it when
+[General] imap_transport=asyncio and IMAPBatchFetcher then splits each batch in
+[General] nb_pipelined_fetches pipelined FETCH commands (fetch_many).
+
+'''
+import asyncio
+import base64
+import collections
+import functools
+import imaplib  #for the exceptions
+import random
+import re
+import ssl
+import threading
+import time
+import zlib
+
+import imapclient
+from imapclient.imap_utf7 import encode as encode_utf7, decode as decode_utf7
+from imapclient.response_parser import parse_fetch_response, parse_message_list, parse_response
+
+import gmv.log_utils as log_utils
+import gmv.mod_imap as mimap
+
+LOG = log_utils.LoggerFactory.get_logger('aio_imap')
+
+CRLF = b'\r\n'
+
+UNTAGGED_STATUS_RE = re.compile(br'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?$')
+UNTAGGED_RE        = re.compile(br'\* (?P<type>[A-Z-]+)( (?P<data>.*))?$')
+TAGGED_RE          = re.compile(br'(?P<tag>[A-Za-z0-9]+) (?P<type>[A-Z]+) ?(?P<data>.*)$')
+RESPONSE_CODE_RE   = re.compile(br'\[(?P<type>[A-Z-]+)( (?P<data>.*))?\]')
+LITERAL_RE         = re.compile(br'\{(?P<size>\d+)\}$')
+
+READ_CHUNK = 65536
+
+class Literal(bytes):
+    """ command argument sent as an IMAP literal """
+    pass
+
+class _Command(object): #pylint:disable=R0903
+    """
+       A command waiting for its tagged response
+    """
+    def __init__(self, tag, name, loop):
+        self.tag          = tag
+        self.name         = name
+        self.untagged     = {}
+        self.future       = loop.create_future()
+        self.continuation = None
+        self.on_ok        = None
+
+    def add_untagged(self, typ, items):
+        """ store untagged data the way imaplib does: { type : [data, ...] } """
+        self.untagged.setdefault(typ, []).extend(items)
+
+class AsyncIMAPClient(object): #pylint:disable=R0902,R0904
+    """
+       asyncio IMAP client. The results have the same types as the IMAPClient ones
+    """
+    Error      = imaplib.IMAP4.error
+    AbortError = imaplib.IMAP4.abort
+
+    def __init__(self, host, port = None, use_uid = True, need_ssl = False):
+        """
+           constructor. connect() opens the connection
+        """
+        self.host            = host
+        self.port            = port or (imaplib.IMAP4_SSL_PORT if need_ssl else imaplib.IMAP4_PORT)
+        self.use_uid         = use_uid
+        self.ssl             = need_ssl
+        self.normalise_times = True
+        self.welcome         = None
+
+        self._reader        = None
+        self._writer        = None
+        self._read_task     = None
+        self._buffer        = bytearray()
+        self._compressor    = None
+        self._decompressor  = None
+        self.compression_stats = None # CompressionStats once COMPRESS is active
+        self.read_size      = READ_CHUNK
+        self._send_lock     = None
+        self._pending       = collections.deque()
+        self._waiting       = None # command waiting for a continuation request
+        self._idle_cmd      = None
+        self._idle_queue    = None
+        self._unsolicited   = None # receives the untagged responses sent when no command is pending
+        self._error         = None
+        self._capabilities  = None
+        self._tag_prefix    = ''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4)).encode('ascii')
+        self._tag_nb        = 0
+
+    # ----------------------------------------------------------------- connection
+
+    async def connect(self):
+        """
+           open the connection and read the greeting
+        """
+        context = mimap.get_tls_context() if self.ssl else None
+        try:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port, ssl = context)
+        except OSError as err:
+            raise self.AbortError("cannot connect to %s:%s: %s" % (self.host, self.port, err))
+
+        self._send_lock   = asyncio.Lock()
+        self._idle_queue  = asyncio.Queue()
+        self._unsolicited = _Command(b'*', 'unsolicited', asyncio.get_running_loop())
+        greeting = await self._read_response()
+        self.welcome = greeting[-1]
+        if not self.welcome.startswith((b'* OK', b'* PREAUTH')):
+            raise self.Error("Unexpected greeting %s" % (self.welcome))
+        self._set_capabilities(self.welcome[2:])
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    @property
+    def tls_session_reused(self):
+        """ True if the TLS handshake resumed a previous session (ssl_object.session_reused, False without TLS) """
+        ssl_object = self._writer.get_extra_info('ssl_object') if self._writer else None
+        return bool(ssl_object and ssl_object.session_reused)
+
+    async def _close(self):
+        """ close the socket """
+        if self._writer:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+        if self._read_task:
+            self._read_task.cancel()
+
+    # ----------------------------------------------------------------- reading
+
+    async def _fill(self):
+        """ read more data from the socket """
+        stats = self.compression_stats
+        if stats is None:
+            data = await self._reader.read(self.read_size)
+            if not data:
+                raise EOFError("socket closed")
+            self._buffer += data
+            return
+        start = time.perf_counter()
+        data  = await self._reader.read(self.read_size)
+        if self._pending: # do not count the time waiting for nothing
+            stats.io_time += time.perf_counter() - start
+        if not data:
+            raise EOFError("socket closed")
+        start = time.thread_time()
+        inflated = self._decompressor.decompress(data)
+        stats.cpu_time   += time.thread_time() - start
+        stats.wire_in    += len(data)
+        stats.payload_in += len(inflated)
+        self._buffer += inflated
+
+    async def _readline(self):
+        """ read a line without its CRLF """
+        start = 0
+        while True:
+            pos = self._buffer.find(b'\n', start)
+            if pos >= 0:
+                line = bytes(self._buffer[:pos+1])
+                del self._buffer[:pos+1]
+                return line.rstrip(CRLF)
+            start = len(self._buffer)
+            await self._fill()
+
+    async def _read_exact(self, size):
+        """ read size bytes """
+        while len(self._buffer) < size:
+            await self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def _read_response(self):
+        """ read a response and its literals as imaplib does: [(line, literal), ..., line] """
+        parts = []
+        line  = await self._readline()
+        while True:
+            match = LITERAL_RE.search(line)
+            if not match:
+                parts.append(line)
+                return parts
+            parts.append((line, await self._read_exact(int(match.group('size')))))
+            line = await self._readline()
+
+    async def _read_loop(self):
+        """ read and dispatch the responses until the connection is closed """
+        try:
+            while True:
+                self._dispatch(await self._read_response())
+        except asyncio.CancelledError:
+            self._fail(self.AbortError("connection closed"))
+        except (EOFError, OSError, ssl.SSLError, zlib.error) as err:
+            self._fail(self.AbortError("connection lost: %s" % (err)))
+        except Exception as err: #pylint:disable=W0703
+            LOG.exception(err)
+            self._fail(self.AbortError("unexpected response: %s" % (err)))
+
+    def _fail(self, error):
+        """ fail the pending commands """
+        self._error = error
+        while self._pending:
+            cmd = self._pending.popleft()
+            if cmd.continuation and not cmd.continuation.done():
+                cmd.continuation.set_exception(error)
+            if not cmd.future.done():
+                cmd.future.set_exception(error)
+        self._idle_queue.put_nowait(error)
+
+    def _dispatch(self, parts):
+        """ handle one response """
+        first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+        if first.startswith(b'+'):
+            if self._waiting and self._waiting.continuation and not self._waiting.continuation.done():
+                self._waiting.continuation.set_result(first[2:])
+            return
+
+        if first.startswith(b'* '):
+            # Assumption: the server answers the pipelined commands one after the other and never
+            # interleaves their FETCH responses (Gmail and the fake server do so). The untagged
+            # responses received before a tagged one thus belong to the oldest pending command.
+            # Otherwise fetch() would drop the messages of the other commands as unsolicited and
+            # IMAPBatchFetcher would report them as unreturned.
+            self._untagged(first, parts)
+            return
+
+        match = TAGGED_RE.match(first)
+        if not match:
+            raise self.AbortError("unexpected response %r" % (first))
+        cmd = next((cmd for cmd in self._pending if cmd.tag == match.group('tag')), None)
+        if cmd is None:
+            raise self.AbortError("unexpected tagged response %r" % (first))
+        self._pending.remove(cmd)
+        status, text = match.group('type').decode('ascii'), match.group('data')
+        self._response_code(cmd, text)
+        if status == 'OK' and cmd.on_ok:
+            cmd.on_ok(cmd)
+        if cmd.continuation and not cmd.continuation.done():
+            cmd.continuation.set_result(None)
+        cmd.future.set_result((status, text))
+
+    def _untagged(self, first, parts):
+        """ store an untagged response in the oldest pending command (the server answers in order) """
+        match = UNTAGGED_STATUS_RE.match(first)
+        if match:
+            typ, dat = match.group('type'), match.group('data')
+            if match.group('data2'):
+                dat = dat + b' ' + match.group('data2')
+        else:
+            match = UNTAGGED_RE.match(first)
+            if not match:
+                raise self.AbortError("unexpected response %r" % (first))
+            typ, dat = match.group('type'), match.group('data') or b''
+        typ = typ.decode('ascii')
+
+        if self._idle_cmd is not None and typ not in ('BYE',):
+            self._idle_queue.put_nowait(imapclient.imapclient._parse_untagged_response(first)) #pylint:disable=W0212
+            return
+
+        items = [ (dat, parts[0][1]) if isinstance(parts[0], tuple) else dat ] + parts[1:]
+        cmd   = self._pending[0] if self._pending else self._unsolicited
+        cmd.add_untagged(typ, items)
+        if typ in ('OK', 'NO', 'BAD', 'PREAUTH', 'BYE'):
+            self._response_code(cmd, dat)
+        if typ == 'CAPABILITY':
+            self._set_capabilities(b'[CAPABILITY ' + dat + b']')
+
+    def _response_code(self, cmd, text):
+        """ store the response code ([UIDVALIDITY 1], [READ-WRITE] ...) of text """
+        match = RESPONSE_CODE_RE.match(text)
+        if match:
+            cmd.add_untagged(match.group('type').decode('ascii'), [match.group('data')])
+            if match.group('type') == b'CAPABILITY':
+                self._set_capabilities(text)
+
+    def _set_capabilities(self, text):
+        """ memorize the capabilities announced in a [CAPABILITY ...] code """
+        match = RESPONSE_CODE_RE.search(text)
+        if match and match.group('type') == b'CAPABILITY' and match.group('data'):
+            self._capabilities = tuple(match.group('data').upper().split())
+
+    # ----------------------------------------------------------------- writing
+
+    async def _send(self, data):
+        """ write data (deflated after COMPRESS) """
+        stats = self.compression_stats
+        if stats is None:
+            self._writer.write(data)
+            await self._writer.drain()
+            return
+        start = time.thread_time()
+        deflated = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        stats.cpu_time    += time.thread_time() - start
+        stats.payload_out += len(data)
+        stats.wire_out    += len(deflated)
+        start = time.perf_counter()
+        self._writer.write(deflated)
+        await self._writer.drain()
+        stats.io_time += time.perf_counter() - start
+
+    def _next_tag(self):
+        """ a new command tag """
+        self._tag_nb += 1
+        return self._tag_prefix + str(self._tag_nb).encode('ascii')
+
+    async def _wait_continuation(self, cmd):
+        """ wait for the continuation request of cmd. Return False when cmd is completed instead """
+        await cmd.continuation
+        return not cmd.future.done()
+
+    async def _command(self, name, *args, exclusive = False, on_ok = None, untagged = None):
+        """
+           Send a command and wait for its completion. Return (status, text, untagged).
+           args are bytes, str or Literal. The other commands are sent without waiting for
+           this one unless exclusive is True. untagged: dict receiving the untagged responses
+           (still readable when the command fails).
+        """
+        if self._error:
+            raise self._error
+
+        loop = asyncio.get_running_loop()
+        async with self._send_lock:
+            cmd = _Command(self._next_tag(), name, loop)
+            cmd.on_ok = on_ok
+            if untagged is not None:
+                cmd.untagged = untagged
+            self._pending.append(cmd)
+            line = cmd.tag + b' ' + name.encode('ascii')
+            for arg in args:
+                if arg is None:
+                    continue
+                if isinstance(arg, Literal):
+                    if b'LITERAL+' in (self._capabilities or ()):
+                        await self._send(line + b' {%d+}' % (len(arg)) + CRLF)
+                    else:
+                        cmd.continuation, self._waiting = loop.create_future(), cmd
+                        await self._send(line + b' {%d}' % (len(arg)) + CRLF)
+                        if not await self._wait_continuation(cmd):
+                            break
+                    line = bytes(arg)
+                else:
+                    line += b' ' + (arg.encode('utf-8') if isinstance(arg, str) else arg)
+            else:
+                await self._send(line + CRLF)
+
+            if exclusive:
+                await asyncio.wait([cmd.future])
+
+        status, text = await cmd.future
+        return status, text, cmd.untagged
+
+    def _check(self, command, status, text):
+        """ raise an error when the command failed """
+        if status != 'OK':
+            raise self.Error("%s failed: %s" % (command, text.decode('utf-8', 'replace')))
+
+    async def _command_and_check(self, name, *args, **kwargs):
+        """ send a command, raise an error if it fails. Return (text, untagged) """
+        status, text, untagged = await self._command(name, *args, **kwargs)
+        self._check(name.split()[-1].lower(), status, text)
+        return text, untagged
+
+    def _uid(self, name):
+        """ command name with the UID prefix """
+        return 'UID %s' % (name) if self.use_uid else name
+
+    @classmethod
+    def _normalise_folder(cls, folder):
+        """ utf7 quoted folder name """
+        if isinstance(folder, bytes):
+            folder = folder.decode('ascii')
+        return imapclient.imapclient._quote(encode_utf7(folder)) #pylint:disable=W0212
+
+    @classmethod
+    def _normalise_msg(cls, msg):
+        """ message as bytes with CRLF line ends """
+        return imaplib.MapCRLF.sub(CRLF, mimap.to_bytes(msg))
+
+    # ----------------------------------------------------------------- commands
+
+    async def capabilities(self):
+        """ the server capabilities (bytes, upper case) """
+        if self._capabilities is None:
+            _, untagged = await self._command_and_check('CAPABILITY')
+            self._capabilities = tuple(b' '.join(untagged.get('CAPABILITY', [b''])).upper().split())
+        return self._capabilities
+
+    async def has_capability(self, capability):
+        """ True if the server announces capability """
+        return mimap.to_bytes(capability).upper() in (await self.capabilities())
+
+    async def login(self, username, password):
+        """ LOGIN """
+        text, _ = await self._command_and_check('LOGIN', imapclient.imapclient._quote(username), \
+                                                imapclient.imapclient._quote(password)) #pylint:disable=W0212
+        return text
+
+    async def oauth2_login(self, oauth2_cred):
+        """ AUTHENTICATE XOAUTH2 """
+        return await self.authenticate('XOAUTH2', mimap.to_bytes(oauth2_cred))
+
+    async def authenticate(self, mechanism, response):
+        """ SASL authentication with a single client response """
+        if self._error:
+            raise self._error
+        loop = asyncio.get_running_loop()
+        async with self._send_lock:
+            cmd = _Command(self._next_tag(), 'AUTHENTICATE', loop)
+            cmd.continuation, self._waiting = loop.create_future(), cmd
+            self._pending.append(cmd)
+            await self._send(cmd.tag + b' AUTHENTICATE ' + mechanism.encode('ascii') + CRLF)
+            if await self._wait_continuation(cmd):
+                cmd.continuation = loop.create_future()
+                await self._send(base64.b64encode(response) + CRLF)
+                # a failure is announced by a continuation with the error details
+                while await self._wait_continuation(cmd):
+                    cmd.continuation = loop.create_future()
+                    await self._send(CRLF)
+        status, text = await cmd.future
+        self._check('authenticate', status, text)
+        return text
+
+    async def enable_compression(self, level = zlib.Z_DEFAULT_COMPRESSION, read_size = None):
+        """
+           COMPRESS DEFLATE. Everything after the tagged OK is deflated.
+           level: zlib level of the data sent. read_size: nb of bytes read at once from then on
+        """
+        def activate(_):
+            """ called by the reader right after the tagged OK """
+            self._compressor   = zlib.compressobj(level, zlib.DEFLATED, -15)
+            self._decompressor = zlib.decompressobj(-15)
+            self.compression_stats = mimap.CompressionStats()
+            self.read_size = read_size or self.read_size
+            if self._buffer:
+                self._buffer = bytearray(self._decompressor.decompress(bytes(self._buffer)))
+
+        status, text, _ = await self._command('COMPRESS', b'DEFLATE', exclusive = True, on_ok = activate)
+        return status == 'OK'
+
+    async def select_folder(self, folder, readonly = False):
+        """ SELECT or EXAMINE. Return the IMAPClient dict (b'EXISTS', b'UIDVALIDITY', ...) """
+        _, untagged = await self._command_and_check('EXAMINE' if readonly else 'SELECT', \
+                                                     self._normalise_folder(folder))
+        return imapclient.IMAPClient._process_select_response(None, untagged) #pylint:disable=W0212
+
+    async def search(self, criteria):
+        """ imap or gmail search: { 'type' : 'imap' | 'gmail', 'req' : ..., 'restrict' : ... } """
+        restrict = criteria.get('restrict', None)
+        if criteria.get('type', '') == 'imap':
+            req = criteria['req']
+            if restrict:
+                req = '%s %s' % (restrict, req)
+            args = [b'CHARSET', b'utf-8', req.encode('utf-8')]
+        elif criteria.get('type', '') == 'gmail':
+            req = criteria.get('req', '').replace('\\', '\\\\').replace('"', '\\"')
+            args = [b'CHARSET', b'utf-8'] + (restrict.split() if restrict else []) + \
+                   [b'X-GM-RAW', Literal(self._normalise_msg('"%s"' % (req)))]
+        else:
+            raise Exception("Unknown search type %s" % (criteria.get('type', 'no request type passed')))
+
+        _, untagged = await self._command_and_check(self._uid('SEARCH'), *args)
+        return parse_message_list(untagged.get('SEARCH', []))
+
+    async def fetch(self, messages, data, modifiers = None):
+        """ UID FETCH. Return { uid : { attribute : value } } as IMAPClient.fetch """
+        if not messages:
+            return {}
+        untagged = {}
+        try:
+            await self._command_and_check(self._uid('FETCH'), \
+                                          imapclient.imapclient.join_message_ids(messages), \
+                                          imapclient.imapclient.seq_to_parenstr_upper(data), \
+                                          imapclient.imapclient.seq_to_parenstr_upper(modifiers) if modifiers else None, \
+                                          untagged = untagged)
+        except self.AbortError as err:
+            # the error is shared by the pending commands: attach the messages received to a copy
+            error = self.AbortError(str(err))
+            error.partial = mimap.parse_partial_fetch(untagged.get('FETCH', []), messages, \
+                                                      self.normalise_times, self.use_uid)
+            raise error from err
+        response = parse_fetch_response(untagged.get('FETCH', []), self.normalise_times, self.use_uid)
+        # drop unsolicited responses for other messages
+        return { msg_id : response[msg_id] for msg_id in imapclient.imapclient.to_ints(messages) \
+                 if msg_id in response }
+
+    async def fetch_many(self, batches, data):
+        """
+           pipelined fetches: one command per batch of ids, all sent at once. Return the merged dict.
+           On error, the first error is raised with the messages received by all the commands (partial)
+        """
+        result = {}
+        error  = None
+        for response in await asyncio.gather(*[ self.fetch(batch, data) for batch in batches ], \
+                                             return_exceptions = True):
+            if isinstance(response, Exception):
+                result.update(getattr(response, 'partial', None) or {})
+                error = error or response
+            else:
+                result.update(response)
+        if error is not None:
+            error.partial = result
+            raise error
+        return result
+
+    async def append(self, folder, msg, flags = (), msg_time = None):
+        """ APPEND. Return the tagged response ([APPENDUID uidvalidity uid] (Success)) """
+        time_val = ('"%s"' % (mimap.datetime_to_imap(msg_time))) if msg_time else None
+        text, _ = await self._command_and_check('APPEND', self._normalise_folder(folder), \
+                                                imapclient.imapclient.seq_to_parenstr(flags), \
+                                                time_val, Literal(self._normalise_msg(msg)))
+        return text
+
+    async def uid_store(self, messages, item, value):
+        """ UID STORE. Return (status, data) as imaplib does """
+        status, text, untagged = await self._command(self._uid('STORE'), \
+                                     imapclient.imapclient.join_message_ids(messages), item, value)
+        if status == 'BAD':
+            raise self.Error("store failed: %s" % (text.decode('utf-8', 'replace')))
+        if status != 'OK':
+            return status, [text]
+        return status, untagged.get('FETCH', [None])
+
+    async def delete_messages(self, messages, silent = False):
+        """ add the \\Deleted flag """
+        status, data = await self.uid_store(messages, '+FLAGS.SILENT' if silent else '+FLAGS', '(\\Deleted)')
+        self._check('store', status, data[0] or b'')
+        return None if silent else parse_fetch_response([ item for item in data if item ])
+
+    async def expunge(self):
+        """ EXPUNGE. Return (text, [(seq, b'EXPUNGE'), ...]) """
+        text, untagged = await self._command_and_check('EXPUNGE')
+        return text, [ (int(seq), b'EXPUNGE') for seq in untagged.get('EXPUNGE', []) ]
+
+    async def _list(self, command, directory = '', pattern = '*'):
+        """ LIST or XLIST. Return [(flags, delimiter, name), ...] """
+        _, untagged = await self._command_and_check(command, self._normalise_folder(directory), \
+                                                    self._normalise_folder(pattern))
+        folders = []
+        for flags, delim, name in imapclient.util.chunk(parse_response(untagged.get(command, [])), size = 3):
+            folders.append((flags, delim, str(name) if isinstance(name, int) else decode_utf7(name)))
+        return folders
+
+    async def xlist_folders(self, directory = '', pattern = '*'):
+        """ XLIST """
+        return await self._list('XLIST', directory, pattern)
+
+    async def list_folders(self, directory = '', pattern = '*'):
+        """ LIST """
+        return await self._list('LIST', directory, pattern)
+
+    async def folder_exists(self, folder):
+        """ True if folder exists """
+        return len(await self.list_folders('', folder)) > 0
+
+    async def create_folder(self, folder):
+        """ CREATE. Return the tagged response """
+        text, _ = await self._command_and_check('CREATE', self._normalise_folder(folder))
+        return text
+
+    async def delete_folder(self, folder):
+        """ DELETE. Return the tagged response """
+        text, _ = await self._command_and_check('DELETE', self._normalise_folder(folder))
+        return text
+
+    async def noop(self):
+        """ NOOP """
+        text, _ = await self._command_and_check('NOOP')
+        return text
+
+    async def idle(self):
+        """ enter IDLE: the untagged responses are queued for idle_check """
+        if self._error:
+            raise self._error
+        loop = asyncio.get_running_loop()
+        async with self._send_lock:
+            cmd = _Command(self._next_tag(), 'IDLE', loop)
+            cmd.continuation, self._waiting = loop.create_future(), cmd
+            self._pending.append(cmd)
+            await self._send(cmd.tag + b' IDLE' + CRLF)
+            if not await self._wait_continuation(cmd):
+                status, text = await cmd.future
+                self._check('idle', status, text)
+            self._idle_cmd = cmd
+
+    async def idle_check(self, timeout = None):
+        """ wait at most timeout seconds for IDLE responses. Return them parsed as IMAPClient does """
+        responses = []
+        try:
+            responses.append(await asyncio.wait_for(self._idle_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            return responses
+        while not self._idle_queue.empty():
+            responses.append(self._idle_queue.get_nowait())
+        for resp in responses:
+            if isinstance(resp, Exception):
+                raise resp
+        return responses
+
+    async def idle_done(self):
+        """ leave IDLE. Return (text, responses not read by idle_check) """
+        cmd = self._idle_cmd
+        await self._send(b'DONE' + CRLF)
+        try:
+            status, text = await cmd.future
+        finally:
+            self._idle_cmd = None
+        self._check('idle', status, text)
+        responses = []
+        while not self._idle_queue.empty():
+            responses.append(self._idle_queue.get_nowait())
+        return text, [ resp for resp in responses if not isinstance(resp, Exception) ]
+
+    async def logout(self):
+        """ LOGOUT and close the connection. Return the BYE message """
+        try:
+            _, _, untagged = await self._command('LOGOUT')
+            return (untagged.get('BYE') or [b''])[0]
+        finally:
+            await self._close()
+
+_LOOP      = None
+_LOOP_LOCK = threading.Lock()
+
+def get_event_loop():
+    """
+       The event loop of the blocking clients, running in a daemon thread
+    """
+    global _LOOP #pylint:disable=W0603
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target = _LOOP.run_forever, name = 'gmv-imap-loop', daemon = True).start()
+    return _LOOP
+
+def run_sync(coro):
+    """
+       Run coro in the shared event loop and wait for its result
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+class BlockingIMAPClient(object): #pylint:disable=R0903
+    """
+       MonkeyIMAPClient API over an AsyncIMAPClient: the coroutines run in the shared event loop
+    """
+    def __init__(self, host, port = None, use_uid = True, need_ssl = False):
+        """
+           constructor. Connect to the server as IMAPClient does
+        """
+        self.client = AsyncIMAPClient(host, port, use_uid, need_ssl)
+        run_sync(self.client.connect())
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def blocking(*args, **kwargs):
+            """ run the coroutine and wait for its result """
+            return run_sync(attr(*args, **kwargs))
+        return blocking
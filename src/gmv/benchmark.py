@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+End to end performance benchmark.
+
+Runs sync, restore and export against a synthetic mailbox served by the local
+fake Gmail IMAP server and reports msgs/s, MB/s, peak RSS and syscall counts.
+
+    python -m gmv.benchmark --emails 10000 --size 4096 --latency 0.005 --bandwidth 10000000
+
+--headers [mbox file or dir of .eml] benchmarks the metadata header parsing alone,
+the previous three regexes parser against GmailStorer.parse_header_fields, on
+the given corpus or on a built-in set of real world header shapes. The speedups
+are relative to the previous parser followed by the same encoded-word decoding
+as the current one (legacy-raw: without it, legacy+email: with the email.header one),
+on the whole corpus and on its plain blocks (no encoded-word nor folded value).
+
+Each operation runs in a freshly spawned interpreter so that peak RSS and the
+syscall counters only account for gmvault (the server lives in the parent).
+Syscall counts come from /proc/self/io (read()/write() family, socket
+send/recv are not included) and are only available on Linux.
+
+'''
+import argparse
+import email.header
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import gmv.fake_imap_server as fake_imap_server
+
+SOURCE_LOGIN  = 'benchmark.source@gmail.com'
+RESTORE_LOGIN = 'benchmark.restore@gmail.com'
+CREDENTIAL    = { 'type' : 'passwd', 'value' : 'benchmark' }
+
+OPERATIONS = ('sync', 'restore', 'export')
+
+# header fields fetched with the metadata (IMAP_HEADER_PEEK_FIELDS)
+HEADER_FIELDS = ('subject', 'message-id', 'x-gmail-received')
+
+# real world shapes: encoded-words (B and Q, several charsets), folding, odd casing
+HEADER_TEMPLATES = (
+    'Subject: Re: Weekly report #{i}\r\nMessage-ID: <CAF{i}x7Q@mail.gmail.com>\r\n\r\n',
+    'Message-ID: <{i}.JavaMail.root@mailer{i}.example.com>\r\nSubject: =?UTF-8?B?UmU6IGTDqWrDoCB2dQ==?= {i}\r\n\r\n',
+    'SUBJECT: =?iso-8859-1?Q?R=E9union_du_lundi?= =?iso-8859-1?Q?_=E0_10h?= {i}\r\n'
+    'message-id: <20{i}.GA1234@relay.example.org>\r\nX-Gmail-Received: 3f2a{i}c0ffee\r\n\r\n',
+    'Subject: A long subject line that the sending client decided to fold at\r\n'
+    ' the 78th column, as RFC 5322 allows, number {i}\r\nMessage-Id:\r\n <folded.{i}@lists.example.net>\r\n\r\n',
+    'Subject: =?UTF-8?Q?Votre_commande_n=C2=B0{i}_a_=C3=A9t=C3=A9_exp=C3=A9di=C3=A9e?=\r\n'
+    'Message-ID: <0100017{i}.abc@email.amazonses.com>\r\n\r\n',
+    'Message-ID: <{i}@localhost>\r\nSubject: =?GB2312?B?xOO6ww==?= {i}\r\n\r\n',
+)
+
+# the parser gmvault used before the single pass scanner (baseline of the headers benchmark)
+LEGACY_HF_RES = [ re.compile(pattern) for pattern in (
+    r"[S,s][U,u][b,B][J,j][E,e][C,c][T,t]:\s+(?P<value>.*)\s*",
+    r"[M,m][E,e][S,s][S,s][a,A][G,g][E,e]-[I,i][D,d]:\s+<(?P<value>.*)>",
+    r"[X,x]-[G,g][M,m][A,a][I,i][L,l]-[R,r][E,e][C,c][E,e][I,i][V,v][E,e][D,d]:\s+(?P<value>.*)\s*") ]
+
+def read_proc_io():
+    """
+       read/write syscall and bytes counters of the current process (Linux only).
+       Return an empty dict when /proc is not available
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as the_file:
+            for line in the_file:
+                key, _, value = line.partition(':')
+                counters[key.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+def peak_rss_mb():
+    """ peak resident set size of the current process in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, KB everywhere else
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def _do_operation(operation, host, port, db_dir, export_dir):
+    """ run one gmvault operation """
+    import gmv.gmvault as gmvault #pylint:disable=C0415
+    import gmv.gmvault_export as gmvault_export #pylint:disable=C0415
+
+    if operation == 'sync':
+        gmvaulter = gmvault.GMVaulter(db_dir, host, port, SOURCE_LOGIN, CREDENTIAL, use_ssl = False)
+        gmvaulter.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' })
+        gmvaulter.src.disconnect()
+    elif operation == 'restore':
+        gmvaulter = gmvault.GMVaulter(db_dir, host, port, RESTORE_LOGIN, CREDENTIAL, \
+                                      read_only_access = False, use_ssl = False)
+        gmvaulter.restore()
+        gmvaulter.src.disconnect()
+    elif operation == 'export':
+        mailbox = gmvault_export.Maildir(export_dir)
+        gmvault_export.GMVaultExporter(db_dir, mailbox).export()
+        mailbox.close()
+    else:
+        raise ValueError("Unknown operation %s" % (operation))
+
+def measure_operation(operation, host, port, db_dir, export_dir):
+    """
+       run operation and return its resource usage
+    """
+    io_before    = read_proc_io()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start        = time.time()
+
+    _do_operation(operation, host, port, db_dir, export_dir)
+
+    elapsed      = time.time() - start
+    usage_after  = resource.getrusage(resource.RUSAGE_SELF)
+    io_after     = read_proc_io()
+
+    result = { 'operation'       : operation,
+               'elapsed'         : elapsed,
+               'cpu_user'        : usage_after.ru_utime - usage_before.ru_utime,
+               'cpu_sys'         : usage_after.ru_stime - usage_before.ru_stime,
+               'peak_rss_mb'     : peak_rss_mb(),
+               'ctx_switches'    : (usage_after.ru_nvcsw - usage_before.ru_nvcsw) + \
+                                   (usage_after.ru_nivcsw - usage_before.ru_nivcsw) }
+    if io_after:
+        result['read_syscalls']  = io_after['syscr'] - io_before['syscr']
+        result['write_syscalls'] = io_after['syscw'] - io_before['syscw']
+    return result
+
+def _child_main(queue, operation, host, port, db_dir, export_dir, gmvault_dir): #pylint:disable=R0913
+    """ entry point of the spawned process """
+    os.environ['GMVAULT_DIR'] = gmvault_dir
+    try:
+        queue.put(measure_operation(operation, host, port, db_dir, export_dir))
+    except Exception as err: #pylint:disable=W0703
+        queue.put({ 'operation' : operation, 'error' : repr(err) })
+
+def run_benchmark(nb_emails = 10000, nb_chats = 0, msg_size = 4096, latency = 0.0, bandwidth = None, \
+                  operations = OPERATIONS, work_dir = None, isolate = True): #pylint:disable=R0913,R0914
+    """
+       Serve a synthetic mailbox and run the operations against it.
+       Return a list of result dicts (one per operation).
+       isolate: run each operation in a spawned process (accurate RSS and syscall counts)
+    """
+    own_dir  = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix = 'gmv-bench-')
+    db_dir, export_dir, gmvault_dir = [ os.path.join(work_dir, name) for name in ('db', 'export', 'conf') ]
+    for a_dir in (db_dir, gmvault_dir):
+        if not os.path.exists(a_dir):
+            os.makedirs(a_dir)
+
+    account = fake_imap_server.FakeGmailAccount(nb_emails = nb_emails, nb_chats = nb_chats, msg_size = msg_size)
+    nb_msgs    = account.nb_messages()
+    total_size = account.total_size()
+
+    server = fake_imap_server.FakeGmailServer({ SOURCE_LOGIN : account }, latency = latency, \
+                                              bandwidth = bandwidth).start()
+    results = []
+    try:
+        for operation in operations:
+            stats_before = dict(server.stats)
+            if isolate:
+                ctx   = multiprocessing.get_context('spawn')
+                queue = ctx.Queue()
+                child = ctx.Process(target = _child_main, args = (queue, operation, server.host, server.port, \
+                                                                  db_dir, export_dir, gmvault_dir))
+                child.start()
+                result = queue.get()
+                child.join()
+            else:
+                os.environ.setdefault('GMVAULT_DIR', gmvault_dir)
+                result = measure_operation(operation, server.host, server.port, db_dir, export_dir)
+
+            result['messages'] = nb_msgs
+            result['mbytes']   = total_size / (1024.0 * 1024.0)
+            result['imap_commands'] = server.stats['commands'] - stats_before['commands']
+            result['wire_mbytes']   = (server.stats['bytes_in'] + server.stats['bytes_out'] - \
+                                       stats_before['bytes_in'] - stats_before['bytes_out']) / (1024.0 * 1024.0)
+            if 'elapsed' in result:
+                result['msgs_per_sec'] = nb_msgs / result['elapsed'] if result['elapsed'] else 0
+                result['mb_per_sec']   = result['mbytes'] / result['elapsed'] if result['elapsed'] else 0
+            results.append(result)
+    finally:
+        server.stop()
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors = True)
+
+    return results
+
+def legacy_parse_header_fields(header_fields):
+    """ subject, msgid and x_gmail_recv with the previous three regexes parser """
+    values = []
+    for regexp in LEGACY_HF_RES:
+        matched = regexp.search(header_fields)
+        values.append(matched.group('value').strip() if matched else None)
+    return tuple(values)
+
+def _filter_header_fields(raw):
+    """ keep the HEADER_FIELDS lines (and their continuations) of a raw header block, like the IMAP server """
+    kept, keep = [], False
+    for line in raw.split(b'\n'):
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                kept.append(line)
+            continue
+        keep = line.split(b':', 1)[0].strip().lower().decode('ascii', 'replace') in HEADER_FIELDS
+        if keep:
+            kept.append(line)
+    return b'\n'.join(kept) + b'\r\n\r\n'
+
+def load_header_corpus(path):
+    """
+       Header field blocks of the messages of an mbox file or of a dir of .eml files
+    """
+    if os.path.isdir(path):
+        raws = []
+        for name in sorted(os.listdir(path)):
+            with open(os.path.join(path, name), 'rb') as the_file:
+                raws.append(the_file.read())
+    else:
+        with open(path, 'rb') as the_file:
+            raws = re.split(br'(?m)^From .*\r?\n', the_file.read())
+    blocks = []
+    for raw in raws:
+        raw = re.split(br'\r?\n\r?\n', raw.lstrip(), 1)[0]
+        if raw:
+            blocks.append(_filter_header_fields(raw))
+    return blocks
+
+def build_header_corpus(nb_headers = 6000):
+    """ header field blocks built from HEADER_TEMPLATES """
+    return [ HEADER_TEMPLATES[i % len(HEADER_TEMPLATES)].format(i = i).encode('utf-8') for i in range(nb_headers) ]
+
+def is_plain_header_block(block):
+    """ True if the header block has no encoded-word and no folded value """
+    return b'=?' not in block and b'\n ' not in block and b'\n\t' not in block
+
+def run_header_benchmark(corpus = None, batch_size = 500, rounds = 5):
+    """
+       Process the corpus header blocks in metadata batches with the legacy parser (followed by the encoded-word
+       decoding of the current parser, by none and by the email.header one) and with the current parser,
+       all after the same bytes decoding.
+       Done on the whole corpus and on its plain blocks (if they are not the whole corpus).
+       Return a list of result dicts (best of rounds), the speedups are relative to legacy on the same blocks
+    """
+    import gmv.gmvault_db as gmvault_db #pylint:disable=C0415
+    import gmv.gmvault_utils as gmvault_utils #pylint:disable=C0415
+
+    corpus = corpus if corpus is not None else build_header_corpus()
+
+    def decode(block):
+        return gmvault_utils.ENCODING_DETECTOR.decode(block, charsets = [])[0]
+
+    def legacy_raw(block):
+        return legacy_parse_header_fields(decode(block))
+
+    def legacy(block):
+        subject, msgid, x_gmail_recv = legacy_parse_header_fields(decode(block))
+        if subject and '=?' in subject:
+            subject = gmvault_db.GmailStorer.decode_header_value(subject)
+        return subject, msgid, x_gmail_recv
+
+    def legacy_email(block):
+        subject, msgid, x_gmail_recv = legacy_raw(block)
+        if subject:
+            subject = str(email.header.make_header(email.header.decode_header(subject)))
+        return subject, msgid, x_gmail_recv
+
+    def current(block):
+        return gmvault_db.GmailStorer.parse_header_fields(decode(block))
+
+    subsets = [('all', corpus)]
+    plain   = [ block for block in corpus if is_plain_header_block(block) ]
+    if plain and len(plain) < len(corpus):
+        subsets.append(('plain', plain))
+
+    results = []
+    parsers = (('legacy', legacy), ('legacy-raw', legacy_raw), ('legacy+email', legacy_email), ('current', current))
+    for blocks_name, blocks in subsets:
+        batches = [ blocks[i:i + batch_size] for i in range(0, len(blocks), batch_size) ]
+        bests = {}
+        for _ in range(rounds): # the parsers take turns: a noisy period does not favour one of them
+            for operation, parse in parsers:
+                start = time.perf_counter()
+                for batch in batches:
+                    for block in batch:
+                        parse(block)
+                elapsed = time.perf_counter() - start
+                bests[operation] = min(bests.get(operation, elapsed), elapsed)
+        for operation, _ in parsers:
+            best = bests[operation]
+            msgs_per_sec = len(blocks) / best if best else 0
+            if operation == 'legacy':
+                legacy_rate = msgs_per_sec
+            results.append({ 'operation' : operation, 'blocks' : blocks_name, 'elapsed' : best, \
+                             'messages' : len(blocks), 'msgs_per_sec' : msgs_per_sec, \
+                             'speedup' : msgs_per_sec / legacy_rate if legacy_rate else 0 })
+    return results
+
+def format_header_results(results):
+    """ human readable table of the headers benchmark """
+    header = '%-16s %-6s %8s %10s %12s %10s' % ('parser', 'blocks', 'nb', 'time(s)', 'headers/s', 'speedup')
+    lines  = [header, '-' * len(header)]
+    for res in results:
+        lines.append('%-16s %-6s %8d %10.3f %12.0f %9.2fx' % (res['operation'], res['blocks'], res['messages'], \
+                                                             res['elapsed'], res['msgs_per_sec'], res['speedup']))
+    return '\n'.join(lines)
+
+def format_results(results):
+    """ human readable table """
+    header = '%-8s %10s %10s %8s %10s %12s %12s %10s' % ('op', 'time(s)', 'msgs/s', 'MB/s', 'peak RSS', \
+                                                         'read calls', 'write calls', 'imap cmds')
+    lines  = [header, '-' * len(header)]
+    for res in results:
+        if 'error' in res:
+            lines.append('%-8s error: %s' % (res['operation'], res['error']))
+            continue
+        lines.append('%-8s %10.2f %10.1f %8.2f %8.1fMB %12s %12s %10d' % \
+                     (res['operation'], res['elapsed'], res['msgs_per_sec'], res['mb_per_sec'], \
+                      res['peak_rss_mb'], res.get('read_syscalls', 'n/a'), res.get('write_syscalls', 'n/a'), \
+                      res['imap_commands']))
+    return '\n'.join(lines)
+
+def main(argv = None):
+    """ command line entry point """
+    parser = argparse.ArgumentParser(prog = 'python -m gmv.benchmark', \
+                                     description = 'gmvault end to end benchmark against a local fake Gmail server.')
+    parser.add_argument('--emails', type = int, default = 10000, help = 'nb of emails in All Mail (default 10000)')
+    parser.add_argument('--chats', type = int, default = 0, help = 'nb of chats (default 0)')
+    parser.add_argument('--size', type = int, default = 4096, help = 'approximate message size in bytes')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds added to each IMAP command')
+    parser.add_argument('--bandwidth', type = int, default = None, help = 'server bandwidth in bytes/s')
+    parser.add_argument('--ops', default = ','.join(OPERATIONS), help = 'operations to run (default sync,restore,export)')
+    parser.add_argument('--work-dir', default = None, help = 'keep the gmvault-db and export in this dir')
+    parser.add_argument('--json', default = None, help = 'write the results in this json file')
+    parser.add_argument('--no-isolate', action = 'store_true', help = 'run the operations in this process')
+    parser.add_argument('--headers', nargs = '?', const = '', default = None, metavar = 'CORPUS', \
+                        help = 'only benchmark the header parsing (on an mbox file or a dir of .eml files)')
+    args = parser.parse_args(argv)
+
+    if args.headers is not None:
+        results = run_header_benchmark(load_header_corpus(args.headers) if args.headers else None)
+        print(format_header_results(results))
+        if args.json:
+            with open(args.json, 'w') as the_file:
+                json.dump(results, the_file, indent = 2)
+        return 0
+
+    results = run_benchmark(args.emails, args.chats, args.size, args.latency, args.bandwidth, \
+                            [ op.strip() for op in args.ops.split(',') if op.strip() ], \
+                            args.work_dir, not args.no_isolate)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as the_file:
+            json.dump(results, the_file, indent = 2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
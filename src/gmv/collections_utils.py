@@ -16,7 +16,10 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
+import array
+import bisect
 import collections
+import itertools
 
 ## {{{ http://code.activestate.com/recipes/576669/ (r18)
 class OrderedDict(dict, collections.abc.MutableMapping):
@@ -170,3 +173,82 @@ class DictMultimap(Map):
         """ remove key"""
         del self._dict[key][value]
 
+class GmailIdIndex(collections.abc.Mapping):
+    """
+       Read only mapping gm_id => directory name for a whole gmvault-db.
+       The gm_ids are kept sorted in an array of unsigned 64 bits with a parallel array of
+       indexes in the list of directory names: 12 bytes per id instead of the ~200 bytes of
+       a dict entry with its int key and str value.
+    """
+    def __init__(self, ids = None, dir_indexes = None, dirs = None):
+        self._ids         = ids if ids is not None else array.array('Q')
+        self._dir_indexes = dir_indexes if dir_indexes is not None else array.array('I')
+        self._dirs        = dirs if dirs is not None else []
+
+    @classmethod
+    def from_items(cls, items):
+        """
+           Build the index from (gm_id, directory name) pairs in any order.
+           Like for a dict, the last pair wins for a duplicated gm_id.
+        """
+        ids, dir_indexes, dirs, dir_pos = array.array('Q'), array.array('I'), [], {}
+        for gm_id, a_dir in items:
+            pos = dir_pos.get(a_dir)
+            if pos is None:
+                pos = dir_pos[a_dir] = len(dirs)
+                dirs.append(a_dir)
+            ids.append(gm_id)
+            dir_indexes.append(pos)
+
+        # the dirs are walked in order so the ids are usually sorted already
+        if not all(prev < curr for prev, curr in zip(ids, itertools.islice(ids, 1, None))):
+            sorted_ids, sorted_indexes = array.array('Q'), array.array('I')
+            for pos in sorted(range(len(ids)), key = ids.__getitem__): # stable: the last duplicate comes last
+                if sorted_ids and sorted_ids[-1] == ids[pos]:
+                    sorted_indexes[-1] = dir_indexes[pos]
+                else:
+                    sorted_ids.append(ids[pos])
+                    sorted_indexes.append(dir_indexes[pos])
+            ids, dir_indexes = sorted_ids, sorted_indexes
+
+        return cls(ids, dir_indexes, dirs)
+
+    def find(self, gm_id):
+        """ position of gm_id or -1 """
+        pos = bisect.bisect_left(self._ids, gm_id)
+        if pos < len(self._ids) and self._ids[pos] == gm_id:
+            return pos
+        return -1
+
+    def index(self, gm_id):
+        """ position of gm_id. Raise ValueError if not in the index """
+        pos = self.find(gm_id)
+        if pos < 0:
+            raise ValueError("%s is not in the index" % (gm_id))
+        return pos
+
+    def tail(self, start):
+        """ index of the ids from position start """
+        return GmailIdIndex(self._ids[start:], self._dir_indexes[start:], self._dirs)
+
+    def nbytes(self):
+        """ memory used by the arrays """
+        return self._ids.itemsize * len(self._ids) + self._dir_indexes.itemsize * len(self._dir_indexes)
+
+    def __getitem__(self, gm_id):
+        pos = self.find(gm_id)
+        if pos < 0:
+            raise KeyError(gm_id)
+        return self._dirs[self._dir_indexes[pos]]
+
+    def __contains__(self, gm_id):
+        return self.find(gm_id) >= 0
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __repr__(self):
+        return '%s(%d ids in %d dirs)' % (self.__class__.__name__, len(self._ids), len(self._dirs))
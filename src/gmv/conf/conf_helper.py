@@ -246,6 +246,39 @@ class Resource(object):
             raise ValueError('Not a boolean: %s' % val)
         return self._boolean_states[val.lower()]
 
+class ConfView(object):
+    """
+       Typed view of a set of options resolved once, so that reading them is a plain attribute read:
+       
+         view = conf.view({ 'keep_in_bin' : ('boolean', 'General', 'keep_in_bin', False) })
+         view.keep_in_bin
+       
+       The view is refreshed when its Conf is reloaded. list and dict values are shared, do not modify them.
+    """
+    GETTERS = { 'str'     : 'get',
+                'int'     : 'getint',
+                'float'   : 'getfloat',
+                'boolean' : 'getboolean',
+                'list'    : 'get_list',
+                'dict'    : 'get_dict' }
+    
+    def __init__(self, conf, spec):
+        """
+           spec: { attribute : (type, section, option, default) } with type in ConfView.GETTERS
+        """
+        for name, (the_type, _, _, _) in spec.items():
+            if the_type not in self.GETTERS:
+                raise exceptions.Error("Unknown type %s for %s. Use one of %s" \
+                                       % (the_type, name, ', '.join(sorted(self.GETTERS))))
+        self._conf = conf
+        self._spec = dict(spec)
+        self.refresh()
+    
+    def refresh(self):
+        """ (re)resolve all the options """
+        for name, (the_type, section, option, default) in self._spec.items():
+            setattr(self, name, getattr(self._conf, self.GETTERS[the_type])(section, option, default))
+
 class MockConf(object):
     """
        MockConf Object that returns only defaults
@@ -322,6 +355,19 @@ class MockConf(object):
     def get_dict(cls, section, option, default=None, fail_if_missing=False):#pylint: disable=W0613
         """ get a dict """
         return default
+    
+    get_int     = getint
+    get_float   = getfloat
+    get_boolean = getboolean
+    
+    def view(self, spec):
+        """ typed view of the defaults """
+        return ConfView(self, spec)
+    
+    @classmethod
+    def reload(cls):
+        """ nothing to reload """
+        pass
  
 class Conf(object):
     """ Configuration Object with a several features:
@@ -389,6 +435,12 @@ class Conf(object):
         
         self._configuration_file_path = None
         
+        # typed values already converted: (getter, section, option, default, fail_if_missing) -> value
+        self._typed_cache = {}
+        
+        # views to refresh when the conf is reloaded
+        self._views = []
+        
         # create config object 
         if use_resource:       
             self._load_config()
@@ -414,6 +466,45 @@ class Conf(object):
             print("Current executing from dir = %s\n" % os.getcwd())
             raise exce
 
+    def reload(self):
+        """
+           Re-read the configuration file, drop the cached values and refresh the views
+        """
+        self._sections = {}
+        self._load_config(self._configuration_file_path)
+        self.invalidate_cache()
+        for a_view in self._views:
+            a_view.refresh()
+    
+    def invalidate_cache(self):
+        """ forget the typed values already converted """
+        self._typed_cache = {}
+    
+    def view(self, spec):
+        """
+           Return a ConfView of spec refreshed when the conf is reloaded
+        """
+        a_view = ConfView(self, spec)
+        self._views.append(a_view)
+        return a_view
+    
+    def _cached(self, getter, section, option, default, fail_if_missing, convert):
+        """
+           convert(value) memoized per (getter, section, option, default). 
+           Unhashable defaults (list, dict) and the ENV and CLI sections are not cached.
+        """
+        if section in (Conf._ENVGROUP, Conf._CLIGROUP):
+            return convert(self.get(section, option, default, fail_if_missing))
+        key = (getter, section, option, default, fail_if_missing)
+        try:
+            return self._typed_cache[key]
+        except KeyError:
+            value = convert(self.get(section, option, default, fail_if_missing))
+            self._typed_cache[key] = value
+            return value
+        except TypeError:
+            return convert(self.get(section, option, default, fail_if_missing))
+    
     def get_conf_file_path(self):
         """return conf_file_path"""
         return self._configuration_file_path if self._configuration_file_path != None else "unknown"
@@ -653,7 +744,7 @@ class Conf(object):
 
     def _get(self, section, conv, option, default, fail_if_missing):
         """ Internal getter """
-        return conv(self.get(section, option, default, fail_if_missing))
+        return self._cached(conv.__name__, section, option, default, fail_if_missing, conv)
 
     def getint(self, section, option, default=0, fail_if_missing=False):
         """Return the int value of the option.
@@ -678,32 +769,34 @@ class Conf(object):
     _boolean_states = {'1': True, 'yes': True, 'true': True, 'on': True,
                        '0': False, 'no': False, 'false': False, 'off': False}
 
+    @classmethod
+    def _to_boolean(cls, val):
+        """ convert a boolean string """
+        if val.lower() not in cls._boolean_states:
+            raise ValueError('Not a boolean: %s' % val)
+        return cls._boolean_states[val.lower()]
+
     def getboolean(self, section, option, default=False, fail_if_missing=False):
         """getboolean value""" 
-        val = self.get(section, option, default, fail_if_missing)
-        if val.lower() not in self._boolean_states:
-            raise ValueError('Not a boolean: %s' % val)
-        return self._boolean_states[val.lower()]
+        return self._cached('boolean', section, option, default, fail_if_missing, self._to_boolean)
     
     def get_boolean(self, section, option, default=False, fail_if_missing=False):
         """get_boolean value"""
-        val = self.get(section, option, default, fail_if_missing)
-        if val.lower() not in self._boolean_states:
-            raise ValueError('Not a boolean: %s' % val)
-        return self._boolean_states[val.lower()]
+        return self._cached('boolean', section, option, default, fail_if_missing, self._to_boolean)
     
-    def get_list(self, section, option, default=None, fail_if_missing=False):
-        """ get a list of string, int  """
-        
-        val = self.get(section, option, default, fail_if_missing)
-        
-        # parse it and return an error if invalid
+    @classmethod
+    def _to_list(cls, val):
+        """ parse a list """
         try:
             compiler = struct_parser.Compiler()
             return compiler.compile_list(val)
         except struct_parser.CompilerError as err: 
             raise exceptions.Error(err.message)
     
+    def get_list(self, section, option, default=None, fail_if_missing=False):
+        """ get a list of string, int (the returned list is shared, do not modify it) """
+        return self._cached('list', section, option, default, fail_if_missing, self._to_list)
+    
     def getlist(self, section, option, default=None, fail_if_missing=False):
         """ Deprecated, use get_list instead"""
         return self.get_list(section, option, default, fail_if_missing)
@@ -713,17 +806,18 @@ class Conf(object):
         return self.get_dict(section, option, default, fail_if_missing)
         
     
-    def get_dict(self, section, option, default=None, fail_if_missing=False):
-        """ get a dict """
-        
-        val = self.get(section, option, default, fail_if_missing)
-        
-        # parse it and return an error if invalid
+    @classmethod
+    def _to_dict(cls, val):
+        """ parse a dict """
         try:
             compiler = struct_parser.Compiler()
             return compiler.compile_dict(val)
         except struct_parser.CompilerError as err: 
             raise exceptions.Error(err.message)
+    
+    def get_dict(self, section, option, default=None, fail_if_missing=False):
+        """ get a dict (the returned dict is shared, do not modify it) """
+        return self._cached('dict', section, option, default, fail_if_missing, self._to_dict)
         
     @classmethod
     def optionxform(cls, optionstr):
@@ -282,7 +282,40 @@ class TestConf(unittest.TestCase): #pylint: disable=R0904
             return
          
         self.fail('Should never reach that point')
-        
+
+    def test_typed_cache_and_view(self):
+        """ typed values are converted once and refreshed on reload """
+
+        with open('/tmp/fake_conf.config', 'w') as the_file:
+            the_file.write("[General]\nkeep_in_bin=False\nbatch=10\nmap={ 'a' : 'b' }\n")
+
+        conf = gmv.conf.conf_helper.Conf(use_resource=False)
+        conf._load_config('/tmp/fake_conf.config') #pylint: disable=W0212
+
+        a_view = conf.view({ 'keep_in_bin' : ('boolean', 'General', 'keep_in_bin', True),
+                             'batch'       : ('int', 'General', 'batch', 0),
+                             'the_map'     : ('dict', 'General', 'map', {}),
+                             'missing'     : ('str', 'General', 'missing', None) })
+
+        self.assertEqual((a_view.keep_in_bin, a_view.batch, a_view.the_map, a_view.missing), \
+                         (False, 10, { 'a' : 'b' }, None))
+        self.assertEqual(conf.getint('General', 'batch'), 10)
+        self.assertTrue(conf.get_dict('General', 'map') is conf.get_dict('General', 'map'))
+
+        with open('/tmp/fake_conf.config', 'w') as the_file:
+            the_file.write("[General]\nkeep_in_bin=True\nbatch=20\n")
+
+        # cached until reloaded
+        self.assertEqual(conf.getint('General', 'batch'), 10)
+        conf.reload()
+        self.assertEqual(conf.getint('General', 'batch'), 20)
+        self.assertEqual((a_view.keep_in_bin, a_view.batch, a_view.the_map), (True, 20, {}))
+
+        self.assertRaises(gmv.conf.exceptions.Error, conf.view, { 'foo' : ('set', 'General', 'foo', None) })
+
+        mock_view = gmv.conf.conf_helper.MockConf().view({ 'batch' : ('int', 'General', 'batch', 5) })
+        self.assertEqual(mock_view.batch, 5)
+
 class TestResource(unittest.TestCase): #pylint: disable=R0904
     """
        Test Class for the Resource object
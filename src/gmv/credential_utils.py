@@ -28,6 +28,7 @@ import urllib.request, urllib.error, urllib.parse
 
 import os
 import getpass
+import threading
 
 import gmv.log_utils as log_utils
 import gmv.blowfish as blowfish
@@ -63,6 +64,14 @@ class CredentialHelper(object):
     """
     SECRET_FILEPATH = '%s/token.sec'
     
+    # serialize the oauth2 token refreshes of the threads sharing the process (daemon mode)
+    _OAUTH2_LOCK    = threading.RLock()
+
+    # email : (expiry epoch, credential). Reconnections reuse the access token without reading the token file
+    _OAUTH2_CACHE   = {}
+    # renew the access token that many seconds before it expires
+    OAUTH2_EXPIRY_MARGIN = 60
+    
     @classmethod
     def get_secret_key(cls, a_filepath):
         """
@@ -209,6 +218,7 @@ class CredentialHelper(object):
             #password to be renewed so need an interactive phase to get the new pass
             if not passwd or args['passwd'] in ['renew', 'store']: # go to interactive mode
                 if not test_mode.get('activate', False):
+                    log_utils.LoggerFactory.flush() # the prompt comes after the queued messages
                     passwd = getpass.getpass('Please enter gmail password for %s and press ENTER:' % (args['email']))
                 else:
                     passwd = test_mode.get('value', 'no_password_given')
@@ -317,6 +327,7 @@ class CredentialHelper(object):
         permission_url = generate_permission_url()
 
         #message to indicate that a browser will be opened
+        log_utils.LoggerFactory.flush() # the prompt comes after the queued messages
         input('gmvault will now open a web browser page in order for you to grant gmvault access to your Gmail.\n'\
                   'Please make sure you\'re logged into the correct Gmail account (%s) before granting access.\n'\
                   'Press ENTER to open the browser.' % (email))
@@ -330,6 +341,7 @@ class CredentialHelper(object):
                 LOG.critical("=== Exception traceback ===")
                 LOG.critical(gmvault_utils.get_exception_traceback())
                 LOG.critical("=== End of Exception traceback ===\n")
+                log_utils.LoggerFactory.flush()
 
             verification_code = input("You should now see the web page on your browser now.\n"\
                       "If you don\'t, you can manually open:\n\n%s\n\nOnce you've granted"\
@@ -373,6 +385,44 @@ class CredentialHelper(object):
         :param email: user email used to load refresh token from peristent file
         :return: credential { 'type' : 'oauth2', 'value' : auth_str, 'option':None }
         """
+        with cls._OAUTH2_LOCK:
+            if not renew_cred:
+                expiry, credential = cls._OAUTH2_CACHE.get(email, (0, None))
+                if gmvault_utils.get_utcnow_epoch() < expiry:
+                    return dict(credential)
+            return cls._get_oauth2_credential(email, renew_cred)
+
+    @classmethod
+    def forget_oauth2_credential(cls, email):
+        """
+           Drop the cached access token of email (rejected by the server)
+        """
+        with cls._OAUTH2_LOCK:
+            cls._OAUTH2_CACHE.pop(email, None)
+
+    @classmethod
+    def get_stored_credential(cls, email, auth_type = 'oauth2'):
+        """
+           Non interactive version of get_credential (daemon mode): only use the oauth2 token
+           or the password stored in $HOME/.gmvault
+           :param auth_type: oauth2 or passwd
+        """
+        if auth_type == 'passwd':
+            passwd = cls.read_password(email)
+            if not passwd:
+                raise Exception("No password stored for %s. Run gmvault sync --store-passwd %s once." \
+                                % (email, email))
+            return { 'type' : 'passwd', 'value' : passwd, 'option':'read' }
+        
+        if not cls.read_oauth2_tok_sec(email):
+            raise Exception("No OAuth2 token stored for %s. Run gmvault sync %s once to get it." % (email, email))
+        return cls.get_oauth2_credential(email)
+
+    @classmethod
+    def _get_oauth2_credential(cls, email, renew_cred):
+        """
+           get_oauth2_credential without the lock
+        """
         oauth2_creds = cls.read_oauth2_tok_sec(email)
 
         #workflow when you connect for the first time or want to renew the oauth2 credentials
@@ -391,6 +441,7 @@ class CredentialHelper(object):
 
                 #store newly created token
                 cls.store_oauth2_credentials(email, access_token, refresh_token, validity, type)
+                expiry = gmvault_utils.get_utcnow_epoch() + validity
         else:
 
             # check if the access token is still valid otherwise renew it from the refresh token
@@ -404,6 +455,7 @@ class CredentialHelper(object):
             if  now < tok_creation + validity:
                 LOG.debug("Access Token is still valid")
                 access_token = oauth2_creds['access_token']
+                expiry       = tok_creation + validity
             else:
                 #expired so request a new access token and store it
                 LOG.debug("Access Token is expired. Renew it")
@@ -411,10 +463,14 @@ class CredentialHelper(object):
                 access_token, type = cls._get_oauth2_acc_tok_from_ref_tok(oauth2_creds['refresh_token'])
                 # update stored information
                 cls.store_oauth2_credentials(email, access_token, oauth2_creds['refresh_token'], validity, type)
+                expiry = now + validity
 
         auth_str = cls._generate_oauth2_auth_string(email, access_token, base64_encode=False)
 
         LOG.debug("auth_str generated: %s" % (auth_str))
         LOG.debug("Successfully read oauth2 credentials with get_oauth2_credential_from_refresh_token\n")
 
-        return { 'type' : 'oauth2', 'value' : auth_str, 'option':None }
+        credential = { 'type' : 'oauth2', 'value' : auth_str, 'option':None }
+        cls._OAUTH2_CACHE[email] = (expiry - cls.OAUTH2_EXPIRY_MARGIN, credential)
+
+        return dict(credential)
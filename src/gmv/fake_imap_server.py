@@ -0,0 +1,1100 @@
+# -*- coding: utf-8 -*-
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing a local stand-in of the Gmail IMAP server.
+
+It speaks enough IMAP (plus the Gmail extensions X-GM-MSGID, X-GM-THRID,
+X-GM-LABELS, X-GM-RAW, COMPRESS=DEFLATE and UIDPLUS APPENDUID) to run
+GMVaulter.sync and GMVaulter.restore against synthetic mailboxes without
+any network access. Latency and bandwidth can be configured to mimic a
+remote server.
+
+Simplifications:
+    - only All Mail and Chats hold messages, the other folders are listed but empty.
+    - sequence numbers are the UIDs.
+    - plain text unless a server side ssl_context is given (connect with use_ssl = False).
+
+'''
+import base64
+import datetime
+import email.parser
+import email.utils
+import hashlib
+import re
+import socket
+import socketserver
+import threading
+import time
+import zlib
+
+from imapclient import imap_utf7
+
+import gmv.log_utils as log_utils
+
+LOG = log_utils.LoggerFactory.get_logger('fake_imap_server')
+
+CRLF = b'\r\n'
+
+ALL_MAIL = '[Gmail]/All Mail'
+CHATS    = '[Gmail]/Chats'
+DRAFTS   = '[Gmail]/Drafts'
+
+CAPABILITIES = b'IMAP4rev1 UNSELECT IDLE NAMESPACE QUOTA ID XLIST CHILDREN X-GM-EXT-1 UIDPLUS ' \
+               b'COMPRESS=DEFLATE ENABLE MOVE CONDSTORE ESEARCH LITERAL+ AUTH=XOAUTH2 AUTH=PLAIN'
+
+DEFAULT_LABELS = ['work', 'family', 'travel', 'newsletters', 'projects/gmvault', 'receipts']
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+LITERAL_RE = re.compile(br'\{(\d+)(\+?)\}\r\n$')
+
+FILLER = b'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor ' \
+         b'incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam.'
+
+class FakeMessage(object): #pylint:disable=R0903
+    """
+       A message stored in the fake server
+    """
+    __slots__ = ('uid', 'gm_id', 'thr_id', 'labels', 'flags', 'internal_date', 'body', 'modseq', 'subject')
+
+    def __init__(self, uid, gm_id, thr_id, labels, flags, internal_date, body, modseq, subject = ''): #pylint:disable=R0913
+        self.uid           = uid
+        self.gm_id         = gm_id
+        self.thr_id        = thr_id
+        self.labels        = labels
+        self.flags         = flags
+        self.internal_date = internal_date
+        self.body          = body
+        self.modseq        = modseq
+        self.subject       = subject
+
+class FakeFolder(object):
+    """
+       A folder holding nb_generated synthetic messages (uids 1..nb_generated)
+       built on demand by generator plus the appended/modified ones.
+       Synthetic messages are not kept in memory to allow mailboxes of millions of emails.
+    """
+    def __init__(self, name, flags = (), uidvalidity = 1, generator = None, nb_generated = 0): #pylint:disable=R0913
+        self.name          = name
+        self.flags         = flags
+        self.uidvalidity   = uidvalidity
+        self.generator     = generator
+        self.nb_generated  = nb_generated
+        self.stored        = {} # uid -> FakeMessage (appended or modified messages)
+        self.expunged      = set()
+        self.uidnext       = nb_generated + 1
+        # synthetic message uid has modseq uid
+        self.highestmodseq = max(1, nb_generated)
+
+    def get(self, uid):
+        """ return the message with this uid or None """
+        if uid in self.expunged:
+            return None
+        msg = self.stored.get(uid)
+        if msg is None and 0 < uid <= self.nb_generated:
+            msg = self.generator(uid)
+        return msg
+
+    def uids(self):
+        """ iterate over the existing uids in order """
+        for uid in range(1, self.nb_generated + 1):
+            if uid not in self.expunged:
+                yield uid
+        for uid in sorted(uid for uid in self.stored if uid > self.nb_generated):
+            if uid not in self.expunged:
+                yield uid
+
+    def __len__(self):
+        return self.uidnext - 1 - len(self.expunged)
+
+    def max_uid(self):
+        """ biggest uid ever allocated """
+        return self.uidnext - 1
+
+    def messages(self):
+        """ iterate over the existing messages """
+        for uid in self.uids():
+            yield self.get(uid)
+
+    def update(self, msg):
+        """ store a modified message and bump its modseq """
+        self.highestmodseq += 1
+        msg.modseq = self.highestmodseq
+        self.stored[msg.uid] = msg
+
+    def append(self, msg):
+        """ add a new message and return its uid """
+        msg.uid = self.uidnext
+        self.uidnext += 1
+        self.update(msg)
+        return msg.uid
+
+class FakeGmailAccount(object):
+    """
+       A synthetic Gmail account.
+       nb_emails messages in All Mail and nb_chats in Chats, each around msg_size bytes.
+       Everything is derived from the uid so two accounts built with the same parameters are identical.
+    """
+    GM_ID_BASE   = 1400000000000000000
+    CHAT_ID_BASE = 1500000000000000000
+
+    def __init__(self, nb_emails = 0, nb_chats = 0, msg_size = 2048, labels = None, \
+                 start_date = datetime.datetime(2005, 1, 1)): #pylint:disable=R0913
+        self.msg_size    = msg_size
+        self.labels      = DEFAULT_LABELS if labels is None else list(labels)
+        self.start_date  = start_date
+        self.next_gm_id  = self.GM_ID_BASE + 900000000000000000
+        self.lock        = threading.RLock()
+
+        self.folders = {}
+        self._add_folder(ALL_MAIL, (b'\\HasNoChildren', b'\\AllMail'), \
+                         lambda uid: self._make_message(uid, False), nb_emails)
+        self._add_folder(CHATS, (b'\\HasNoChildren',), lambda uid: self._make_message(uid, True), nb_chats)
+        self._add_folder(DRAFTS, (b'\\HasNoChildren', b'\\Drafts'))
+        self._add_folder('INBOX', (b'\\HasNoChildren', b'\\Inbox'))
+        self._add_folder('[Gmail]/Sent Mail', (b'\\HasNoChildren', b'\\Sent'))
+        self._add_folder('[Gmail]/Starred', (b'\\HasNoChildren', b'\\Starred'))
+        self._add_folder('[Gmail]/Trash', (b'\\HasNoChildren', b'\\Trash'))
+        self._add_folder('[Gmail]/Spam', (b'\\HasNoChildren', b'\\Spam'))
+        for label in self.labels:
+            self.create_folder(label)
+
+    def _add_folder(self, name, flags, generator = None, nb_generated = 0):
+        """ register a folder """
+        self.folders[name] = FakeFolder(name, flags, len(self.folders) + 1, generator, nb_generated)
+
+    def create_folder(self, name):
+        """ create a label folder (and its parents). Return False if it already exists """
+        if self.get_folder(name):
+            return False
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            parent = '/'.join(parts[:i])
+            if not self.get_folder(parent):
+                self._add_folder(parent, (b'\\HasChildren',))
+        self._add_folder(name, (b'\\HasNoChildren',))
+        return True
+
+    def get_folder(self, name):
+        """ folder lookup (INBOX and labels are case insensitive) """
+        folder = self.folders.get(name)
+        if folder is None:
+            lower = name.lower()
+            for f_name, a_folder in self.folders.items():
+                if f_name.lower() == lower:
+                    return a_folder
+        return folder
+
+    def _make_message(self, uid, chat):
+        """ build the synthetic message uid """
+        gm_id  = (self.CHAT_ID_BASE if chat else self.GM_ID_BASE) + uid
+        thr_id = gm_id - (uid - 1) % 3
+        a_date = self.start_date + datetime.timedelta(seconds = 300 * uid)
+
+        if chat:
+            labels  = ()
+            subject = 'Chat with buddy%d' % (uid % 20)
+        else:
+            labels = [ self.labels[uid % len(self.labels)].encode('utf-8') ] if self.labels else []
+            if uid % 4 == 0:
+                labels.append(b'\\Inbox')
+            if uid % 10 == 0:
+                labels.append(b'\\Starred')
+            labels  = tuple(labels)
+            subject = 'Synthetic message %d' % (uid)
+
+        flags = (b'\\Seen',) if uid % 5 else ()
+
+        headers = 'From: Sender %d <sender%d@example.com>\r\n' \
+                  'To: fake.account@gmail.com\r\n' \
+                  'Subject: %s\r\n' \
+                  'Date: %s\r\n' \
+                  'Message-ID: <%d.%d@fake.gmail.com>\r\n' \
+                  'X-Gmail-Received: %s\r\n' \
+                  'MIME-Version: 1.0\r\n' \
+                  'Content-Type: text/plain; charset="utf-8"\r\n\r\n' \
+                  % (uid % 50, uid % 50, subject, email.utils.format_datetime(a_date), gm_id, uid, \
+                     hashlib.sha1(str(gm_id).encode('ascii')).hexdigest())
+        headers = headers.encode('utf-8')
+
+        line = b'%d: ' % (uid) + FILLER + CRLF
+        nb_lines = max(1, (self.msg_size - len(headers)) // len(line))
+        body = headers + line * nb_lines
+
+        return FakeMessage(uid, gm_id, thr_id, labels, flags, a_date, body, uid, subject)
+
+    def new_message(self, body, flags, internal_date):
+        """ build a message received by APPEND """
+        self.next_gm_id += 1
+        subject = email.parser.BytesHeaderParser().parsebytes(body).get('Subject', '')
+        return FakeMessage(0, self.next_gm_id, self.next_gm_id, (), tuple(flags), \
+                           internal_date, body, 0, str(subject))
+
+    def nb_messages(self):
+        """ nb of messages in All Mail and Chats """
+        return len(self.folders[ALL_MAIL]) + len(self.folders[CHATS])
+
+    def total_size(self):
+        """ size in bytes of all the messages in All Mail and Chats """
+        return sum(len(msg.body) for name in (ALL_MAIL, CHATS) for msg in self.folders[name].messages())
+
+class IMAPError(Exception):
+    """ Error answered as a BAD/NO to the client """
+    def __init__(self, a_msg, status = b'BAD'):
+        super(IMAPError, self).__init__(a_msg)
+        self.status = status
+
+def quote(a_str):
+    """ quote an IMAP string """
+    if isinstance(a_str, str):
+        a_str = a_str.encode('utf-8')
+    return b'"' + a_str.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+def literal(data):
+    """ IMAP literal """
+    return b'{%d}\r\n' % (len(data)) + data
+
+def imap_date(a_date):
+    """ INTERNALDATE format """
+    return ('%02d-%s-%04d %02d:%02d:%02d +0000' % (a_date.day, MONTHS[a_date.month - 1], a_date.year, \
+                                                   a_date.hour, a_date.minute, a_date.second)).encode('ascii')
+
+def parse_imap_date(a_str):
+    """ parse 1-Jan-2012 (and optional time) """
+    a_str = a_str.strip('"')
+    parts = a_str.split()
+    day, month, year = parts[0].split('-')
+    a_date = datetime.datetime(int(year), MONTHS.index(month.capitalize()) + 1, int(day))
+    if len(parts) > 1:
+        hour, minute, sec = [ int(x) for x in parts[1].split(':') ]
+        a_date = a_date.replace(hour = hour, minute = minute, second = sec)
+        if len(parts) > 2:
+            tz = parts[2]
+            offset = datetime.timedelta(hours = int(tz[1:3]), minutes = int(tz[3:5]))
+            a_date = a_date - offset if tz[0] == '+' else a_date + offset
+    return a_date
+
+def tokenize(parts):
+    """
+       Tokenize a command made of text parts and literals (bytes instances in parts at odd indexes).
+       Atoms are returned as str, strings and literals as bytes and parenthesized lists as lists.
+    """
+    stack = [[]]
+    for i, part in enumerate(parts):
+        if i % 2:
+            stack[-1].append(part)
+            continue
+        pos, length = 0, len(part)
+        while pos < length:
+            char = part[pos:pos+1]
+            if char == b' ':
+                pos += 1
+            elif char == b'(':
+                stack.append([])
+                pos += 1
+            elif char == b')':
+                if len(stack) == 1:
+                    raise IMAPError('unbalanced parenthesis')
+                a_list = stack.pop()
+                stack[-1].append(a_list)
+                pos += 1
+            elif char == b'"':
+                pos += 1
+                buf = bytearray()
+                while pos < length and part[pos:pos+1] != b'"':
+                    if part[pos:pos+1] == b'\\':
+                        pos += 1
+                    buf += part[pos:pos+1]
+                    pos += 1
+                pos += 1
+                stack[-1].append(bytes(buf))
+            else:
+                start, depth = pos, 0
+                while pos < length:
+                    char = part[pos:pos+1]
+                    if char == b'[':
+                        depth += 1
+                    elif char == b']':
+                        depth -= 1
+                    elif depth == 0 and char in (b' ', b'(', b')'):
+                        break
+                    pos += 1
+                stack[-1].append(part[start:pos].decode('utf-8'))
+    if len(stack) != 1:
+        raise IMAPError('unbalanced parenthesis')
+    return stack[0]
+
+def to_str(token):
+    """ astring token to str """
+    if isinstance(token, bytes):
+        return token.decode('utf-8')
+    if isinstance(token, list):
+        raise IMAPError('string expected')
+    return token
+
+def parse_uid_set(a_set, max_uid):
+    """ parse 1,3:5,7:* into a predicate and an ordered list of candidate uids """
+    ranges = []
+    for elem in to_str(a_set).split(','):
+        if ':' in elem:
+            start, end = elem.split(':')
+            start = max_uid if start == '*' else int(start)
+            end   = max_uid if end == '*' else int(end)
+            ranges.append((min(start, end), max(start, end)))
+        else:
+            the_id = max_uid if elem == '*' else int(elem)
+            ranges.append((the_id, the_id))
+    return ranges
+
+def in_ranges(uid, ranges):
+    """ True if uid is in one of the ranges """
+    for start, end in ranges:
+        if start <= uid <= end:
+            return True
+    return False
+
+class GmailRawQuery(object): #pylint:disable=R0903
+    """
+       Small subset of the Gmail search syntax used by X-GM-RAW:
+       label: in: subject: after: before: is:starred is:unread is:read, -negation and plain words (subject)
+    """
+    DATE_FORMAT = '%Y/%m/%d'
+
+    def __init__(self, query):
+        self.terms = []
+        for term in re.findall(r'-?\w+:"[^"]*"|-?"[^"]*"|\S+', query):
+            negate = term.startswith('-')
+            if negate:
+                term = term[1:]
+            key, _, value = term.partition(':') if ':' in term else ('', '', term)
+            self.terms.append((negate, key.lower(), value.strip('"').lower()))
+
+    def match(self, msg):
+        """ True if msg matches the query """
+        for negate, key, value in self.terms:
+            if self._match_term(msg, key, value) == negate:
+                return False
+        return True
+
+    def _match_term(self, msg, key, value): #pylint:disable=R0911
+        """ match a single term """
+        if key in ('label', 'in', 'l'):
+            if value in ('anywhere', 'all'):
+                return True
+            value = value.replace('-', '/')
+            return any(label.decode('utf-8').lower().lstrip('\\') == value for label in msg.labels)
+        elif key == 'subject':
+            return value in msg.subject.lower()
+        elif key == 'after':
+            return msg.internal_date >= datetime.datetime.strptime(value, self.DATE_FORMAT)
+        elif key == 'before':
+            return msg.internal_date < datetime.datetime.strptime(value, self.DATE_FORMAT)
+        elif key == 'is':
+            if value == 'starred':
+                return b'\\Starred' in msg.labels
+            elif value == 'unread':
+                return b'\\Seen' not in msg.flags
+            elif value == 'read':
+                return b'\\Seen' in msg.flags
+            return False
+        return value in msg.subject.lower()
+
+class FakeIMAPHandler(socketserver.BaseRequestHandler):
+    """
+       One IMAP session
+    """
+    READ_CHUNK  = 65536
+    FLUSH_LIMIT = 256 * 1024
+    IDLE_POLL   = 0.05 # seconds between two checks of the folder in IDLE
+    QUICKACK    = getattr(socket, 'TCP_QUICKACK', None)
+
+    def setup(self):
+        self.server.stats['sessions'] += 1
+        self.server.stats['max_sessions'] = max(self.server.stats['max_sessions'], self.server.stats['sessions'])
+        if self.server.ssl_context:
+            self.request = self.server.ssl_context.wrap_socket(self.request, server_side = True)
+            if self.request.session_reused:
+                self.server.stats['tls_resumed'] += 1
+        self.conf         = self.server.fake_conf
+        self.account      = None
+        self.folder       = None
+        self.readonly     = True
+        self.in_buffer    = b''
+        self.out_buffer   = []
+        self.out_size     = 0
+        self.compressor   = None
+        self.decompressor = None
+        self.closed       = False
+        self.pending_compression = False
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # ----------------------------------------------------------------- I/O
+
+    def _fill(self):
+        """ read more data from the socket """
+        data = self.request.recv(self.READ_CHUNK)
+        if not data:
+            raise EOFError()
+        if self.QUICKACK:
+            # no delayed ACKs: imaplib sends literals in several small writes
+            # and would wait 40ms on each one on the loopback
+            self.request.setsockopt(socket.IPPROTO_TCP, self.QUICKACK, 1)
+        self.server.stats['bytes_in'] += len(data)
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        self.in_buffer += data
+
+    def _readline(self):
+        """ read a line including CRLF """
+        while True:
+            pos = self.in_buffer.find(b'\n')
+            if pos >= 0:
+                line, self.in_buffer = self.in_buffer[:pos+1], self.in_buffer[pos+1:]
+                return line
+            self._fill()
+
+    def _read_exact(self, size):
+        """ read size bytes """
+        while len(self.in_buffer) < size:
+            self._fill()
+        data, self.in_buffer = self.in_buffer[:size], self.in_buffer[size:]
+        return data
+
+    def _write(self, data):
+        """ buffer data and send it when the buffer is big enough """
+        self.out_buffer.append(data)
+        self.out_size += len(data)
+        if self.out_size >= self.FLUSH_LIMIT:
+            self._flush()
+
+    def _flush(self):
+        """ send buffered data applying compression and bandwidth limit """
+        if not self.out_buffer:
+            return
+        data = b''.join(self.out_buffer)
+        self.out_buffer, self.out_size = [], 0
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        bandwidth = self.conf['bandwidth']
+        if bandwidth:
+            # send by chunks of 64KB to keep a smooth rate
+            for pos in range(0, len(data), 65536):
+                chunk = data[pos:pos+65536]
+                self.request.sendall(chunk)
+                time.sleep(len(chunk) / float(bandwidth))
+        else:
+            self.request.sendall(data)
+        self.server.stats['bytes_out'] += len(data)
+
+    def _start_compression(self):
+        """ deflate everything from now on (RFC 4978) """
+        self.compressor   = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        #data already received after the COMPRESS command is compressed
+        if self.in_buffer:
+            self.in_buffer = self.decompressor.decompress(self.in_buffer)
+        self.pending_compression = False
+
+    def _read_command(self):
+        """ read a command and its literals. Return the list of text parts and literals """
+        line  = self._readline()
+        parts = []
+        while True:
+            match = LITERAL_RE.search(line)
+            if not match:
+                parts.append(line.rstrip(CRLF))
+                return parts
+            parts.append(line[:match.start()])
+            if not match.group(2): #synchronizing literal
+                self._write(b'+ go ahead' + CRLF)
+                self._flush()
+            parts.append(self._read_exact(int(match.group(1))))
+            line = self._readline()
+
+    # ----------------------------------------------------------------- session
+
+    def handle(self):
+        self._write(b'* OK [CAPABILITY ' + CAPABILITIES + b'] Gimap ready for requests from fake server' + CRLF)
+        self._flush()
+        try:
+            while not self.closed:
+                parts = self._read_command()
+                self._dispatch(parts)
+                self._flush()
+                if self.pending_compression:
+                    self._start_compression()
+        except (EOFError, ConnectionError, OSError):
+            pass
+
+    def _dispatch(self, parts):
+        """ execute one command """
+        tag = b'*'
+        try:
+            tokens = tokenize(parts)
+            if len(tokens) < 2:
+                raise IMAPError('missing command')
+            tag, command, args = tokens[0].encode('utf-8'), tokens[1].upper(), tokens[2:]
+            uid = False
+            if command == 'UID':
+                if not args:
+                    raise IMAPError('missing UID command')
+                uid, command, args = True, to_str(args[0]).upper(), args[1:]
+
+            self.server.stats['commands'] += 1
+            if self.conf['latency']:
+                time.sleep(self.conf['latency'])
+
+            method = getattr(self, 'cmd_%s' % (command.lower().replace('-', '_')), None)
+            if method is None:
+                raise IMAPError('Unknown command %s' % (command))
+
+            if command not in ('CAPABILITY', 'LOGIN', 'AUTHENTICATE', 'NOOP', 'LOGOUT', 'ID') and not self.account:
+                raise IMAPError('Not authenticated')
+
+            failures = self.conf['fail_commands']
+            if failures.get(command):
+                raise IMAPError(failures.pop(command), status = b'NO')
+
+            if self.account and command != 'IDLE': # IDLE waits for the other sessions
+                with self.account.lock:
+                    text = method(args, uid) if uid else method(args)
+            else:
+                text = method(args, uid) if uid else method(args)
+
+            if self.closed:
+                self._write(tag + b' OK LOGOUT completed' + CRLF)
+            else:
+                self._write(tag + b' OK ' + (text or b'Success') + CRLF)
+        except IMAPError as err:
+            self._write(tag + b' ' + err.status + b' ' + str(err).encode('utf-8') + CRLF)
+        except (EOFError, ConnectionError):
+            raise
+        except Exception as err: #pylint:disable=W0703
+            LOG.debug("Fake server error %s" % (err))
+            self._write(tag + b' BAD Server error ' + str(err).encode('utf-8', 'replace') + CRLF)
+
+    # ----------------------------------------------------------------- commands
+
+    def cmd_capability(self, _):
+        """ CAPABILITY """
+        self._write(b'* CAPABILITY ' + CAPABILITIES + CRLF)
+        return b'Thats all she wrote!'
+
+    def cmd_noop(self, _):
+        """ NOOP """
+        return b'Success'
+
+    def cmd_id(self, _):
+        """ ID """
+        self._write(b'* ID ("name" "GImap" "vendor" "Google, Inc.")' + CRLF)
+        return b'Success'
+
+    def cmd_enable(self, _):
+        """ ENABLE """
+        return b'Success'
+
+    def cmd_logout(self, _):
+        """ LOGOUT """
+        self._write(b'* BYE LOGOUT Requested' + CRLF)
+        self.closed = True
+        return b'LOGOUT completed'
+
+    def _login(self, login):
+        """ attach the account of login """
+        self.account = self.server.get_account(login)
+        if self.account is None:
+            raise IMAPError('[AUTHENTICATIONFAILED] Invalid credentials (Failure)', b'NO')
+
+    def cmd_login(self, args):
+        """ LOGIN user password """
+        if len(args) < 2:
+            raise IMAPError('LOGIN needs a user and a password')
+        self._login(to_str(args[0]))
+        return b'[CAPABILITY ' + CAPABILITIES + b'] fake.account authenticated (Success)'
+
+    def cmd_authenticate(self, args):
+        """ AUTHENTICATE XOAUTH2 """
+        if not args or to_str(args[0]).upper() not in ('XOAUTH2', 'PLAIN'):
+            raise IMAPError('Unsupported authentication mechanism', b'NO')
+        mechanism = to_str(args[0]).upper()
+        if len(args) > 1:
+            response = to_str(args[1])
+        else:
+            self._write(b'+ ' + CRLF)
+            self._flush()
+            response = self._readline().strip().decode('ascii')
+        decoded = base64.b64decode(response).decode('utf-8', 'replace')
+        if mechanism == 'XOAUTH2':
+            match = re.match(r'user=([^\x01]*)\x01', decoded)
+            login = match.group(1) if match else ''
+        else:
+            login = decoded.split('\x00')[1] if decoded.count('\x00') >= 2 else ''
+        self._login(login)
+        return b'[CAPABILITY ' + CAPABILITIES + b'] fake.account authenticated (Success)'
+
+    def cmd_compress(self, args):
+        """ COMPRESS DEFLATE """
+        if not args or to_str(args[0]).upper() != 'DEFLATE':
+            raise IMAPError('Unknown compression mechanism')
+        if self.compressor:
+            raise IMAPError('[COMPRESSIONACTIVE] DEFLATE active', b'NO')
+        #the tagged answer is sent in clear, compression starts after it (see handle)
+        self.pending_compression = True
+        self.server.stats['compress'] += 1
+        return b'DEFLATE active'
+
+    def _list(self, args, command):
+        """ LIST and XLIST """
+        pattern = to_str(args[1]) if len(args) > 1 else '*'
+        regexp  = re.compile('^%s$' % re.escape(pattern).replace(r'\*', '.*').replace('%', '[^/]*'))
+        for name, folder in sorted(self.account.folders.items()):
+            if not regexp.match(name):
+                continue
+            flags = folder.flags
+            if command == b'LIST':
+                flags = tuple(flag for flag in flags if flag in (b'\\HasNoChildren', b'\\HasChildren'))
+            self._write(b'* ' + command + b' (' + b' '.join(flags) + b') "/" ' + \
+                        quote(imap_utf7.encode(name)) + CRLF)
+        return b'Success'
+
+    def cmd_list(self, args):
+        """ LIST """
+        return self._list(args, b'LIST')
+
+    def cmd_xlist(self, args):
+        """ XLIST """
+        return self._list(args, b'XLIST')
+
+    def _folder_arg(self, token):
+        """ decode a folder name """
+        name = imap_utf7.decode(token if isinstance(token, bytes) else token.encode('utf-8'))
+        return name
+
+    def _select(self, args, readonly):
+        """ SELECT and EXAMINE """
+        folder = self.account.get_folder(self._folder_arg(args[0]))
+        if folder is None:
+            self.folder = None
+            raise IMAPError('[NONEXISTENT] Unknown Mailbox: %s (Failure)' % (args[0]), b'NO')
+        self.folder, self.readonly = folder, readonly
+        self._write(b'* FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen $NotPhishing $Phishing)' + CRLF)
+        self._write(b'* OK [PERMANENTFLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen \\*)] Flags permitted.' + CRLF)
+        self._write(b'* OK [UIDVALIDITY %d] UIDs valid.' % (folder.uidvalidity) + CRLF)
+        self._write(b'* %d EXISTS' % (len(folder)) + CRLF)
+        self._write(b'* 0 RECENT' + CRLF)
+        self._write(b'* OK [UIDNEXT %d] Predicted next UID.' % (folder.uidnext) + CRLF)
+        self._write(b'* OK [HIGHESTMODSEQ %d]' % (folder.highestmodseq) + CRLF)
+        return b'[READ-ONLY] (Success)' if readonly else b'[READ-WRITE] (Success)'
+
+    def cmd_select(self, args):
+        """ SELECT """
+        return self._select(args, False)
+
+    def cmd_examine(self, args):
+        """ EXAMINE """
+        return self._select(args, True)
+
+    def cmd_unselect(self, _):
+        """ UNSELECT """
+        self.folder = None
+        return b'Success'
+
+    def cmd_close(self, _):
+        """ CLOSE """
+        return self.cmd_expunge(None) and self.cmd_unselect(None)
+
+    def cmd_check(self, _):
+        """ CHECK """
+        return b'Success'
+
+    def cmd_create(self, args):
+        """ CREATE """
+        name = self._folder_arg(args[0])
+        if not self.account.create_folder(name):
+            raise IMAPError('[ALREADYEXISTS] Duplicate folder name %s (Failure)' % (name), b'NO')
+        return b'Success'
+
+    def cmd_delete(self, args):
+        """ DELETE """
+        name   = self._folder_arg(args[0])
+        folder = self.account.get_folder(name)
+        if folder is None:
+            raise IMAPError('[NONEXISTENT] Unknown Mailbox: %s (Failure)' % (name), b'NO')
+        del self.account.folders[folder.name]
+        return b'Success'
+
+    def _check_selected(self):
+        """ a folder must be selected """
+        if self.folder is None:
+            raise IMAPError('Command needs a selected folder')
+
+    def cmd_append(self, args):
+        """ APPEND folder [flags] [date] literal """
+        folder = self.account.get_folder(self._folder_arg(args[0]))
+        if folder is None:
+            raise IMAPError('[TRYCREATE] Folder doesn\'t exist. (Failure)', b'NO')
+        flags, a_date, body = (), datetime.datetime.utcnow(), args[-1]
+        for arg in args[1:-1]:
+            if isinstance(arg, list):
+                flags = tuple(to_str(flag).encode('utf-8') for flag in arg)
+            else:
+                a_date = parse_imap_date(to_str(arg))
+        if not isinstance(body, bytes):
+            raise IMAPError('APPEND needs a message literal')
+
+        msg = self.account.new_message(body, flags, a_date)
+        if folder.name not in (ALL_MAIL, CHATS):
+            #labels folders: the message goes in All Mail with the label
+            msg.labels = (folder.name.encode('utf-8'),) if folder.name != DRAFTS else (b'\\Draft',)
+            folder = self.account.folders[ALL_MAIL]
+        new_uid = folder.append(msg)
+        self.server.stats['appended'] += 1
+        return b'[APPENDUID %d %d] (Success)' % (folder.uidvalidity, new_uid)
+
+    def cmd_search(self, args, _uid = False):
+        """ SEARCH """
+        self._check_selected()
+        predicate = self._build_search(list(args))
+        if self.conf['search_latency']:
+            time.sleep(self.conf['search_latency'])
+        found = [ b'%d' % (msg.uid) for msg in self.folder.messages() if predicate(msg) ]
+        self._write(b'* SEARCH' + (b' ' + b' '.join(found) if found else b'') + CRLF)
+        self.server.stats['searches'] += 1
+        return b'SEARCH completed (Success)'
+
+    def _build_search(self, args): #pylint:disable=R0912,R0915
+        """ build a predicate from a list of search keys (ANDed) """
+        predicates = []
+        while args:
+            key = args.pop(0)
+            if isinstance(key, list):
+                predicates.append(self._build_search(list(key)))
+                continue
+            key = to_str(key)
+            u_key = key.upper()
+            if u_key == 'CHARSET':
+                args.pop(0)
+            elif u_key == 'ALL':
+                continue
+            elif u_key == 'UID' or re.match(r'^[0-9*][0-9:,*]*$', key):
+                a_set = args.pop(0) if u_key == 'UID' else key
+                ranges = parse_uid_set(a_set, self.folder.max_uid())
+                predicates.append(lambda msg, ranges = ranges: in_ranges(msg.uid, ranges))
+            elif u_key in ('SINCE', 'BEFORE', 'ON'):
+                a_date = parse_imap_date(to_str(args.pop(0))).date()
+                if u_key == 'SINCE':
+                    predicates.append(lambda msg, d = a_date: msg.internal_date.date() >= d)
+                elif u_key == 'BEFORE':
+                    predicates.append(lambda msg, d = a_date: msg.internal_date.date() < d)
+                else:
+                    predicates.append(lambda msg, d = a_date: msg.internal_date.date() == d)
+            elif u_key == 'X-GM-MSGID':
+                gm_id = int(to_str(args.pop(0)))
+                predicates.append(lambda msg, gm_id = gm_id: msg.gm_id == gm_id)
+            elif u_key == 'X-GM-THRID':
+                thr_id = int(to_str(args.pop(0)))
+                predicates.append(lambda msg, thr_id = thr_id: msg.thr_id == thr_id)
+            elif u_key == 'X-GM-LABELS':
+                label = to_str(args.pop(0)).lower().encode('utf-8')
+                predicates.append(lambda msg, label = label: label in [ l.lower() for l in msg.labels ])
+            elif u_key == 'X-GM-RAW':
+                #gmvault sends the quoted query in a literal and Gmail accepts it
+                query = GmailRawQuery(to_str(args.pop(0)).strip().strip('"'))
+                predicates.append(query.match)
+            elif u_key == 'MODSEQ':
+                modseq = int(to_str(args.pop(0)))
+                predicates.append(lambda msg, modseq = modseq: msg.modseq >= modseq)
+            elif u_key == 'SUBJECT':
+                value = to_str(args.pop(0)).lower()
+                predicates.append(lambda msg, value = value: value in msg.subject.lower())
+            elif u_key in ('SEEN', 'UNSEEN', 'DELETED', 'UNDELETED'):
+                flag = b'\\Seen' if 'SEEN' in u_key else b'\\Deleted'
+                expected = not u_key.startswith('UN')
+                predicates.append(lambda msg, flag = flag, exp = expected: (flag in msg.flags) == exp)
+            elif u_key == 'NOT':
+                sub = self._build_search([args.pop(0)])
+                predicates.append(lambda msg, sub = sub: not sub(msg))
+            elif u_key == 'OR':
+                left, right = self._build_search([args.pop(0)]), self._build_search([args.pop(0)])
+                predicates.append(lambda msg, l = left, r = right: l(msg) or r(msg))
+            else:
+                raise IMAPError('[CLIENTBUG] Unsupported search key %s' % (key))
+
+        return lambda msg: all(pred(msg) for pred in predicates)
+
+    @classmethod
+    def _header_fields(cls, body, fields):
+        """ extract the header lines named in fields """
+        end = body.find(b'\r\n\r\n')
+        headers = body[:end + 2] if end >= 0 else body
+        result, keep = [], False
+        for line in headers.split(b'\r\n'):
+            if line[:1] in (b' ', b'\t'):
+                if keep:
+                    result.append(line)
+                continue
+            keep = line.split(b':', 1)[0].strip().upper() in fields
+            if keep:
+                result.append(line)
+        return b''.join(line + CRLF for line in result) + CRLF
+
+    def _fetch_item(self, msg, item): #pylint:disable=R0911
+        """ produce one FETCH data item """
+        u_item = item.upper()
+        if u_item == 'UID':
+            return b'UID %d' % (msg.uid)
+        elif u_item == 'X-GM-MSGID':
+            return b'X-GM-MSGID %d' % (msg.gm_id)
+        elif u_item == 'X-GM-THRID':
+            return b'X-GM-THRID %d' % (msg.thr_id)
+        elif u_item == 'X-GM-LABELS':
+            labels = [ label if label.startswith(b'\\') else quote(imap_utf7.encode(label.decode('utf-8'))) \
+                       for label in msg.labels ]
+            return b'X-GM-LABELS (' + b' '.join(labels) + b')'
+        elif u_item == 'INTERNALDATE':
+            return b'INTERNALDATE "' + imap_date(msg.internal_date) + b'"'
+        elif u_item == 'FLAGS':
+            return b'FLAGS (' + b' '.join(msg.flags) + b')'
+        elif u_item == 'RFC822.SIZE':
+            return b'RFC822.SIZE %d' % (len(msg.body))
+        elif u_item == 'MODSEQ':
+            return b'MODSEQ (%d)' % (msg.modseq)
+        elif u_item in ('BODY[]', 'BODY.PEEK[]', 'RFC822'):
+            self.server.stats['bodies'] += 1
+            return (b'RFC822 ' if u_item == 'RFC822' else b'BODY[] ') + literal(msg.body)
+        elif u_item.startswith('BODY.PEEK[HEADER') or u_item.startswith('BODY[HEADER'):
+            section = item[item.index('['):]
+            if section.upper() == '[HEADER]':
+                end = msg.body.find(b'\r\n\r\n')
+                data = msg.body[:end + 4] if end >= 0 else msg.body
+            else:
+                fields = set(field.encode('ascii').upper() for field in \
+                             section[section.index('(') + 1:section.index(')')].split())
+                data = self._header_fields(msg.body, fields)
+            return b'BODY' + section.encode('ascii') + b' ' + literal(data)
+        raise IMAPError('Unsupported fetch item %s' % (item))
+
+    def cmd_fetch(self, args, use_uid = False):
+        """ FETCH set items """
+        self._check_selected()
+        ranges = parse_uid_set(args[0], self.folder.max_uid())
+        items  = args[1] if isinstance(args[1], list) else [ args[1] ]
+        items  = [ to_str(item) for item in items ]
+        if use_uid and 'UID' not in [ item.upper() for item in items ]:
+            items.insert(0, 'UID')
+        for start, end in ranges:
+            for the_uid in range(start, min(end, self.folder.max_uid()) + 1):
+                msg = self.folder.get(the_uid)
+                if msg is None:
+                    continue
+                data = b' '.join(self._fetch_item(msg, item) for item in items)
+                self._write(b'* %d FETCH (' % (msg.uid) + data + b')' + CRLF)
+                self.server.stats['fetched'] += 1
+                self._drop_fetch()
+        return b'Success'
+
+    def _drop_fetch(self):
+        """ simulate a connection loss in the middle of a FETCH (drop_fetch_after) """
+        drop_after = self.conf['drop_fetch_after']
+        if drop_after is None:
+            return
+        if drop_after > 1:
+            self.conf['drop_fetch_after'] = drop_after - 1
+            return
+        self.conf['drop_fetch_after'] = None
+        # send what has been fetched so far and the beginning of the next response
+        self._write(b'* 0 FETCH (UID 0 BODY[] {100}' + CRLF + b'truncated')
+        self._flush()
+        self.request.shutdown(socket.SHUT_RDWR)
+        raise EOFError()
+
+    def cmd_store(self, args, _uid = False):
+        """ STORE set +X-GM-LABELS(.SILENT) / +FLAGS(.SILENT) """
+        self._check_selected()
+        ranges = parse_uid_set(args[0], self.folder.max_uid())
+        action = to_str(args[1]).upper()
+        values = args[2] if isinstance(args[2], list) else args[2:]
+        values = [ to_str(value) for value in values ]
+        silent = action.endswith('.SILENT')
+        action = action.replace('.SILENT', '')
+        what   = action.lstrip('+-')
+        if what == 'X-GM-LABELS':
+            values = [ value.encode('utf-8') if value.startswith('\\') \
+                       else imap_utf7.decode(value.encode('utf-8')).encode('utf-8') for value in values ]
+        elif what == 'FLAGS':
+            values = [ value.encode('utf-8') for value in values ]
+        else:
+            raise IMAPError('Unsupported store item %s' % (action))
+
+        for start, end in ranges:
+            for the_uid in range(start, min(end, self.folder.max_uid()) + 1):
+                msg = self.folder.get(the_uid)
+                if msg is None:
+                    continue
+                current = list(msg.labels if what == 'X-GM-LABELS' else msg.flags)
+                if action.startswith('+'):
+                    current.extend(value for value in values if value not in current)
+                elif action.startswith('-'):
+                    current = [ value for value in current if value not in values ]
+                else:
+                    current = values
+                if what == 'X-GM-LABELS':
+                    msg.labels = tuple(current)
+                else:
+                    msg.flags = tuple(current)
+                self.folder.update(msg)
+                if not silent:
+                    self._write(b'* %d FETCH (UID %d ' % (msg.uid, msg.uid) + \
+                                self._fetch_item(msg, what) + b')' + CRLF)
+        return b'Success'
+
+    def cmd_expunge(self, _):
+        """ EXPUNGE """
+        self._check_selected()
+        for msg in list(self.folder.messages()):
+            if b'\\Deleted' in msg.flags:
+                self.folder.expunged.add(msg.uid)
+                self._write(b'* %d EXPUNGE' % (msg.uid) + CRLF)
+        return b'Success'
+
+    def _folder_state(self):
+        """ (nb of expunged messages, UIDNEXT, HIGHESTMODSEQ) of the selected folder """
+        with self.account.lock:
+            return len(self.folder.expunged), self.folder.uidnext, self.folder.highestmodseq
+
+    def cmd_idle(self, _):
+        """ IDLE: notify the changes of the selected folder until DONE """
+        self._check_selected()
+        self._write(b'+ idling' + CRLF)
+        self._flush()
+        state = self._folder_state()
+        self.request.settimeout(self.IDLE_POLL)
+        try:
+            while True:
+                if b'\n' in self.in_buffer:
+                    if self._readline().strip().upper() == b'DONE':
+                        return b'IDLE terminated (Success)'
+                    raise IMAPError('Expected DONE')
+                try:
+                    self._fill()
+                except socket.timeout:
+                    pass
+                new_state = self._folder_state()
+                if new_state == state:
+                    continue
+                with self.account.lock:
+                    nb_msgs = len(self.folder)
+                for _ in range(new_state[0] - state[0]):
+                    self._write(b'* %d EXPUNGE' % (nb_msgs + 1) + CRLF)
+                if new_state[1] != state[1]:
+                    self._write(b'* %d EXISTS' % (nb_msgs) + CRLF)
+                elif new_state[0] == state[0]:
+                    self._write(b'* 1 FETCH (MODSEQ (%d))' % (new_state[2]) + CRLF)
+                self._flush()
+                state = new_state
+        finally:
+            self.request.settimeout(None)
+
+    def finish(self):
+        try:
+            self._flush()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.stats['sessions'] -= 1
+
+class _ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ one thread per connection """
+    daemon_threads      = True
+    allow_reuse_address = True
+    request_queue_size  = 128 # many clients may connect at the same time (asyncio transport)
+
+class FakeGmailServer(object):
+    """
+       Local Gmail IMAP stand-in.
+
+       server = FakeGmailServer({'foo@gmail.com': FakeGmailAccount(nb_emails = 100)}).start()
+       gmvaulter = GMVaulter(db_dir, server.host, server.port, 'foo@gmail.com', \
+                             {'type': 'passwd', 'value': 'pwd'}, use_ssl = False)
+
+       latency: seconds added to each command
+       bandwidth: bytes per second sent by the server (None for no limit)
+       search_latency: extra seconds for each SEARCH (Gmail searches are slow)
+       auto_create: give an empty account to unknown logins (restore target)
+       ssl_context: server side ssl.SSLContext to serve IMAP over TLS
+       conf['drop_fetch_after']: close the connection after sending that many FETCH responses (once)
+       conf['fail_commands']: { command : error text } answered NO once instead of running the command
+    """
+    def __init__(self, accounts = None, latency = 0.0, bandwidth = None, search_latency = 0.0, \
+                 auto_create = True, host = '127.0.0.1', port = 0, ssl_context = None): #pylint:disable=R0913
+        self.accounts    = dict(accounts or {})
+        self.auto_create = auto_create
+        self.conf        = { 'latency' : latency, 'bandwidth' : bandwidth, 'search_latency' : search_latency, \
+                            'drop_fetch_after' : None, 'fail_commands' : {} }
+        self._server     = _ThreadedServer((host, port), FakeIMAPHandler)
+        self._server.fake_conf   = self.conf
+        self._server.get_account = self.get_account
+        self._server.ssl_context = ssl_context
+        self._server.stats       = dict.fromkeys(['commands', 'bytes_in', 'bytes_out', 'fetched', 'bodies', \
+                                                  'searches', 'appended', 'compress', 'tls_resumed', \
+                                                  'sessions', 'max_sessions'], 0)
+        self._thread     = None
+
+    @property
+    def host(self):
+        """ listening host """
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        """ listening port """
+        return self._server.server_address[1]
+
+    @property
+    def stats(self):
+        """ counters (commands, bytes_in, bytes_out, fetched, ...) and nb of open sessions """
+        return self._server.stats
+
+    def get_account(self, login):
+        """ account for login """
+        account = self.accounts.get(login)
+        if account is None and self.auto_create:
+            account = self.accounts.setdefault(login, FakeGmailAccount())
+        return account
+
+    def start(self):
+        """ serve in a background thread """
+        self._thread = threading.Thread(target = self._server.serve_forever, name = 'fake-imap-server')
+        self._thread.daemon = True
+        self._thread.start()
+        LOG.debug("Fake IMAP server listening on %s:%s" % (self.host, self.port))
+        return self
+
+    def stop(self):
+        """ stop serving """
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
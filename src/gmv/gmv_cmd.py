@@ -17,7 +17,6 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
-import socket
 import sys
 import datetime
 import os
@@ -25,15 +24,16 @@ import signal
 import traceback
 
 import argparse
-import imaplib
 import gmv.log_utils as log_utils
 import gmv.gmvault_utils as gmvault_utils
-import gmv.gmvault as gmvault
-import gmv.gmvault_export as gmvault_export
+import gmv.metrics_utils as metrics_utils
 import gmv.collections_utils as collections_utils
 
 from gmv.cmdline_utils  import CmdLineParser
-from gmv.credential_utils import CredentialHelper
+
+# gmvault, gmvault_export, gmvault_db, gmvault_daemon, credential_utils and profiler_utils 
+# (imapclient, ssl, chardet, ...) are imported by the commands needing them to keep the 
+# startup fast. gmvault_startup_tests.py checks the import time.
 
 GMVAULT_VERSION = gmvault_utils.GMVAULT_VERSION
 
@@ -45,6 +45,7 @@ a) Get help for each of the individual commands
 #> gmvault restore --help
 #> gmvault check -h
 #> gmvault export -h
+#> gmvault daemon -h
 
 """
 
@@ -94,6 +95,10 @@ e) Custom synchronisation with an Gmail request for advance users.
 
 #> gmvault sync --type custom --gmail-req "in:work from:foo" foo.bar@gmail.com
 
+f) Quick synchronisation then continuous backup of the new emails as they arrive
+
+#> gmvault sync --type quick --watch foo.bar@gmail.com
+
 """
 
 EXPORT_HELP_EPILOGUE = """Warning: Experimental Functionality requiring more testing.
@@ -117,8 +122,39 @@ d) Use one of the export type dedicated to a specific tool (dovecot or offlineIM
 #> gmvault export -t dovecot /tmp/a-dovecot-dir
 """
 
+DAEMON_HELP_EPILOGUE = """Examples:
+
+a) Sync every account of accounts.json at its own interval, 4 syncs at most at the same time
+
+#> gmvault daemon --max-connections 4 accounts.json
+
+accounts.json:
+
+{ "accounts" : [
+    { "email" : "foo@gmail.com", "db_dir" : "/backup/foo", "interval" : 3600, "type" : "quick" },
+    { "email" : "bar@gmail.com", "db_dir" : "/backup/bar", "interval" : 86400, "type" : "full" }
+  ] }
+
+Each account must have been synced once interactively (to store its OAuth2 token or password).
+
+b) Share 5MB/s between all the syncs and serve the daemon status on http://127.0.0.1:8080/status
+
+#> gmvault daemon --max-bandwidth 5000000 --status-port 8080 accounts.json
+"""
+
 LOG = log_utils.LoggerFactory.get_logger('gmv')
 
+class _NoImapError(Exception):
+    """ never raised: stands for imaplib.IMAP4.error while imaplib is not loaded """
+    pass
+
+def _imap_error():
+    """
+       imaplib.IMAP4.error if imaplib has been imported (an imap error cannot happen before)
+    """
+    imaplib = sys.modules.get('imaplib')
+    return imaplib.IMAP4.error if imaplib else _NoImapError
+
 class NotSeenAction(argparse.Action): #pylint:disable=R0903,w0232
     """
        to differenciate between a seen and non seen command
@@ -137,11 +173,13 @@ class GMVaultLauncher(object):
     SYNC_TYPES    = ['full', 'quick', 'custom']
     RESTORE_TYPES = ['full', 'quick']
     CHECK_TYPES   = ['full']
+    # export type -> gmvault_export class name (see get_export_type)
     EXPORT_TYPES  = collections_utils.OrderedDict([
-                     ('offlineimap', gmvault_export.OfflineIMAP),
-                     ('dovecot', gmvault_export.Dovecot),
-                     ('maildir', gmvault_export.OfflineIMAP),
-                     ('mbox', gmvault_export.MBox)])
+                     ('offlineimap', 'OfflineIMAP'),
+                     ('dovecot', 'Dovecot'),
+                     ('maildir', 'OfflineIMAP'),
+                     ('mbox', 'MBox'),
+                     ('fast-mbox', 'StreamingMBox')])
     EXPORT_TYPE_NAMES = ", ".join(EXPORT_TYPES)
     
     DEFAULT_GMVAULT_DB = "%s/gmvault-db" % (os.getenv("HOME", "."))
@@ -150,6 +188,14 @@ class GMVaultLauncher(object):
         """ constructor """
         super(GMVaultLauncher, self).__init__()
 
+    @classmethod
+    def get_export_type(cls, export_type):
+        """
+           Return the gmvault_export class of export_type
+        """
+        import gmv.gmvault_export as gmvault_export #pylint:disable=C0415
+        return getattr(gmvault_export, cls.EXPORT_TYPES[export_type])
+
     @gmvault_utils.memoized
     def _create_parser(self): #pylint: disable=R0915
         """
@@ -229,6 +275,16 @@ class GMVaultLauncher(object):
                                  action='store_true', dest='only_chats', \
                                  default=False, help= 'Only sync chats.')
         
+        sync_parser.add_argument("--newest-first", \
+                                 action='store_true', dest='newest_first', \
+                                 default=False, help= 'Sync the most recent emails first. '\
+                                                      'A resumed sync skips all the emails already synced.')
+        
+        sync_parser.add_argument("--watch", \
+                                 action='store_true', dest='watch', \
+                                 default=False, help= 'After the sync, stay connected and back up the new '\
+                                                      'and changed emails as they arrive (IMAP IDLE).')
+        
         sync_parser.add_argument("-e", "--encrypt", \
                                  help="encrypt stored email messages in the database.",\
                                  action='store_true',dest="encrypt", default=False)
@@ -260,6 +316,8 @@ class GMVaultLauncher(object):
                               dest="debug", default=False)
         
         
+        self._add_metrics_options(sync_parser)
+
         sync_parser.set_defaults(verb='sync')
     
         sync_parser.epilogue = SYNC_HELP_EPILOGUE
@@ -326,6 +384,8 @@ class GMVaultLauncher(object):
                               action='store_true', help="Activate debugging info",\
                               dest="debug", default=False)
         
+        self._add_metrics_options(rest_parser)
+
         rest_parser.set_defaults(verb='restore')
     
         rest_parser.epilogue = REST_HELP_EPILOGUE
@@ -389,16 +449,66 @@ class GMVaultLauncher(object):
                                    action='append', dest='label', \
                                    default=None,
                                    help='specify a label to export')
+
+        export_parser.add_argument('--hardlinks', \
+                                   action='store_true', dest='hardlinks', \
+                                   default=False, help='maildir types only: write each email once and '\
+                                                       'hardlink it in the other label folders.')
+
         export_parser.add_argument("--debug", "-debug", \
                        action='store_true', help="Activate debugging info",\
                        dest="debug", default=False)
 
+        self._add_metrics_options(export_parser)
+
         export_parser.set_defaults(verb='export')
         
         export_parser.epilogue = EXPORT_HELP_EPILOGUE
 
+        # daemon command
+        daemon_parser = subparsers.add_parser('daemon', \
+                                              help='periodically sync a list of accounts in one process.')
+
+        daemon_parser.add_argument('accounts_file', \
+                                   action='store', help='JSON file listing the accounts and their gmvault-db.')
+
+        daemon_parser.add_argument("--max-connections", metavar = "N", type = int, \
+                                   action='store', help="max nb of simultaneous syncs (default: max_connections "\
+                                                        "of the accounts file or 2)",\
+                                   dest="max_connections", default=None)
+
+        daemon_parser.add_argument("--max-bandwidth", metavar = "BYTES", type = int, \
+                                   action='store', help="bandwidth in bytes/s shared by all the syncs "\
+                                                        "(default: max_bandwidth of the accounts file or no limit)",\
+                                   dest="max_bandwidth", default=None)
+
+        daemon_parser.add_argument("--status-port", metavar = "PORT", type = int, \
+                                   action='store', help="serve the daemon status on http://127.0.0.1:PORT/status.",\
+                                   dest="status_port", default=None)
+
+        daemon_parser.add_argument("--debug", "-debug", \
+                       action='store_true', help="Activate debugging info",\
+                       dest="debug", default=False)
+
+        daemon_parser.set_defaults(verb='daemon')
+
+        daemon_parser.epilogue = DAEMON_HELP_EPILOGUE
+
         return parser
       
+    @classmethod
+    def _add_metrics_options(cls, a_parser):
+        """
+           Options publishing the run metrics (sync, restore and export)
+        """
+        a_parser.add_argument("--metrics-file", metavar = "FILE", \
+                              action='store', help="write the run metrics in FILE (Prometheus textfile format).",\
+                              dest="metrics_file", default=None)
+
+        a_parser.add_argument("--metrics-port", metavar = "PORT", type = int, \
+                              action='store', help="serve the run metrics on http://127.0.0.1:PORT/metrics.",\
+                              dest="metrics_port", default=None)
+
     @classmethod
     def _parse_common_args(cls, options, parser, parsed_args, list_of_types = []): #pylint:disable=W0102
         """
@@ -504,6 +614,10 @@ class GMVaultLauncher(object):
            
             parsed_args['emails_only'] = options.only_emails
             parsed_args['chats_only']  = options.only_chats
+
+            parsed_args['watch'] = options.watch
+
+            parsed_args['newest_first'] = options.newest_first
         
             # add db-cleaning
             # if request passed put it False unless it has been forced by the user
@@ -568,11 +682,25 @@ class GMVaultLauncher(object):
                 parsed_args['type'] = options.type.lower()
             else:
                 parser.error('Unknown type for command export. The type should be one of %s' % self.EXPORT_TYPE_NAMES)
+            import gmv.gmvault_export as gmvault_export #pylint:disable=C0415
+            if options.hardlinks and not issubclass(self.get_export_type(parsed_args['type']), gmvault_export.Maildir):
+                parser.error('--hardlinks can only be used with a maildir export type.')
+            parsed_args['hardlinks'] = options.hardlinks
             parsed_args['debug'] = options.debug
 
+        elif parsed_args.get('command', '') == 'daemon':
+            parsed_args['accounts_file']   = options.accounts_file
+            parsed_args['max_connections'] = options.max_connections
+            parsed_args['max_bandwidth']   = options.max_bandwidth
+            parsed_args['status_port']     = options.status_port
+            parsed_args['debug']           = options.debug
+
         elif parsed_args.get('command', '') == 'config':
             pass
     
+        parsed_args['metrics_file'] = getattr(options, 'metrics_file', None)
+        parsed_args['metrics_port'] = getattr(options, 'metrics_port', None)
+
         #add parser
         parsed_args['parser'] = parser
         
@@ -594,27 +722,35 @@ class GMVaultLauncher(object):
         return request
     
     @classmethod
-    def _export(cls, args):
+    def _export(cls, args, metrics = None):
         """
            Export gmvault-db into another format
         """
-        export_type = cls.EXPORT_TYPES[args['type']]
-        output_dir = export_type(args['output-dir'])
+        import gmv.gmvault_export as gmvault_export #pylint:disable=C0415
+
+        export_type = cls.get_export_type(args['type'])
+        if args.get('hardlinks'):
+            output_dir = export_type(args['output-dir'], use_hardlinks = True)
+        else:
+            output_dir = export_type(args['output-dir'])
         LOG.critical("Export gmvault-db as a %s mailbox." % (args['type']))
         exporter = gmvault_export.GMVaultExporter(args['db-dir'], output_dir,
-            labels=args['labels'])
+            labels=args['labels'], metrics=metrics)
         exporter.export()
         output_dir.close()
 
     @classmethod
-    def _restore(cls, args, credential):
+    def _restore(cls, args, credential, metrics = None):
         """
            Execute All restore operations
         """
+        import gmv.gmvault as gmvault #pylint:disable=C0415
+
         LOG.critical("Connect to Gmail server.\n")
         # Create a gmvault releaving read_only_access
         restorer = gmvault.GMVaulter(args['db-dir'], args['host'], args['port'], \
-                                       args['email'], credential, read_only_access = False)
+                                       args['email'], credential, read_only_access = False, \
+                                       metrics = metrics)
         
         #full sync is the first one
         if args.get('type', '') == 'full':
@@ -646,82 +782,150 @@ class GMVaultLauncher(object):
         LOG.critical(restorer.get_operation_report()) 
             
     @classmethod        
-    def _sync(cls, args, credential):
+    def _sync(cls, args, credential, metrics = None):
         """
            Execute All synchronisation operations
         """
+        import gmv.gmvault as gmvault #pylint:disable=C0415
+
         LOG.critical("Connect to Gmail server.\n")
         
         # handle credential in all levels
         syncer = gmvault.GMVaulter(args['db-dir'], args['host'], args['port'], \
                                    args['email'], credential, read_only_access = True, \
-                                   use_encryption = args['encrypt'])
-        #full sync is the first one
-        if args.get('type', '') == 'full':
+                                   use_encryption = args['encrypt'], metrics = metrics, \
+                                   concurrent_phases = args.get('concurrent_phases'))
+        try:
+            #full sync is the first one
+            if args.get('type', '') == 'full':
         
-            #choose full sync. Ignore the request
-            syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' } , compress_on_disk = args['compression'], \
-                        db_cleaning = args['db-cleaning'], ownership_checking = args['ownership_control'],\
-                        restart = args['restart'], emails_only = args['emails_only'], chats_only = args['chats_only'])
+                #choose full sync. Ignore the request
+                syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' } , compress_on_disk = args['compression'], \
+                            db_cleaning = args['db-cleaning'], ownership_checking = args['ownership_control'],\
+                            restart = args['restart'], emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                            newest_first = args.get('newest_first', False))
         
-        elif args.get('type', '') == 'auto':
+            elif args.get('type', '') == 'auto':
         
-            #choose auto sync. imap request = ALL and restart = True
-            syncer.sync({ 'mode': 'auto', 'type': 'imap', 'req': 'ALL' } , compress_on_disk = args['compression'], \
-                        db_cleaning = args['db-cleaning'], ownership_checking = args['ownership_control'],\
-                        restart = True, emails_only = args['emails_only'], chats_only = args['chats_only'])
+                #choose auto sync. imap request = ALL and restart = True
+                syncer.sync({ 'mode': 'auto', 'type': 'imap', 'req': 'ALL' } , compress_on_disk = args['compression'], \
+                            db_cleaning = args['db-cleaning'], ownership_checking = args['ownership_control'],\
+                            restart = True, emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                            newest_first = args.get('newest_first', False))
               
-        elif args.get('type', '') == 'quick':
+            elif args.get('type', '') == 'quick':
             
-            #sync only the last x days (taken in defaults) in order to be quick 
-            #(cleaning is import here because recent days might move again
+                #sync only the last x days (taken in defaults) in order to be quick 
+                #(cleaning is import here because recent days might move again
             
-            # today - 2 months
-            today = datetime.date.today()
-            begin = today - datetime.timedelta(gmvault_utils.get_conf_defaults().getint("Sync", "quick_days", 8))
+                # today - 2 months
+                today = datetime.date.today()
+                begin = today - datetime.timedelta(gmvault_utils.get_conf_defaults().getint("Sync", "quick_days", 8))
             
-            LOG.critical("Quick sync mode. Check for new emails since %s." % (begin.strftime('%d-%b-%Y')))
+                LOG.critical("Quick sync mode. Check for new emails since %s." % (begin.strftime('%d-%b-%Y')))
             
-            # today + 1 day
-            end   = today + datetime.timedelta(1)
+                # today + 1 day
+                end   = today + datetime.timedelta(1)
             
-            req   = { 'type' : 'imap', \
-                      'req'  : syncer.get_imap_request_btw_2_dates(begin, end), \
-                      'mode' : 'quick'}
+                req   = { 'type' : 'imap', \
+                          'req'  : syncer.get_imap_request_btw_2_dates(begin, end), \
+                          'mode' : 'quick'}
             
-            syncer.sync( req, \
-                         compress_on_disk = args['compression'], \
-                         db_cleaning = args['db-cleaning'], \
-                         ownership_checking = args['ownership_control'], restart = args['restart'], \
-                         emails_only = args['emails_only'], chats_only = args['chats_only'])
+                syncer.sync( req, \
+                             compress_on_disk = args['compression'], \
+                             db_cleaning = args['db-cleaning'], \
+                             ownership_checking = args['ownership_control'], restart = args['restart'], \
+                             emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                             newest_first = args.get('newest_first', False))
             
-        elif args.get('type', '') == 'custom':
+            elif args.get('type', '') == 'custom':
             
-            #convert args to unicode
-            u_str = gmvault_utils.convert_argv_to_unicode(args['request']['req'])
-            args['request']['req']     = u_str
-            args['request']['charset'] = 'utf-8' #for the moment always utf-8
-            args['request']['mode']    = 'custom'
-
-            # pass an imap request. Assume that the user know what to do here
-            LOG.critical("Perform custom synchronisation with %s request: %s.\n" \
-                         % (args['request']['type'], args['request']['req']))
+                #convert args to unicode
+                u_str = gmvault_utils.convert_argv_to_unicode(args['request']['req'])
+                args['request']['req']     = u_str
+                args['request']['charset'] = 'utf-8' #for the moment always utf-8
+                args['request']['mode']    = 'custom'
+
+                # pass an imap request. Assume that the user know what to do here
+                LOG.critical("Perform custom synchronisation with %s request: %s.\n" \
+                             % (args['request']['type'], args['request']['req']))
             
-            syncer.sync(args['request'], compress_on_disk = args['compression'], db_cleaning = args['db-cleaning'], \
-                        ownership_checking = args['ownership_control'], restart = args['restart'], \
-                        emails_only = args['emails_only'], chats_only = args['chats_only'])
-        else:
-            raise ValueError("Unknown synchronisation mode %s. Please use full (default), quick or custom.")
+                syncer.sync(args['request'], compress_on_disk = args['compression'], db_cleaning = args['db-cleaning'], \
+                            ownership_checking = args['ownership_control'], restart = args['restart'], \
+                            emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                            newest_first = args.get('newest_first', False))
+            else:
+                raise ValueError("Unknown synchronisation mode %s. Please use full (default), quick or custom.")
         
         
-        #print error report
-        LOG.critical(syncer.get_operation_report())
+            #print error report
+            LOG.critical(syncer.get_operation_report())
+
+            if args.get('watch'):
+                syncer.watch(compress_on_disk = args['compression'], db_cleaning = args['db-cleaning'], \
+                             emails_only = args['emails_only'], chats_only = args['chats_only'])
+        finally:
+            # the daemon runs many syncs: do not leave the session open
+            syncer.src.disconnect()
     
+    @classmethod
+    def _daemon_sync(cls, job, credential, metrics):
+        """
+           sync one account of the daemon
+        """
+        cls._sync(job.sync_args(), credential, metrics)
+
+    @classmethod
+    def _daemon_credential(cls, job):
+        """
+           stored credential of one account of the daemon (no interactive session)
+        """
+        from gmv.credential_utils import CredentialHelper #pylint:disable=C0415
+        return CredentialHelper.get_stored_credential(job.email, job.auth)
+
+    @classmethod
+    def _daemon(cls, args):
+        """
+           Sync the accounts of the accounts file until CTRL-C or SIGTERM
+        """
+        import gmv.gmvault_daemon as gmvault_daemon #pylint:disable=C0415
+
+        jobs, settings = gmvault_daemon.load_accounts_file(args['accounts_file'])
+        conf = gmvault_utils.get_conf_defaults()
+
+        scheduler = gmvault_daemon.SyncScheduler(jobs, cls._daemon_sync, cls._daemon_credential, \
+                                                 max_connections = args.get('max_connections') or \
+                                                                   settings.get('max_connections', 2), \
+                                                 max_bandwidth = args.get('max_bandwidth') or \
+                                                                 settings.get('max_bandwidth'), \
+                                                 backoff = conf.getint('Daemon', 'backoff', 60), \
+                                                 max_backoff = conf.getint('Daemon', 'max_backoff', 3600))
+        status_server = scheduler.serve_status(args['status_port']) if args.get('status_port') else None
+
+        def sigterm_handler(signum, frame): #pylint:disable=W0613
+            """ stop scheduling new syncs """
+            LOG.critical("Received SIGTERM. Wait for the running syncs and stop.")
+            scheduler.stop()
+
+        signal.signal(signal.SIGTERM, sigterm_handler)
+        try:
+            scheduler.run_forever(conf.getint('Daemon', 'poll_interval', 30))
+        except KeyboardInterrupt:
+            LOG.critical("\nCTRL-C. Wait for the running syncs and stop.\n")
+            scheduler.stop()
+            scheduler.wait()
+        finally:
+            if status_server:
+                status_server.shutdown()
+                status_server.server_close()
+
     @classmethod
     def _check_db(cls, args, credential):
         """
            Check DB
         """
+        import gmv.gmvault as gmvault #pylint:disable=C0415
+
         LOG.critical("Connect to Gmail server.\n")
         
         # handle credential in all levels
@@ -738,16 +942,23 @@ class GMVaultLauncher(object):
         on_error       = True
         die_with_usage = True
         
+        metrics        = metrics_utils.MetricsRegistry(operation = args.get('command', ''))
+        metrics_server = None
+        
         try:
-            if args.get('command') not in ('export'):
+            if args.get('metrics_port'):
+                metrics_server = metrics.serve_http(args['metrics_port'])
+                
+            if args.get('command') not in ('export', 'daemon'):
+                from gmv.credential_utils import CredentialHelper #pylint:disable=C0415
                 credential = CredentialHelper.get_credential(args)
             
             if args.get('command', '') == 'sync':
-                self._sync(args, credential)
+                self._sync(args, credential, metrics)
                 
             elif args.get('command', '') == 'restore':
                 
-                self._restore(args, credential)
+                self._restore(args, credential, metrics)
             
             elif args.get('command', '') == 'check':
                 
@@ -755,7 +966,11 @@ class GMVaultLauncher(object):
                 
             elif args.get('command', '') == 'export':
 
-                self._export(args)
+                self._export(args, metrics)
+
+            elif args.get('command', '') == 'daemon':
+
+                self._daemon(args)
 
             elif args.get('command', '') == 'config':
                 
@@ -766,14 +981,14 @@ class GMVaultLauncher(object):
         except KeyboardInterrupt:
             LOG.critical("\nCTRL-C. Stop all operations.\n")
             on_error = False
-        except socket.error:
+        except OSError: # socket.error
             LOG.critical("Error: Network problem. Please check your gmail server hostname,"\
                          " the internet connection or your network setup.\n")
             LOG.critical("=== Exception traceback ===")
             LOG.critical(gmvault_utils.get_exception_traceback())
             LOG.critical("=== End of Exception traceback ===\n")
             die_with_usage = False
-        except imaplib.IMAP4.error as imap_err:
+        except _imap_error() as imap_err:
             #bad login or password
             if str(imap_err) in ['[AUTHENTICATIONFAILED] Invalid credentials (Failure)', \
                                  '[ALERT] Web login required: http://support.google.com/'\
@@ -794,17 +1009,34 @@ class GMVaultLauncher(object):
             LOG.critical("=== End of Exception traceback ===\n")
             die_with_usage = False
         finally: 
+            self._publish_metrics(args, metrics, metrics_server)
             if on_error:
                 if die_with_usage:
                     args['parser'].die_with_usage()
                 sys.exit(1)
  
+    @classmethod
+    def _publish_metrics(cls, args, metrics, metrics_server):
+        """
+           Write the Prometheus textfile if requested and stop the metrics endpoint
+        """
+        if args.get('metrics_file'):
+            try:
+                metrics.write_textfile(args['metrics_file'])
+                LOG.critical("Metrics written in %s." % (args['metrics_file']))
+            except (IOError, OSError) as err:
+                LOG.critical("Error: cannot write the metrics in %s: %s." % (args['metrics_file'], err))
+        if metrics_server:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+ 
 def init_logging():
     """
        init logging infrastructure
     """       
     #setup application logs: one handler for stdout and one for a log file
-    log_utils.LoggerFactory.setup_cli_app_handler(log_utils.STANDALONE, activate_log_file=False, file_path="./gmvault.log") 
+    log_utils.LoggerFactory.setup_cli_app_handler(log_utils.STANDALONE, activate_log_file=False, file_path="./gmvault.log", \
+                                                  queued = True)
     
 def activate_debug_mode():
     """
@@ -812,7 +1044,8 @@ def activate_debug_mode():
     """
     LOG.critical("Debugging logs are going to be saved in file %s/gmvault.log.\n" % os.getenv("HOME","."))
     log_utils.LoggerFactory.setup_cli_app_handler(log_utils.STANDALONE, activate_log_file=True, \
-                               console_level= 'DEBUG', file_path="%s/gmvault.log" % os.getenv("HOME","."))
+                               console_level= 'DEBUG', file_path="%s/gmvault.log" % os.getenv("HOME","."), \
+                               queued = True)
 
 def sigusr1_handler(signum, frame): #pylint:disable=W0613
     """
@@ -831,6 +1064,24 @@ def register_traceback_signal():
     """ To register a USR1 signal allowing to get stack trace """
     signal.signal(signal.SIGUSR1, sigusr1_handler)
 
+def register_profiler_signal(args):
+    """
+       To register a USR2 signal starting and stopping a profiler.
+       The profiles are written in the .info dir of the gmvault-db
+    """
+    if not hasattr(signal, 'SIGUSR2') or not args.get('db-dir'):
+        return None
+
+    import gmv.gmvault_db as gmvault_db #pylint:disable=C0415
+    import gmv.profiler_utils as profiler_utils #pylint:disable=C0415
+
+    conf     = gmvault_utils.get_conf_defaults()
+    profiler = profiler_utils.SamplingProfiler('%s/%s' % (args['db-dir'], gmvault_db.GmailStorer.INFO_AREA), \
+                                               interval = conf.getfloat('General', 'profiler_sample_interval', 0.01), \
+                                               mode = conf.get('General', 'profiler_mode', profiler_utils.SAMPLING))
+    profiler_utils.register_toggle_signal(profiler, signal.SIGUSR2)
+    return profiler
+
 def setup_default_conf():
     """
        set the environment GMVAULT_CONF_FILE which is necessary for Conf object
@@ -859,6 +1110,8 @@ def bootstrap_run():
     # force instanciation of conf to load the defaults
     gmvault_utils.get_conf_defaults() 
     
+    register_profiler_signal(args)
+    
     gmvlt.run(args)
    
     
@@ -16,21 +16,31 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
+import bisect
 import json
 import time
 import datetime
 import os
 import itertools
 import imaplib
+import copy
+import threading
+from array import array
 
 import gmv.log_utils as log_utils
 import gmv.collections_utils as collections_utils
 import gmv.gmvault_utils as gmvault_utils
 import gmv.imap_utils as imap_utils
 import gmv.gmvault_db as gmvault_db
+import gmv.metrics_utils as metrics_utils
+import gmv.quota_utils as quota_utils
+import gmv.retry_utils as retry_utils
 
 LOG = log_utils.LoggerFactory.get_logger('gmvault')
 
+# errors of a lost connection (retries exhausted or circuit breaker open): sync --watch waits and resumes
+WATCH_OUTAGE_ERRORS = imap_utils.CONNECTION_ERRORS + (retry_utils.CircuitOpenError,)
+
 def handle_restore_imap_error(the_exception, gm_id, db_gmail_ids_info, gmvaulter):
     """
        function to handle restore IMAPError and OSError([Errno 2] No such file or directory) in restore functions 
@@ -153,22 +163,94 @@ def handle_sync_imap_error(the_exception, the_id, error_report, src):
     else:
         raise the_exception    
 
+class UIDRanges(object):
+    """
+       Set of imap ids kept as sorted and disjoint [first, last] ranges.
+       Records the sync progress whatever the order in which the ids are processed
+    """
+    def __init__(self, ranges = ()):
+        self.ranges = []
+        for first, last in ranges:
+            self.add(first, last)
+
+    def add(self, first, last):
+        """
+           Add the range of ids between first and last (included) and merge the overlapping ranges
+        """
+        first, last = min(first, last), max(first, last)
+        merged = []
+        for r_first, r_last in self.ranges:
+            if r_last < first - 1 or r_first > last + 1:
+                merged.append([r_first, r_last])
+            else:
+                first, last = min(first, r_first), max(last, r_last)
+        merged.append([first, last])
+        merged.sort()
+        self.ranges = merged
+
+    def discard(self, the_id):
+        """
+           Remove the_id (if present) splitting its range in two
+        """
+        index = bisect.bisect_right(self.ranges, [the_id, float('inf')]) - 1
+        if index < 0 or self.ranges[index][1] < the_id:
+            return
+        first, last = self.ranges[index]
+        self.ranges[index:index + 1] = [[r_first, r_last] for r_first, r_last in \
+                                        ((first, the_id - 1), (the_id + 1, last)) if r_first <= r_last]
+
+    def __contains__(self, the_id):
+        index = bisect.bisect_right(self.ranges, [the_id, float('inf')]) - 1
+        return index >= 0 and self.ranges[index][1] >= the_id
+
+    def __len__(self):
+        """
+           Number of ranges
+        """
+        return len(self.ranges)
+
 class IMAPBatchFetcher(object):
     """
-       Fetch IMAP data in batch 
+       Fetch IMAP data in batch.
+       The batch size adapts itself: it grows while the time per message improves,
+       shrinks when it degrades or when an error occurs and it is capped by the
+       response size. A failing batch is bisected to isolate the faulty ids.
+       The ids are kept in an array walked with a cursor (position) and the ids
+       returned by the server are marked in a bitmap to find the unreturned ones.
     """
-    def __init__(self, src, imap_ids, error_report, request, default_batch_size = 100):
+    GROWTH_FACTOR    = 2
+    SHRINK_FACTOR    = 0.75
+    IMPROVEMENT      = 0.95 # grow when time per message is 5% better than the best one
+    DEGRADATION      = 1.25 # shrink when time per message is 25% worse than the best one
+
+    def __init__(self, src, imap_ids, error_report, request, default_batch_size = 100, \
+                 max_batch_size = None, max_batch_bytes = None): #pylint:disable=R0913
         """
            constructor
         """
         self.src                = src
-        self.imap_ids           = imap_ids
+        self.imap_ids           = array('Q', imap_ids)
         self.def_batch_size     = default_batch_size
         self.request            = request
         self.error_report       = error_report  
         
-        self.to_fetch           = list(imap_ids)
-    
+        self.position           = 0 # index of the next id to fetch
+        self.batch_start        = 0 # index of the first id of the last batch
+        self.start_position     = 0
+        self.returned           = bytearray((len(self.imap_ids) + 7) // 8) # 1 bit per returned id
+
+        self.batch_size         = default_batch_size
+        self.max_batch_size     = max_batch_size if max_batch_size else \
+                                  gmvault_utils.get_conf_defaults().getint("General", "max_messages_per_batch", 2000)
+        self.max_batch_bytes    = max_batch_bytes if max_batch_bytes else \
+                                  gmvault_utils.get_conf_defaults().getint("General", "max_bytes_per_batch", 8388608)
+        self.best_time_per_msg  = None
+        self.avg_bytes_per_msg  = None
+        self.batch_sizes        = [] # sizes used so far, to tune the defaults
+        # nb of pipelined FETCH commands per batch (only the asyncio transport pipelines)
+        self.nb_pipelined       = gmvault_utils.get_conf_defaults().getint("General", "nb_pipelined_fetches", 4) \
+                                  if getattr(src, 'transport', None) == 'asyncio' else 1
+
     def individual_fetch(self, imap_ids):
         """
            Find the imap_id creating the issue
@@ -183,7 +265,116 @@ class IMAPBatchFetcher(object):
                 handle_sync_imap_error(error, the_id, self.error_report, self.src) #do everything in this handler
 
         return new_data
-   
+
+    def bisect_fetch(self, imap_ids):
+        """
+           Fetch imap_ids splitting the list in two halves on error
+           to find the faulty ids in O(log n) fetches
+        """
+        if len(imap_ids) <= 1:
+            return self.individual_fetch(imap_ids)
+
+        try:
+            return self.src.fetch(imap_ids, self.request)
+        except imaplib.IMAP4.error:
+            return self.split_fetch(imap_ids)
+
+    def split_fetch(self, imap_ids):
+        """
+           Bisect fetch the two halves of imap_ids which could not be fetched at once
+        """
+        LOG.debug("Error when fetching %d ids. Split the batch in two." % (len(imap_ids)))
+        middle = len(imap_ids) // 2
+        new_data = self.bisect_fetch(imap_ids[:middle])
+        new_data.update(self.bisect_fetch(imap_ids[middle:]))
+        return new_data
+
+    @classmethod
+    def _response_size(cls, data):
+        """
+           Approximate size in bytes of a fetch response
+        """
+        size = 0
+        for msg in data.values():
+            for val in msg.values():
+                if isinstance(val, (bytes, str)):
+                    size += len(val)
+                elif isinstance(val, (list, tuple)):
+                    size += sum(len(elem) for elem in val if isinstance(elem, (bytes, str)))
+        return size
+
+    def _set_batch_size(self, new_size, reason):
+        """
+           Change the batch size within the limits
+        """
+        new_size = max(1, min(int(new_size), self.max_batch_size))
+        if self.avg_bytes_per_msg:
+            new_size = max(1, min(new_size, int(self.max_batch_bytes / self.avg_bytes_per_msg)))
+
+        if new_size != self.batch_size:
+            LOG.debug("Batch size %d => %d (%s)." % (self.batch_size, new_size, reason))
+            self.batch_size = new_size
+
+    def _adapt_batch_size(self, nb_msgs, elapsed, data):
+        """
+           Adapt the batch size from the time spent and the size of the last batch
+        """
+        if nb_msgs <= 0 or not data:
+            return
+
+        bytes_per_msg = float(self._response_size(data)) / len(data)
+        self.avg_bytes_per_msg = bytes_per_msg if self.avg_bytes_per_msg is None else \
+                                 (0.8 * self.avg_bytes_per_msg) + (0.2 * bytes_per_msg)
+
+        time_per_msg = elapsed / nb_msgs
+        if self.best_time_per_msg is None or time_per_msg < self.best_time_per_msg * self.IMPROVEMENT:
+            self.best_time_per_msg = time_per_msg
+            self._set_batch_size(self.batch_size * self.GROWTH_FACTOR, \
+                                 "%.2f ms per message" % (time_per_msg * 1000))
+        elif time_per_msg > self.best_time_per_msg * self.DEGRADATION:
+            self._set_batch_size(self.batch_size * self.SHRINK_FACTOR, \
+                                 "%.2f ms per message" % (time_per_msg * 1000))
+        else:
+            # keep the size but respect the bytes cap
+            self._set_batch_size(self.batch_size, "size cap")
+
+    def _mark_returned(self, batch, data):
+        """
+           Set the bitmap bit of the batch ids present in data
+        """
+        for index, the_id in enumerate(batch, self.batch_start):
+            if the_id in data:
+                self.returned[index >> 3] |= 1 << (index & 7)
+
+    def unreturned_ids(self):
+        """
+           Generator of the ids fetched so far that the server did not return
+        """
+        for index in range(self.start_position, self.position):
+            if not self.returned[index >> 3] & (1 << (index & 7)):
+                yield self.imap_ids[index]
+
+    def __len__(self):
+        """
+           Number of ids left to fetch
+        """
+        return len(self.imap_ids) - self.position
+
+    def checkpoint(self):
+        """
+           Return (position, imap id) of the first id of the batch being processed.
+           All the ids before it have been fetched and processed (_common_sync saves them as done).
+        """
+        if self.batch_start >= len(self.imap_ids):
+            return self.batch_start, None
+        return self.batch_start, self.imap_ids[self.batch_start]
+
+    def seek(self, position):
+        """
+           Restart the iteration at position (e.g. from a checkpoint)
+        """
+        self.position = self.batch_start = self.start_position = max(0, min(position, len(self.imap_ids)))
+
     def __iter__(self):
         return self     
     
@@ -191,22 +382,37 @@ class IMAPBatchFetcher(object):
         """
             Return the next batch of elements
         """
-        new_data = {}
-        batch = self.to_fetch[:self.def_batch_size]
+        self.batch_start = self.position
+        batch = self.imap_ids[self.position:self.position + self.batch_size].tolist()
         
         if len(batch) <= 0:
+            if self.batch_sizes:
+                LOG.info("Fetched %d batches. Batch sizes: min %d, max %d, avg %d." \
+                         % (len(self.batch_sizes), min(self.batch_sizes), max(self.batch_sizes), \
+                            sum(self.batch_sizes) / len(self.batch_sizes)))
             raise StopIteration
         
+        self.position += len(batch)
+        self.batch_sizes.append(len(batch))
+
+        the_timer = gmvault_utils.Timer()
+        the_timer.start()
         try:
-        
-            new_data = self.src.fetch(batch, self.request)
-            
-            self.to_fetch = self.to_fetch[self.def_batch_size:]
-            
-            return new_data
+            if self.nb_pipelined > 1:
+                new_data = self.src.fetch_many(batch, self.request, self.nb_pipelined)
+            else:
+                new_data = self.src.fetch(batch, self.request)
+            self._adapt_batch_size(len(batch), the_timer.elapsed_ms(), new_data)
+        except imaplib.IMAP4.error as error:
+            self._set_batch_size(self.batch_size / 2, "fetch error")
+            # the whole batch has just failed: do not fetch it again
+            if len(batch) > 1:
+                new_data = self.split_fetch(batch)
+            else:
+                new_data = {}
+                handle_sync_imap_error(error, batch[0], self.error_report, self.src)
 
-        except imaplib.IMAP4.error:
-            new_data = self.individual_fetch(batch) 
+        self._mark_returned(batch, new_data)
     
         return new_data
     
@@ -214,7 +420,8 @@ class IMAPBatchFetcher(object):
         """
            Restart from the beginning
         """
-        self.to_fetch = self.imap_ids              
+        self.seek(0)
+        self.returned = bytearray(len(self.returned))
                
 class GMVaulter(object):
     """
@@ -236,24 +443,41 @@ class GMVaulter(object):
                        OP_CHAT_RESTORE  : CHAT_RESTORE_PROGRESS,
                        OP_CHAT_SYNC     : CHAT_SYNC_PROGRESS
                      }
+
+    SEARCH_CACHE            = 'search_cache.info'
+    SEARCH_CACHE_LOCK       = threading.Lock()
+    METRICS_SUMMARY         = '%s_metrics.info'
+    QUOTA_STATE             = 'quota.info'
     
     
     def __init__(self, db_root_dir, host, port, login, \
-                 credential, read_only_access = True, use_encryption = False): #pylint:disable-msg=R0913,R0914
+                 credential, read_only_access = True, use_encryption = False, use_ssl = True, \
+                 metrics = None, concurrent_phases = None): #pylint:disable-msg=R0913,R0914
         """
            constructor
+           metrics: MetricsRegistry collecting the run metrics (created if None)
+           concurrent_phases: run the chat phase in a thread with a second connection
+                              (General.concurrent_phases if None)
         """   
         self.db_root_dir = db_root_dir
         
+        self.metrics = metrics if metrics is not None else metrics_utils.MetricsRegistry()
+        self.metrics.set_label('login', login)
+        
         #create dir if it doesn't exist
         gmvault_utils.makedirs(self.db_root_dir)
         
         #keep track of login email
         self.login = login
             
+        # transfers paced against the Gmail quotas, with the state of the previous runs
+        pacer = quota_utils.QuotaPacer.from_conf('%s/%s/%s_%s' % (self.db_root_dir, gmvault_db.GmailStorer.INFO_AREA, \
+                                                                   login, self.QUOTA_STATE))
+
         # create source and try to connect
         self.src = imap_utils.GIMAPFetcher(host, port, login, credential, \
-                                           readonly_folder = read_only_access)
+                                           readonly_folder = read_only_access, use_ssl = use_ssl, \
+                                           metrics = self.metrics, pacer = pacer)
         
         self.src.connect()
         
@@ -269,11 +493,87 @@ class GMVaulter(object):
                               'key_error' : []}
         
         #instantiate gstorer
-        self.gstorer =  gmvault_db.GmailStorer(self.db_root_dir, self.use_encryption)
+        self.gstorer =  gmvault_db.GmailStorer(self.db_root_dir, self.use_encryption, metrics = self.metrics)
         
         #timer used to mesure time spent in the different values
         self.timer = gmvault_utils.Timer()
+
+        #progress shared by the email and chat phases when they run at the same time
+        self.progress = None
+        self.concurrent_phases = concurrent_phases
         
+    def _progress_logger(self, timer, total, what, action):
+        """
+           Return the progress logger of a phase
+        """
+        if self.progress:
+            return self.progress.phase(what, total)
+        return log_utils.ProgressLogger(LOG, timer, total, what, action, \
+                                        gmvault_utils.get_conf_defaults().getint("General", "progress_log_period", 5))
+
+    def _new_source(self):
+        """
+           Open another connection with the settings of self.src
+        """
+        src = imap_utils.GIMAPFetcher(self.src.host, self.src.port, self.login, self.src.credential, \
+                                      readonly_folder = self.src.readonly_folder, use_ssl = self.src.ssl, \
+                                      metrics = self.metrics, transport = self.src.transport, pacer = self.src.pacer)
+        src.connect()
+        return src
+
+    def _run_phases(self, phases, action, concurrent = None):
+        """
+           Run the phases, a list of (name, function(vaulter)).
+           With concurrent (self.concurrent_phases or General.concurrent_phases if None), the phases after the first one run at the same
+           time in threads, each with its own connection (a copy of self sharing the db, metrics, error report
+           and a combined progress of the action when it is not None).
+           Return the nb of reconnections of these extra connections.
+        """
+        if concurrent is None:
+            concurrent = self.concurrent_phases
+        if concurrent is None:
+            concurrent = gmvault_utils.get_conf_defaults().getboolean("General", "concurrent_phases", True)
+
+        if len(phases) < 2 or not concurrent:
+            for _, phase_fn in phases:
+                phase_fn(self)
+            return 0
+
+        errors   = []
+        def run_phase(vaulter, phase_fn):
+            """ thread target """
+            try:
+                phase_fn(vaulter)
+            except Exception as error: #pylint:disable=W0703
+                LOG.exception(error)
+                errors.append(error)
+            finally:
+                vaulter.src.disconnect()
+
+        if action:
+            self.progress = log_utils.CombinedProgress(LOG, self.timer, action, \
+                                                       gmvault_utils.get_conf_defaults().getint("General", "progress_log_period", 5))
+        vaulters, threads = [], []
+        try:
+            for name, phase_fn in phases[1:]:
+                vaulter = copy.copy(self)
+                vaulter.src = self._new_source()
+                vaulters.append(vaulter)
+                threads.append(threading.Thread(target = run_phase, args = (vaulter, phase_fn), name = 'gmv-%s' % (name)))
+                threads[-1].start()
+
+            LOG.debug("%s running at the same time." % (", ".join(name for name, _ in phases)))
+            phases[0][1](self)
+        finally:
+            for thread in threads:
+                thread.join()
+            self.progress = None
+
+        if errors:
+            raise errors[0]
+
+        return sum(vaulter.src.total_nb_reconns for vaulter in vaulters)
+
     @classmethod
     def get_imap_request_btw_2_dates(cls, begin_date, end_date):
         """
@@ -341,38 +641,20 @@ class GMVaulter(object):
         """
            Needs update
         """
-        if curr_metadata[gmvault_db.GmailStorer.ID_K] != new_metadata[b'X-GM-MSGID']:
-            raise Exception("Gmail id has changed for %s" % (curr_metadata['id']))
+        if curr_metadata.gm_id != new_metadata[imap_utils.GIMAPFetcher.GMAIL_ID]:
+            raise Exception("Gmail id has changed for %s" % (curr_metadata.gm_id))
                 
         #check flags   
-        prev_set = set(new_metadata[b'FLAGS'])    
-        
-        for flag in curr_metadata['flags']:
-            if bytes(flag, 'utf-8') not in prev_set:
-                return True
-            else:
-                prev_set.remove(bytes(flag, 'utf-8'))
-        
-        if len(prev_set) > 0:
+        if set(curr_metadata.flags) != set(flag.decode('utf-8') for flag in new_metadata[imap_utils.GIMAPFetcher.IMAP_FLAGS]):
             return True
         
         #check labels
-        prev_labels = set(new_metadata[b'X-GM-LABELS'])
+        prev_labels = set(new_metadata[imap_utils.GIMAPFetcher.GMAIL_LABELS])
         
         if chat_metadata: #add gmvault-chats labels
             prev_labels.add(gmvault_db.GmailStorer.CHAT_GM_LABEL)
-            
-        
-        for label in curr_metadata['labels']:
-            if label not in prev_labels:
-                return True
-            else:
-                prev_labels.remove(label)
         
-        if len(prev_labels) > 0:
-            return True
-        
-        return False
+        return set(curr_metadata.labels) != prev_labels
     
     
     def _check_email_db_ownership(self, ownership_control):
@@ -402,7 +684,7 @@ class GMVaulter(object):
         #try to save db_owner in the list of owners
         self.gstorer.store_db_owner(self.login)
         
-    def _sync_chats(self, imap_req, compress, restart):
+    def _sync_chats(self, imap_req, compress, restart, newest_first = False):
         """
            sync emails
         """
@@ -418,7 +700,7 @@ class GMVaulter(object):
         LOG.debug("Selection is finished")
 
         if chat_dir:
-            imap_ids = self._common_sync(timer, "chat", imap_req, compress, restart)
+            imap_ids = self._common_sync(timer, "chat", imap_req, compress, restart, newest_first = newest_first)
         else:
             imap_ids = []    
         
@@ -427,27 +709,174 @@ class GMVaulter(object):
         return imap_ids
 
 
-    def _common_sync(self, a_timer, a_type, imap_req, compress, restart):
+    def _get_search_cache_path(self):
+        """
+           Return the path of the search cache file in the .info dir
+        """
+        return '%s/%s_%s' % (self.gstorer.get_info_dir(), self.login, self.SEARCH_CACHE)
+
+    def _load_search_cache(self):
+        """
+           Load the search cache. Return an empty cache if it cannot be read
+        """
+        filepath = self._get_search_cache_path()
+        if not os.path.exists(filepath):
+            return {}
+
+        try:
+            with open(filepath, 'r') as f:
+                return json.load(f)
+        except ValueError as json_error:
+            LOG.debug("Cannot read search cache %s (%s). Ignore it." % (filepath, json_error))
+            return {}
+
+    def _save_search_cache(self, key, entry):
+        """
+           Add entry to the search cache and only keep the most recently used searches
+        """
+        max_entries = gmvault_utils.get_conf_defaults().getint("Sync", "search_cache_size", 10)
+
+        # the email and chat phases can save their searches at the same time: reload the cache
+        # under the lock to keep the entry of the other one
+        with self.SEARCH_CACHE_LOCK:
+            cache = self._load_search_cache()
+            cache[key] = entry
+            for old_key in sorted(cache, key = lambda k: cache[k]['last_used'], reverse = True)[max_entries:]:
+                del cache[old_key]
+
+            with open(self._get_search_cache_path(), 'w') as f:
+                json.dump(cache, f)
+
+    def search_with_cache(self, imap_req):
+        """
+           Search the current folder and cache the result in the .info dir.
+           The cache is keyed by (folder, request, UIDVALIDITY, HIGHESTMODSEQ):
+            - same HIGHESTMODSEQ: nothing changed in the folder, reuse the result.
+            - otherwise only the messages modified since the cached HIGHESTMODSEQ
+              (including the new ones) are searched again.
+           Expunged messages can stay in a reused result: they are then reported as empty.
+        """
+        if (imap_req.get('type') == 'imap' and imap_req.get('req', '').upper() == 'ALL') or \
+           not gmvault_utils.get_conf_defaults().getboolean("Sync", "search_cache", True):
+            return self.src.search(imap_req)
+
+        status = self.src.get_folder_status()
+        if not status:
+            LOG.debug("No HIGHESTMODSEQ returned by the server. Do not use the search cache.")
+            return self.src.search(imap_req)
+
+        uidvalidity, highestmodseq, uidnext = status
+
+        key   = json.dumps([str(self.src.current_folder), imap_req.get('type'), imap_req.get('req')])
+        entry = self._load_search_cache().get(key)
+
+        if entry and entry['uidvalidity'] == uidvalidity and entry['highestmodseq'] == highestmodseq:
+            imap_ids = entry['ids']
+            LOG.critical("Folder unchanged since the last search. Reuse the %d cached results." % (len(imap_ids)))
+        elif entry and entry['uidvalidity'] == uidvalidity:
+            modseq_req = 'MODSEQ %d' % (entry['highestmodseq'] + 1)
+            changed    = set(self.src.search({'type': 'imap', 'req': modseq_req}))
+            delta      = self.src.search(dict(imap_req, restrict = modseq_req))
+            imap_ids   = sorted(set(the_id for the_id in entry['ids'] if the_id not in changed).union(delta))
+            LOG.critical("Reuse the cached search results. %d messages changed since the last search, %d of them match." \
+                         % (len(changed), len(delta)))
+        else:
+            imap_ids = self.src.search(imap_req)
+
+        self._save_search_cache(key, { 'uidvalidity'   : uidvalidity,
+                                       'highestmodseq' : highestmodseq,
+                                       'uidnext'       : uidnext,
+                                       'last_used'     : gmvault_utils.get_utcnow_epoch(),
+                                       'ids'           : list(imap_ids) })
+
+        return imap_ids
+
+    def _light_sync(self, a_type, imap_ids, progress):
+        """
+           First tier of the sync: fetch only the gmail id, flags and labels of imap_ids
+           in large batches and update the messages already in the db.
+           Return the imap ids of the messages missing from the db (they need a full fetch)
+        """
+        if a_type == "email":
+            db_index     = self.gstorer.get_all_existing_gmail_ids()
+            dir_fmt      = '%s'
+            extra_labels = ()
+        else:
+            db_index     = self.gstorer.get_all_chats_gmail_ids()
+            dir_fmt      = self.gstorer.SUB_CHAT_AREA
+            extra_labels = (gmvault_db.GmailStorer.CHAT_GM_LABEL,)
+
+        batch_size = gmvault_utils.get_conf_defaults().getint("Sync", "nb_messages_per_light_batch", 2000)
+        light_fetcher = IMAPBatchFetcher(self.src, imap_ids, self.error_report, imap_utils.GIMAPFetcher.GET_FLAGS_LABELS, \
+                                         default_batch_size = batch_size, max_batch_size = batch_size)
+
+        new_ids = []
+        for new_data in light_fetcher:
+            for the_id, email_info in new_data.items():
+                gid     = email_info.get(imap_utils.GIMAPFetcher.GMAIL_ID)
+                db_dir  = db_index.get(gid) if gid is not None else None
+                if db_dir is None:
+                    new_ids.append(the_id)
+                    continue
+
+                the_dir = dir_fmt % (db_dir)
+                curr_metadata = GMVaulter.check_email_on_disk(self.gstorer, gid, the_dir)
+                if not curr_metadata:
+                    new_ids.append(the_id)
+                    continue
+
+                email_info[imap_utils.GIMAPFetcher.GMAIL_LABELS] = \
+                    imap_utils.decode_labels(email_info.get(imap_utils.GIMAPFetcher.GMAIL_LABELS, ()))
+                if self._metadata_needs_update(curr_metadata, email_info, a_type == "chat"):
+                    LOG.debug("{} with imap id {} and gmail id {} has changed. Updated it.", a_type, the_id, gid)
+                    self.gstorer.update_metadata(curr_metadata, email_info, the_dir, extra_labels)
+                    self.metrics.inc('%ss_updated' % (a_type))
+                else:
+                    LOG.debug("On disk metadata for {} is up to date.", gid)
+                progress.update()
+
+        # no data returned: let the full fetch report them
+        new_ids.extend(light_fetcher.unreturned_ids())
+
+        LOG.critical("%d %ss already in the db checked. %d %ss to be fully fetched." \
+                     % (len(light_fetcher.imap_ids) - len(new_ids), a_type, len(new_ids), a_type))
+        return new_ids
+
+    def _common_sync(self, a_timer, a_type, imap_req, compress, restart, imap_ids = None, \
+                     newest_first = False): #pylint:disable=R0913
         """
            common syncing method for both emails and chats. 
+           imap_ids: sync these ids instead of the result of imap_req
+           newest_first: process the ids in descending order (Gmail gives the imap ids in arrival order)
         """
-        # get all imap ids in All Mail
-        imap_ids = self.src.search(imap_req)
+        # get all imap ids in All Mail. The progress is only saved for a complete search result
+        save_progress = imap_ids is None
+        if imap_ids is None:
+            imap_ids = self.search_with_cache(imap_req)
 
         last_id_file = self.OP_EMAIL_SYNC if a_type == "email" else self.OP_CHAT_SYNC
         
         # check if there is a restart
+        done = UIDRanges()
         if restart:
             LOG.critical("Restart mode activated for emails. Need to find information in Gmail, be patient ...")
-            imap_ids = self.get_gmails_ids_left_to_sync(last_id_file, imap_ids, imap_req)
+            done = self.get_sync_done_ranges(last_id_file, imap_ids, imap_req)
+
+        imap_ids = sorted((the_id for the_id in imap_ids if the_id not in done), reverse = newest_first)
+        # all the ids between first_id and the last processed one (batch fetcher checkpoint) are done but the failed ones
+        first_id = imap_ids[0] if imap_ids else None
+        last_ids = imap_ids[-1:]
         
         total_nb_msgs_to_process = len(imap_ids) # total number of emails to get
         
         LOG.critical("%d %ss to be fetched." % (total_nb_msgs_to_process, a_type))
         
         nb_msgs_processed = 0
-        
-        to_fetch = set(imap_ids)
+        progress = self._progress_logger(a_timer, total_nb_msgs_to_process, '%ss' % (a_type), 'stored')
+
+        if gmvault_utils.get_conf_defaults().getboolean("Sync", "light_fetch", True):
+            imap_ids = sorted(self._light_sync(a_type, imap_ids, progress), reverse = newest_first)
+
         batch_fetcher = IMAPBatchFetcher(self.src, imap_ids, self.error_report, imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA, \
                                          default_batch_size = \
                                          gmvault_utils.get_conf_defaults().getint("General","nb_messages_per_batch",500))
@@ -464,11 +893,27 @@ class GMVaulter(object):
         else:
             raise Exception("Error a_type %s in _common_sync is unknown" % (a_type))
         
+        gid    = None
+        failed = set() # ids in error: they are not saved as done to be synced again by a resume
+
+        def save_done(last_id):
+            """ save as done the ids between first_id and last_id except the failed and unreturned ones """
+            synced = UIDRanges(done.ranges)
+            synced.add(first_id, last_id)
+            for the_id in failed.union(batch_fetcher.unreturned_ids()):
+                synced.discard(the_id)
+            self.save_sync_progress(last_id_file, gid, synced, imap_req)
+
         #LAST Thing to do remove all found ids from imap_ids and if ids left add missing in report
         for new_data in batch_fetcher:            
-            for the_id in new_data:
+            # the batches before this one have been processed: save them as done
+            position, _ = batch_fetcher.checkpoint()
+            if save_progress and position:
+                save_done(batch_fetcher.imap_ids[position - 1])
+
+            for the_id in sorted(new_data, reverse = newest_first):
                 if new_data.get(the_id, None):
-                    LOG.debug("\nProcess imap id %s" % ( the_id ))
+                    LOG.debug("\nProcess imap id {}", the_id)
                         
                     gid      = new_data[the_id].get(imap_utils.GIMAPFetcher.GMAIL_ID, None)
                     eml_date = new_data[the_id].get(imap_utils.GIMAPFetcher.IMAP_INTERNALDATE, None)
@@ -476,6 +921,7 @@ class GMVaulter(object):
                     if gid is None or eml_date is None:
                         LOG.info("Ignore email with id %s. No %s nor %s found in %s." % (the_id, imap_utils.GIMAPFetcher.GMAIL_ID, imap_utils.GIMAPFetcher.IMAP_INTERNALDATE, new_data[the_id]))
                         self.error_report['empty'].append((the_id, gid if gid else None))
+                        failed.add(the_id)
                         pass #ignore this email and process the next one
                     
                     if a_type == "email":
@@ -485,7 +931,7 @@ class GMVaulter(object):
                     else:
                         raise Exception("Error a_type %s in _common_sync is unknown" % (a_type))
                     
-                    LOG.critical("Process %s num %d (imap_id:%s) from %s." % (a_type, nb_msgs_processed, the_id, the_dir))
+                    LOG.debug("Process {} num {} (imap_id:{}) from {}.", a_type, nb_msgs_processed, the_id, the_dir)
                     
                     #decode the labels that are received as utf7 => unicode
                     try:
@@ -504,9 +950,10 @@ class GMVaulter(object):
                                       % (the_id, id_info, str(err)))
                             LOG.info("Missing labels information for email id %s. Ignore it\n" % (the_id))
                             self.error_report['key_error'].append((the_id, new_data.get(the_id)))
+                            failed.add(the_id)
                             continue
 
-                    LOG.debug("metadata info collected: %s\n" % (new_data[the_id]))
+                    LOG.debug("metadata info collected: {}\n", new_data[the_id])
                 
                     #pass the dir and the ID
                     curr_metadata = GMVaulter.check_email_on_disk( self.gstorer , \
@@ -516,66 +963,59 @@ class GMVaulter(object):
                     #if on disk check that the data is not different
                     if curr_metadata:
                         
-                        LOG.debug("metadata for %s already exists. Check if different." % (gid))
+                        LOG.debug("metadata for {} already exists. Check if different.", gid)
                         
                         if self._metadata_needs_update(curr_metadata, new_data[the_id], chat_metadata):
-                            LOG.debug("%s with imap id %s and gmail id %s has changed. Updated it." % (a_type, the_id, gid))
+                            LOG.debug("{} with imap id {} and gmail id {} has changed. Updated it.", a_type, the_id, gid)
                             
                             #restore everything at the moment
                             gid  = bury_metadata_fn(new_data[the_id], local_dir = the_dir)
+                            self.metrics.inc('%ss_updated' % (a_type))
                             
                             #update local index id gid => index per directory to be thought out
                         else:
-                            LOG.debug("On disk metadata for %s is up to date." % (gid))
+                            LOG.debug("On disk metadata for {} is up to date.", gid)
                     else:  
                         try:
                             #get the data
-                            LOG.debug("Get Data for %s." % (gid))
+                            LOG.debug("Get Data for {}.", gid)
                             email_data = self.src.fetch(the_id, imap_utils.GIMAPFetcher.GET_DATA_ONLY )
                             
                             new_data[the_id][imap_utils.GIMAPFetcher.EMAIL_BODY] = \
                             email_data[the_id][imap_utils.GIMAPFetcher.EMAIL_BODY]
                             
-                            LOG.debug("Storing on disk data for %s" % (gid))
+                            LOG.debug("Storing on disk data for {}", gid)
                             # store data on disk within year month dir 
                             gid  = bury_data_fn(new_data[the_id], local_dir = the_dir, compress = compress)
+                            self.metrics.inc('%ss_stored' % (a_type))
                             
                             #update local index id gid => index per directory to be thought out
-                            LOG.debug("Create and store email with imap id %s, gmail id %s." % (the_id, gid))   
+                            LOG.debug("Create and store email with imap id {}, gmail id {}.", the_id, gid)
                         except Exception as error:
+                            failed.add(the_id)
                             handle_sync_imap_error(error, the_id, self.error_report, self.src) #do everything in this handler    
                     
                     nb_msgs_processed += 1
                     
-                    #indicate every 50 messages the number of messages left to process
-                    left_emails = (total_nb_msgs_to_process - nb_msgs_processed)
-                    
-                    if (nb_msgs_processed % 50) == 0 and (left_emails > 0):
-                        elapsed = a_timer.elapsed() #elapsed time in seconds
-                        LOG.critical("\n== Processed %d emails in %s. %d left to be stored (time estimate %s).==\n" % \
-                                     (nb_msgs_processed,  \
-                                      a_timer.seconds_to_human_time(elapsed), left_emails, \
-                                      a_timer.estimate_time_left(nb_msgs_processed, elapsed, left_emails)))
-                    
-                    # save id every 10 restored emails
-                    if (nb_msgs_processed % 10) == 0:
-                        if gid:
-                            self.save_lastid(last_id_file, gid, eml_date, imap_req)
+                    #indicate periodically the number of messages left to process
+                    progress.update()
                 else:
                     LOG.info("Could not process message with id %s. Ignore it\n" % (the_id))
                     self.error_report['empty'].append((the_id, gid if gid else None))
-                    
-            to_fetch -= set(new_data.keys()) #remove all found keys from to_fetch set
+                    failed.add(the_id)
                 
-        for the_id in to_fetch:
+        for the_id in batch_fetcher.unreturned_ids():
             # case when gmail IMAP server returns OK without any data whatsoever
             # eg. imap uid 142221L ignore it
             LOG.info("Could not process imap with id %s. Ignore it\n" % (the_id))
             self.error_report['empty'].append((the_id, None))
+
+        if save_progress and first_id is not None:
+            save_done(last_ids[0])
         
         return imap_ids
 
-    def _sync_emails(self, imap_req, compress, restart):
+    def _sync_emails(self, imap_req, compress, restart, newest_first = False):
         """
            sync emails
         """
@@ -585,7 +1025,7 @@ class GMVaulter(object):
         #select all mail folder using the constant name defined in GIMAPFetcher
         self.src.select_folder('ALLMAIL')
 
-        imap_ids = self._common_sync(timer, "email", imap_req, compress, restart)
+        imap_ids = self._common_sync(timer, "email", imap_req, compress, restart, newest_first = newest_first)
 
         LOG.critical("\nEmails synchronisation operation performed in %s.\n" % (timer.seconds_to_human_time(timer.elapsed())))
 
@@ -595,9 +1035,10 @@ class GMVaulter(object):
 
     def sync(self, imap_req, compress_on_disk = True, \
              db_cleaning = False, ownership_checking = True, \
-            restart = False, emails_only = False, chats_only = False):
+            restart = False, emails_only = False, chats_only = False, newest_first = False):
         """
            sync mode 
+           newest_first: sync the most recent messages first
         """
         #check ownership to have one email per db unless user wants different
         #save the owner if new
@@ -619,19 +1060,26 @@ class GMVaulter(object):
         now = datetime.datetime.now()
         LOG.critical("Start synchronization (%s).\n" % (now.strftime('%Y-%m-%dT%Hh%Mm%Ss')))
         
+        phases = []
         if not chats_only:
             # backup emails
             LOG.critical("Start emails synchronization.")
-            self._sync_emails(imap_req, compress = compress_on_disk, restart = restart)
+            phases.append(('emails', lambda vaulter: vaulter._sync_emails(imap_req, compress = compress_on_disk, \
+                                                                          restart = restart, \
+                                                                          newest_first = newest_first))) #pylint:disable=W0212
         else:
             LOG.critical("Skip emails synchronization.\n")
         
         if not emails_only:
             # backup chats
             LOG.critical("Start chats synchronization.")
-            self._sync_chats(imap_req, compress = compress_on_disk, restart = restart)
+            phases.append(('chats', lambda vaulter: vaulter._sync_chats(imap_req, compress = compress_on_disk, \
+                                                                        restart = restart, \
+                                                                        newest_first = newest_first))) #pylint:disable=W0212
         else:
             LOG.critical("\nSkip chats synchronization.\n")
+
+        nb_reconns = self._run_phases(phases, 'stored')
         
         #delete supress emails from DB since last sync
         self.check_clean_db(db_cleaning)
@@ -641,16 +1089,174 @@ class GMVaulter(object):
         self.error_report["operation_time"] = self.timer.seconds_to_human_time(self.timer.elapsed())
         
         #update number of reconnections
-        self.error_report["reconnections"] = self.src.total_nb_reconns
+        self.error_report["reconnections"] = self.src.total_nb_reconns + nb_reconns
+        
+        self.save_metrics('sync')
         
         return self.error_report
 
+    def watch(self, compress_on_disk = True, db_cleaning = False, emails_only = False, chats_only = False, \
+              stop_event = None): #pylint:disable=R0913
+        """
+           Continuous backup: stay connected to All Mail and Chats (one connection each) in IMAP IDLE
+           and sync the new or changed messages when the server notifies a change.
+           Everything is reconciled with a full sync every Sync.watch_reconcile_interval seconds,
+           and after a lost connection.
+           Run until stop_event is set, Ctrl-C or an error (raised).
+        """
+        stop_event = stop_event if stop_event is not None else threading.Event()
+
+        phases = []
+        if not chats_only:
+            phases.append(('emails', lambda vaulter: vaulter._watch_folder('email', compress_on_disk, \
+                                                                           db_cleaning, stop_event))) #pylint:disable=W0212
+        if not emails_only:
+            phases.append(('chats', lambda vaulter: vaulter._watch_folder('chat', compress_on_disk, \
+                                                                          db_cleaning, stop_event))) #pylint:disable=W0212
+
+        LOG.critical("Watch the changes in Gmail. Press Ctrl-C to stop.\n")
+        try:
+            self.error_report["reconnections"] += self._run_phases(phases, None, concurrent = True)
+        except KeyboardInterrupt:
+            LOG.critical("\nStop watching the changes in Gmail.\n")
+
+        self.save_metrics('watch')
+
+        return self.error_report
+
+    def _watch_folder(self, a_type, compress, db_cleaning, stop_event): #pylint:disable=R0912,R0915
+        """
+           Watch All Mail (email) or Chats (chat) until stop_event is set.
+           The changed messages are found with CONDSTORE: the ones with a MODSEQ greater than
+           the HIGHESTMODSEQ seen before the notification.
+           When the connection is lost, wait (backoff), reconnect and reconcile. Any other error
+           sets stop_event (the other folder stops too) and is raised.
+        """
+        conf = gmvault_utils.get_conf_defaults()
+        idle_timeout       = conf.getint("Sync", "watch_idle_timeout", 1500) # servers drop IDLE after 30 min
+        debounce           = conf.getint("Sync", "watch_debounce", 2)
+        reconcile_interval = conf.getint("Sync", "watch_reconcile_interval", 3600)
+        clean_interval     = conf.getint("Sync", "watch_clean_interval", 600)
+
+        if a_type == "chat" and not self.src.is_visible('CHATS'):
+            return
+
+        self.src.select_folder('ALLMAIL' if a_type == "email" else 'CHATS')
+        status         = self.src.get_folder_status()
+        last_reconcile = last_clean = time.time()
+        clean_pending  = notified = False
+        backoff        = retry_utils.Backoff(1, 2, conf.getint("General", "retry_max_sleep", 60))
+        connected      = True
+
+        try:
+            while not stop_event.is_set():
+                try:
+                    if not connected:
+                        LOG.critical("Reconnect to watch the %ss." % (a_type))
+                        self.src.connect(go_to_current_folder = True)
+                        status, last_reconcile, connected = self.src.get_folder_status(), 0, True
+                        backoff.reset()
+
+                    now = time.time()
+                    if now - last_reconcile >= reconcile_interval:
+                        LOG.critical("Reconcile the %ss with Gmail." % (a_type))
+                        status = self.src.get_folder_status()
+                        self._watch_sync(a_type, compress, None)
+                        if db_cleaning:
+                            self._clean_folder(a_type)
+                            clean_pending, last_clean = False, time.time()
+                        last_reconcile, notified = time.time(), False
+                        continue
+
+                    if clean_pending and now - last_clean >= clean_interval:
+                        self._clean_folder(a_type)
+                        clean_pending, last_clean = False, time.time()
+
+                    # check the folder before (re)entering IDLE: the changes made while we were
+                    # not in IDLE are not notified
+                    new_status = self.src.get_folder_status()
+                    if new_status is None or status is None or new_status[0] != status[0]:
+                        if new_status != status or notified:
+                            # no CONDSTORE or UIDVALIDITY changed: reconcile everything
+                            last_reconcile = 0
+                            continue
+                    elif new_status[1] != status[1]:
+                        self._watch_sync(a_type, compress, \
+                                         self.src.search({'type': 'imap', 'req': 'MODSEQ %d' % (status[1] + 1)}))
+                        status = new_status
+                        continue
+
+                    timeout = min(idle_timeout, max(1, last_reconcile + reconcile_interval - now))
+                    if clean_pending:
+                        timeout = min(timeout, max(1, last_clean + clean_interval - now))
+                    changes  = self.src.idle_wait(timeout, debounce, stop_event)
+                    notified = bool(changes)
+                    if changes:
+                        LOG.debug("{} notifications received in IDLE.", len(changes))
+                        if db_cleaning and any(change[1] == b'EXPUNGE' for change in changes):
+                            clean_pending = True
+                except WATCH_OUTAGE_ERRORS as err:
+                    delay = err.retry_in if isinstance(err, retry_utils.CircuitOpenError) else backoff.next_delay()
+                    LOG.critical("Lost the connection while watching the %ss (%s). Resume in %.1f second(s)." \
+                                 % (a_type, err, delay))
+                    self.metrics.inc('watch_outages')
+                    self.src.disconnect()
+                    connected = False
+                    stop_event.wait(delay)
+        finally:
+            stop_event.set() # an error or Ctrl-C in one folder stops the other one
+
+    def _watch_sync(self, a_type, compress, imap_ids):
+        """
+           Sync imap_ids (all the messages if None) of the selected folder
+        """
+        timer = gmvault_utils.Timer()
+        timer.start()
+        if imap_ids is None:
+            self._common_sync(timer, a_type, {'type': 'imap', 'req': 'ALL'}, compress, False)
+        elif imap_ids:
+            LOG.critical("%d new or changed %ss in Gmail." % (len(imap_ids), a_type))
+            self._common_sync(timer, a_type, None, compress, False, imap_ids = imap_ids)
+        try:
+            self.gstorer.label_dict.save()
+        except (IOError, OSError) as err:
+            # the .meta files have the names: keep watching, the next save will write them
+            LOG.info("Cannot save the label dictionary: %s" % (err))
+
+    def _clean_folder(self, a_type):
+        """
+           Remove from the db the messages of the selected folder deleted in Gmail
+        """
+        if len(self.gstorer.get_db_owners()) > 1:
+            return
+        db_gmail_ids_info = self.gstorer.get_all_existing_gmail_ids() if a_type == "email" \
+                            else self.gstorer.get_all_chats_gmail_ids()
+        self._delete_sync(self.src.search(imap_utils.GIMAPFetcher.IMAP_ALL), db_gmail_ids_info, a_type)
+
+    def save_metrics(self, operation):
+        """
+           Write the metrics summary of the run (and the new labels and quota state) in the .info dir and return its path
+        """
+        self.src.pacer.save()
+        self.metrics.set_label('operation', operation)
+        for key in ('empty', 'cannot_be_fetched', 'emails_in_quarantine', 'key_error'):
+            self.metrics.set_counter('errors_%s' % (key), len(self.error_report.get(key, [])))
+
+        path = '%s/%s_%s' % (self.gstorer.get_info_dir(), self.login, self.METRICS_SUMMARY % (operation))
+        try:
+            self.gstorer.label_dict.save()
+            self.metrics.save_json(path)
+        except (IOError, OSError) as err:
+            LOG.info("Cannot save the metrics summary in %s: %s" % (path, err))
+            return None
+        LOG.debug("Metrics summary saved in %s." % (path))
+        return path
     
-    def _delete_sync(self, imap_ids, db_gmail_ids, db_gmail_ids_info, msg_type):
+    def _delete_sync(self, imap_ids, db_gmail_ids_info, msg_type):
         """
            Delete emails or chats from the database if necessary
            imap_ids      : all remote imap_ids to check
-           db_gmail_ids_info : info read from metadata
+           db_gmail_ids_info : GmailIdIndex read from the metadata
            msg_type : email or chat
         """
         
@@ -660,27 +1266,34 @@ class GMVaulter(object):
         LOG.critical("Call Gmail to check the stored %ss against the Gmail %ss ids and see which ones have been deleted.\n\n"\
                      "This might take a few minutes ...\n" % (msg_type, msg_type)) 
          
+        # one byte per db id (instead of a set of the ids): 1 if still in Gmail
+        on_server = bytearray(len(db_gmail_ids_info))
+        nb_left   = len(db_gmail_ids_info)
+        
         #calculate the list elements to delete
         #query nb_items items in one query to minimise number of imap queries
         for group_imap_id in itertools.zip_longest(fillvalue=None, *[iter(imap_ids)]*nb_items):
             
+            if nb_left == 0:
+                break
+            
             # if None in list remove it
             if None in group_imap_id: 
                 group_imap_id = [ im_id for im_id in group_imap_id if im_id != None ]
             
             data = self.src.fetch(group_imap_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID)
             
-            # syntax for 2.7 set comprehension { data[key][imap_utils.GIMAPFetcher.GMAIL_ID] for key in data }
-            # need to create a list for 2.6
-            db_gmail_ids.difference_update([data[key].get(imap_utils.GIMAPFetcher.GMAIL_ID) for key in data if data[key].get(imap_utils.GIMAPFetcher.GMAIL_ID)])
-            
-            if len(db_gmail_ids) == 0:
-                break
-        
-        LOG.critical("Will delete %s %s(s) from gmvault db.\n" % (len(db_gmail_ids), msg_type) )
-        for gm_id in db_gmail_ids:
-            LOG.critical("gm_id %s not in the Gmail server. Delete it." % (gm_id))
-            self.gstorer.delete_emails([(gm_id, db_gmail_ids_info[gm_id])], msg_type)
+            for key in data:
+                pos = db_gmail_ids_info.find(data[key].get(imap_utils.GIMAPFetcher.GMAIL_ID, -1))
+                if pos >= 0 and not on_server[pos]:
+                    on_server[pos] = 1
+                    nb_left -= 1
+        
+        LOG.critical("Will delete %s %s(s) from gmvault db.\n" % (nb_left, msg_type) )
+        for gm_id, found in zip(db_gmail_ids_info, on_server):
+            if not found:
+                LOG.critical("gm_id %s not in the Gmail server. Delete it." % (gm_id))
+                self.gstorer.delete_emails([(gm_id, db_gmail_ids_info[gm_id])], msg_type)
         
     def search_on_date(self, a_eml_date):
         """
@@ -699,6 +1312,13 @@ class GMVaulter(object):
            Get the ids that still needs to be sync
            Return a list of ids
         """
+        return imap_ids[self.get_sync_restart_position(op_type, imap_ids):]
+
+    def get_sync_restart_position(self, op_type, imap_ids):
+        """
+           Get the position in imap_ids of the last synced id
+           Return 0 to sync the complete list
+        """
         filename = self.OP_TO_FILENAME.get(op_type, None)
         
         if not filename:
@@ -709,15 +1329,13 @@ class GMVaulter(object):
         
         if not os.path.exists(filepath):
             LOG.critical("last_id.sync file %s doesn't exist.\nSync the full list of backed up emails." %(filepath))
-            return imap_ids
+            return 0
         
         json_obj = json.load(open(filepath, 'r'))
         
         last_id = json_obj['last_id']
         
-        last_id_index = -1
-        
-        new_gmail_ids = imap_ids
+        last_id_index = 0
         
         try:
             #get imap_id from stored gmail_id
@@ -728,15 +1346,69 @@ class GMVaulter(object):
             last_id_index = imap_ids.index(imap_id)
             
             LOG.critical("Restart from gmail id %s (imap id %s)." % (last_id, imap_id))
-            
-            new_gmail_ids = imap_ids[last_id_index:]   
         except Exception: #ignore any exception and try to get all ids in case of problems. pylint:disable=W0703
             #element not in keys return current set of keys
             LOG.critical("Error: Cannot restore from last restore gmail id. It is not in Gmail."\
                          " Sync the complete list of gmail ids requested from Gmail.")
         
-        return new_gmail_ids
+        return last_id_index
         
+    def get_sync_done_ranges(self, op_type, imap_ids, imap_req):
+        """
+           Get the UIDRanges of the ids synced by the previous run of the same request in the same folder.
+           A progress file from an older version (last id only) gives the ids before the last id
+        """
+        filepath = '%s/%s_%s' % (self.gstorer.get_info_dir(), self.login, self.OP_TO_FILENAME[op_type])
+
+        if not os.path.exists(filepath):
+            LOG.critical("last_id.sync file %s doesn't exist.\nSync the full list of backed up emails." %(filepath))
+            return UIDRanges()
+
+        with open(filepath, 'r') as f:
+            json_obj = json.load(f)
+
+        if 'done' not in json_obj:
+            position = self.get_sync_restart_position(op_type, imap_ids)
+            return UIDRanges([(min(imap_ids[:position]), max(imap_ids[:position]))] if position else [])
+
+        if json_obj.get('uidvalidity') != self._get_uidvalidity() or \
+           json_obj.get('req') != self._get_req_key(imap_req):
+            LOG.critical("The last sync was done with another request or the folder has been reset. "\
+                         "Sync the complete list of gmail ids requested from Gmail.")
+            return UIDRanges()
+
+        done = UIDRanges(json_obj['done'])
+        LOG.critical("Restart without the %d range(s) of imap ids already synced." % (len(done)))
+        return done
+
+    def save_sync_progress(self, op_type, gm_id, done, imap_req):
+        """
+           Save the UIDRanges of the ids synced so far (and the last gmail id for the older versions)
+        """
+        filepath = '%s/%s_%s' % (self.gstorer.get_info_dir(), self.login, self.OP_TO_FILENAME[op_type])
+
+        with open(filepath, 'w') as f:
+            json.dump({
+                'last_id'     : gm_id,
+                'uidvalidity' : self._get_uidvalidity(),
+                'req'         : self._get_req_key(imap_req),
+                'done'        : done.ranges,
+            }, f)
+
+    def _get_uidvalidity(self):
+        """
+           UIDVALIDITY of the selected folder (the imap ids of the ranges are only valid with it)
+        """
+        uidvalidity = (self.src.current_folder_info or {}).get(b'UIDVALIDITY')
+        return int(uidvalidity) if uidvalidity is not None else None
+
+    @classmethod
+    def _get_req_key(cls, imap_req):
+        """
+           Part of imap_req selecting the ids (the mode can change between a sync and its resume)
+        """
+        return [imap_req.get('type'), imap_req.get('req')] if imap_req else None
+
     def check_clean_db(self, db_cleaning):
         """
            Check and clean the database (remove file that are not anymore in Gmail)
@@ -765,9 +1437,6 @@ class GMVaulter(object):
         
             LOG.critical("Found %s email(s) in the Gmvault db.\n" % (len(db_gmail_ids_info)) )
         
-            #create a set of keys
-            db_gmail_ids = set(db_gmail_ids_info.keys())
-            
             # get all imap ids in All Mail
             self.src.select_folder('ALLMAIL') #go to all mail
             imap_ids = self.src.search(imap_utils.GIMAPFetcher.IMAP_ALL) #search all
@@ -775,7 +1444,7 @@ class GMVaulter(object):
             LOG.debug("Got %s emails imap_id(s) from the Gmail Server." % (len(imap_ids)))
             
             #delete supress emails from DB since last sync
-            self._delete_sync(imap_ids, db_gmail_ids, db_gmail_ids_info, 'email')
+            self._delete_sync(imap_ids, db_gmail_ids_info, 'email')
             
             # get all chats ids
             if self.src.is_visible('CHATS'):
@@ -787,12 +1456,10 @@ class GMVaulter(object):
                 self.src.select_folder('CHATS') #go to chats
                 chat_ids = self.src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
                 
-                db_chat_ids = set(db_gmail_ids_info.keys())
-                
                 LOG.debug("Got %s chat imap_ids from the Gmail Server." % (len(chat_ids)))
             
                 #delete supress emails from DB since last sync
-                self._delete_sync(chat_ids, db_chat_ids, db_gmail_ids_info , 'chat')
+                self._delete_sync(chat_ids, db_gmail_ids_info, 'chat')
             else:
                 LOG.critical("Chats IMAP Directory not visible on Gmail. Ignore deletion of chats.")
                 
@@ -839,7 +1506,7 @@ class GMVaulter(object):
     def get_gmails_ids_left_to_restore(self, op_type, db_gmail_ids_info):
         """
            Get the ids that still needs to be restored
-           Return a dict key = gm_id, val = directory
+           Return a GmailIdIndex (gm_id => directory) of the ids left
         """
         filename = self.OP_TO_FILENAME.get(op_type, None)
 
@@ -860,23 +1527,15 @@ class GMVaulter(object):
 
         last_id = json_obj['last_id']
 
-        last_id_index = -1
         try:
-            keys = list(db_gmail_ids_info.keys())
-            last_id_index = keys.index(last_id)
+            last_id_index = db_gmail_ids_info.index(last_id)
             LOG.critical("Restart from gmail id %s." % last_id)
         except ValueError:
             #element not in keys return current set of keys
             LOG.error("Cannot restore from last restore gmail id. It is not in the disk database.")
+            return db_gmail_ids_info
 
-        new_gmail_ids_info = collections_utils.OrderedDict()
-        if last_id_index != -1:
-            for key in list(db_gmail_ids_info.keys())[last_id_index+1:]:
-                new_gmail_ids_info[key] =  db_gmail_ids_info[key]
-        else:
-            new_gmail_ids_info = db_gmail_ids_info    
-            
-        return new_gmail_ids_info 
+        return db_gmail_ids_info.tail(last_id_index + 1)
            
     def restore(self, pivot_dir = None, extra_labels = [], \
                 restart = False, emails_only = False, chats_only = False): #pylint:disable=W0102
@@ -890,6 +1549,7 @@ class GMVaulter(object):
         now = datetime.datetime.now()
         LOG.critical("Start restoration (%s).\n" % (now.strftime('%Y-%m-%dT%Hh%Mm%Ss')))
         
+        phases = []
         if not chats_only:
             # backup emails
             LOG.critical("Start emails restoration.\n")
@@ -897,16 +1557,18 @@ class GMVaulter(object):
             if pivot_dir:
                 LOG.critical("Quick mode activated. Will only restore all emails since %s.\n" % (pivot_dir))
             
-            self.restore_emails(pivot_dir, extra_labels, restart)
+            phases.append(('emails', lambda vaulter: vaulter.restore_emails(pivot_dir, extra_labels, restart)))
         else:
             LOG.critical("Skip emails restoration.\n")
         
         if not emails_only:
             # backup chats
             LOG.critical("Start chats restoration.\n")
-            self.restore_chats(extra_labels, restart)
+            phases.append(('chats', lambda vaulter: vaulter.restore_chats(extra_labels, restart)))
         else:
             LOG.critical("Skip chats restoration.\n")
+
+        nb_reconns = self._run_phases(phases, 'restored')
         
         LOG.debug("Restore operation performed in %s.\n" \
                      % (self.timer.seconds_to_human_time(self.timer.elapsed())))
@@ -914,7 +1576,9 @@ class GMVaulter(object):
         self.error_report["operation_time"] = self.timer.seconds_to_human_time(self.timer.elapsed())
         
         #update number of reconnections
-        self.error_report["reconnections"] = self.src.total_nb_reconns
+        self.error_report["reconnections"] = self.src.total_nb_reconns + nb_reconns
+        
+        self.save_metrics('restore')
         
         return self.error_report
        
@@ -929,7 +1593,7 @@ class GMVaulter(object):
         #get gmail_ids from db
         db_gmail_ids_info = self.gstorer.get_all_chats_gmail_ids()
         
-        LOG.critical("Total number of chats to restore %s." % (len(list(db_gmail_ids_info.keys()))))
+        LOG.critical("Total number of chats to restore %s." % (len(db_gmail_ids_info)))
         
         if restart:
             db_gmail_ids_info = self.get_gmails_ids_left_to_restore(self.OP_CHAT_RESTORE, db_gmail_ids_info)
@@ -938,10 +1602,9 @@ class GMVaulter(object):
         LOG.critical("Got all chats id left to restore. Still %s chats to do.\n" % (total_nb_emails_to_restore) )
         
         existing_labels     = set() #set of existing labels to not call create_gmail_labels all the time
-        reserved_labels_map = gmvault_utils.get_conf_defaults().get_dict("Restore", "reserved_labels_map", \
-                              { 'migrated' : 'gmv-migrated', '\muted' : 'gmv-muted' })
-        nb_emails_restored  = 0  #to count nb of emails restored
         labels_to_apply     = collections_utils.SetMultimap()
+        # restore name => utf7 name, the extra labels are encoded once
+        imap_names          = { label : imap_utils.utf7_encode(label) for label in extra_labels }
 
         #get all mail folder name
         all_mail_name = self.src.get_folder_name("ALLMAIL")
@@ -952,6 +1615,7 @@ class GMVaulter(object):
         
         timer = gmvault_utils.Timer() # local timer for restore emails
         timer.start()
+        progress = self._progress_logger(timer, total_nb_emails_to_restore, 'chats', 'restored')
         
         nb_items = gmvault_utils.get_conf_defaults().get_int("General", "nb_messages_per_restore_batch", 100) 
         
@@ -963,33 +1627,28 @@ class GMVaulter(object):
            
             labels_to_create    = set(extra_labels) #create label set, add xtra labels in set
             
-            LOG.critical("Processing next batch of %s chats.\n" % (nb_items))
+            LOG.debug("Processing next batch of {} chats.\n", nb_items)
             
             # unbury the metadata for all these emails
             for gm_id in group_imap_ids:    
                 try:
                     email_meta, email_data = self.gstorer.unbury_email(gm_id)
                     
-                    LOG.critical("Pushing chat content with id %s." % (gm_id))
-                    LOG.debug("Subject = %s." % (email_meta[self.gstorer.SUBJECT_K]))
+                    LOG.debug("Pushing chat content with id {}.", gm_id)
+                    LOG.debug("Subject = {}.", email_meta.subject)
                     
                     # push data in gmail account and get uids
                     imap_id = self.src.push_data(all_mail_name, email_data, \
-                                    email_meta[self.gstorer.FLAGS_K] , \
-                                    email_meta[self.gstorer.INT_DATE_K] )      
+                                    email_meta.flags, email_meta.internal_datetime())
                 
-                    #labels for this email => real_labels U extra_labels
-                    labels = set(email_meta[self.gstorer.LABELS_K])
-                    
                     # add in the labels_to_create struct
-                    for label in labels:
-                        LOG.debug("label = %s\n" % (label))
-                        if label.lower() in list(reserved_labels_map.keys()): #exclude creation of migrated label
-                            n_label = reserved_labels_map.get(label.lower(), "gmv-default-label")
+                    for entry in email_meta.label_entries():
+                        LOG.debug("label = {}\n", entry.name)
+                        if entry.reserved(): #exclude creation of migrated label
                             LOG.info("Apply label '%s' instead of '%s' (lower or uppercase)"\
-                                     " because it is a Gmail reserved label." % (n_label, label))
-                            label = n_label
-                        labels_to_apply[str(label)] = imap_id #add in multimap
+                                     " because it is a Gmail reserved label." % (entry.restore_name, entry.name))
+                        labels_to_apply[entry.restore_name] = imap_id #add in multimap
+                        imap_names[entry.restore_name] = entry.imap_name
             
                     # get list of labels to create (do a union with labels to create)
                     #labels_to_create.update([ label for label in labels if label not in existing_labels]) 
@@ -1013,7 +1672,7 @@ class GMVaulter(object):
                 LOG.debug("Changing directory. Going into ALLMAIL")
                 self.src.select_folder('ALLMAIL') #go to ALL MAIL to make STORE usable
                 for label in list(labels_to_apply.keys()):
-                    self.src.apply_labels_to(labels_to_apply[label], [label]) 
+                    self.src.apply_labels_to(labels_to_apply[label], [imap_names[label]], utf7_encoded = True)
             except Exception as err:
                 LOG.error("Problem when applying labels %s to the following ids: %s" %(label, labels_to_apply[label]), err)
                 if isinstance(err, imap_utils.LabelError) and err.ignore() == True:
@@ -1031,17 +1690,8 @@ class GMVaulter(object):
                 self.src.select_folder(folder_def_location) # go back to an empty DIR (Drafts) to be fast
                 labels_to_apply = collections_utils.SetMultimap() #reset label to apply
             
-            nb_emails_restored += nb_items
-                
-            #indicate every 10 messages the number of messages left to process
-            left_emails = (total_nb_emails_to_restore - nb_emails_restored)
-            
-            if (left_emails > 0): 
-                elapsed = timer.elapsed() #elapsed time in seconds
-                LOG.critical("\n== Processed %d chats in %s. %d left to be restored "\
-                             "(time estimate %s).==\n" % \
-                             (nb_emails_restored, timer.seconds_to_human_time(elapsed), \
-                              left_emails, timer.estimate_time_left(nb_emails_restored, elapsed, left_emails)))
+            #indicate periodically the number of messages left to process
+            progress.update(nb_items)
             
             # save id every nb_items restored emails
             # add the last treated gm_id
@@ -1065,7 +1715,7 @@ class GMVaulter(object):
         #get gmail_ids from db
         db_gmail_ids_info = self.gstorer.get_all_existing_gmail_ids(pivot_dir)
         
-        LOG.critical("Total number of elements to restore %s." % (len(list(db_gmail_ids_info.keys()))))
+        LOG.critical("Total number of elements to restore %s." % (len(db_gmail_ids_info)))
         
         if restart:
             db_gmail_ids_info = self.get_gmails_ids_left_to_restore(self.OP_EMAIL_RESTORE, db_gmail_ids_info)
@@ -1075,9 +1725,9 @@ class GMVaulter(object):
         LOG.critical("Got all emails id left to restore. Still %s emails to do.\n" % (total_nb_emails_to_restore) )
         
         existing_labels     = set() #set of existing labels to not call create_gmail_labels all the time
-        reserved_labels_map = gmvault_utils.get_conf_defaults().get_dict("Restore", "reserved_labels_map", { 'migrated' : 'gmv-migrated', '\muted' : 'gmv-muted' })
-        nb_emails_restored  = 0  #to count nb of emails restored
         labels_to_apply     = collections_utils.SetMultimap()
+        # restore name => utf7 name, the extra labels are encoded once
+        imap_names          = { label : imap_utils.utf7_encode(label) for label in extra_labels }
 
         #get all mail folder name
         all_mail_name = self.src.get_folder_name("ALLMAIL")
@@ -1088,6 +1738,7 @@ class GMVaulter(object):
         
         timer = gmvault_utils.Timer() # local timer for restore emails
         timer.start()
+        progress = self._progress_logger(timer, total_nb_emails_to_restore, 'emails', 'restored')
         
         nb_items = gmvault_utils.get_conf_defaults().get_int("General", "nb_messages_per_restore_batch", 80) 
         
@@ -1099,38 +1750,32 @@ class GMVaulter(object):
            
             labels_to_create    = set(extra_labels) #create label set and add extra labels to apply to all emails
             
-            LOG.critical("Processing next batch of %s emails.\n" % (nb_items))
+            LOG.debug("Processing next batch of {} emails.\n", nb_items)
             
             # unbury the metadata for all these emails
             for gm_id in group_imap_ids:    
                 try:
 
-                    LOG.debug("Unbury email with gm_id %s." % (gm_id))
+                    LOG.debug("Unbury email with gm_id {}.", gm_id)
 
                     email_meta, email_data = self.gstorer.unbury_email(gm_id)
                     
-                    LOG.critical("Pushing email body with id %s." % (gm_id))
-                    LOG.debug("Subject = %s." % (email_meta[self.gstorer.SUBJECT_K]))
+                    LOG.debug("Pushing email body with id {}.", gm_id)
+                    LOG.debug("Subject = {}.", email_meta.subject)
                     
                     # push data in gmail account and get uids
                     imap_id = self.src.push_data(all_mail_name, email_data, \
-                                    email_meta[self.gstorer.FLAGS_K] , \
-                                    email_meta[self.gstorer.INT_DATE_K] )      
+                                    email_meta.flags, email_meta.internal_datetime())
                 
-                    #labels for this email => real_labels U extra_labels
-                    labels = set(email_meta[self.gstorer.LABELS_K])
-
                     # add in the labels_to_create struct
-                    for label in labels:
-                        if label != "\\Starred":
-                            #LOG.debug("label = %s\n" % (label.encode('utf-8')))
-                            LOG.debug("label = %s\n" % (label))
-                            if label.lower() in list(reserved_labels_map.keys()): #exclude creation of migrated label
-                                n_label = reserved_labels_map.get(label.lower(), "gmv-default-label")
+                    for entry in email_meta.label_entries():
+                        if entry.name != "\\Starred":
+                            LOG.debug("label = {}\n", entry.name)
+                            if entry.reserved(): #exclude creation of migrated label
                                 LOG.info("Apply label '%s' instead of '%s' (lower or uppercase)"\
-                                 " because it is a Gmail reserved label." % (n_label, label)) 
-                                label = n_label
-                            labels_to_apply[label] = imap_id #add item in multimap
+                                 " because it is a Gmail reserved label." % (entry.restore_name, entry.name)) 
+                            labels_to_apply[entry.restore_name] = imap_id #add item in multimap
+                            imap_names[entry.restore_name] = entry.imap_name
             
                     # get list of labels to create (do a union with labels to create)
                     #labels_to_create.update([ label for label in labels if label not in existing_labels]) 
@@ -1157,7 +1802,7 @@ class GMVaulter(object):
                 self.src.select_folder('ALLMAIL') #go to ALL MAIL to make STORE usable
                 LOG.debug("Changed dir. Operation time = %s ms" % (the_timer.elapsed_ms()))
                 for label in list(labels_to_apply.keys()):
-                    self.src.apply_labels_to(labels_to_apply[label], [label]) 
+                    self.src.apply_labels_to(labels_to_apply[label], [imap_names[label]], utf7_encoded = True)
             except Exception as err:
                 LOG.error("Problem when applying labels %s to the following ids: %s" %(label, labels_to_apply[label]), err)
                 if isinstance(err, imap_utils.LabelError) and err.ignore() == True:
@@ -1175,17 +1820,8 @@ class GMVaulter(object):
                 self.src.select_folder(folder_def_location) # go back to an empty DIR (Drafts) to be fast
                 labels_to_apply = collections_utils.SetMultimap() #reset label to apply
             
-            nb_emails_restored += nb_items
-                
-            #indicate every 10 messages the number of messages left to process
-            left_emails = (total_nb_emails_to_restore - nb_emails_restored)
-            
-            if (left_emails > 0): 
-                elapsed = timer.elapsed() #elapsed time in seconds
-                LOG.critical("\n== Processed %d emails in %s. %d left to be restored "\
-                             "(time estimate %s). ==\n" % \
-                             (nb_emails_restored, timer.seconds_to_human_time(elapsed), \
-                              left_emails, timer.estimate_time_left(nb_emails_restored, elapsed, left_emails)))
+            #indicate periodically the number of messages left to process
+            progress.update(nb_items)
             
             # save id every 50 restored emails
             # add the last treated gm_id
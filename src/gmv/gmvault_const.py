@@ -39,6 +39,19 @@ DEFAULT_CONF_FILE = """#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 [Sync]
 quick_days=10
+#cache the search results in the gmvault-db .info dir (requires CONDSTORE)
+search_cache=True
+search_cache_size=10
+#first fetch only the flags and labels of all messages (light batches),
+#then the headers and bodies of the ones that are not in the db
+light_fetch=True
+nb_messages_per_light_batch=2000
+#sync --watch: IDLE timeout, seconds to group the notifications,
+#seconds between two full reconciliations and two removals of the deleted messages
+watch_idle_timeout=1500
+watch_debounce=2
+watch_reconcile_interval=3600
+watch_clean_interval=600
 
 [Restore]
 # it is 10 days but currently it will always be the current month or the last 2 months
@@ -50,10 +63,58 @@ reserved_labels_map = { u'migrated' : u'gmv-migrated', u'\muted' : u'gmv-muted'
 limit_per_chat_dir=2000
 errors_if_chat_not_visible=False
 nb_messages_per_batch=500
+#the batch size adapts itself within these limits
+max_messages_per_batch=2000
+max_bytes_per_batch=8388608
+#sync or restore the emails and the chats at the same time (one more IMAP connection)
+concurrent_phases=True
 nb_messages_per_restore_batch=80
 restore_default_location=DRAFTS
 keep_in_bin=False
+#compress the IMAP connections (COMPRESS=DEFLATE)
 enable_imap_compression=False
+#always, or auto: measure the compression ratio against the zlib CPU time and reconnect without compression when it does not pay off
+imap_compression_mode=auto
+#zlib level of the data sent (1 fastest to 9 smallest)
+imap_compression_level=1
+#nb of bytes read at once from a compressed connection
+imap_compression_read_size=65536
+#auto mode: nb of bytes transferred before deciding, and min payload/wire bytes ratio worth the CPU
+imap_compression_sample_bytes=4194304
+imap_compression_min_ratio=1.1
+#imapclient (blocking sockets) or asyncio (pipelined commands, one event loop for all the connections)
+imap_transport=imapclient
+#asyncio transport: nb of FETCH commands a sync batch is split in, sent at once (pipelined)
+nb_pipelined_fetches=4
+#nb of seconds the capabilities and folder names found at login are reused by the reconnections (0 to disable)
+session_cache_ttl=3600
+#max nb of seconds between two reconnection attempts (the waits double with a random jitter)
+retry_max_sleep=60
+#Gmail IMAP transfer quotas (MB per quota_window seconds) the fetches and appends are paced against (0: no limit)
+quota_download_mb=2500
+quota_upload_mb=500
+quota_window=86400
+#share of a quota from which the transfers slow down to the sustainable rate, and from which they pause
+quota_slowdown_ratio=0.75
+quota_pause_ratio=0.95
+#nb of seconds the transfers pause when Gmail answers that the account exceeded its limits (doubled each time)
+quota_throttle_pause=900
+#nb of consecutive connection failures with an account before failing fast
+circuit_breaker_failures=5
+#nb of seconds the calls fail fast once the circuit breaker is open
+circuit_breaker_cooldown=300
+#min nb of seconds between two progress messages
+progress_log_period=5
+#profiler started/stopped with kill -USR2 <pid>: sampling (collapsed stacks) or cprofile (pstats)
+profiler_mode=sampling
+profiler_sample_interval=0.01
+
+[Daemon]
+#first and max nb of seconds before retrying a failed sync (doubled after each failure)
+backoff=60
+max_backoff=3600
+#max nb of seconds between two checks of the accounts to sync
+poll_interval=30
 
 [Localisation]
 #example with Russian
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the daemon mode: one long running process syncing several accounts.
+
+The accounts are read from a JSON file:
+
+    { "max_connections" : 4,
+      "max_bandwidth"   : 5000000,
+      "accounts" : [
+         { "email" : "foo@gmail.com", "db_dir" : "/backup/foo", "interval" : 3600, "type" : "quick" },
+         { "email" : "bar@gmail.com", "db_dir" : "/backup/bar", "interval" : 86400, "auth" : "passwd" }
+      ] }
+
+The scheduler runs the due syncs in worker threads. max_connections bounds the number of
+simultaneous syncs (one IMAP connection each: the email and chat phases of a daemon sync run one
+after the other) and max_bandwidth (bytes/s) is shared by all of them. A failed sync is retried with an exponential backoff instead of waiting for its interval.
+
+'''
+import json
+import threading
+import time
+
+import http.server
+
+import gmv.log_utils as log_utils
+import gmv.gmvault_utils as gmvault_utils
+import gmv.metrics_utils as metrics_utils
+
+LOG = log_utils.LoggerFactory.get_logger('gmvault_daemon')
+
+class DaemonError(Exception):
+    """ Error in the daemon configuration """
+    pass
+
+class TokenBucket(object):
+    """
+       Bandwidth budget shared by threads. consume() sleeps when the budget is exhausted
+    """
+    def __init__(self, rate, capacity = None):
+        """
+           rate: bytes per second, capacity: max burst (one second of traffic by default)
+        """
+        self.rate     = float(rate)
+        self.capacity = float(capacity if capacity else rate)
+        self._tokens  = self.capacity
+        self._last    = time.monotonic()
+        self._lock    = threading.Lock()
+
+    def consume(self, nb_bytes):
+        """
+           take nb_bytes from the budget and wait until the debt is paid back.
+           Return the nb of seconds waited
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last   = now
+            self._tokens -= nb_bytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class BudgetedMetrics(metrics_utils.MetricsRegistry):
+    """
+       Metrics registry charging the transferred bytes to a TokenBucket
+    """
+    BUDGETED_COUNTERS = ('bytes_in', 'bytes_out')
+
+    def __init__(self, bucket, **labels):
+        super(BudgetedMetrics, self).__init__(**labels)
+        self.bucket = bucket
+
+    def inc(self, name, value = 1):
+        """ increment the counter name and consume the bandwidth budget """
+        super(BudgetedMetrics, self).inc(name, value)
+        if self.bucket and name in self.BUDGETED_COUNTERS:
+            waited = self.bucket.consume(value)
+            if waited:
+                self.observe('bandwidth_wait', waited)
+
+class AccountJob(object):
+    """
+       Periodic sync of one account
+    """
+    DEFAULT_INTERVAL = 3600
+    OPTIONS          = ('emails_only', 'chats_only', 'db_cleaning', 'encrypt', 'compression', 'ownership_control', \
+                        'newest_first')
+
+    def __init__(self, email, db_dir, interval = DEFAULT_INTERVAL, sync_type = 'quick', auth = 'oauth2', \
+                 host = 'imap.gmail.com', port = 993, **options): #pylint:disable=R0913
+        """
+           options: emails_only, chats_only, db_cleaning, encrypt, compression, ownership_control, newest_first
+        """
+        if sync_type not in ('full', 'quick'):
+            raise DaemonError("%s: unknown sync type %s. Use full or quick." % (email, sync_type))
+        if auth not in ('oauth2', 'passwd'):
+            raise DaemonError("%s: unknown auth %s. Use oauth2 or passwd." % (email, auth))
+        unknown = set(options) - set(self.OPTIONS)
+        if unknown:
+            raise DaemonError("%s: unknown option(s) %s." % (email, ', '.join(sorted(unknown))))
+
+        self.email     = email
+        self.db_dir    = db_dir
+        self.interval  = interval
+        self.sync_type = sync_type
+        self.auth      = auth
+        self.host      = host
+        self.port      = int(port)
+        self.options   = options
+
+        self.next_run      = 0 # first run asap
+        self.running       = False
+        self.nb_runs       = 0
+        self.nb_failures   = 0 # consecutive failures
+        self.last_status   = None
+        self.last_error    = None
+        self.last_start    = None
+        self.last_duration = None
+        self.last_metrics  = None
+
+    @classmethod
+    def from_dict(cls, a_dict):
+        """ create a job from one entry of the accounts file """
+        params = dict(a_dict)
+        try:
+            email, db_dir = params.pop('email'), params.pop('db_dir')
+        except KeyError as err:
+            raise DaemonError("Account %s has no %s." % (a_dict, err))
+        if 'type' in params:
+            params['sync_type'] = params.pop('type')
+        return cls(email, db_dir, **params)
+
+    def sync_args(self):
+        """ args dict in the format of the sync command line """
+        return { 'command'           : 'sync',
+                 'email'             : self.email,
+                 'db-dir'            : self.db_dir,
+                 'host'              : self.host,
+                 'port'              : self.port,
+                 'type'              : self.sync_type,
+                 'restart'           : False,
+                 'emails_only'       : self.options.get('emails_only', False),
+                 'chats_only'        : self.options.get('chats_only', False),
+                 'db-cleaning'       : self.options.get('db_cleaning', True),
+                 'encrypt'           : self.options.get('encrypt', False),
+                 'compression'       : self.options.get('compression', True),
+                 'ownership_control' : self.options.get('ownership_control', True),
+                 'newest_first'      : self.options.get('newest_first', False),
+                 # the emails and chats one after the other: one IMAP connection per sync (max_connections)
+                 'concurrent_phases' : False }
+
+    def started(self, now):
+        """ the job is launched """
+        self.running, self.last_start = True, now
+
+    def succeeded(self, now, metrics = None):
+        """ schedule the next run after interval """
+        self.running, self.nb_runs, self.nb_failures = False, self.nb_runs + 1, 0
+        self.last_status, self.last_error = 'ok', None
+        self.last_duration = now - self.last_start
+        self.last_metrics  = metrics.summary() if metrics else None
+        self.next_run      = self.last_start + self.interval
+
+    def failed(self, now, error, backoff, max_backoff):
+        """ retry after an exponential backoff (never later than the normal interval) """
+        self.running, self.nb_runs, self.nb_failures = False, self.nb_runs + 1, self.nb_failures + 1
+        self.last_status, self.last_error = 'error', str(error)
+        self.last_duration = now - self.last_start
+        delay = min(backoff * (2 ** (self.nb_failures - 1)), max_backoff, self.interval)
+        self.next_run = now + delay
+        return delay
+
+    def status(self):
+        """ dict status """
+        return { 'email'         : self.email,
+                 'db_dir'        : self.db_dir,
+                 'type'          : self.sync_type,
+                 'interval'      : self.interval,
+                 'running'       : self.running,
+                 'next_run'      : self.next_run,
+                 'nb_runs'       : self.nb_runs,
+                 'nb_failures'   : self.nb_failures,
+                 'last_status'   : self.last_status,
+                 'last_error'    : self.last_error,
+                 'last_start'    : self.last_start,
+                 'last_duration' : self.last_duration,
+                 'last_metrics'  : self.last_metrics }
+
+def load_accounts_file(path):
+    """
+       Read the JSON accounts file. Return (jobs, settings)
+    """
+    try:
+        with open(path) as the_file:
+            content = json.load(the_file)
+    except (IOError, OSError, ValueError) as err:
+        raise DaemonError("Cannot read the accounts file %s: %s" % (path, err))
+
+    accounts = content.get('accounts') if isinstance(content, dict) else None
+    if not accounts:
+        raise DaemonError("No accounts defined in %s." % (path))
+
+    jobs = [ AccountJob.from_dict(account) for account in accounts ]
+    seen = set()
+    for job in jobs:
+        if job.db_dir in seen:
+            raise DaemonError("The gmvault-db %s is used by several accounts." % (job.db_dir))
+        seen.add(job.db_dir)
+
+    settings = dict((key, val) for key, val in content.items() if key != 'accounts')
+    return jobs, settings
+
+class SyncScheduler(object):
+    """
+       Run the account jobs under a global connection and bandwidth budget
+    """
+    def __init__(self, jobs, sync_fn, credential_fn, max_connections = 2, max_bandwidth = None, \
+                 backoff = 60, max_backoff = 3600): #pylint:disable=R0913
+        """
+           sync_fn(job, credential, metrics): perform the sync
+           credential_fn(job): return the credential of job (non interactive)
+           max_connections: max nb of simultaneous syncs
+           max_bandwidth: bytes/s shared by all the syncs (None for no limit)
+           backoff, max_backoff: first and max delay before retrying a failed job
+        """
+        self.jobs            = list(jobs)
+        self.sync_fn         = sync_fn
+        self.credential_fn   = credential_fn
+        self.max_connections = max_connections
+        self.bucket          = TokenBucket(max_bandwidth) if max_bandwidth else None
+        self.backoff         = backoff
+        self.max_backoff     = max_backoff
+        self.start_time      = time.time()
+
+        self._slots      = threading.BoundedSemaphore(max_connections)
+        self._stop_event = threading.Event()
+        self._wakeup     = threading.Event()
+        self._threads    = []
+
+    def run_pending(self):
+        """
+           launch the due jobs while there are free connections. Return the launched jobs
+        """
+        now      = time.time()
+        launched = []
+        for job in sorted((job for job in self.jobs if not job.running and job.next_run <= now), \
+                          key = lambda a_job: a_job.next_run):
+            if not self._slots.acquire(False):
+                break
+            job.started(now)
+            thread = threading.Thread(target = self._run_job, args = (job,), name = 'gmvault-sync-%s' % (job.email))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+            launched.append(job)
+        self._threads = [ thread for thread in self._threads if thread.is_alive() ]
+        return launched
+
+    def _run_job(self, job):
+        """ worker thread """
+        LOG.critical("Start sync of %s in %s." % (job.email, job.db_dir))
+        try:
+            metrics = BudgetedMetrics(self.bucket, operation = 'sync', login = job.email)
+            try:
+                credential = self.credential_fn(job)
+                self.sync_fn(job, credential, metrics)
+            except Exception as err: #pylint:disable=W0703
+                delay = job.failed(time.time(), err, self.backoff, self.max_backoff)
+                LOG.critical("Sync of %s failed (%s). Retry in %d sec." % (job.email, err, delay))
+                LOG.debug(gmvault_utils.get_exception_traceback())
+            else:
+                job.succeeded(time.time(), metrics)
+                LOG.critical("Sync of %s done in %.1f sec. Next one in %d sec." \
+                             % (job.email, job.last_duration, max(job.next_run - time.time(), 0)))
+        finally:
+            self._slots.release()
+            self._wakeup.set()
+
+    def next_wakeup(self):
+        """ nb of seconds until the next due job """
+        waiting = [ job.next_run for job in self.jobs if not job.running ]
+        return max(min(waiting) - time.time(), 0) if waiting else None
+
+    def run_forever(self, poll = 30):
+        """
+           schedule the jobs until stop() is called
+        """
+        LOG.critical("Gmvault daemon started for %d account(s) (max %d simultaneous syncs)." \
+                     % (len(self.jobs), self.max_connections))
+        while not self._stop_event.is_set():
+            self._wakeup.clear()
+            self.run_pending()
+            next_wakeup = self.next_wakeup()
+            self._wakeup.wait(poll if next_wakeup is None else min(next_wakeup, poll))
+        self.wait()
+        LOG.critical("Gmvault daemon stopped.")
+
+    def stop(self):
+        """ stop scheduling new jobs (the running syncs are finished) """
+        self._stop_event.set()
+        self._wakeup.set()
+
+    def wait(self, timeout = None):
+        """ wait for the running syncs """
+        for thread in list(self._threads):
+            thread.join(timeout)
+
+    def status(self):
+        """ dict status of the daemon and its jobs """
+        return { 'start'           : self.start_time,
+                 'uptime'          : round(time.time() - self.start_time, 3),
+                 'max_connections' : self.max_connections,
+                 'max_bandwidth'   : self.bucket.rate if self.bucket else None,
+                 'running'         : len([ job for job in self.jobs if job.running ]),
+                 'accounts'        : [ job.status() for job in self.jobs ] }
+
+    def serve_status(self, port, host = '127.0.0.1'):
+        """
+           Serve the JSON status on http://host:port/status in a background thread.
+           Return the server (call shutdown() to stop it)
+        """
+        scheduler = self
+
+        class StatusHandler(http.server.BaseHTTPRequestHandler):
+            """ /status handler """
+            def do_GET(self): #pylint:disable=C0103
+                """ GET """
+                if self.path.split('?')[0] not in ('/', '/status'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(scheduler.status(), indent = 1, sort_keys = True).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): #pylint:disable=W0221
+                """ no access logs on stderr """
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), StatusHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target = server.serve_forever, name = 'gmvault-status')
+        thread.daemon = True
+        thread.start()
+        LOG.critical("Serve the daemon status on http://%s:%s/status" % (host, server.server_address[1]))
+        return server
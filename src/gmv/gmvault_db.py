@@ -18,14 +18,18 @@
 """
 from contextlib import contextmanager
 import json
+import binascii
 import gzip
 import re
 import os
 import itertools
 import fnmatch
 import shutil
+import sys
+import threading
 import codecs
 import io
+import time
 
 import gmv.blowfish as blowfish
 import gmv.log_utils as log_utils
@@ -33,6 +37,7 @@ import gmv.log_utils as log_utils
 import gmv.collections_utils as collections_utils
 import gmv.gmvault_utils as gmvault_utils
 import gmv.imap_utils as imap_utils
+import gmv.metrics_utils as metrics_utils
 import gmv.credential_utils as credential_utils
 
 LOG = log_utils.LoggerFactory.get_logger('gmvault_db')
@@ -56,13 +61,18 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
     MSGID_K      = 'msg_id'
     XGM_RECV_K   = 'x_gmail_received'
 
-    HF_MSGID_PATTERN       = r"[M,m][E,e][S,s][S,s][a,A][G,g][E,e]-[I,i][D,d]:\s+<(?P<msgid>.*)>"
-    HF_SUB_PATTERN         = r"[S,s][U,u][b,B][J,j][E,e][C,c][T,t]:\s+(?P<subject>.*)\s*"
-    HF_XGMAIL_RECV_PATTERN = r"[X,x]-[G,g][M,m][A,a][I,i][L,l]-[R,r][E,e][C,c][E,e][I,i][V,v][E,e][D,d]:\s+(?P<received>.*)\s*"
+    # single scan of the unfolded header block prefixed with a newline: one group per value (subject,
+    # message id between the first < and the last >, message id without <>, x-gmail-received).
+    # The literal newline lets the regex engine jump from line start to line start (^ would not)
+    HF_FIELDS_RE = re.compile(r"\n(?:subject[ \t]*:[ \t]*([^\r\n]*)"
+                              r"|message-id[ \t]*:(?:[^\r\n<]*<([^\r\n]*)>|[ \t]*([^\r\n]*))"
+                              r"|x-gmail-received[ \t]*:[ \t]*([^\r\n]*))", re.IGNORECASE)
 
-    HF_MSGID_RE          = re.compile(HF_MSGID_PATTERN)
-    HF_SUB_RE            = re.compile(HF_SUB_PATTERN)
-    HF_XGMAIL_RECV_RE    = re.compile(HF_XGMAIL_RECV_PATTERN)
+    # RFC 2047 encoded-word, the spaces up to an adjacent encoded-word are part of the match (ignored)
+    HF_EWORD_PATTERN = r"=\?([^?\s]+)\?([bBqQ])\?([^?\s]*)\?="
+    HF_EWORD_RE      = re.compile(r"%s(?:\s+(?=%s))?" % (HF_EWORD_PATTERN, HF_EWORD_PATTERN.replace('(', '(?:')))
+    HF_EWORD_CACHE   = {} # decoded encoded-words (mailing list prefixes, repeated subjects)
+    HF_EWORD_CACHE_SIZE = 4096
 
     ENCRYPTED_PATTERN = r"[\w+,\.]+crypt[\w,\.]*"
     ENCRYPTED_RE      = re.compile(ENCRYPTED_PATTERN)
@@ -77,16 +87,20 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
     ENCRYPTION_KEY_FILENAME    = '.storage_key.sec'
     EMAIL_OWNER                = '.owner_account.info'
     GMVAULTDB_VERSION          = '.gmvault_db_version.info'   
+    LABELS_FILENAME            = 'labels.json'
 
-    def __init__(self, a_storage_dir, encrypt_data=False):
+    def __init__(self, a_storage_dir, encrypt_data=False, metrics=None):
         """
            Store on disks
            args:
               a_storage_dir: Storage directory
               a_use_encryption: Encryption key. If there then encrypt
+              metrics: MetricsRegistry recording the disk operations
         """
         self._top_dir = a_storage_dir
 
+        self.metrics = metrics if metrics is not None else metrics_utils.MetricsRegistry()
+
         self._db_dir          = '%s/%s' % (a_storage_dir, GmailStorer.DB_AREA)
         self._quarantine_dir  = '%s/%s' % (a_storage_dir, GmailStorer.QUARANTINE_AREA)
         self._info_dir        = '%s/%s' % (a_storage_dir, GmailStorer.INFO_AREA)
@@ -111,9 +125,12 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
 
         self.fsystem_info_cache = {}
 
+        self.label_dict = LabelDictionary('%s/%s' % (self._info_dir, GmailStorer.LABELS_FILENAME))
+
         self._encrypt_data   = encrypt_data
         self._encryption_key = None
-        self._cipher         = None
+        self._key_lock       = threading.Lock()
+        self._ciphers        = threading.local() # the CTR state is per cipher: one per thread (concurrent phases)
 
         #add version if it is needed to migrate gmvault-db in the future
         self._create_gmvault_db_version()
@@ -216,18 +233,20 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
 
     def get_encryption_cipher(self):
         """
-           Return the cipher to encrypt an decrypt.
+           Return the cipher of the calling thread to encrypt an decrypt.
            If the secret key doesn't exist, it will be generated.
         """
-        if not self._cipher:
-            if not self._encryption_key:
-                self._encryption_key = credential_utils.CredentialHelper.get_secret_key('%s/%s'
-                % (self._info_dir, self.ENCRYPTION_KEY_FILENAME))
+        cipher = getattr(self._ciphers, 'cipher', None)
+        if not cipher:
+            with self._key_lock:
+                if not self._encryption_key:
+                    self._encryption_key = credential_utils.CredentialHelper.get_secret_key('%s/%s'
+                    % (self._info_dir, self.ENCRYPTION_KEY_FILENAME))
 
             #create blowfish cipher if data needs to be encrypted
-            self._cipher = blowfish.Blowfish(self._encryption_key)
+            cipher = self._ciphers.cipher = blowfish.Blowfish(self._encryption_key)
 
-        return self._cipher
+        return cipher
 
     @classmethod
     def get_encryption_key_path(cls, a_root_dir):
@@ -244,86 +263,95 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         """
         return credential_utils.CredentialHelper.get_secret_key('%s/%s' % (a_info_dir, cls.ENCRYPTION_KEY_FILENAME))
 
+    @classmethod
+    def _decode_eword(cls, matched):
+        """
+           decode one encoded-word (RFC 2047: it holds an integral number of characters)
+        """
+        charset, encoding, text = matched.groups()
+        try:
+            if encoding in 'bB':
+                data = binascii.a2b_base64(text + '=' * (-len(text) % 4))
+            else:
+                data = binascii.a2b_qp(text, header = True)
+            return data.decode(charset.split('*', 1)[0], 'replace') # drop the RFC 2231 language
+        except (LookupError, ValueError) as err: # unknown charset, bad base64 or non ascii word
+            LOG.debug("Cannot decode encoded-word {}: {}", matched.group(0), err)
+            return matched.group(0)
+
+    @classmethod
+    def _decode_cached_eword(cls, matched):
+        """
+           _decode_eword with a cache of the words already decoded
+        """
+        word    = matched.group(0)
+        decoded = cls.HF_EWORD_CACHE.get(word)
+        if decoded is None:
+            if len(cls.HF_EWORD_CACHE) >= cls.HF_EWORD_CACHE_SIZE:
+                cls.HF_EWORD_CACHE.clear()
+            decoded = cls.HF_EWORD_CACHE[word] = cls._decode_eword(matched)
+        return decoded
+
+    @classmethod
+    def decode_header_value(cls, value):
+        """
+           decode the RFC 2047 encoded-words of an unfolded header value
+        """
+        if '=?' not in value:
+            return value
+        return cls.HF_EWORD_RE.sub(cls._decode_cached_eword, value)
+
     @classmethod
     def parse_header_fields(cls, header_fields):
         """
-           extract subject and message ids from the given header fields.
-           Additionally, convert subject byte string to unicode and then encode in utf-8
+           extract subject and message ids from the given header fields (unicode string).
+           Folded values are unfolded and the subject encoded-words are decoded.
+           The first non empty value of a field wins.
         """
-        subject = None
-        msgid   = None
-        x_gmail_recv = None
+        # most blocks have no folded value: no unfolding for them
+        if '\n ' in header_fields or '\n\t' in header_fields:
+            header_fields = header_fields.replace('\r\n', '\n').replace('\n ', ' ').replace('\n\t', '\t')
 
-        # look for subject
-        matched = GmailStorer.HF_SUB_RE.search(header_fields)
-        if matched:
-            tempo = matched.group('subject').strip()
-            #guess encoding and convert to utf-8
-            u_tempo  = None
-            encod    = "not found"
-            try:
-                encod  = gmvault_utils.guess_encoding(tempo, use_encoding_list = False)
-                u_tempo = str(tempo, encoding = encod)
-            except gmvault_utils.GuessEncoding as enc_err:
-                  #it is already in unicode so ignore encoding
-                  u_tempo = tempo
-            except Exception as e:
-                  LOG.critical(e)
-                  LOG.critical("Warning: Guessed encoding = (%s). Ignore those characters" % (encod))
-                  #try utf-8
-                  u_tempo = str(tempo, encoding="utf-8", errors='replace')
-
-            if u_tempo:
-                subject = u_tempo.encode('utf-8')
-
-        # look for a msg id
-        matched = GmailStorer.HF_MSGID_RE.search(header_fields)
-        if matched:
-            msgid = matched.group('msgid').strip()
-
-        # look for received xgmail id
-        matched = GmailStorer.HF_XGMAIL_RECV_RE.search(header_fields)
-        if matched:
-            x_gmail_recv = matched.group('received').strip()
-
-        if subject:
-            subject = subject.decode('utf-8')
-        return subject, msgid, x_gmail_recv
+        subject = msgid = msgid_value = x_gmail_recv = ''
+        for subj, mid, mid_value, x_recv in cls.HF_FIELDS_RE.findall('\n' + header_fields):
+            subject, msgid, msgid_value, x_gmail_recv = subject or subj, msgid or mid, \
+                                                        msgid_value or mid_value, x_gmail_recv or x_recv
+
+        subject = subject.strip()
+        if '=?' in subject:
+            subject = cls.decode_header_value(subject)
+        msgid = (msgid or msgid_value).strip()
+
+        return subject or None, msgid or None, x_gmail_recv.strip() or None
+
+    @classmethod
+    def _ids_from_paths(cls, the_iter):
+        """
+           (gm_id, directory name) pairs of the .meta paths
+        """
+        for filepath in the_iter:
+            directory, fname = os.path.split(filepath)
+            yield int(os.path.splitext(fname)[0]), sys.intern(os.path.basename(directory))
 
     def get_all_chats_gmail_ids(self):
         """
            Get only chats dirs 
+           Return a GmailIdIndex (gm_id => directory, sorted by gm_id)
         """
-        # first create a normal dir and sort it below with an OrderedDict
-        # beware orderedDict preserve order by insertion and not by key order
-        gmail_ids = {}
-
         chat_dir = '%s/%s' % (self._db_dir, self.CHATS_AREA)
-        if os.path.exists(chat_dir):
-            the_iter = gmvault_utils.ordered_dirwalk(chat_dir, "*.meta")
-
-            #get all ids
-            for filepath in the_iter:
-                directory, fname = os.path.split(filepath)
-                gmail_ids[int(os.path.splitext(fname)[0])] = os.path.basename(directory)
-
-            #sort by key 
-            #used own orderedDict to be compliant with version 2.5
-            gmail_ids = collections_utils.OrderedDict(
-                sorted(list(gmail_ids.items()), key=lambda t: t[0]))
+        if not os.path.exists(chat_dir):
+            return collections_utils.GmailIdIndex()
 
-        return gmail_ids
+        return collections_utils.GmailIdIndex.from_items(
+            self._ids_from_paths(gmvault_utils.ordered_dirwalk(chat_dir, "*.meta")))
 
     def get_all_existing_gmail_ids(self, pivot_dir=None,
                                    ignore_sub_dir=('chats',)):
         """
            get all existing gmail_ids from the database within the passed month 
            and all posterior months
+           Return a GmailIdIndex (gm_id => directory, sorted by gm_id)
         """
-        # first create a normal dir and sort it below with an OrderedDict
-        # beware orderedDict preserve order by insertion and not by key order
-        gmail_ids = {}
-
         if pivot_dir is None:
             #the_iter = gmvault_utils.dirwalk(self._db_dir, "*.meta")
             the_iter = gmvault_utils.ordered_dirwalk(self._db_dir, "*.meta",
@@ -342,17 +370,7 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
 
             the_iter = itertools.chain.from_iterable(iter_dirs)
 
-        #get all ids
-        for filepath in the_iter:
-            directory, fname = os.path.split(filepath)
-            gmail_ids[int(os.path.splitext(fname)[0])] = os.path.basename(directory)
-
-        #sort by key 
-        #used own orderedDict to be compliant with version 2.5
-        gmail_ids = collections_utils.OrderedDict(sorted(list(gmail_ids.items()),
-                                                         key=lambda t: t[0]))
-
-        return gmail_ids
+        return collections_utils.GmailIdIndex.from_items(self._ids_from_paths(the_iter))
 
     def bury_chat_metadata(self, email_info, local_dir = None):
         """
@@ -379,38 +397,34 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
 
         with open(meta_path, 'w') as meta_desc:
             # parse header fields to extract subject and msgid
-            subject, msgid, received = self.parse_header_fields(
-                email_info[imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY].decode('utf-8'))
-
-            # need to convert labels that are number as string
-            # come from imap_lib when label is a number
-            labels = []
-            for label in email_info[imap_utils.GIMAPFetcher.GMAIL_LABELS]:
-                if isinstance(label, (int, float, complex)):
-                    label = str(label)
-
-                labels.append(str(gmvault_utils.remove_consecutive_spaces_and_strip(label)))
-
-            labels.extend(extra_labels) #add extra labels
-
-            #create json structure for metadata
-            meta_obj = {
-                         self.ID_K         : email_info[imap_utils.GIMAPFetcher.GMAIL_ID],
-                         self.LABELS_K     : labels,
-                         self.FLAGS_K      : [f.decode('utf-8') for f in email_info[imap_utils.GIMAPFetcher.IMAP_FLAGS]],
-                         self.THREAD_IDS_K : email_info[imap_utils.GIMAPFetcher.GMAIL_THREAD_ID],
-                         self.INT_DATE_K   : gmvault_utils.datetime2e(email_info[imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]),
-                         self.SUBJECT_K    : subject,
-                         self.MSGID_K      : msgid,
-                         self.XGM_RECV_K   : received
-                       }
-            
-            json.dump(meta_obj, meta_desc)
+            header_fields, _, _ = gmvault_utils.ENCODING_DETECTOR.decode(
+                email_info[imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY], charsets = [], metrics = self.metrics)
+            record = MessageRecord.from_imap(self.label_dict, email_info, extra_labels, \
+                                             self.parse_header_fields(header_fields))
+
+            json.dump(record.to_meta(), meta_desc)
 
             meta_desc.flush()
 
         return email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
 
+    def update_metadata(self, record, email_info, local_dir=None, extra_labels=()):
+        """
+            Update the labels and flags of a stored message from a light
+            fetch response (GMAIL_ID, FLAGS and LABELS only)
+            Arguments:
+             record    : the MessageRecord on disk
+             email_info: the fetch response
+             local_dir : intermediary dir (month dir)
+        """
+        the_dir = '%s/%s' % (self._db_dir, local_dir) if local_dir else self._db_dir
+
+        record.update_from_imap(email_info, extra_labels)
+        with open(self.METADATA_FNAME % (the_dir, record.gm_id), 'w') as meta_desc:
+            json.dump(record.to_meta(), meta_desc)
+
+        return record.gm_id
+
     def bury_chat(self, chat_info, local_dir=None, compress=False):
         """
             Like bury email but with a special label: gmvault-chats
@@ -462,6 +476,8 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         if self._encrypt_data:
             data_path = '%s.crypt' % data_path
 
+        write_start = time.perf_counter()
+        written     = 0
         if compress:
             data_path = '%s.gz' % data_path
             data_desc = gzip.open(data_path, 'wb')
@@ -470,22 +486,27 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         try:
             if self._encrypt_data:
                 # need to be done for every encryption
-                cipher = self.get_encryption_cipher()
-                cipher.initCTR()
-                data = cipher.encryptCTR(email_info[imap_utils.GIMAPFetcher.EMAIL_BODY])
+                with self.metrics.time('encrypt'):
+                    cipher = self.get_encryption_cipher()
+                    cipher.initCTR()
+                    data = cipher.encryptCTR(email_info[imap_utils.GIMAPFetcher.EMAIL_BODY])
                 LOG.debug("Encrypt data.")
 
                 #write encrypted data without encoding
                 data_desc.write(data)
+                written = len(data)
 
             #no encryption then utf-8 encode and write
             else:
                 #convert email content to unicode
-                data = gmvault_utils.convert_to_unicode(email_info[imap_utils.GIMAPFetcher.EMAIL_BODY])
+                data = gmvault_utils.convert_to_unicode(email_info[imap_utils.GIMAPFetcher.EMAIL_BODY], \
+                                                         metrics = self.metrics)
       
                 # write in chunks of one 1 MB
                 for chunk in gmvault_utils.chunker(data, 1048576):
-                    data_desc.write(chunk.encode('utf-8'))
+                    chunk = chunk.encode('utf-8')
+                    data_desc.write(chunk)
+                    written += len(chunk)
 
             #store metadata info
             self.bury_metadata(email_info, local_dir, extra_labels)
@@ -494,6 +515,9 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         finally:
             data_desc.close()
 
+        self.metrics.observe('write', time.perf_counter() - write_start)
+        self.metrics.inc('bytes_written', written)
+
         return email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
 
     def get_directory_from_id(self, a_id, a_local_dir=None):
@@ -606,19 +630,27 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         """
         the_dir = self.get_directory_from_id(a_id)
 
-        with self._get_data_file_from_id(the_dir, a_id) as f:
+        data = self._read_data_file(the_dir, a_id)
+
+        return self.unbury_metadata(a_id, the_dir), data
+
+    def _read_data_file(self, a_dir, a_id):
+        """
+           Read (decompress and decrypt if needed) the email content
+        """
+        with self._get_data_file_from_id(a_dir, a_id) as f:
+            with self.metrics.time('decompress' if f.name.endswith('.gz') else 'read'):
+                data = f.read()
+            self.metrics.inc('bytes_read', len(data))
             if self.email_encrypted(f.name):
                 LOG.debug("Restore encrypted email %s." % a_id)
                 # need to be done for every encryption
-                cipher = self.get_encryption_cipher()
-                cipher.initCTR()
-                LOG.debug("Decrypt data.")
-                data = cipher.decryptCTR(f.read())
-            else:
-                #data = codecs.decode(f.read(), "utf-8" )
-                data = f.read()
+                with self.metrics.time('decrypt'):
+                    cipher = self.get_encryption_cipher()
+                    cipher.initCTR()
+                    data = cipher.decryptCTR(data)
 
-        return self.unbury_metadata(a_id, the_dir), data
+        return data
 
     def unbury_data(self, a_id, a_id_dir=None):
         """
@@ -627,43 +659,18 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         if not a_id_dir:
             a_id_dir = self.get_directory_from_id(a_id)
 
-        with self._get_data_file_from_id(a_id_dir, a_id) as f:
-            if self.email_encrypted(f.name):
-                LOG.debug("Restore encrypted email %s" % a_id)
-                # need to be done for every encryption
-                cipher = self.get_encryption_cipher()
-                cipher.initCTR()
-                data = cipher.decryptCTR(f.read())
-            else:
-                data = f.read()
-
-        return data    
+        return self._read_data_file(a_id_dir, a_id)
 
     def unbury_metadata(self, a_id, a_id_dir=None):
         """
            Get metadata info from DB
+           Return a MessageRecord
         """
         if not a_id_dir:
             a_id_dir = self.get_directory_from_id(a_id)
 
         with self._get_metadata_file_from_id(a_id_dir, a_id) as f:
-            metadata = json.load(f)
-
-        metadata[self.INT_DATE_K] = gmvault_utils.e2datetime(
-            metadata[self.INT_DATE_K])
-        
-        # force conversion of labels as string because IMAPClient
-        # returns a num when the label is a number (ie. '00000') and handle utf-8
-        new_labels = []
-
-        for label in metadata[self.LABELS_K]:
-            if isinstance(label, (int, float, complex)):
-                label = str(label)
-            new_labels.append(str(label))
- 
-        metadata[self.LABELS_K] = new_labels
-
-        return metadata
+            return MessageRecord.from_meta(self.label_dict, json.load(f))
 
     def delete_emails(self, emails_info, msg_type):
         """
@@ -674,8 +681,7 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         else:
             db_dir = self._chats_dir
 
-        move_to_bin = gmvault_utils.get_conf_defaults().get_boolean(
-            "General", "keep_in_bin" , False)
+        move_to_bin = gmvault_utils.get_conf_view().keep_in_bin
 
         if move_to_bin:
             LOG.critical("Move emails to the bin:%s" % self._bin_dir)
@@ -718,3 +724,239 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
 
                 if os.path.exists(metadata_p):
                     os.remove(metadata_p)
+
+
+_SHARED_TUPLES = {} # flag and label id tuples shared by the records
+
+def intern_tuple(values):
+    """ Return the shared tuple equal to values """
+    values = tuple(values)
+    return _SHARED_TUPLES.setdefault(values, values)
+
+def intern_labels(labels):
+    """
+       Return the shared tuple of the interned labels.
+       IMAPClient returns a num when the label is a number (ie. '00000'), force it to str.
+    """
+    return intern_tuple(sys.intern(label if isinstance(label, str) else str(label)) for label in labels)
+
+class LabelEntry(object): #pylint:disable=R0903
+    """
+       A label of the LabelDictionary and its precomputed forms
+    """
+    __slots__ = ('label_id', 'name', 'lower', 'restore_name', 'imap_name')
+
+    def __init__(self, label_id, name, reserved_labels_map):
+        self.label_id     = label_id
+        self.name         = sys.intern(name)
+        self.lower        = name.lower()
+        # Gmail reserved labels are restored under another name
+        self.restore_name = reserved_labels_map.get(self.lower, name)
+        self.imap_name    = imap_utils.utf7_encode(self.restore_name)
+
+    def reserved(self):
+        """ True if the label is a Gmail reserved one (restored with another name) """
+        return self.restore_name != self.name
+
+class LabelDictionary(object):
+    """
+       Vault level dictionary of the labels: name <=> small integer id, saved in the .info dir.
+       The records carry label ids, each label is lowercased, mapped to its restore name
+       and UTF-7 encoded once. The .meta files keep the label names.
+    """
+    VERSION = 1
+
+    def __init__(self, path = None, reserved_labels_map = None):
+        self._path     = path
+        self._reserved = reserved_labels_map if reserved_labels_map is not None \
+                         else gmvault_utils.get_conf_view().reserved_labels_map
+        self._entries  = []
+        self._ids      = {} # name => id
+        self._names    = {} # id tuple => name tuple
+        self._nb_saved = 0
+        self._lock     = threading.Lock()
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as the_file:
+                    names = json.load(the_file)['labels']
+            except (ValueError, KeyError, TypeError) as err:
+                # the .meta files have the names: the ids are rebuilt when reading them
+                LOG.info("Ignore the corrupted label dictionary %s (%s)." % (path, err))
+                names = []
+            for name in names:
+                self._add(name)
+            self._nb_saved = len(self._entries)
+
+    def _add(self, name):
+        """ add a new label and return its id """
+        with self._lock:
+            label_id = self._ids.get(name)
+            if label_id is None:
+                label_id = len(self._entries)
+                self._entries.append(LabelEntry(label_id, name, self._reserved))
+                self._ids[self._entries[label_id].name] = label_id
+            return label_id
+
+    def id_of(self, name):
+        """ id of the label name (added if new) """
+        label_id = self._ids.get(name)
+        return label_id if label_id is not None else self._add(name)
+
+    def ids_of(self, names):
+        """ shared tuple of the ids of the label names """
+        return intern_tuple(self.id_of(name if isinstance(name, str) else str(name)) for name in names)
+
+    def entry(self, label_id):
+        """ LabelEntry of label_id """
+        return self._entries[label_id]
+
+    def names(self, label_ids):
+        """ shared tuple of the names of label_ids """
+        names = self._names.get(label_ids)
+        if names is None:
+            names = self._names[label_ids] = intern_tuple(self._entries[label_id].name for label_id in label_ids)
+        return names
+
+    def save(self):
+        """ write the dictionary if labels were added since the last save (thread safe) """
+        if not self._path or self._nb_saved == len(self._entries):
+            return
+        # the email and chat watchers can save at the same time: one writer of the tmp file at a time
+        with self._lock:
+            if self._nb_saved == len(self._entries):
+                return
+            names    = [ entry.name for entry in self._entries ]
+            tmp_path = '%s.tmp' % (self._path)
+            with open(tmp_path, 'w') as the_file:
+                json.dump({ 'version' : self.VERSION, 'labels' : names }, the_file)
+            os.replace(tmp_path, self._path)
+            self._nb_saved = len(names)
+
+    def __len__(self):
+        return len(self._entries)
+
+class MessageRecord(object):
+    """
+       Compact metadata of one message (the content of a .meta file).
+       Labels are a shared tuple of LabelDictionary ids, flags a shared tuple of interned strings
+       and the internal date an epoch.
+       Still readable like the former metadata dict (record[GmailStorer.LABELS_K]).
+    """
+    __slots__ = ('label_dict', 'gm_id', 'thread_id', 'label_ids', 'flags', 'internal_date', \
+                 'subject', 'msg_id', 'x_gmail_received')
+
+    # meta key => attribute
+    META_KEYS = { GmailStorer.ID_K         : 'gm_id',
+                  GmailStorer.LABELS_K     : 'labels',
+                  GmailStorer.FLAGS_K      : 'flags',
+                  GmailStorer.THREAD_IDS_K : 'thread_id',
+                  GmailStorer.INT_DATE_K   : 'internal_date',
+                  GmailStorer.SUBJECT_K    : 'subject',
+                  GmailStorer.MSGID_K      : 'msg_id',
+                  GmailStorer.XGM_RECV_K   : 'x_gmail_received' }
+
+    def __init__(self, label_dict, gm_id, thread_id, labels = (), flags = (), internal_date = 0, \
+                 subject = None, msg_id = None, x_gmail_received = None): #pylint:disable=R0913
+        self.label_dict       = label_dict
+        self.gm_id            = gm_id
+        self.thread_id        = thread_id
+        self.label_ids        = label_dict.ids_of(labels)
+        self.flags            = intern_labels(flags)
+        self.internal_date    = internal_date
+        self.subject          = subject
+        self.msg_id           = msg_id
+        self.x_gmail_received = x_gmail_received
+
+    @classmethod
+    def from_imap(cls, label_dict, email_info, extra_labels = (), header_fields = (None, None, None)):
+        """
+           Record of an IMAPClient fetch response (labels already decoded).
+           header_fields: (subject, msgid, x_gmail_received) from GmailStorer.parse_header_fields
+        """
+        subject, msg_id, x_gmail_received = header_fields
+        return cls(label_dict,
+                   email_info[imap_utils.GIMAPFetcher.GMAIL_ID],
+                   email_info[imap_utils.GIMAPFetcher.GMAIL_THREAD_ID],
+                   cls._imap_labels(email_info, extra_labels),
+                   cls._imap_flags(email_info),
+                   gmvault_utils.datetime2e(email_info[imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]),
+                   subject, msg_id, x_gmail_received)
+
+    @classmethod
+    def _imap_labels(cls, email_info, extra_labels):
+        """ label names of a fetch response plus the extra labels """
+        labels = [ gmvault_utils.remove_consecutive_spaces_and_strip(str(label)) \
+                   for label in email_info[imap_utils.GIMAPFetcher.GMAIL_LABELS] ]
+        labels.extend(extra_labels) #add extra labels
+        return labels
+
+    @classmethod
+    def _imap_flags(cls, email_info):
+        """ flags of a fetch response """
+        return [ flag.decode('utf-8') for flag in email_info[imap_utils.GIMAPFetcher.IMAP_FLAGS] ]
+
+    def update_from_imap(self, email_info, extra_labels = ()):
+        """
+           Take the labels and flags of a fetch response (the only mutable attributes of a message)
+        """
+        self.label_ids = self.label_dict.ids_of(self._imap_labels(email_info, extra_labels))
+        self.flags     = intern_labels(self._imap_flags(email_info))
+
+    @classmethod
+    def from_meta(cls, label_dict, meta):
+        """ record of a .meta json object """
+        return cls(label_dict, meta[GmailStorer.ID_K], meta[GmailStorer.THREAD_IDS_K], meta[GmailStorer.LABELS_K], \
+                   meta[GmailStorer.FLAGS_K], meta[GmailStorer.INT_DATE_K], meta.get(GmailStorer.SUBJECT_K), \
+                   meta.get(GmailStorer.MSGID_K), meta.get(GmailStorer.XGM_RECV_K))
+
+    @property
+    def labels(self):
+        """ label names """
+        return self.label_dict.names(self.label_ids)
+
+    def label_entries(self):
+        """ LabelEntry of each label """
+        return [ self.label_dict.entry(label_id) for label_id in self.label_ids ]
+
+    def to_meta(self):
+        """ .meta json object """
+        meta = { key : getattr(self, attr) for key, attr in self.META_KEYS.items() }
+        meta[GmailStorer.LABELS_K] = list(self.labels)
+        meta[GmailStorer.FLAGS_K]  = list(self.flags)
+        return meta
+
+    def internal_datetime(self):
+        """ internal date as a datetime """
+        return gmvault_utils.e2datetime(self.internal_date)
+
+    def __getitem__(self, key):
+        if key == GmailStorer.INT_DATE_K:
+            return self.internal_datetime()
+        try:
+            return getattr(self, self.META_KEYS[key])
+        except KeyError:
+            raise KeyError(key)
+
+    def get(self, key, default = None):
+        """ dict like get """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """ meta keys """
+        return list(self.META_KEYS.keys())
+
+    def __iter__(self):
+        return iter(self.META_KEYS)
+
+    def __eq__(self, other):
+        return isinstance(other, MessageRecord) and self.to_meta() == other.to_meta()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'MessageRecord(%s)' % (', '.join('%s=%r' % item for item in sorted(self.to_meta().items())))
@@ -21,6 +21,9 @@
 
 import os
 import re
+import time
+import errno
+import shutil
 import mailbox
 
 import imapclient.imap_utf7 as imap_utf7
@@ -29,6 +32,7 @@ import gmv.imap_utils as imap_utils
 import gmv.log_utils as log_utils
 import gmv.gmvault_utils as gmvault_utils
 import gmv.gmvault_db as gmvault_db
+import gmv.metrics_utils as metrics_utils
 
 LOG = log_utils.LoggerFactory.get_logger('gmvault_export')
 
@@ -49,11 +53,15 @@ class GMVaultExporter(object):
     GM_SEEN = '\\Seen'
     GM_FLAGGED = '\\Flagged'
 
-    def __init__(self, db_dir, a_mailbox, labels = None):
+    METRICS_SUMMARY = 'export_metrics.info'
+
+    def __init__(self, db_dir, a_mailbox, labels = None, metrics = None):
         """
            constructor
         """
-        self.storer = gmvault_db.GmailStorer(db_dir)
+        self.metrics = metrics if metrics is not None else metrics_utils.MetricsRegistry()
+        self.metrics.set_label('operation', 'export')
+        self.storer = gmvault_db.GmailStorer(db_dir, metrics = self.metrics)
         self.mailbox = a_mailbox
         self.labels = labels
 
@@ -69,10 +77,20 @@ class GMVaultExporter(object):
             default_folder = self.GM_ALL, use_labels = True)
         self.export_ids('chats', self.storer.get_all_chats_gmail_ids(), \
             default_folder = self.CHATS_FOLDER, use_labels = False)
+        self.save_metrics()
+
+    def save_metrics(self):
+        """ write the metrics summary of the export (and the new labels) in the gmvault-db .info dir """
+        path = '%s/%s' % (self.storer.get_info_dir(), self.METRICS_SUMMARY)
+        try:
+            self.storer.label_dict.save()
+            self.metrics.save_json(path)
+        except (IOError, OSError) as err:
+            LOG.info("Cannot save the metrics summary in %s: %s" % (path, err))
 
     def printable_label_list(self, labels):
         """helper to print a list of labels"""
-        labels = [l.encode('ascii', 'backslashreplace') for l in labels]
+        labels = [l.encode('ascii', 'backslashreplace').decode('ascii') for l in labels]
         return '; '.join(labels)
 
     def export_ids(self, kind, ids, default_folder, use_labels):
@@ -91,7 +109,7 @@ class GMVaultExporter(object):
 
             folders = [default_folder]
             if use_labels:
-                add_labels = meta[gmvault_db.GmailStorer.LABELS_K]
+                add_labels = list(meta.labels)
                 if not add_labels:
                     add_labels = [GMVaultExporter.ARCHIVED_FOLDER]
                 folders.extend(add_labels)
@@ -100,8 +118,9 @@ class GMVaultExporter(object):
 
             LOG.debug("Processing id %s in labels %s." % \
                 (a_id, self.printable_label_list(folders)))
-            for folder in folders:
-                self.mailbox.add(msg, folder, meta[gmvault_db.GmailStorer.FLAGS_K])
+            with self.metrics.time('export_write'):
+                self.mailbox.add_to_folders(msg, folders, meta.flags)
+            self.metrics.inc('%s_exported' % (kind))
 
             done += 1
             left = len(ids) - done
@@ -118,15 +137,23 @@ class Mailbox(object):
     """ Mailbox abstract class"""
     def add(self, msg, folder, flags):
         raise NotImplementedError('implement in subclass')
+    def add_to_folders(self, msg, folders, flags):
+        """ add the same message in all the given folders """
+        for folder in folders:
+            self.add(msg, folder, flags)
     def close(self):
         pass
 
 class Maildir(Mailbox):
     """ Class delaing with the Maildir format """
-    def __init__(self, path, separator = '/'):
+    def __init__(self, path, separator = '/', use_hardlinks = False):
         self.path = path
         self.subdirs = {}
         self.separator = separator
+        self.use_hardlinks = use_hardlinks
+        self.nb_linked = 0
+        self.nb_copied = 0
+        self.bytes_saved = 0
         if not self.root_is_maildir() and not os.path.exists(self.path):
             os.makedirs(self.path)
 
@@ -154,6 +181,8 @@ class Maildir(Mailbox):
             self.subdir(parent)
             path = self.subdir_name(folder)
             path = imap_utf7.encode(path)
+            if isinstance(path, bytes): # imapclient returns the modified utf-7 as bytes
+                path = path.decode('ascii')
         else:
             if not self.root_is_maildir():
                 return
@@ -164,8 +193,9 @@ class Maildir(Mailbox):
         self.subdirs[folder] = sub
         return sub
 
-    def add(self, msg, folder, flags):
-        """ add message in a given subdir """
+    @classmethod
+    def _create_message(cls, msg, flags):
+        """ create the MaildirMessage with the Maildir flags matching the gmail ones """
         mmsg = mailbox.MaildirMessage(msg)
 
         if GMVaultExporter.GM_SEEN in flags:
@@ -174,13 +204,62 @@ class Maildir(Mailbox):
         if mmsg.get_subdir() == 'cur' and GMVaultExporter.GM_FLAGGED in flags:
             mmsg.add_flag('F')
 
-        self.subdir(folder).add(mmsg)
+        return mmsg
+
+    def add(self, msg, folder, flags):
+        """ add message in a given subdir """
+        self.subdir(folder).add(self._create_message(msg, flags))
+
+    def add_to_folders(self, msg, folders, flags):
+        """
+           add message in all the given subdirs.
+           With hardlinks, the message is written once and linked in the other subdirs
+        """
+        if not self.use_hardlinks or len(folders) < 2:
+            return super(Maildir, self).add_to_folders(msg, folders, flags)
+
+        mmsg = self._create_message(msg, flags)
+        first = self.subdir(folders[0])
+
+        # same file name in every maildir: flags are identical and the name is unique
+        suffix = first.colon + mmsg.get_info()
+        if suffix == first.colon:
+            suffix = ''
+
+        fname = first.add(mmsg) + suffix
+        src_path = os.path.join(os.path.abspath(first._path), mmsg.get_subdir(), fname) #pylint:disable=W0212
+        size = os.path.getsize(src_path)
+
+        done = set([folders[0]])
+        for folder in folders[1:]:
+            if folder in done:
+                continue
+            done.add(folder)
+            dest_path = os.path.join(os.path.abspath(self.subdir(folder)._path), \
+                                     mmsg.get_subdir(), fname) #pylint:disable=W0212
+            try:
+                os.link(src_path, dest_path)
+                self.nb_linked += 1
+                self.bytes_saved += size
+            except OSError as err:
+                # cannot link across filesystems (or not supported): copy the file
+                if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                LOG.debug("Cannot hardlink %s (%s). Copy it instead." % (dest_path, err))
+                shutil.copy2(src_path, dest_path)
+                self.nb_copied += 1
+
+    def close(self):
+        """ report the space saved by the hardlinks """
+        if self.use_hardlinks:
+            LOG.critical("Hardlinked %d messages (%d copied across filesystems). %.2f MB saved." % \
+                         (self.nb_linked, self.nb_copied, self.bytes_saved / (1024.0 * 1024.0)))
 
 class OfflineIMAP(Maildir):
     """ Class dealing with offlineIMAP specificities """
     DEFAULT_SEPARATOR = '.'
-    def __init__(self, path, separator = DEFAULT_SEPARATOR):
-        super(OfflineIMAP, self).__init__(path, separator = separator)
+    def __init__(self, path, separator = DEFAULT_SEPARATOR, use_hardlinks = False):
+        super(OfflineIMAP, self).__init__(path, separator = separator, use_hardlinks = use_hardlinks)
 
 class Dovecot(Maildir):
     """ Class dealing with Dovecot specificities """
@@ -206,8 +285,9 @@ class Dovecot(Maildir):
                  layout = MaildirPlusPlusLayout(),
                  ns_sep = DEFAULT_NS_SEP,
                  listescape = DEFAULT_LISTESCAPE,
-                 sep_escape = DEFAULT_SEP_ESCAPE):
-        super(Dovecot, self).__init__(path, separator = layout.SEPARATOR)
+                 sep_escape = DEFAULT_SEP_ESCAPE,
+                 use_hardlinks = False):
+        super(Dovecot, self).__init__(path, separator = layout.SEPARATOR, use_hardlinks = use_hardlinks)
         self.layout = layout
         self.ns_sep = ns_sep
         self.listescape = listescape
@@ -273,12 +353,16 @@ class MBox(Mailbox):
                 if not os.path.exists(cur_path):
                     os.makedirs(cur_path)
                 mbox_path = os.path.join(cur_path, s)
-                self.open[cur_label] = mailbox.mbox(mbox_path)
+                self.open[cur_label] = self._open_mbox(mbox_path)
             # Use .sbd folders a la Thunderbird, to allow nested folders
             cur_path = os.path.join(cur_path, s + '.sbd')
 
         return self.open[real_label]
 
+    def _open_mbox(self, mbox_path):
+        """ open the mbox file of a label """
+        return mailbox.mbox(mbox_path)
+
     def add(self, msg, folder, flags):
         mmsg = mailbox.mboxMessage(msg)
         if GMVaultExporter.GM_SEEN in flags:
@@ -286,3 +370,82 @@ class MBox(Mailbox):
         if GMVaultExporter.GM_FLAGGED in flags:
             mmsg.add_flag('F')
         self.subdir(folder).add(mmsg)
+
+class _MBoxFileWriter(object):
+    """ Append only writer on one mbox file """
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, path):
+        needs_sep = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_sep = (f.read(1) != b'\n')
+        self.path = path
+        self.file = open(path, 'ab', self.BUFFER_SIZE)
+        if needs_sep:
+            self.file.write(b'\n')
+
+    def add(self, data):
+        """ write already formatted bytes """
+        self.file.write(data)
+
+    def close(self):
+        """ flush and close the file """
+        self.file.close()
+
+class StreamingMBox(MBox):
+    """
+       MBox writer appending the raw messages to the mbox files.
+       The messages are not parsed by the email package and mailbox.mbox
+       table of contents and locking are bypassed.
+       It produces the same Thunderbird layout (.sbd folders) as MBox.
+    """
+    HEADERS_END_RE  = re.compile(br'\n\n')
+    STATUS_HDR_RE   = re.compile(br'^(Status|X-Status):[^\n]*\n([ \t][^\n]*\n)*', re.IGNORECASE | re.MULTILINE)
+    FROM_ESCAPE_RE  = re.compile(br'^From ', re.MULTILINE)
+
+    def _open_mbox(self, mbox_path):
+        """ open an append only buffered file """
+        return _MBoxFileWriter(mbox_path)
+
+    @classmethod
+    def format_message(cls, msg, flags):
+        """
+           Return the bytes to append to a mbox file for msg (bytes or str):
+           From_ line, Status and X-Status headers and escaped From lines
+        """
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+
+        msg = msg.replace(b'\r\n', b'\n')
+
+        from_line = None
+        if msg.startswith(b'From '):
+            from_line, _, msg = msg.partition(b'\n')
+        if not from_line:
+            from_line = b'From MAILER-DAEMON ' + time.asctime(time.gmtime()).encode('ascii')
+
+        matched = cls.HEADERS_END_RE.search(msg)
+        if matched:
+            headers, body = msg[:matched.start() + 1], msg[matched.start() + 1:]
+        else:
+            headers, body = (msg if msg.endswith(b'\n') else msg + b'\n'), b'\n'
+
+        # same Status and X-Status headers as mailbox.mboxMessage
+        status = b'R' if GMVaultExporter.GM_SEEN in flags else b''
+        x_status = b'F' if GMVaultExporter.GM_FLAGGED in flags else b''
+        if status or x_status:
+            headers = cls.STATUS_HDR_RE.sub(b'', headers)
+            headers += b'Status: ' + status + b'\n'
+            if x_status:
+                headers += b'X-Status: ' + x_status + b'\n'
+
+        body = cls.FROM_ESCAPE_RE.sub(b'>From ', body)
+        if not body.endswith(b'\n'):
+            body += b'\n'
+
+        return b''.join((from_line, b'\n', cls.FROM_ESCAPE_RE.sub(b'>From ', headers), body, b'\n'))
+
+    def add(self, msg, folder, flags):
+        self.subdir(folder).add(self.format_message(msg, flags))
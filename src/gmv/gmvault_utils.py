@@ -25,14 +25,15 @@ import time
 import calendar
 import fnmatch
 import functools
+import collections
+import threading
 
 import io
 import sys
 import traceback
 import random 
 import locale
-import urllib.request, urllib.parse, urllib.error
-import chardet
+import urllib.parse
 
 import gmv.log_utils as log_utils
 import gmv.conf.conf_helper
@@ -506,7 +507,7 @@ def guess_encoding(byte_str, use_encoding_list=True):
        raise GuessEncoding("Error. The passed string is a unicode string and not a byte string")
 
     if use_encoding_list:
-        encoding_list = get_conf_defaults().get('Localisation', 'encoding_guess_list', DEFAULT_ENC_LIST)
+        encoding_list = get_conf_view().encoding_guess_list
         for enc in encoding_list:
            try:
               str(byte_str ,enc,"strict")
@@ -517,36 +518,164 @@ def guess_encoding(byte_str, use_encoding_list=True):
               break
 
     if not encoding:
-       #detect encoding with chardet
-       enc = chardet.detect(byte_str)
-       if enc and enc.get("encoding") != None:
-          encoding = enc.get("encoding")
-       else:
-          LOG.debug("Force encoding to utf-8")
-          encoding = "utf-8"
+       encoding = chardet_encoding(byte_str)
 
     return encoding
 
+def chardet_encoding(byte_str):
+    """
+       detect the encoding of byte_str with chardet. Return utf-8 if chardet has no answer
+    """
+    #chardet is imported here, it is slow to import
+    import chardet #pylint:disable=C0415
+    enc = chardet.detect(byte_str)
+    if enc and enc.get("encoding") != None:
+        return enc.get("encoding")
+
+    LOG.debug("Force encoding to utf-8")
+    return "utf-8"
 
-def convert_to_unicode(a_str):
+class EncodingDetector(object):
+    """
+       Tiered encoding detection of the email bodies and subjects.
+       The cheap tiers come first: strict ascii, strict utf-8, the charset= parameters declared
+       in the MIME headers and the encoding last chosen for the sender domain.
+       chardet (slow) is only run on a sample when all of them failed.
+    """
+    TIERS = ('ascii', 'utf-8', 'charset', 'domain', 'chardet', 'replace')
+
+    CHARSET_RE  = re.compile(br'charset\s*=\s*"?\s*([\w.:+-]+)', re.IGNORECASE)
+    FROM_RE     = re.compile(br'^from:[^\r\n]*@([\w.-]+)', re.IGNORECASE | re.MULTILINE)
+    HEADERS_END = re.compile(br'\r?\n\r?\n')
+
+    def __init__(self, sample_size = 20000, max_domains = 1024):
+        self.sample_size  = sample_size
+        self.max_domains  = max_domains
+        self._domains     = collections.OrderedDict() # sender domain -> encoding (LRU)
+        self._lock        = threading.Lock() # the LRU is shared by the sync threads
+        self._tiers       = dict.fromkeys(self.TIERS, 0)
+
+    def stats(self):
+        """ number of decisions taken by each tier """
+        return dict(self._tiers)
+
+    def reset(self):
+        """ forget the sender domains and the tier stats """
+        self._domains.clear()
+        self._tiers = dict.fromkeys(self.TIERS, 0)
+
+    @classmethod
+    def parse_headers(cls, byte_str):
+        """
+           Return (declared charsets, sender domain) of a raw email.
+           The charsets are searched in the whole email to get the ones of the MIME parts.
+        """
+        charsets = []
+        for charset in cls.CHARSET_RE.findall(byte_str):
+            charset = charset.decode('ascii').lower()
+            if charset not in charsets:
+                charsets.append(charset)
+
+        matched = cls.HEADERS_END.search(byte_str)
+        matched = cls.FROM_RE.search(byte_str, 0, matched.start() if matched else len(byte_str))
+        domain  = matched.group(1).decode('ascii').lower() if matched else None
+
+        return charsets, domain
+
+    @classmethod
+    def _strict_decode(cls, byte_str, encoding):
+        """ decode byte_str or return None if encoding is unknown or does not fit """
+        try:
+            return str(byte_str, encoding = encoding)
+        except (LookupError, UnicodeError):
+            return None
+
+    def _hit(self, tier, metrics):
+        """ count a tier decision """
+        self._tiers[tier] += 1
+        if metrics:
+            metrics.inc('encoding_%s' % (tier.replace('-', '')))
+
+    def _remember(self, domain, encoding):
+        """ keep the encoding chosen for the sender domain """
+        if domain:
+            with self._lock:
+                self._domains[domain] = encoding
+                self._domains.move_to_end(domain)
+                if len(self._domains) > self.max_domains:
+                    self._domains.popitem(last = False)
+
+    def _recall(self, domain):
+        """ encoding last chosen for the sender domain or None """
+        with self._lock:
+            encoding = self._domains.get(domain)
+            if encoding:
+                self._domains.move_to_end(domain)
+            return encoding
+
+    def decode(self, byte_str, charsets = None, domain = None, metrics = None):
+        """
+           Decode byte_str. Return (unicode string, encoding, tier).
+           charsets and domain are parsed from byte_str when None
+        """
+        if byte_str.isascii():
+            self._hit('ascii', metrics)
+            return byte_str.decode('ascii'), 'ascii', 'ascii'
+
+        u_str = self._strict_decode(byte_str, 'utf-8')
+        if u_str is not None:
+            self._hit('utf-8', metrics)
+            return u_str, 'utf-8', 'utf-8'
+
+        if charsets is None and domain is None:
+            charsets, domain = self.parse_headers(byte_str)
+
+        for charset in charsets or ():
+            u_str = self._strict_decode(byte_str, charset)
+            if u_str is not None:
+                self._remember(domain, charset)
+                self._hit('charset', metrics)
+                return u_str, charset, 'charset'
+
+        encoding = self._recall(domain) if domain else None
+        if encoding:
+            u_str = self._strict_decode(byte_str, encoding)
+            if u_str is not None:
+                self._hit('domain', metrics)
+                return u_str, encoding, 'domain'
+
+        encoding = chardet_encoding(byte_str[:self.sample_size])
+        u_str = self._strict_decode(byte_str, encoding)
+        if u_str is not None:
+            self._remember(domain, encoding)
+            self._hit('chardet', metrics)
+            return u_str, encoding, 'chardet'
+
+        LOG.info("Warning: Guessed encoding = (%s). Ignore those characters" % (encoding))
+        self._hit('replace', metrics)
+        return str(byte_str, encoding = "utf-8", errors = 'replace'), 'utf-8', 'replace'
+
+ENCODING_DETECTOR = EncodingDetector()
+
+def convert_to_unicode(a_str, metrics = None):
     """
     Convert a string to unicode (except terminal strings)
     :param a_str:
+    :param metrics: optional MetricsRegistry counting the encoding_<tier> decisions
     :return: unicode string
     """
     encoding = None
 
     #if email encoding is forced no more guessing
-    email_encoding = get_conf_defaults().get('Localisation', 'email_encoding', None)
+    email_encoding = get_conf_view().email_encoding
 
-    try:
-        if email_encoding:
-            encoding = email_encoding
-        else:
-            LOG.debug("Guess encoding")
-            #guess encoding based on the beginning of the string up to 128K character
-            encoding = guess_encoding(a_str[:20000], use_encoding_list = False)
+    if not email_encoding:
+        u_str, encoding, tier = ENCODING_DETECTOR.decode(a_str, metrics = metrics)
+        LOG.debug("Converted from {} (tier {})", encoding, tier)
+        return u_str
 
+    try:
+        encoding = email_encoding
         LOG.debug("Convert to %s" % (encoding))
         u_str = str(a_str, encoding = encoding) #convert to unicode with given encoding
     except Exception as e:
@@ -566,7 +695,7 @@ def convert_argv_to_unicode(a_str):
         return a_str
 
     #encoding can be forced from conf
-    terminal_encoding = get_conf_defaults().get('Localisation', 'terminal_encoding', None)
+    terminal_encoding = get_conf_view().terminal_encoding
     if not terminal_encoding:
         terminal_encoding = locale.getpreferredencoding() #use it to find the encoding for text terminal
         LOG.debug("encoding found with locale.getpreferredencoding()")
@@ -634,6 +763,30 @@ def get_conf_defaults():
         return the_cf
     else:
         return gmv.conf.conf_helper.MockConf() #retrun MockObject that will play defaults
+
+# options read in the hot paths: resolved once in a ConfView (refreshed by reload_conf_defaults)
+CONF_VIEW_SPEC = {
+    'reserved_labels_map' : ('dict',    'Restore',      'reserved_labels_map',
+                             { 'migrated' : 'gmv-migrated', '\\muted' : 'gmv-muted' }),
+    'keep_in_bin'         : ('boolean', 'General',      'keep_in_bin',         False),
+    'email_encoding'      : ('str',     'Localisation', 'email_encoding',      None),
+    'terminal_encoding'   : ('str',     'Localisation', 'terminal_encoding',   None),
+    'encoding_guess_list' : ('list',    'Localisation', 'encoding_guess_list', DEFAULT_ENC_LIST),
+}
+
+@memoized
+def get_conf_view():
+    """
+       Return the typed view of the options used in the hot paths (CONF_VIEW_SPEC).
+       ex: get_conf_view().keep_in_bin
+    """
+    return get_conf_defaults().view(CONF_VIEW_SPEC)
+
+def reload_conf_defaults():
+    """
+       Re-read the defaults file: drop the cached values and refresh the conf view
+    """
+    get_conf_defaults().reload()
     
 #VERSION DETECTION PATTERN
 VERSION_PATTERN  = r'\s*conf_version=\s*(?P<version>\S*)\s*'
@@ -642,6 +795,9 @@ VERSION_RE  = re.compile(VERSION_PATTERN)
 #list of version conf to not overwrite with the next
 VERSIONS_TO_PRESERVE = [ '1.9' ]
 
+#version of the conf file written by this gmvault (never overwritten either)
+CURRENT_CONF_VERSION = VERSION_RE.search(gmvault_const.DEFAULT_CONF_FILE).group('version')
+
 def _get_version_from_conf(home_conf_file):
     """
        Check if the config file need to be replaced because it comes from an older version
@@ -688,7 +844,7 @@ def get_conf_filepath():
     else:
         # check if the conf file needs to be replaced
         version = _get_version_from_conf(home_conf_file)
-        if version not in VERSIONS_TO_PRESERVE:
+        if version != CURRENT_CONF_VERSION and version not in VERSIONS_TO_PRESERVE:
             LOG.debug("%s with version %s is too old, overwrite it with the latest file." \
                        % (home_conf_file, version))
             return _create_default_conf_file(home_conf_file)    
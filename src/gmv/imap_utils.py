@@ -19,12 +19,15 @@
 Module containing the IMAPFetcher object which is the Wrapper around the modified IMAPClient object
 
 '''
+import base64
+import copy
 import math
 import time
 import socket
 import re
 
 import functools
+import threading
 
 import ssl
 import imaplib
@@ -34,7 +37,10 @@ import gmv.log_utils as log_utils
 import gmv.credential_utils as credential_utils
 
 import gmv.gmvault_utils as gmvault_utils
+import gmv.metrics_utils as metrics_utils
 import gmv.mod_imap as mimap
+import gmv.quota_utils as quota_utils
+import gmv.retry_utils as retry_utils
 
 LOG = log_utils.LoggerFactory.get_logger('imap_utils')
 
@@ -68,11 +74,144 @@ class LabelError(Exception):
         """ ignore """
         return self._ignore
 
+class SessionCache(object):
+    """
+       What a connection discovers after login (capabilities, localized folder names), per account.
+       Shared by the connections of the process so that a reconnection skips the discovery
+    """
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, ttl):
+        """ the entry of key if it is less than ttl seconds old, None otherwise """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] >= ttl:
+                return None
+            return copy.deepcopy(entry[1])
+
+    def put(self, key, value):
+        """ store value for key """
+        with self._lock:
+            self._entries[key] = (time.time(), copy.deepcopy(value))
+
+    def invalidate(self, key):
+        """ forget key """
+        with self._lock:
+            self._entries.pop(key, None)
+
+SESSION_CACHE = SessionCache()
+
+# errors after which the connection is reopened and the call retried
+RETRY_ERRORS = (PushEmailError, imaplib.IMAP4.error, socket.error, ssl.SSLError)
+# the ones counted by the circuit breaker (the others are answers of a working server)
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, socket.error, ssl.SSLError)
+
+def _retry_message(error):
+    """ message logged when error is retried """
+    if isinstance(error, imaplib.IMAP4.abort):
+        return "Received an IMAP abort error."
+    if isinstance(error, imaplib.IMAP4.error):
+        return "Error when reaching Gmail server."
+    return "Cannot reach the Gmail server."
+
+def _reconnect(the_self, error, nb_tries, max_tries, backoff, breaker):
+    """
+       Disconnect, wait and reconnect the_self to its current folder until it works or max_tries is reached.
+       Return the new nb of tries. Raise error when there are no tries left
+    """
+    while nb_tries < max_tries:
+        LOG.critical("Disconnecting from Gmail Server and sleeping ...")
+        the_self.disconnect()
+
+        # a throttled account waits for the end of its pause
+        delay = max(backoff.next_delay(), the_self.pacer.pause_left())
+        LOG.critical("%s Wait %.1f second(s) and retrying." % (_retry_message(error), delay))
+        with the_self.metrics.time('retry_wait'):
+            time.sleep(delay)
+
+        nb_tries += 1
+        #increase total nb of reconns
+        the_self.total_nb_reconns += 1
+        the_self.metrics.inc('reconnections')
+
+        try:
+            breaker.check()
+        except retry_utils.CircuitOpenError as open_err:
+            the_self.metrics.inc('circuit_open')
+            raise open_err from error
+
+        try:
+            LOG.critical("Reconnecting to the from Gmail Server.")
+            #reconnect to the current folder
+            with the_self.metrics.time('reconnect'):
+                the_self.connect(go_to_current_folder = True)
+            return nb_tries
+        except Exception as ignored: #pylint:disable=W0703
+            # catch all errors and try as long as we have tries left
+            LOG.exception(ignored)
+            if quota_utils.is_throttling(ignored):
+                the_self.metrics.inc('throttled')
+                the_self.pacer.throttled()
+            if breaker.failure():
+                the_self.metrics.inc('circuit_open')
+
+    LOG.critical("Stop retrying, tried too many times ...")
+    #cascade error
+    raise error
+
+def retry_call(the_self, a_operation, a_nb_tries = 3, a_sleep_time = 1, a_backoff = 2):
+    """
+       Call a_operation() and return its result. When it fails with an imap, socket or ssl error,
+       reconnect the_self (a GIMAPFetcher) to its current folder and call it again, up to a_nb_tries times
+       (2 times for an IMAP4.error that is not an abort).
+       - the waits start at a_sleep_time and are multiplied by a_backoff, with a random jitter,
+         up to [General] retry_max_sleep seconds
+       - all the calls to an account share a circuit breaker. After [General] circuit_breaker_failures
+         consecutive failures, calls fail fast with CircuitOpenError for circuit_breaker_cooldown seconds
+       - retries, waits and reconnections are recorded in the_self.metrics
+       - when Gmail answers that the account exceeded its limits, the_self.pacer pauses the transfers
+         and the reconnection waits for the end of the pause
+       a_operation can keep what it has done so far (see GIMAPFetcher.fetch) to only redo the rest.
+    """
+    conf    = gmvault_utils.get_conf_defaults()
+    backoff = retry_utils.Backoff(a_sleep_time, a_backoff, conf.getint('General', 'retry_max_sleep', 60))
+    breaker = the_self.circuit_breaker()
+    nb_tries = 0
+    while True:
+        try:
+            breaker.check()
+        except retry_utils.CircuitOpenError:
+            the_self.metrics.inc('circuit_open')
+            raise
+
+        try:
+            if the_self.server is None: # a previous call could not reconnect
+                raise imaplib.IMAP4.abort("Not connected to the Gmail server")
+            result = a_operation()
+        except RETRY_ERRORS as err:
+            LOG.debug("error message = %s. traceback:%s" % (err, gmvault_utils.get_exception_traceback()))
+            if isinstance(err, CONNECTION_ERRORS) and breaker.failure():
+                the_self.metrics.inc('circuit_open')
+            the_self.metrics.inc('retries')
+            if quota_utils.is_throttling(err):
+                the_self.metrics.inc('throttled')
+                the_self.pacer.throttled()
+            # an IMAP4.error (not an abort) is rarely recoverable: retry 2 times before to quit
+            recoverable = isinstance(err, (PushEmailError, ) + CONNECTION_ERRORS)
+            nb_tries = _reconnect(the_self, err, nb_tries, a_nb_tries if recoverable else min(2, a_nb_tries), \
+                                  backoff, breaker)
+        else:
+            breaker.success()
+            the_self.pacer.succeeded()
+            return result
+
 #retry decorator with nb of tries and sleep_time and backoff
-def retry(a_nb_tries=3, a_sleep_time=1, a_backoff=1): #pylint:disable=R0912
+def retry(a_nb_tries=3, a_sleep_time=1, a_backoff=1):
     """
       Decorator for retrying command when it failed with a imap or socket error.
-      Should be used exclusively on imap exchanges.
+      Should be used exclusively on imap exchanges (see retry_call).
       Strategy, always retry on any imaplib or socket error. Wait few seconds before to retry
       backoff sets the factor by which the a_sleep_time should lengthen after each failure. backoff must be greater than 1,
       or else it isn't really a backoff
@@ -86,110 +225,13 @@ def retry(a_nb_tries=3, a_sleep_time=1, a_backoff=1): #pylint:disable=R0912
 
     if a_sleep_time <= 0:
         raise ValueError("a_sleep_time must be greater than 0")
-    
-    def reconnect(the_self, rec_nb_tries, total_nb_tries, rec_error, rec_sleep_time = [1]): #pylint: disable=W0102
-        """
-           Reconnect procedure. Sleep and try to reconnect
-        """
-        # go in retry mode if less than a_nb_tries
-        while rec_nb_tries[0] < total_nb_tries:
-            
-            LOG.critical("Disconnecting from Gmail Server and sleeping ...")
-            the_self.disconnect()            
-            
-            # add X sec of wait
-            time.sleep(rec_sleep_time[0])
-            rec_sleep_time[0] *= a_backoff #increase sleep time for next time
-            
-            rec_nb_tries[0] += 1
-            
-            #increase total nb of reconns
-            the_self.total_nb_reconns += 1
-           
-            # go in retry mode: reconnect.
-            # retry reconnect as long as we have tries left
-            try:
-                LOG.critical("Reconnecting to the from Gmail Server.")
-                
-                #reconnect to the current folder
-                the_self.connect(go_to_current_folder = True )
-                
-                return 
-            
-            except Exception as ignored:
-                # catch all errors and try as long as we have tries left
-                LOG.exception(ignored)
-        else:
-            #cascade error
-            raise rec_error
-    
-    def inner_retry(the_func): #pylint:disable=C0111,R0912
-        def wrapper(*args, **kwargs): #pylint:disable=C0111,R0912
-            nb_tries = [0] # make it mutable in reconnect
-            m_sleep_time = [a_sleep_time]  #make it mutable in reconnect
-            while True:
-                try:
-                    return the_func(*args, **kwargs)
-                except PushEmailError as p_err:
-                    
-                    LOG.debug("error message = %s. traceback:%s" % (p_err, gmvault_utils.get_exception_traceback()))
-                    
-                    if nb_tries[0] < a_nb_tries:
-                        LOG.critical("Cannot reach the Gmail server. Wait %s second(s) and retrying." % (m_sleep_time[0]))
-                    else:
-                        LOG.critical("Stop retrying, tried too many times ...")
-                    
-                    reconnect(args[0], nb_tries, a_nb_tries, p_err, m_sleep_time)
-                
-                except imaplib.IMAP4.abort as err: #abort is recoverable and error is not
-                    
-                    LOG.debug("IMAP (abort) error message = %s. traceback:%s" % (err, gmvault_utils.get_exception_traceback()))
-                    
-                    if nb_tries[0] < a_nb_tries:
-                        LOG.critical("Received an IMAP abort error. Wait %s second(s) and retrying." % (m_sleep_time[0]))
-                    else:
-                        LOG.critical("Stop retrying, tried too many times ...")
-                        
-                    # problem with this email, put it in quarantine
-                    reconnect(args[0], nb_tries, a_nb_tries, err, m_sleep_time)    
-                    
-                except socket.error as sock_err:
-                    LOG.debug("error message = %s. traceback:%s" % (sock_err, gmvault_utils.get_exception_traceback()))
-                    
-                    if nb_tries[0] < a_nb_tries:
-                        LOG.critical("Cannot reach the Gmail server. Wait %s second(s) and retrying." % (m_sleep_time[0]))
-                    else:
-                        LOG.critical("Stop retrying, tried too many times ...")
-                        
-                    reconnect(args[0], nb_tries, a_nb_tries, sock_err, m_sleep_time)
-                
-                except ssl.SSLError as ssl_err:
-                    LOG.debug("error message = %s. traceback:%s" % (ssl_err, gmvault_utils.get_exception_traceback()))
-                    
-                    if nb_tries[0] < a_nb_tries:
-                        LOG.critical("Cannot reach the Gmail server. Wait %s second(s) and retrying." % (m_sleep_time[0]))
-                    else:
-                        LOG.critical("Stop retrying, tried too many times ...")
-                        
-                    reconnect(args[0], nb_tries, a_nb_tries, sock_err, m_sleep_time)
-                
-                except imaplib.IMAP4.error as err:
-                    
-                    #just trace it back for the moment
-                    LOG.debug("IMAP (normal) error message = %s. traceback:%s" % (err, gmvault_utils.get_exception_traceback()))
-                    
-                    if nb_tries[0] < a_nb_tries:
-                        LOG.critical("Error when reaching Gmail server. Wait %s second(s) and retry up to 2 times." \
-                                     % (m_sleep_time[0]))
-                    else:
-                        LOG.critical("Stop retrying, tried too many times ...")
-                    
-                    #raise err
-                    # retry 2 times before to quit
-                    reconnect(args[0], nb_tries, 2, err, m_sleep_time)
+
+    def inner_retry(the_func): #pylint:disable=C0111
+        def wrapper(*args, **kwargs): #pylint:disable=C0111
+            return retry_call(args[0], functools.partial(the_func, *args, **kwargs), \
+                              a_nb_tries, a_sleep_time, a_backoff)
 
         return functools.wraps(the_func)(wrapper)
-        #return wrapper
     return inner_retry
 
 class GIMAPFetcher(object): #pylint:disable=R0902,R0904
@@ -215,9 +257,9 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
     
     EMAIL_BODY        = b'BODY[]'
     
-    GMAIL_SPECIAL_DIRS = [b'\\Inbox', b'\\Starred', b'\\Sent', b'\\Draft', b'\\Important']
+    GMAIL_SPECIAL_DIRS = ['\\Inbox', '\\Starred', '\\Sent', '\\Draft', '\\Important']
     
-    GMAIL_SPECIAL_DIRS_LOWER = [b'\\inbox', b'\\starred', b'\\sent', b'\\draft', b'\\important', b'\\trash']
+    GMAIL_SPECIAL_DIRS_LOWER = ['\\inbox', '\\starred', '\\sent', '\\draft', '\\important', '\\trash']
     
     IMAP_BODY_PEEK     = b'BODY.PEEK[]' #get body without setting msg as seen
 
@@ -228,7 +270,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
     IMAP_HEADER_FIELDS_KEY      = b'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]'
     
     #GET_IM_UID_RE
-    APPENDUID         = r'^[APPENDUID [0-9]* ([0-9]*)] \(Success\)$'
+    APPENDUID         = r'^\[APPENDUID [0-9]+ ([0-9]+)\] \(Success\)$'
     
     APPENDUID_RE      = re.compile(APPENDUID)
     
@@ -239,23 +281,39 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
                           IMAP_FLAGS, IMAP_HEADER_PEEK_FIELDS]
     
     GET_DATA_ONLY     = [ GMAIL_ID, IMAP_BODY_PEEK]
+
+    # what can change for a message already in the db
+    GET_FLAGS_LABELS  = [ GMAIL_ID, GMAIL_LABELS, IMAP_FLAGS]
  
     GET_GMAIL_ID      = [ GMAIL_ID ]
     
     GET_GMAIL_ID_DATE = [ GMAIL_ID,  IMAP_INTERNALDATE]
 
-    def __init__(self, host, port, login, credential, readonly_folder = True): #pylint:disable=R0913
+    TRANSPORTS = ('imapclient', 'asyncio')
+
+    def __init__(self, host, port, login, credential, readonly_folder = True, use_ssl = True, \
+                 metrics = None, transport = None, pacer = None): #pylint:disable=R0913
         '''
             Constructor
+            use_ssl: set it to False to talk to a plain text IMAP server (local test servers)
+            metrics: MetricsRegistry shared with the caller (a private one is created otherwise)
+            transport: imapclient or asyncio ([General] imap_transport by default)
+            pacer: QuotaPacer shared by the connections of the account (one from the defaults otherwise)
         '''
         self.host                   = host
         self.port                   = port
         self.login                  = login
         self.once_connected         = False
         self.credential             = credential
-        self.ssl                    = True
+        self.ssl                    = use_ssl
         self.use_uid                = True
         self.readonly_folder        = readonly_folder
+        self.metrics                = metrics if metrics is not None else metrics_utils.MetricsRegistry()
+        self.pacer                  = pacer if pacer is not None else quota_utils.QuotaPacer.from_conf()
+        self.transport              = transport or gmvault_utils.get_conf_defaults().get('General', 'imap_transport', \
+                                                                                         'imapclient')
+        if self.transport not in self.TRANSPORTS:
+            raise Exception("Unknown imap transport %s. Please use one of %s" % (self.transport, self.TRANSPORTS))
         
         self.localized_folders      = { 'ALLMAIL': { 'loc_dir' : None, 'friendly_name' : 'allmail'}, 
                                         'CHATS'  : { 'loc_dir' : None, 'friendly_name' : 'chats'}, 
@@ -263,8 +321,13 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         
         # memoize the current folder (All Mail or Chats) for reconnection management
         self.current_folder        = None
+        # SELECT response of the current folder (UIDVALIDITY, HIGHESTMODSEQ, ...)
+        self.current_folder_info   = {}
         
         self.server                 = None
+        # adaptive compression: None until measured, then True (keep it) or False (connect without it)
+        self.compression            = None
+        self.capabilities           = ()
         self.go_to_all_folder       = True
         self.total_nb_reconns       = 0
         # True when CHATS or other folder error msg has been already printed
@@ -277,7 +340,10 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         """
            spawn a connection with the same parameters
         """
-        conn = GIMAPFetcher(self.host, self.port, self.login, self.credential, self.readonly_folder)
+        conn = GIMAPFetcher(self.host, self.port, self.login, self.credential, self.readonly_folder, \
+                            use_ssl = self.ssl, metrics = self.metrics, transport = self.transport, \
+                            pacer = self.pacer)
+        conn.compression = self.compression
         conn.connect()
         return conn
         
@@ -286,7 +352,12 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
            connect to the IMAP server
         """
         # create imap object
-        self.server = mimap.MonkeyIMAPClient(self.host, port = self.port, use_uid= self.use_uid, need_ssl= self.ssl)
+        if self.transport == 'asyncio':
+            import gmv.aio_imap as aio_imap #pylint:disable=C0415
+            self.server = aio_imap.BlockingIMAPClient(self.host, port = self.port, use_uid = self.use_uid, \
+                                                      need_ssl = self.ssl)
+        else:
+            self.server = mimap.MonkeyIMAPClient(self.host, port = self.port, use_uid= self.use_uid, need_ssl= self.ssl)
         # connect with password or xoauth
         if self.credential['type'] == 'passwd':
             self.server.login(self.login, self.credential['value'])
@@ -297,7 +368,11 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
 
             LOG.debug("credential['value'] = %s" % (self.credential['value']))
             #try to login
-            self.server.oauth2_login(self.credential['value'])
+            try:
+                self.server.oauth2_login(self.credential['value'])
+            except imaplib.IMAP4.error:
+                credential_utils.CredentialHelper.forget_oauth2_credential(self.login)
+                raise
         else:
             raise Exception("Unknown authentication method %s. Please use xoauth or passwd authentication " \
                             % (self.credential['type']))
@@ -305,22 +380,58 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         #set connected to True to handle reconnection in case of failure
         self.once_connected = True
         
-        # check gmailness
-        self.check_gmailness()
-         
-        # find allmail chats and drafts folders
-        self.find_folder_names()
+        if self.server.tls_session_reused:
+            self.metrics.inc('tls_resumed')
+
+        # check gmailness and find allmail chats and drafts folders unless a connection did it recently
+        if not self._load_session():
+            self.check_gmailness()
+            self.find_folder_names()
+            self._save_session()
 
         if go_to_current_folder and self.current_folder:
-            self.server.select_folder(self.current_folder, readonly = self.readonly_folder)
+            self.current_folder_info = self.server.select_folder(self.current_folder, readonly = self.readonly_folder)
             
         #enable compression
-        if gmvault_utils.get_conf_defaults().get_boolean('General', 'enable_imap_compression', True):
-            self.enable_compression()
+        if self.compression_mode() != 'off' and self.enable_compression():
             LOG.debug("After Enabling compression.")
         else:
             LOG.debug("Do not enable imap compression.") 
             
+    def _session_key(self):
+        """ SESSION_CACHE key of the account """
+        return (self.host, self.port, self.login)
+
+    def _load_session(self):
+        """
+           Take the capabilities and folder names from SESSION_CACHE.
+           Return False if there are none younger than [General] session_cache_ttl seconds
+        """
+        ttl = gmvault_utils.get_conf_defaults().getint('General', 'session_cache_ttl', 3600)
+        session = SESSION_CACHE.get(self._session_key(), ttl) if ttl > 0 else None
+        if session is None:
+            return False
+        self.capabilities, self.localized_folders = session['capabilities'], session['folders']
+        self.metrics.inc('session_cache_hits')
+        LOG.debug("Reuse the capabilities and folder names of a previous connection")
+        return True
+
+    def _save_session(self):
+        """
+           Put the capabilities and folder names in SESSION_CACHE
+        """
+        SESSION_CACHE.put(self._session_key(), { 'capabilities' : self.capabilities, \
+                                                 'folders'      : self.localized_folders })
+
+    def circuit_breaker(self):
+        """
+           CircuitBreaker of the account, shared by all its connections
+        """
+        conf = gmvault_utils.get_conf_defaults()
+        return retry_utils.get_circuit_breaker(self._session_key(), \
+                                               conf.getint('General', 'circuit_breaker_failures', 5), \
+                                               conf.getint('General', 'circuit_breaker_cooldown', 300))
+
     def disconnect(self):
         """
            disconnect to avoid too many simultaneous connection problem
@@ -330,7 +441,8 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
                 self.server.logout()
             except Exception as ignored: #ignored exception but still log it in log file if activated
                 LOG.exception(ignored)
-                
+
+            self._report_compression()
             self.server = None
     
     def reconnect(self):
@@ -340,12 +452,66 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         self.disconnect()
         self.connect()
     
+    @classmethod
+    def compression_mode(cls):
+        """
+           off, always or auto ([General] enable_imap_compression and imap_compression_mode)
+        """
+        conf = gmvault_utils.get_conf_defaults()
+        if not conf.get_boolean('General', 'enable_imap_compression', False):
+            return 'off'
+        mode = conf.get('General', 'imap_compression_mode', 'auto').strip().lower()
+        if mode not in ('always', 'auto'):
+            raise Exception("Unknown imap_compression_mode %s. Please use always or auto" % (mode))
+        return mode
+
     def enable_compression(self):
         """
-           Try to enable the compression
+           Try to enable the compression (COMPRESS=DEFLATE) unless the adaptive mode found
+           that it does not pay off with this server. Return True if the connection is compressed
+        """
+        if self.compression is False or not self.server.has_capability('COMPRESS=DEFLATE'):
+            return False
+        conf = gmvault_utils.get_conf_defaults()
+        return self.server.enable_compression(conf.getint('General', 'imap_compression_level', 1), \
+                                              conf.getint('General', 'imap_compression_read_size', 65536))
+
+    def _check_compression(self):
+        """
+           Adaptive compression: once [General] imap_compression_sample_bytes have been transferred,
+           keep the compression if the time it saves on the wire exceeds its CPU time.
+           Reconnect without it otherwise (COMPRESS cannot be stopped on a connection)
         """
-        #self.server.enable_compression()
-        pass
+        stats = getattr(self.server, 'compression_stats', None)
+        if self.compression is not None or stats is None or self.compression_mode() != 'auto':
+            return
+        conf = gmvault_utils.get_conf_defaults()
+        if stats.payload < conf.getint('General', 'imap_compression_sample_bytes', 4194304):
+            return
+
+        self.compression = stats.pays_off(conf.getfloat('General', 'imap_compression_min_ratio', 1.1))
+        details = "ratio %.2f, %d ms of CPU for %d ms of transfers" \
+                  % (stats.ratio, stats.cpu_time * 1000, stats.io_time * 1000)
+        if self.compression:
+            LOG.debug("Keep the IMAP compression (%s)." % (details))
+            return
+        LOG.critical("IMAP compression does not pay off (%s). Reconnect without it." % (details))
+        self.metrics.inc('compression_disabled')
+        self.disconnect()
+        self.connect(go_to_current_folder = True)
+
+    def _report_compression(self):
+        """
+           Add the compression figures of the connection to the metrics
+        """
+        stats = getattr(self.server, 'compression_stats', None)
+        if not stats:
+            return
+        self.metrics.inc('compress_wire_bytes', stats.wire_in + stats.wire_out)
+        self.metrics.inc('compress_payload_bytes', stats.payload)
+        self.metrics.observe('deflate', stats.cpu_time)
+        LOG.debug("IMAP compression effective ratio %.2f (%d bytes on the wire for %d bytes)" \
+                  % (stats.ratio, stats.wire_in + stats.wire_out, stats.payload))
 
     @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
     def find_folder_names(self):
@@ -468,15 +634,67 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
             folder = self.localized_folders.get(a_folder_name, {'loc_dir' : 'GMVNONAME'})['loc_dir']
             
             if self.current_folder != folder:
-                self.server.select_folder(folder, readonly = self.readonly_folder)
+                try:
+                    self.current_folder_info = self.server.select_folder(folder, readonly = self.readonly_folder)
+                except imaplib.IMAP4.error:
+                    # the folder names may be outdated: find them again at the next connection
+                    SESSION_CACHE.invalidate(self._session_key())
+                    raise
                 self.current_folder = folder
             
         elif self.current_folder != a_folder_name:
-            self.server.select_folder(a_folder_name, readonly = self.readonly_folder)
+            self.current_folder_info = self.server.select_folder(a_folder_name, readonly = self.readonly_folder)
             self.current_folder = a_folder_name
         
         return self.current_folder
+
+    @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
+    def get_folder_status(self):
+        """
+           Reselect the current folder and return its (UIDVALIDITY, HIGHESTMODSEQ, UIDNEXT).
+           Return None if the server does not send HIGHESTMODSEQ (no CONDSTORE)
+        """
+        if not self.current_folder:
+            return None
+
+        self.current_folder_info = self.server.select_folder(self.current_folder, readonly = self.readonly_folder)
+
+        info = self.current_folder_info or {}
+        if b'UIDVALIDITY' not in info or b'HIGHESTMODSEQ' not in info:
+            return None
+
+        return int(info[b'UIDVALIDITY']), int(info[b'HIGHESTMODSEQ']), int(info.get(b'UIDNEXT', 0))
         
+    IDLE_CHANGES = (b'EXISTS', b'EXPUNGE', b'FETCH')
+
+    @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
+    def idle_wait(self, timeout, debounce = 2, stop_event = None):
+        """
+           Wait in IDLE until the server notifies a change of the current folder (EXISTS, EXPUNGE, FETCH),
+           for at most timeout seconds or until stop_event is set.
+           The notifications arriving less than debounce seconds apart are grouped (for at most 10 x debounce).
+           Return the list of notifications: (seq, b'EXISTS') ...
+        """
+        changes  = []
+        deadline = time.time() + timeout
+        self.server.idle()
+        try:
+            while not changes and time.time() < deadline and not (stop_event and stop_event.is_set()):
+                changes = [ resp for resp in self.server.idle_check(timeout = max(0, min(1, deadline - time.time()))) \
+                            if len(resp) > 1 and resp[1] in self.IDLE_CHANGES ]
+
+            debounce_end = time.time() + 10 * debounce
+            while changes and time.time() < debounce_end:
+                more = [ resp for resp in self.server.idle_check(timeout = debounce) \
+                         if len(resp) > 1 and resp[1] in self.IDLE_CHANGES ]
+                if not more:
+                    break
+                changes.extend(more)
+        finally:
+            self.server.idle_done()
+
+        return changes
+
     @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
     def list_all_folders(self): 
         """
@@ -492,7 +710,8 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         if not self.server:
             raise Exception("GIMAPFetcher not connect to the GMAIL server")
 
-        return self.server.capabilities()
+        self.capabilities = self.server.capabilities()
+        return self.capabilities
     
     @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
     def check_gmailness(self):
@@ -510,14 +729,61 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         """
            Return all found ids corresponding to the search
         """
-        return self.server.search(a_criteria)
+        with self.metrics.time('search'):
+            return self.server.search(a_criteria)
     
-    @retry(3,1,2) # try 4 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 8 sec
     def fetch(self, a_ids, a_attributes):
         """
-           Return all attributes associated to each message
+           Return all attributes associated to each message.
+           When the connection is lost in the middle of the FETCH, the messages received so far are kept
+           and only the other ones are requested again after the reconnection
+        """
+        return self.fetch_many(a_ids, a_attributes, 1)
+
+    def fetch_many(self, a_ids, a_attributes, nb_commands):
+        """
+           fetch with the ids split in nb_commands FETCH commands sent at once (pipelined).
+           Only the asyncio transport pipelines: imapclient sends a single command
         """
-        return self.server.fetch(a_ids, a_attributes)
+        stage    = 'body_fetch' if GIMAPFetcher.IMAP_BODY_PEEK in a_attributes else 'metadata_fetch'
+        ids      = [ a_ids ] if isinstance(a_ids, int) else list(a_ids)
+        received = {}
+
+        def fetch_left():
+            """ fetch the ids not received yet """
+            self._check_compression()
+            left = [ the_id for the_id in ids if the_id not in received ] if received else ids
+            try:
+                with self.metrics.time(stage):
+                    if nb_commands > 1 and len(left) > 1 and self.transport == 'asyncio':
+                        size = int(math.ceil(len(left) / float(nb_commands)))
+                        data = self.server.fetch_many([ left[i:i + size] for i in range(0, len(left), size) ], \
+                                                      a_attributes)
+                    else:
+                        data = self.server.fetch(left, a_attributes)
+            except RETRY_ERRORS as err:
+                partial = getattr(err, 'partial', None)
+                if partial:
+                    LOG.debug("Keep the %d message(s) received before the error" % (len(partial)))
+                    self._transferred('in', metrics_utils.data_size(partial))
+                    self.metrics.inc('retry_kept_msgs', len(partial))
+                    received.update(partial)
+                raise
+            self._transferred('in', metrics_utils.data_size(data))
+            received.update(data)
+            return received
+
+        # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2
+        return retry_call(self, fetch_left, 3, 1, 2)
+
+    def _transferred(self, direction, nb_bytes):
+        """
+           Count nb_bytes in the metrics and pace them against the Gmail quotas
+        """
+        self.metrics.inc('bytes_in' if direction == 'in' else 'bytes_out', nb_bytes)
+        waited = self.pacer.pace(direction, nb_bytes)
+        if waited:
+            self.metrics.observe('quota_wait', waited)
 
     @classmethod
     def _build_labels_str(cls, a_labels):
@@ -583,8 +849,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         # get in lower case because Gmail labels are case insensitive
         listed_folders   = set([ directory.lower() for (_, _, directory) in self.list_all_folders() ])
         existing_folders = listed_folders.union(existing_folders)
-        reserved_labels_map = gmvault_utils.get_conf_defaults().get_dict("Restore", "reserved_labels_map", \
-                              { 'migrated' : 'gmv-migrated', '\muted' : 'gmv-muted' })
+        reserved_labels_map = gmvault_utils.get_conf_view().reserved_labels_map
         
         
 
@@ -593,7 +858,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         for lab in labels:
             #LOG.info("Reserved labels = %s\n" % (reserved_labels))
             #LOG.info("lab.lower = %s\n" % (lab.lower()))
-            if lab.lower() in list(reserved_labels_map.keys()): #exclude creation of migrated label
+            if lab.lower() in reserved_labels_map: #exclude creation of migrated label
                 n_lab = reserved_labels_map.get(lab.lower(), "gmv-default-label")
                 LOG.info("Warning ! label '%s' (lower or uppercase) is reserved by Gmail and cannot be used."\
                          "Use %s instead" % (lab, n_lab)) 
@@ -607,7 +872,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
                 low_directory = directory.lower() #get lower case directory but store original label
                 if (low_directory not in existing_folders) and (low_directory not in self.GMAIL_SPECIAL_DIRS_LOWER):
                     try:
-                        if self.server.create_folder(directory) != 'Success':
+                        if mimap.to_unicode(self.server.create_folder(directory)) != 'Success':
                             raise Exception("Cannot create label %s: the directory %s cannot be created." % (lab, directory))
                         else:
                             LOG.debug("============== ####### Created Labels (%s)." % (directory))
@@ -628,9 +893,10 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
     
     
     @retry(3,1,2)
-    def apply_labels_to(self, imap_ids, labels):
+    def apply_labels_to(self, imap_ids, labels, utf7_encoded = False):
         """
            apply one labels to x emails
+           utf7_encoded: the labels are already encoded (LabelDictionary imap names)
         """
         # go to All Mail folder
         LOG.debug("Applying labels %s" % (labels))
@@ -639,7 +905,8 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         the_timer.start()
 
         #utf7 the labels as they should be
-        labels = [ utf7_encode(label) for label in labels ]
+        if not utf7_encoded:
+            labels = [ utf7_encode(label) for label in labels ]
 
         labels_str = self._build_labels_str(labels) # create labels str
     
@@ -650,7 +917,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
             id_list = ",".join(map(str, imap_ids))
             #+X-GM-LABELS.SILENT to have not returned data
             try:
-                ret_code, data = self.server._imap.uid('STORE', id_list, '+X-GM-LABELS.SILENT', labels_str) #pylint: disable=W0212
+                ret_code, data = self.server.uid_store(id_list, '+X-GM-LABELS.SILENT', labels_str)
             except imaplib.IMAP4.error as original_err:
                 LOG.info("Error in apply_labels_to. See exception traceback")
                 LOG.debug(gmvault_utils.get_exception_traceback())
@@ -658,7 +925,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
                 faulty_ids = []
                 for the_id in imap_ids:
                     try:
-                       ret_code, data = self.server._imap.uid('STORE', the_id, '+X-GM-LABELS.SILENT', labels_str) #pylint: disable=W0212
+                       ret_code, data = self.server.uid_store(the_id, '+X-GM-LABELS.SILENT', labels_str)
                     except imaplib.IMAP4.error as store_err:
                        LOG.debug("Error when trying to apply labels %s to emails with imap_id %s. Error:%s" % (labels_str, the_id, store_err))
                        faulty_ids.append(the_id)
@@ -666,6 +933,8 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
                 #raise an error to ignore faulty emails       
                 raise LabelError("Cannot add Labels %s to emails with uids %s. Error:%s" % (labels_str, faulty_ids, original_err), ignore = True) 
 
+            self.metrics.observe('store', the_timer.elapsed_ms())
+
             #ret_code, data = self.server._imap.uid('COPY', id_list, labels[0])
             LOG.debug("After storing labels %s. Operation time = %s s.\nret = %s\ndata=%s" \
                       % (labels_str, the_timer.elapsed_ms(),ret_code, data))
@@ -676,7 +945,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
                 faulty_ids = []
                 for the_id in imap_ids:
                     try:
-                       ret_code, data = self.server._imap.uid('STORE', the_id, '+X-GM-LABELS.SILENT', labels_str) #pylint: disable=W0212
+                       ret_code, data = self.server.uid_store(the_id, '+X-GM-LABELS.SILENT', labels_str)
                     except imaplib.IMAP4.error as store_err:
                        LOG.debug("Error when trying to apply labels %s to emails with imap_id %s. Error:%s" % (labels_str, the_id, store_err))
                        faulty_ids.append(the_id)
@@ -785,6 +1054,9 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         if self.login == 'guillaume.aubert@gmail.com':
             raise Exception("Cannot push to this account")
         
+        self._check_compression()
+        self._transferred('out', len(a_body))
+
         the_timer = gmvault_utils.Timer()
         the_timer.start()
         LOG.debug("Before to Append email contents")
@@ -807,10 +1079,13 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
               self.reconnect()
               res    = self.server.append(a_folder, a_body, a_flags, a_internal_time)
     
+        self.metrics.observe('append', the_timer.elapsed_ms())
+
         LOG.debug("Appended data with flags %s and internal time %s. Operation time = %s.\nres = %s\n" \
                   % (a_flags, a_internal_time, the_timer.elapsed_ms(), res))
         
         # check res otherwise Exception
+        res = mimap.to_unicode(res) if res else ''
         if '(Success)' not in res:
             raise PushEmailError("GIMAPFetcher cannot restore email in %s account." %(self.login))
         
@@ -877,7 +1152,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
             self.server.select_folder('[Google Mail]/All Mail', readonly = self.readonly_folder) # go to current folder
             LOG.debug("Changing folders. elapsed %s s\n" % (the_t.elapsed_ms()))
             the_t.start()
-            ret_code, data = self.server._imap.uid('STORE', result_uid, '+X-GM-LABELS', labels_str) #pylint: disable=W0212
+            ret_code, data = self.server.uid_store(result_uid, '+X-GM-LABELS', labels_str)
             #ret_code = self.server._store('+X-GM-LABELS', [result_uid],labels_str)
             LOG.debug("After storing labels %s. Operation time = %s s.\nret = %s\ndata=%s" \
                       % (labels_str, the_t.elapsed_ms(),ret_code, data))
@@ -902,26 +1177,17 @@ def decode_labels(labels):
 
     return new_labels
 
-# utf7 conversion functions
+# utf7 conversion functions (IMAP modified UTF-7, RFC 3501 5.1.3)
 def utf7_encode(s): #pylint: disable=C0103
     """encode in utf7"""
-    if isinstance(s, str) and sum(n for n in (ord(c) for c in s) if n > 127):
-        raise ValueError("%r contains characters not valid in a str folder name. "
-                              "Convert to unicode first?" % s)
-
     r = [] #pylint: disable=C0103
     _in = []
     for c in s: #pylint: disable=C0103
-        if ord(c) in (list(range(0x20, 0x26)) + list(range(0x27, 0x7f))):
-            if _in:
-                r.extend(['&', utf7_modified_base64(''.join(_in)), '-'])
-                del _in[:]
-            r.append(str(c))
-        elif c == '&':
+        if 0x20 <= ord(c) < 0x7f:
             if _in:
                 r.extend(['&', utf7_modified_base64(''.join(_in)), '-'])
                 del _in[:]
-            r.append('&-')
+            r.append('&-' if c == '&' else c)
         else:
             _in.append(c)
     if _in:
@@ -948,21 +1214,14 @@ def utf7_decode(s): #pylint: disable=C0103
             r.append(c)
     if decode:
         r.append(utf7_modified_unbase64(''.join(decode[1:])))
-    out = ''.join(r)
-
-    if not isinstance(out, str):
-        out = str(out, 'latin-1')
-    return out
+    return ''.join(r)
 
 
 def utf7_modified_base64(s): #pylint: disable=C0103
-    """utf7 base64"""
-    s_utf7 = s.encode('utf-7')
-    return s_utf7[1:-1].replace('/', ',')
+    """utf7 base64: utf-16 big endian, no padding and , instead of /"""
+    return base64.b64encode(s.encode('utf-16-be')).decode('ascii').rstrip('=').replace('/', ',')
 
 
 def utf7_modified_unbase64(s): #pylint: disable=C0103
     """ utf7 unbase64"""
-    s_utf7 = '+' + s.replace(',', '/') + '-'
-    return s_utf7.decode('utf-7')
-
+    return base64.b64decode(s.replace(',', '/') + '=' * (-len(s) % 4)).decode('utf-16-be')
@@ -18,6 +18,10 @@
 '''
 import sys
 import os
+import atexit
+import queue
+import threading
+import time
 
 import logbook
 
@@ -45,6 +49,151 @@ point to the old one.
         """
         return sys.stdout
 
+class QueuedHandler(logbook.WrapperHandler):
+    """
+       Hand the records over to a background thread writing them with the wrapped handler,
+       so that the sync/restore loops do not wait for the terminal or the disk.
+       The record information (message, frame, thread) is pulled before queuing (the args may be
+       modified later by the caller). emit never blocks: it is also called from the signal handlers
+       (traceback dump, profiler toggle), which may interrupt a thread in the middle of an emit,
+       so the queue is a reentrant SimpleQueue (unbounded).
+    """
+    _direct_attrs = frozenset(['handler', 'queue', '_thread'])
+
+    def __init__(self, handler):
+        logbook.WrapperHandler.__init__(self, handler)
+        self.queue   = queue.SimpleQueue()
+        self._thread = threading.Thread(target = self._write_records, name = 'gmvault-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        """ pull the record information now and queue the record """
+        record.pull_information()
+        self.queue.put(record)
+
+    def _write_records(self):
+        """ writer thread """
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            if isinstance(record, threading.Event): # flush marker
+                record.set()
+                continue
+            try:
+                self.handler.handle(record)
+            except Exception: #pylint:disable=W0703
+                pass # nowhere to report it
+
+    def flush(self):
+        """ wait until all the records queued before have been written """
+        if self._thread.is_alive():
+            written = threading.Event()
+            self.queue.put(written)
+            written.wait()
+
+    def close(self):
+        """ write the queued records and stop the writer thread """
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self.handler.close()
+
+class ProgressLogger(object):
+    """
+       Collapse the per message progress in one record logged at most every period seconds.
+    """
+    def __init__(self, logger, timer, total, what = 'emails', action = 'stored', period = 5):
+        """
+           logger: where to log, timer: started gmvault_utils.Timer
+           total: nb of messages to process, what/action: used in the message
+        """
+        self.logger    = logger
+        self.timer     = timer
+        self.total     = total
+        self.what      = what
+        self.action    = action
+        self.period    = period
+        self.done      = 0
+        self._last_log = time.time()
+
+    def update(self, nb_done = 1):
+        """ nb_done more messages processed """
+        self.done += nb_done
+        now = time.time()
+        if (now - self._last_log) >= self.period and self.done < self.total:
+            self._last_log = now
+            self.log_progress()
+
+    def log_progress(self):
+        """ log the progress record now """
+        elapsed, left = self.timer.elapsed(), max(self.total - self.done, 0)
+        self.logger.critical("\n== Processed %d %s in %s. %d left to be %s (time estimate %s). ==\n" % \
+                             (self.done, self.what, self.timer.seconds_to_human_time(elapsed), left, self.action, \
+                              self.timer.estimate_time_left(self.done, elapsed, left)))
+
+class PhaseProgress(ProgressLogger):
+    """
+       Progress of one phase (e.g. the chats) of a CombinedProgress
+    """
+    def __init__(self, parent, total, what):
+        super(PhaseProgress, self).__init__(parent.logger, parent.timer, total, what, parent.action, parent.period)
+        self.parent = parent
+
+    def update(self, nb_done = 1):
+        """ nb_done more messages processed """
+        self.parent.update(self, nb_done)
+
+class CombinedProgress(object):
+    """
+       Progress of phases running at the same time (emails and chats) logged in one record
+       at most every period seconds. Thread safe.
+    """
+    def __init__(self, logger, timer, action = 'stored', period = 5):
+        self.logger    = logger
+        self.timer     = timer
+        self.action    = action
+        self.period    = period
+        self.phases    = []
+        self._lock     = threading.Lock()
+        self._last_log = time.time()
+
+    def phase(self, what, total):
+        """ add a phase of total messages. Return its PhaseProgress """
+        with self._lock:
+            the_phase = PhaseProgress(self, total, what)
+            self.phases.append(the_phase)
+            return the_phase
+
+    @property
+    def done(self):
+        """ nb of messages processed by all the phases """
+        return sum(the_phase.done for the_phase in self.phases)
+
+    @property
+    def total(self):
+        """ nb of messages to process by all the phases """
+        return sum(the_phase.total for the_phase in self.phases)
+
+    def update(self, the_phase, nb_done = 1):
+        """ nb_done more messages processed by the_phase """
+        with self._lock:
+            the_phase.done += nb_done
+            now = time.time()
+            if (now - self._last_log) >= self.period and self.done < self.total:
+                self._last_log = now
+                self.log_progress()
+
+    def log_progress(self):
+        """ log the progress record now """
+        done, total = self.done, self.total
+        elapsed, left = self.timer.elapsed(), max(total - done, 0)
+        phases = ", ".join("%d/%d %s" % (the_phase.done, the_phase.total, the_phase.what) for the_phase in self.phases)
+        self.logger.critical("\n== Processed %s in %s. %d left to be %s (time estimate %s). ==\n" % \
+                             (phases, self.timer.seconds_to_human_time(elapsed), left, self.action, \
+                              self.timer.estimate_time_left(done, elapsed, left)))
+
 #default log file
 DEFAULT_LOG = "%s/gmvault.log" % (os.getenv("HOME", "."))
 
@@ -54,12 +203,40 @@ class LogbookLoggerFactory(object):
     """
     
     def __init__(self):
-        pass
+        self.queued_handlers = []
+    
+    def _queue(self, handler, queued):
+        """
+           wrap handler in a QueuedHandler if queued
+        """
+        if not queued:
+            return handler
+        queued_handler = QueuedHandler(handler)
+        if not self.queued_handlers:
+            atexit.register(self.close_queued_handlers)
+        self.queued_handlers.append(queued_handler)
+        return queued_handler
+    
+    def flush(self):
+        """
+           wait until the queued records have been written (before prompting the user for instance)
+        """
+        for handler in self.queued_handlers:
+            handler.flush()
+    
+    def close_queued_handlers(self):
+        """
+           write the pending records and stop the writer threads
+        """
+        for handler in self.queued_handlers:
+            handler.close()
+        self.queued_handlers = []
     
     def setup_cli_app_handler(self, activate_log_file=False, console_level= 'CRITICAL', \
-                              file_path=DEFAULT_LOG, log_file_level = 'DEBUG'):
+                              file_path=DEFAULT_LOG, log_file_level = 'DEBUG', queued = False):
         """
            Setup a handler for communicating with the user and still log everything in a logfile
+           queued: write the records in a background thread
         """
         null_handler = logbook.NullHandler()
         
@@ -69,7 +246,7 @@ class LogbookLoggerFactory(object):
         null_handler.push_application()
         
         # add output Handler
-        out_handler.push_application() 
+        self._queue(out_handler, queued).push_application() 
         
         # add file Handler
         if activate_log_file:
@@ -77,7 +254,7 @@ class LogbookLoggerFactory(object):
                            '[{record.time:%Y-%m-%d %H:%M}]:{record.level_name}:{record.channel}:{record.message}',\
                                                 level = log_file_level, bubble = True)
             
-            file_handler.push_application()
+            self._queue(file_handler, queued).push_application()
     
     def setup_simple_file_handler(self, file_path):
         """
@@ -158,6 +335,13 @@ class LoggerFactory(object):
         return cls._factory.get_logger(name)
     
     
+    @classmethod
+    def flush(cls):
+        """
+           Wait until the queued records have been written
+        """
+        cls._factory.flush()
+    
     @classmethod
     def setup_simple_stderr_handler(cls, the_type):
         """
@@ -182,11 +366,11 @@ class LoggerFactory(object):
     @classmethod
     def setup_cli_app_handler(cls, the_type, activate_log_file=False, \
                               console_level= 'CRITICAL', file_path=DEFAULT_LOG,\
-                               log_file_level = 'DEBUG'):
+                               log_file_level = 'DEBUG', queued = False):
         """
            init logging engine
         """
         cls.get_factory(the_type).setup_cli_app_handler(activate_log_file, \
                                                     console_level, \
-                                                    file_path, log_file_level)
+                                                    file_path, log_file_level, queued)
         
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the metrics registry used to measure sync, restore and export runs.
+
+Counters (bytes_in, reconnections, ...) and per stage timings (search, metadata_fetch,
+body_fetch, decompress, encrypt, write, append, store, ...) are collected in a
+MetricsRegistry. It can be dumped as a JSON summary, written as a Prometheus textfile
+(node_exporter textfile collector) or served on a local HTTP endpoint.
+
+'''
+import contextlib
+import json
+import os
+import threading
+import time
+
+import gmv.log_utils as log_utils
+
+LOG = log_utils.LoggerFactory.get_logger('metrics_utils')
+
+def data_size(data):
+    """
+       Size in bytes of the bytes/str values of a (nested) IMAP fetch response
+    """
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    if isinstance(data, dict):
+        return sum(data_size(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(data_size(value) for value in data)
+    return 0
+
+class MetricsRegistry(object):
+    """
+       Thread safe registry of counters and stage timings
+    """
+    NAMESPACE = 'gmvault'
+
+    def __init__(self, **labels):
+        """
+           labels: key/values added to all exported metrics (operation, login, ...)
+        """
+        self._lock      = threading.Lock()
+        self.labels     = dict(labels)
+        self.counters   = {}
+        self.stages     = {} # stage -> [calls, total seconds, min, max]
+        self.start_time = time.time()
+
+    def set_label(self, key, value):
+        """ add or change a label """
+        self.labels[key] = value
+
+    def inc(self, name, value = 1):
+        """ increment the counter name """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_counter(self, name, value):
+        """ set the counter name to value """
+        with self._lock:
+            self.counters[name] = value
+
+    def observe(self, stage, seconds):
+        """ record one execution of stage """
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                self.stages[stage] = [1, seconds, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                if seconds < stats[2]:
+                    stats[2] = seconds
+                if seconds > stats[3]:
+                    stats[3] = seconds
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """
+           with metrics.time('search'):
+               ...
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def get_counter(self, name):
+        """ counter value (0 if never incremented) """
+        return self.counters.get(name, 0)
+
+    def summary(self):
+        """ dict summary of the run """
+        with self._lock:
+            stages = {}
+            for stage, (calls, total, s_min, s_max) in self.stages.items():
+                stages[stage] = { 'calls' : calls, 'seconds' : round(total, 6), \
+                                  'min' : round(s_min, 6), 'max' : round(s_max, 6), \
+                                  'avg' : round(total / calls, 6) }
+            return { 'labels'   : dict(self.labels),
+                     'start'    : self.start_time,
+                     'elapsed'  : round(time.time() - self.start_time, 3),
+                     'counters' : dict(self.counters),
+                     'stages'   : stages }
+
+    def save_json(self, path):
+        """ write the JSON summary in path """
+        with open(path, 'w') as the_file:
+            json.dump(self.summary(), the_file, indent = 1, sort_keys = True)
+
+    @classmethod
+    def _escape(cls, value):
+        """ escape a prometheus label value """
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def _labels_str(self, extra = None):
+        """ {key="value",...} """
+        labels = dict(self.labels)
+        if extra:
+            labels.update(extra)
+        if not labels:
+            return ''
+        return '{%s}' % (','.join('%s="%s"' % (key, self._escape(val)) for key, val in sorted(labels.items())))
+
+    def to_prometheus(self):
+        """ Prometheus text exposition format """
+        summary, name = self.summary(), self.NAMESPACE
+        lines = [ '# TYPE %s_run_elapsed_seconds gauge' % (name),
+                  '%s_run_elapsed_seconds%s %s' % (name, self._labels_str(), summary['elapsed']) ]
+        for counter, value in sorted(summary['counters'].items()):
+            lines.append('# TYPE %s_%s_total counter' % (name, counter))
+            lines.append('%s_%s_total%s %s' % (name, counter, self._labels_str(), value))
+        if summary['stages']:
+            lines.append('# TYPE %s_stage_calls_total counter' % (name))
+            lines.append('# TYPE %s_stage_seconds_total counter' % (name))
+            lines.append('# TYPE %s_stage_seconds_max gauge' % (name))
+        for stage, stats in sorted(summary['stages'].items()):
+            labels = self._labels_str({ 'stage' : stage })
+            lines.append('%s_stage_calls_total%s %s' % (name, labels, stats['calls']))
+            lines.append('%s_stage_seconds_total%s %s' % (name, labels, stats['seconds']))
+            lines.append('%s_stage_seconds_max%s %s' % (name, labels, stats['max']))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+           Write the metrics for the node_exporter textfile collector.
+           Atomic (written in a temp file then renamed) so a scrape never sees a partial file
+        """
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as the_file:
+            the_file.write(self.to_prometheus())
+        os.rename(tmp_path, path)
+
+    def serve_http(self, port, host = '127.0.0.1'):
+        """
+           Serve /metrics on host:port in a background thread. Return the server (call shutdown() to stop it)
+        """
+        import http.server #pylint:disable=C0415
+
+        registry = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            """ /metrics handler """
+            def do_GET(self): #pylint:disable=C0103
+                """ GET """
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): #pylint:disable=W0221
+                """ no access logs on stderr """
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target = server.serve_forever, name = 'gmvault-metrics')
+        thread.daemon = True
+        thread.start()
+        LOG.debug("Serve metrics on http://%s:%s/metrics" % (host, server.server_address[1]))
+        return server
@@ -24,11 +24,14 @@ import datetime
 import re
 import socket
 import ssl
-import io
 import os
+import threading
+import time
 
 import imaplib  #for the exception
 import imapclient
+import imapclient.imap4
+import imapclient.tls
 
 #enable imap debugging if GMV_IMAP_DEBUG is set 
 if os.getenv("GMV_IMAP_DEBUG"):
@@ -94,138 +97,189 @@ def datetime_to_imap(dt):
     return dt.strftime("%d-%b-%Y %H:%M:%S %z")
 
 def to_unicode(s):
-    if isinstance(s, imapclient.six.binary_type):
+    if isinstance(s, bytes):
         return s.decode('ascii')
     return s
 
 def to_bytes(s):
-    if isinstance(s, imapclient.six.text_type):
+    if isinstance(s, str):
         return s.encode('ascii')
     return s
 
-class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable=R0904
+class CompressionStats(object):
     """
-       Add support for compression inspired by http://www.janeelix.com/piers/python/py2html.cgi/piers/python/imaplib2
+       What COMPRESS=DEFLATE costs and saves on a connection: bytes on the wire, payload bytes,
+       CPU time spent in zlib and time spent waiting on the socket
     """
-    SOCK_TIMEOUT = 70 # set a socket timeout of 70 sec to avoid for ever blockage in ssl.read
-
-    def __init__(self, host = '', port = imaplib.IMAP4_SSL_PORT, keyfile = None, certfile = None):
+    def __init__(self):
+        self.wire_in     = 0
+        self.payload_in  = 0
+        self.wire_out    = 0
+        self.payload_out = 0
+        self.cpu_time    = 0.0
+        self.io_time     = 0.0
+
+    @property
+    def payload(self):
+        """ payload bytes in both directions """
+        return self.payload_in + self.payload_out
+
+    @property
+    def ratio(self):
+        """ effective compression ratio (payload / wire bytes) """
+        wire = self.wire_in + self.wire_out
+        return float(self.payload) / wire if wire else 1.0
+
+    def pays_off(self, min_ratio = 1.1):
         """
-           constructor
+           True if the compression is worth its CPU time. Without compression the transfers
+           would have taken about io_time * ratio: keep it if it saves more than cpu_time
         """
-        self.compressor = None
-        self.decompressor = None
-        
-        imaplib.IMAP4_SSL.__init__(self, host, port, keyfile, certfile)
-        
-    def activate_compression(self):
+        ratio = self.ratio
+        return ratio >= min_ratio and self.io_time * (ratio - 1) > self.cpu_time
+
+class DeflateIMAP4Mixin(object):
+    """
+       COMPRESS=DEFLATE (RFC 4978) for the imaplib.IMAP4 classes: after activate_compression
+       the socket is read by chunks of read_size and inflated, the data sent is deflated
+    """
+    compressor        = None
+    decompressor      = None
+    compression_stats = None
+    read_size         = 65536
+
+    def activate_compression(self, level = zlib.Z_DEFAULT_COMPRESSION, read_size = None):
         """
-           activate_compressing()
-           Enable deflate compression on the socket (RFC 4978).
+           Deflate the connection from now on (call it after the OK of COMPRESS DEFLATE).
+           level: zlib level of the data sent
         """
         # rfc 1951 - pure DEFLATE, so use -15 for both windows
-        self.decompressor = zlib.decompressobj(-15)
-        self.compressor   = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
-        
-    def open(self, host = '', port = imaplib.IMAP4_SSL_PORT): 
-        """Setup connection to remote server on "host:port".
-           (default: localhost:standard IMAP4 SSL port).
-           This connection will be used by the routines:
-           read, readline, send, shutdown.
-        """
-        self.host   = host
-        self.port   = port
+        self.compressor        = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.decompressor      = zlib.decompressobj(-15)
+        self.compression_stats = CompressionStats()
+        self.read_size         = read_size or self.read_size
+        self._inflated         = bytearray()
+
+    def _fill(self):
+        """ read and inflate the next chunk. Return False on EOF """
+        stats = self.compression_stats
+        start = time.perf_counter()
+        data  = self.sock.recv(self.read_size)
+        stats.io_time += time.perf_counter() - start
+        if not data:
+            return False
+        start = time.thread_time()
+        inflated = self.decompressor.decompress(data)
+        stats.cpu_time   += time.thread_time() - start
+        stats.wire_in    += len(data)
+        stats.payload_in += len(inflated)
+        self._inflated += inflated
+        return True
+
+    def _take(self, size):
+        """ remove and return size bytes from the inflated buffer """
+        data = bytes(self._inflated[:size])
+        del self._inflated[:size]
+        return data
 
-        self.sock   = socket.create_connection((host, port), self.SOCK_TIMEOUT) #add so_timeout  
+    def read(self, size):
+        """ read size bytes (less on EOF) """
+        if self.decompressor is None:
+            return super(DeflateIMAP4Mixin, self).read(size)
+        while len(self._inflated) < size and self._fill():
+            pass
+        return self._take(size)
+
+    def readline(self):
+        """ read a line including CRLF (what is left on EOF) """
+        if self.decompressor is None:
+            return super(DeflateIMAP4Mixin, self).readline()
+        start = 0
+        while True:
+            pos = self._inflated.find(b'\n', start)
+            if pos >= 0:
+                return self._take(pos + 1)
+            if len(self._inflated) > imaplib._MAXLINE: #pylint:disable=W0212
+                raise self.error('got more than %d bytes' % imaplib._MAXLINE) #pylint:disable=W0212
+            start = len(self._inflated)
+            if not self._fill():
+                return self._take(len(self._inflated))
 
-        #self.sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1) #try to set TCP NO DELAY to increase performances
+    def send(self, data):
+        """ send data (deflated once the compression is active) """
+        if self.compressor is None:
+            return super(DeflateIMAP4Mixin, self).send(data)
+        stats = self.compression_stats
+        start = time.thread_time()
+        deflated = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        stats.cpu_time    += time.thread_time() - start
+        stats.payload_out += len(data)
+        stats.wire_out    += len(deflated)
+        start = time.perf_counter()
+        self.sock.sendall(deflated)
+        stats.io_time += time.perf_counter() - start
+        return None
+
+class IMAP4Deflate(DeflateIMAP4Mixin, imapclient.imap4.IMAP4WithTimeout): #pylint:disable=R0904
+    """
+       Plain text IMAP4 connection supporting COMPRESS=DEFLATE
+    """
 
-        self.sslobj = ssl.wrap_socket(self.sock, self.keyfile, self.certfile)
-        #self.sslobj = ssl.wrap_socket(self.sock, self.keyfile, self.certfile, suppress_ragged_eofs = False)
-        
-        # This is the last correction added to avoid memory fragmentation in imaplib
-        # makefile creates a file object that makes use of cStringIO to avoid mem fragmentation
-        # it could be used without the compression 
-        # (maybe make 2 set of methods without compression and with compression)
-        #self.file   = self.sslobj.makefile('rb')
+_TLS_CONTEXT      = None
+_TLS_CONTEXT_LOCK = threading.Lock()
 
-    def new_read(self, size):
-        """
-            Read 'size' bytes from remote.
-            Call _intern_read that takes care of the compression
-        """
-        
-        chunks = io.StringIO() #use cStringIO.cStringIO to avoir too much fragmentation
-        read = 0
-        while read < size:
-            try:
-                data = self._intern_read(min(size-read, 16384)) #never ask more than 16384 because imaplib can do it
-            except ssl.SSLError as err:
-                print(("************* SSLError received %s" % (err))) 
-                raise self.abort('Gmvault ssl socket error: EOF. Connection lost, reconnect.')
-            read += len(data)
-            chunks.write(data)
-        
-        return chunks.getvalue() #return the cStringIO content
-    
-    def read(self, size):
-        """
-            Read 'size' bytes from remote.
-            Call _intern_read that takes care of the compression
-        """
-        
-        chunks = io.StringIO() #use cStringIO.cStringIO to avoir too much fragmentation
-        read = 0
-        while read < size:
-            data = self._intern_read(min(size-read, 16384)) #never ask more than 16384 because imaplib can do it
-            if not data: 
-                #to avoid infinite looping due to empty string returned
-                raise self.abort('Gmvault ssl socket error: EOF. Connection lost, reconnect.') 
-            read += len(data)
-            chunks.write(data)
-        
-        return chunks.getvalue() #return the cStringIO content
-  
-    def _intern_read(self, size):
+def get_tls_context():
+    """
+       The client SSLContext shared by all the connections: a TLS session can only be resumed
+       with the context that created it
+    """
+    global _TLS_CONTEXT #pylint:disable=W0603
+    with _TLS_CONTEXT_LOCK:
+        if _TLS_CONTEXT is None:
+            _TLS_CONTEXT = imapclient.tls.create_default_context()
+    return _TLS_CONTEXT
+
+class IMAP4ResumedTLS(DeflateIMAP4Mixin, imapclient.tls.IMAP4_TLS): #pylint:disable=R0904
+    """
+       IMAP4_TLS resuming the TLS session of the previous connection to the same server,
+       so that a reconnection costs an abbreviated handshake. Supports COMPRESS=DEFLATE
+    """
+    SESSIONS      = {} # (host, port) : ssl.SSLSession
+    SESSIONS_LOCK = threading.Lock()
+
+    def _create_socket(self, timeout = None):
+        if timeout is None:
+            timeout = self._timeout
+        sock = socket.create_connection((self.host, self.port), timeout = timeout)
+        with self.SESSIONS_LOCK:
+            session = self.SESSIONS.get((self.host, self.port))
+        return self.ssl_context.wrap_socket(sock, server_hostname = self.host, session = session)
+
+    def save_tls_session(self):
         """
-            Read at most 'size' bytes from remote.
-            Takes care of the compression
+           Keep the TLS session for the next connection. Call it once data has been read
+           (TLS 1.3 sends the session tickets after the handshake)
         """
-        if self.decompressor is None:
-            return self.sslobj.read(size)
+        if self.sock.session is not None:
+            with self.SESSIONS_LOCK:
+                self.SESSIONS[(self.host, self.port)] = self.sock.session
 
-        if self.decompressor.unconsumed_tail:
-            data = self.decompressor.unconsumed_tail
+def parse_partial_fetch(data, messages, normalise_times = True, uid_is_key = True):
+    """
+       { id : attributes } of the FETCH responses (imaplib format) received for messages before
+       a connection loss. The last response can be truncated: it is dropped
+    """
+    data = list(data)
+    while data:
+        try:
+            response = imapclient.response_parser.parse_fetch_response(data, normalise_times, uid_is_key)
+        except (imapclient.exceptions.ProtocolError, ValueError):
+            data.pop()
         else:
-            data = self.sslobj.read(8192) #Fixed buffer size. maybe change to 16384
+            return { msg_id : response[msg_id] for msg_id in imapclient.imapclient.to_ints(messages) \
+                     if msg_id in response }
+    return {}
 
-        return self.decompressor.decompress(data, size)
-        
-    def readline(self):
-        """Read line from remote."""
-        line = io.StringIO() #use cStringIO to avoid memory fragmentation
-        while 1:
-            #make use of read that takes care of the compression
-            #it could be simplified without compression
-            char = self.read(1) 
-            line.write(char)
-            if char in ("\n", ""): 
-                return line.getvalue()
-    
-    def shutdown(self):
-        """Close I/O established in "open"."""
-        #self.file.close() #if file created
-        self.sock.close()
-        
-      
-    def send(self, data):
-        """send(data)
-        Send 'data' to remote."""
-        if self.compressor is not None:
-            data = self.compressor.compress(data)
-            data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
-        self.sslobj.sendall(data)
-       
 def seq_to_parenlist(flags):
     """Convert a sequence of strings into parenthised list string for
     use with IMAP commands.
@@ -246,7 +300,25 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable=R0903,R0904
         """
            constructor
         """
-        super(MonkeyIMAPClient, self).__init__(host, port, use_uid, need_ssl)
+        super(MonkeyIMAPClient, self).__init__(host, port, use_uid, need_ssl, \
+                                               ssl_context = get_tls_context() if need_ssl else None)
+        if need_ssl:
+            self._imap.save_tls_session() # the greeting has been read
+
+    def _create_IMAP4(self):
+        """
+           TLS connections resume the previous TLS session
+        """
+        if self.ssl:
+            return IMAP4ResumedTLS(self.host, self.port, self.ssl_context, getattr(self._timeout, 'connect', None))
+        return IMAP4Deflate(self.host, self.port, getattr(self._timeout, 'connect', None))
+
+    @property
+    def tls_session_reused(self):
+        """
+           True if the TLS handshake resumed a previous session
+        """
+        return bool(self.ssl and self._imap.sock.session_reused)
 
     def oauth2_login(self, oauth2_cred):
         """
@@ -262,20 +334,26 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable=R0903,R0904
         """
            Perform a imap search or gmail search
         """
+        #optional imap criteria restricting the search (e.g. UID or MODSEQ ranges)
+        restrict = criteria.get('restrict', None)
         if criteria.get('type','') == 'imap':
+            req = criteria['req']
+            if restrict:
+                req = '%s %s' % (restrict, req)
             #encoding criteria in utf-8
-            req     = criteria['req'].encode('utf-8')
+            req     = req.encode('utf-8')
             charset = 'utf-8'
             return super(MonkeyIMAPClient, self).search(req, charset)
         elif criteria.get('type','') == 'gmail':
-            return self.gmail_search(criteria.get('req',''))
+            return self.gmail_search(criteria.get('req',''), restrict)
         else:
             raise Exception("Unknown search type %s" % (criteria.get('type','no request type passed')))
         
-    def gmail_search(self, criteria):
+    def gmail_search(self, criteria, restrict = None):
         """
            perform a search with gmailsearch criteria.
            eg, subject:Hello World
+           restrict is an optional imap criteria ANDed with the gmail search
         """  
         criteria = criteria.replace('\\', '\\\\')
         criteria = criteria.replace('"', '\\"')
@@ -285,12 +363,14 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable=R0903,R0904
         #typ, data = self._imap.uid('SEARCH', *args)
 
         #working Literal search 
-        self._imap.literal = '"%s"' % (criteria)
+        self._imap.literal = ('"%s"' % (criteria)).encode("utf-8")
         self._imap.literal = imaplib.MapCRLF.sub(imaplib.CRLF, self._imap.literal)
-        self._imap.literal = self._imap.literal.encode("utf-8")
  
         #use uid to keep the imap ids consistent
-        args = ['CHARSET', 'utf-8', 'X-GM-RAW']
+        args = ['CHARSET', 'utf-8']
+        if restrict:
+            args.extend(restrict.split())
+        args.append('X-GM-RAW')
         typ, data = self._imap.uid('SEARCH', *args) #pylint: disable=W0142
         
         self._checkok('search', typ, data)
@@ -318,7 +398,7 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable=R0903,R0904
         """
         if msg_time:
             time_val = '"%s"' % datetime_to_imap(msg_time)
-            time_val = to_bytes(time_val)
+            time_val = to_unicode(time_val) #imaplib only accepts a quoted str
         else:
             time_val = None
         return self._command_and_check('append',
@@ -328,19 +408,40 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable=R0903,R0904
                                        to_bytes(msg),
                                        unpack=True)
     
-    def enable_compression(self):
+    def fetch(self, messages, data, modifiers = None):
+        """
+           IMAPClient.fetch. When the connection is lost, the messages fully received
+           are attached to the error (err.partial)
+        """
+        try:
+            return super(MonkeyIMAPClient, self).fetch(messages, data, modifiers)
+        except (imaplib.IMAP4.abort, socket.error) as err:
+            err.partial = parse_partial_fetch(self._imap.untagged_responses.get('FETCH', []), messages, \
+                                              self.normalise_times, self.use_uid)
+            raise
+
+    def uid_store(self, messages, item, value):
+        """
+           UID STORE item value (e.g. +X-GM-LABELS.SILENT). Return (status, data) as imaplib does
         """
-        enable_compression()
-        Ask the server to start compressing the connection.
-        Should be called from user of this class after instantiation, as in:
-            if 'COMPRESS=DEFLATE' in imapobj.capabilities:
-                imapobj.enable_compression()
+        return self._imap.uid('STORE', messages, item, value)
+
+    def enable_compression(self, level = zlib.Z_DEFAULT_COMPRESSION, read_size = None):
+        """
+           Ask the server to start compressing the connection (COMPRESS DEFLATE).
+           Return True if the connection is compressed
         """
         ret_code, _ = self._imap._simple_command('COMPRESS', 'DEFLATE') #pylint: disable=W0212
-        if ret_code == 'OK':
-            self._imap.activate_compression()
-        else:
-            #no errors for the moment
-            pass
+        if ret_code != 'OK':
+            return False
+        self._imap.activate_compression(level, read_size)
+        return True
+
+    @property
+    def compression_stats(self):
+        """
+           CompressionStats of the connection (None if it is not compressed)
+        """
+        return self._imap.compression_stats
 
         
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing a profiler that can be switched on and off in a running gmvault.
+
+    kill -USR2 <gmvault pid>   # start profiling
+    kill -USR2 <gmvault pid>   # stop and write <db-dir>/.info/profile-<date>.collapsed
+
+In sampling mode a background thread looks at the stack of the profiled thread every
+interval and counts the collapsed stacks (one "frame;frame;...;frame count" line per
+stack, the input format of flamegraph.pl and speedscope). The overhead does not depend
+on the number of function calls. The cprofile mode uses cProfile and writes a .pstats file.
+
+'''
+import cProfile
+import os
+import signal
+import sys
+import threading
+import time
+
+import gmv.log_utils as log_utils
+
+LOG = log_utils.LoggerFactory.get_logger('profiler_utils')
+
+SAMPLING = 'sampling'
+CPROFILE = 'cprofile'
+
+class SamplingProfiler(object):
+    """
+       Start/stop profiler of one thread (the main thread by default)
+    """
+    def __init__(self, output_dir, interval = 0.01, mode = SAMPLING, thread_id = None):
+        """
+           output_dir: dir where the profiles are written (created if needed)
+           interval: seconds between two samples (sampling mode)
+           mode: SAMPLING or CPROFILE
+           thread_id: ident of the thread to sample (main thread by default)
+        """
+        if mode not in (SAMPLING, CPROFILE):
+            raise ValueError("Unknown profiler mode %s. Use %s or %s." % (mode, SAMPLING, CPROFILE))
+
+        self.output_dir  = output_dir
+        self.interval    = interval
+        self.mode        = mode
+        self.thread_id   = thread_id if thread_id is not None else threading.main_thread().ident
+        self.nb_samples  = 0
+        self._stacks     = {} # tuple of code objects (root first) -> nb of samples
+        self._stop_event = None
+        self._thread     = None
+        self._cprofile   = None
+        self._start_time = None
+
+    def is_running(self):
+        """ True between start() and stop() """
+        return self._start_time is not None
+
+    def start(self):
+        """
+           Start profiling. In cprofile mode start() must be called from the profiled thread
+        """
+        if self.is_running():
+            return
+        self._stacks, self.nb_samples = {}, 0
+        self._start_time = time.time()
+        if self.mode == CPROFILE:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        else:
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target = self._sample_loop, name = 'gmvault-profiler')
+            self._thread.daemon = True
+            self._thread.start()
+        LOG.critical("Start %s profiling." % (self.mode))
+
+    def stop(self):
+        """
+           Stop profiling and write the profile. Return the path of the written file
+        """
+        if not self.is_running():
+            return None
+        if self.mode == CPROFILE:
+            self._cprofile.disable()
+        else:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+        path = self._write()
+        LOG.critical("Stop profiling after %.1f sec. Profile written in %s." \
+                     % (time.time() - self._start_time, path))
+        self._start_time, self._cprofile = None, None
+        return path
+
+    def toggle(self):
+        """ start if stopped, stop (and return the written file) if started """
+        if self.is_running():
+            return self.stop()
+        self.start()
+        return None
+
+    def _sample_loop(self):
+        """ sampler thread """
+        current_frames, stacks = sys._current_frames, self._stacks #pylint:disable=W0212
+        while not self._stop_event.wait(self.interval):
+            frame = current_frames().get(self.thread_id)
+            if frame is None: # profiled thread is gone
+                break
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            del frame
+            key = tuple(reversed(codes))
+            stacks[key] = stacks.get(key, 0) + 1
+            self.nb_samples += 1
+
+    @classmethod
+    def _frame_name(cls, code):
+        """ func (file:line) without the ; and spaces used by the collapsed format """
+        return ('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), \
+                                code.co_firstlineno)).replace(';', ':')
+
+    def collapsed_stacks(self):
+        """ list of 'frame;frame;...;frame count' lines (sampling mode) """
+        lines = []
+        for codes, count in sorted(self._stacks.items(), key = lambda item: -item[1]):
+            lines.append('%s %d' % (';'.join(self._frame_name(code) for code in codes), count))
+        return lines
+
+    def _write(self):
+        """ write the profile in output_dir """
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        basename = '%s/profile-%s-%s' % (self.output_dir, time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        if self.mode == CPROFILE:
+            path = '%s.pstats' % (basename)
+            self._cprofile.dump_stats(path)
+        else:
+            path = '%s.collapsed' % (basename)
+            with open(path, 'w') as the_file:
+                for line in self.collapsed_stacks():
+                    the_file.write('%s\n' % (line))
+        return path
+
+def register_toggle_signal(profiler, signum = None):
+    """
+       Each reception of signum (SIGUSR2 by default) starts or stops profiler.
+       Return False if the platform has no such signal (Windows)
+    """
+    if signum is None:
+        signum = getattr(signal, 'SIGUSR2', None)
+        if signum is None:
+            return False
+
+    def toggle_handler(a_signum, frame): #pylint:disable=W0613
+        """ signal handler """
+        try:
+            profiler.toggle()
+        except Exception as err: #pylint:disable=W0703
+            LOG.error("Cannot start or stop the profiler: %s" % (err))
+
+    signal.signal(signum, toggle_handler)
+    return True
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the pacing of the transfers against the Gmail IMAP quotas.
+
+Gmail limits the bytes an account can download and upload over a rolling day and
+answers "Account exceeded command or bandwidth limits" once they are reached, sometimes
+locking the account for hours. The QuotaPacer counts the bytes fetched and appended per
+minute over the rolling window: above quota_slowdown_ratio of a limit the transfers are
+slowed down to the sustainable rate (limit / window), above quota_pause_ratio they wait
+for the oldest transfers to leave the window. A throttling answer pauses all the transfers
+(doubling the pause each time). The state is saved in the .info dir of the db so that a
+resumed run continues at a safe rate.
+
+'''
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+import gmv.log_utils as log_utils
+import gmv.gmvault_utils as gmvault_utils
+
+LOG = log_utils.LoggerFactory.get_logger('quota_utils')
+
+# Gmail answers when an account goes over its limits
+THROTTLING_RE = re.compile(r'THROTTLED|OVERQUOTA|bandwidth limits|exceeded command or bandwidth', re.IGNORECASE)
+
+def is_throttling(error):
+    """ True if error is Gmail telling that the account exceeded its limits """
+    return bool(THROTTLING_RE.search(str(error)))
+
+class QuotaPacer(object): #pylint:disable=R0902
+    """
+       Paces the bytes downloaded (in) and uploaded (out) by an account against its quotas.
+       Shared by all the connections of a run (thread safe)
+    """
+    VERSION     = 1
+    BUCKET      = 60 # seconds aggregated in one bucket of the window
+    SAVE_PERIOD = 60 # min nb of seconds between two saves of the state
+    DIRECTIONS  = ('in', 'out')
+
+    def __init__(self, limits = None, window = 86400, slowdown = 0.75, pause = 0.95, \
+                 throttle_pause = 900, path = None, clock = None, sleep = None): #pylint:disable=R0913
+        """
+           limits: { 'in' : bytes, 'out' : bytes } per window (0 or missing: no limit)
+           path: file where the state is saved (None to keep it in memory)
+           clock, sleep: time.time and time.sleep by default
+        """
+        self._lock          = threading.Lock()
+        self.limits         = dict(limits or {})
+        self.window         = window
+        self.slowdown       = slowdown
+        self.pause          = pause
+        self.throttle_pause = throttle_pause
+        self.path           = path
+        self._clock         = clock
+        self._sleep         = sleep
+        self.buckets        = dict((direction, collections.deque()) for direction in self.DIRECTIONS)
+        self.paused_until   = 0
+        self.nb_throttled   = 0 # consecutive throttling answers
+        self._last_save     = self.clock()
+        if path:
+            self.load()
+
+    def clock(self):
+        """ now in seconds """
+        return (self._clock or time.time)()
+
+    def sleep(self, seconds):
+        """ wait seconds """
+        (self._sleep or time.sleep)(seconds)
+
+    @classmethod
+    def from_conf(cls, path = None):
+        """ pacer configured by the [General] quota_* defaults """
+        conf = gmvault_utils.get_conf_defaults()
+        return cls({ 'in'  : conf.getint('General', 'quota_download_mb', 2500) * 1024 * 1024,
+                     'out' : conf.getint('General', 'quota_upload_mb', 500) * 1024 * 1024 },
+                   window         = conf.getint('General', 'quota_window', 86400),
+                   slowdown       = conf.getfloat('General', 'quota_slowdown_ratio', 0.75),
+                   pause          = conf.getfloat('General', 'quota_pause_ratio', 0.95),
+                   throttle_pause = conf.getint('General', 'quota_throttle_pause', 900),
+                   path           = path)
+
+    def _expire(self, direction, now):
+        """ drop the buckets out of the window """
+        buckets = self.buckets[direction]
+        while buckets and buckets[0][0] + self.BUCKET <= now - self.window:
+            buckets.popleft()
+
+    def used(self, direction):
+        """ bytes transferred in direction over the window """
+        with self._lock:
+            self._expire(direction, self.clock())
+            return sum(size for _, size in self.buckets[direction])
+
+    def delay(self, direction, nb_bytes):
+        """ nb of seconds to wait before transferring nb_bytes in direction """
+        with self._lock:
+            return self._delay(direction, nb_bytes, self.clock())
+
+    def _delay(self, direction, nb_bytes, now):
+        """ delay (lock held) """
+        wait  = max(0, self.paused_until - now)
+        limit = self.limits.get(direction)
+        if not limit:
+            return wait
+
+        self._expire(direction, now)
+        used = sum(size for _, size in self.buckets[direction])
+        if used + nb_bytes > self.pause * limit:
+            # wait until enough of the oldest transfers leave the window
+            target = max(0, self.pause * limit - nb_bytes)
+            for start, size in self.buckets[direction]:
+                if used <= target:
+                    break
+                used -= size
+                wait  = max(wait, start + self.BUCKET + self.window - now)
+        elif used > self.slowdown * limit:
+            # sustainable rate
+            wait = max(wait, nb_bytes * self.window / float(limit))
+        return wait
+
+    def _record(self, direction, nb_bytes, now):
+        """ charge nb_bytes to the current bucket (lock held) """
+        buckets = self.buckets[direction]
+        start   = now - now % self.BUCKET
+        if buckets and buckets[-1][0] == start:
+            buckets[-1][1] += nb_bytes
+        else:
+            buckets.append([start, nb_bytes])
+
+    def pace(self, direction, nb_bytes):
+        """
+           Wait if nb_bytes cannot be transferred in direction now, then charge them.
+           Return the nb of seconds waited
+        """
+        wait = self.delay(direction, nb_bytes)
+        if wait > 0:
+            LOG.critical("Close to the Gmail %s quota: wait %d second(s)." \
+                         % ('download' if direction == 'in' else 'upload', wait))
+            self.sleep(wait)
+        with self._lock:
+            now = self.clock()
+            self._record(direction, nb_bytes, now)
+            save = self.path and now - self._last_save >= self.SAVE_PERIOD
+        if save:
+            self.save()
+        return wait
+
+    def throttled(self):
+        """
+           Gmail answered that the account exceeded its limits: pause all the transfers
+           throttle_pause seconds, doubled at each consecutive answer (at most the window).
+           Return the pause
+        """
+        with self._lock:
+            pause = min(self.window, self.throttle_pause * (2 ** self.nb_throttled))
+            self.nb_throttled += 1
+            self.paused_until  = max(self.paused_until, self.clock() + pause)
+        LOG.critical("Gmail throttles the account. Pause the transfers for %d second(s)." % (pause))
+        self.save()
+        return pause
+
+    def succeeded(self):
+        """ a call went through: the next throttling answer starts again with the shortest pause """
+        if self.nb_throttled:
+            with self._lock:
+                self.nb_throttled = 0
+
+    def pause_left(self):
+        """ nb of seconds left in the current pause """
+        with self._lock:
+            return max(0, self.paused_until - self.clock())
+
+    def to_dict(self):
+        """ state to save """
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        """ state to save (the caller holds the lock) """
+        return { 'version'      : self.VERSION,
+                 'buckets'      : dict((direction, [ list(bucket) for bucket in buckets ]) \
+                                       for direction, buckets in self.buckets.items()),
+                 'paused_until' : self.paused_until,
+                 'nb_throttled' : self.nb_throttled }
+
+    def save(self):
+        """ write the state in path (thread safe) """
+        if not self.path:
+            return
+        # the email and chat phases share the pacer: one writer of the tmp file at a time
+        with self._lock:
+            tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+            try:
+                gmvault_utils.makedirs(os.path.dirname(self.path))
+                with open(tmp_path, 'w') as the_file:
+                    json.dump(self._state(), the_file)
+                os.replace(tmp_path, self.path)
+            except (IOError, OSError) as err:
+                LOG.critical("Cannot save the quota state in %s: %s" % (self.path, err))
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            self._last_save = self.clock()
+
+    def load(self):
+        """ read the state saved in path (ignored if it cannot be read) """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as the_file:
+                state = json.load(the_file)
+            if state.get('version') != self.VERSION:
+                raise ValueError("version %s" % (state.get('version')))
+            buckets = dict((direction, collections.deque([ [start, size] for start, size in \
+                                                           state['buckets'].get(direction, []) ])) \
+                           for direction in self.DIRECTIONS)
+        except (IOError, OSError, ValueError, KeyError, TypeError) as err:
+            LOG.info("Ignore the quota state %s (%s)." % (self.path, err))
+            return
+        with self._lock:
+            self.buckets      = buckets
+            self.paused_until = state.get('paused_until', 0)
+            self.nb_throttled = state.get('nb_throttled', 0)
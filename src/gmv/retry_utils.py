@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Module containing the building blocks of the imap retries: jittered backoff and circuit breaker.
+
+The waits between two reconnections grow exponentially with a random jitter so that the
+connections of a run (and the runs of a daemon) do not reconnect all at the same time.
+The circuit breaker of an account opens after too many consecutive failures: the calls then
+fail fast instead of hammering the server until it cools down.
+
+'''
+import random
+import threading
+import time
+
+import gmv.log_utils as log_utils
+
+LOG = log_utils.LoggerFactory.get_logger('retry_utils')
+
+class CircuitOpenError(Exception):
+    """
+       Raised instead of calling the server while the circuit breaker is open
+    """
+    def __init__(self, a_msg, retry_in):
+        """
+           retry_in: nb of seconds before the next call is allowed
+        """
+        super(CircuitOpenError, self).__init__(a_msg)
+        self.retry_in = retry_in
+
+class Backoff(object):
+    """
+       Exponential backoff with jitter: the n-th wait is drawn in [d/2, d] with d = min(cap, base * factor^n)
+    """
+    def __init__(self, base = 1, factor = 2, cap = 60, rand = random.random):
+        self.base    = base
+        self.factor  = factor
+        self.cap     = cap
+        self.rand    = rand
+        self.attempt = 0
+
+    def next_delay(self):
+        """ nb of seconds to wait before the next attempt """
+        delay = min(self.cap, self.base * (self.factor ** self.attempt))
+        self.attempt += 1
+        return delay / 2.0 + self.rand() * delay / 2.0
+
+    def reset(self):
+        """ start again from base """
+        self.attempt = 0
+
+class CircuitBreaker(object):
+    """
+       closed: calls go through. open: after threshold consecutive failures, calls fail fast
+       with CircuitOpenError for cooldown seconds. half open: after the cooldown calls go through
+       again, the first success closes the breaker and the first failure opens it again
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold = 5, cooldown = 300, clock = time.monotonic):
+        self._lock     = threading.Lock()
+        self.threshold = threshold
+        self.cooldown  = cooldown
+        self.clock     = clock
+        self.failures  = 0
+        self.opened_at = None
+        self.nb_opened = 0
+
+    @property
+    def state(self):
+        """ closed, open or half_open """
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        """ state (lock held) """
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def check(self):
+        """ raise CircuitOpenError if the breaker is open """
+        with self._lock:
+            if self._state() == self.OPEN:
+                retry_in = self.cooldown - (self.clock() - self.opened_at)
+                raise CircuitOpenError("Too many consecutive failures with the server. " \
+                                       "No new attempt before %d second(s)." % (retry_in), retry_in)
+
+    def success(self):
+        """ a call succeeded: close the breaker """
+        with self._lock:
+            self.failures, self.opened_at = 0, None
+
+    def failure(self):
+        """ a call failed. Return True if it opened the breaker """
+        with self._lock:
+            self.failures += 1
+            state = self._state()
+            if state == self.HALF_OPEN or (state == self.CLOSED and self.failures >= self.threshold):
+                self.opened_at  = self.clock()
+                self.nb_opened += 1
+                LOG.critical("Circuit breaker opened after %d consecutive failure(s). " \
+                             "Fail fast for %d second(s)." % (self.failures, self.cooldown))
+                return True
+            return False
+
+_BREAKERS      = {}
+_BREAKERS_LOCK = threading.Lock()
+
+def get_circuit_breaker(key, threshold = 5, cooldown = 300):
+    """
+       The CircuitBreaker of key (an account), shared by all its connections
+    """
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(key)
+        if breaker is None:
+            breaker = _BREAKERS[key] = CircuitBreaker(threshold, cooldown)
+        return breaker
+
+def reset_circuit_breakers():
+    """ forget all the breakers """
+    with _BREAKERS_LOCK:
+        _BREAKERS.clear()
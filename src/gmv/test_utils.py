@@ -454,3 +454,35 @@ def delete_db_dir(a_db_dir):
        delete the db directory
     """
     gmvault_utils.delete_all_under(a_db_dir, delete_top_dir = True)
+
+def create_fake_email_info(gm_id, labels, flags = (b'\\Seen',), body = None, internal_date = None):
+    """
+       create an email_info structure as returned by GIMAPFetcher.fetch
+       used to populate a local gmvault-db without Gmail
+    """
+    if internal_date is None:
+        internal_date = datetime.datetime(2012, 5, 1, 10, 30)
+
+    if body is None:
+        body = ("From: sender@example.com\r\nTo: receiver@example.com\r\n"\
+                "Subject: message %s\r\nMessage-ID: <%s@example.com>\r\n\r\n"\
+                "Body of message %s\r\n" % (gm_id, gm_id, gm_id)).encode('utf-8')
+
+    return { imap_utils.GIMAPFetcher.GMAIL_ID          : gm_id,
+             imap_utils.GIMAPFetcher.GMAIL_THREAD_ID   : gm_id,
+             imap_utils.GIMAPFetcher.GMAIL_LABELS      : list(labels),
+             imap_utils.GIMAPFetcher.IMAP_FLAGS        : list(flags),
+             imap_utils.GIMAPFetcher.IMAP_INTERNALDATE : internal_date,
+             imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY : body.split(b'\r\n\r\n')[0] + b'\r\n\r\n',
+             imap_utils.GIMAPFetcher.EMAIL_BODY        : body }
+
+def create_fake_db(a_db_dir, emails, compress = False):
+    """
+       create a local gmvault-db from a list of email_info structures
+    """
+    gstorer = gmvault_db.GmailStorer(a_db_dir)
+    for email_info in emails:
+        gstorer.bury_email(email_info, \
+                           local_dir = gmvault_utils.get_ym_from_datetime(email_info[imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]), \
+                           compress = compress)
+    return gstorer
@@ -0,0 +1,229 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import asyncio
+import datetime
+import imaplib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import gmv.aio_imap as aio_imap
+import gmv.fake_imap_server as fake_imap_server
+import gmv.gmvault as gmvault
+import gmv.imap_utils as imap_utils
+
+CREDENTIAL = { 'type' : 'passwd', 'value' : 'pwd' }
+
+class TestAsyncIMAP(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       asyncio IMAP transport against the fake Gmail server
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.old_gmvault_dir = os.environ.get('GMVAULT_DIR')
+        os.environ['GMVAULT_DIR'] = os.path.join(self.work_dir, 'conf')
+        self.account = fake_imap_server.FakeGmailAccount(nb_emails = 40, nb_chats = 5, msg_size = 1024)
+        self.server  = fake_imap_server.FakeGmailServer({ 'source@gmail.com' : self.account }).start()
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        self.server.stop()
+        if self.old_gmvault_dir is None:
+            del os.environ['GMVAULT_DIR']
+        else:
+            os.environ['GMVAULT_DIR'] = self.old_gmvault_dir
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def _fetcher(self, transport, login = 'source@gmail.com', readonly = True):
+        """ connected GIMAPFetcher """
+        fetcher = imap_utils.GIMAPFetcher(self.server.host, self.server.port, login, CREDENTIAL, \
+                                          readonly_folder = readonly, use_ssl = False, transport = transport)
+        fetcher.connect()
+        return fetcher
+
+    def test_same_results(self):
+        """
+           GIMAPFetcher returns the same data with both transports
+        """
+        fetchers = [ self._fetcher(transport) for transport in imap_utils.GIMAPFetcher.TRANSPORTS ]
+        self.assertTrue(isinstance(fetchers[1].server, aio_imap.BlockingIMAPClient))
+
+        results = []
+        for fetcher in fetchers:
+            fetcher.select_folder('ALLMAIL')
+            results.append((fetcher.get_folder_name('ALLMAIL'), fetcher.get_folder_name('CHATS'), \
+                            sorted(fetcher.list_all_folders()), fetcher.get_folder_status(), \
+                            list(fetcher.search({ 'type' : 'imap', 'req' : 'ALL' })), \
+                            list(fetcher.search({ 'type' : 'gmail', 'req' : 'label:work' })), \
+                            list(fetcher.search({ 'type' : 'gmail', 'req' : 'label:work', 'restrict' : 'UID 10:30' })), \
+                            fetcher.fetch(list(range(1, 21)), imap_utils.GIMAPFetcher.GET_ALL_INFO), \
+                            fetcher.fetch([3, 4], imap_utils.GIMAPFetcher.GET_FLAGS_LABELS)))
+            fetcher.disconnect()
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[1][7]), 20)
+        self.assertEqual(results[1][5], [6, 12, 18, 24, 30, 36])
+        self.assertEqual(results[1][6], [12, 18, 24, 30])
+
+    def test_restore_operations(self):
+        """
+           APPEND, UID STORE of labels, label creation and IDLE through the asyncio transport
+        """
+        fetcher = self._fetcher('asyncio', login = 'dest@gmail.com', readonly = False)
+        fetcher.create_gmail_labels(['projects/gmvault'], set())
+        fetcher.select_folder('ALLMAIL')
+
+        body = 'Subject: restored\nFrom: foo@bar.com\n\nhello\n'
+        uid = fetcher.push_data(fetcher.get_folder_name('ALLMAIL'), body, (b'\\Seen',), datetime.datetime(2014, 5, 1))
+        fetcher.apply_labels_to([uid], ['projects/gmvault', '\\Starred'])
+
+        msg = self.server.accounts['dest@gmail.com'].folders[fake_imap_server.ALL_MAIL].get(uid)
+        self.assertEqual(msg.body, body.replace('\n', '\r\n').encode('utf-8'))
+        self.assertEqual(msg.flags, (b'\\Seen',))
+        self.assertEqual(set(msg.labels), set([b'projects/gmvault', b'\\Starred']))
+        self.assertTrue(fetcher.server.folder_exists('projects/gmvault'))
+
+        def add_message():
+            """ append from another connection while the fetcher is in IDLE """
+            time.sleep(0.3)
+            other = self._fetcher('imapclient', login = 'dest@gmail.com', readonly = False)
+            other.push_data(fetcher.get_folder_name('ALLMAIL'), body, (), datetime.datetime(2014, 5, 2))
+            other.disconnect()
+        thread = threading.Thread(target = add_message)
+        thread.start()
+        changes = fetcher.idle_wait(10, debounce = 0.2)
+        thread.join()
+        self.assertTrue(b'EXISTS' in [ change[1] for change in changes ])
+        self.assertEqual(len(fetcher.search({ 'type' : 'imap', 'req' : 'ALL' })), 2)
+        fetcher.disconnect()
+
+    def test_errors(self):
+        """
+           NO/BAD raise IMAP4.error, a lost connection IMAP4.abort
+        """
+        self.server.auto_create = False
+        client = aio_imap.BlockingIMAPClient(self.server.host, self.server.port)
+        self.assertRaises(imaplib.IMAP4.error, client.login, 'unknown@gmail.com', 'pwd')
+        client.oauth2_login('user=source@gmail.com\x01auth=Bearer token\x01\x01')
+        self.assertRaises(imaplib.IMAP4.error, client.select_folder, 'no such folder')
+        self.assertRaises(imaplib.IMAP4.error, client.create_folder, fake_imap_server.ALL_MAIL)
+        self.assertEqual(client.select_folder(fake_imap_server.ALL_MAIL)[b'EXISTS'], 40)
+
+        client.client._writer.transport.abort() #pylint:disable=W0212
+        self.assertRaises(imaplib.IMAP4.abort, client.noop)
+        self.assertRaises(imaplib.IMAP4.abort, client.noop)
+
+    def test_pipelining(self):
+        """
+           one event loop drives many connections, each one with pipelined and compressed fetches
+        """
+        batches = [ list(range(start, start + 5)) for start in range(1, 41, 5) ]
+
+        async def session(compress):
+            """ login, select and fetch all the bodies with one round trip """
+            client = aio_imap.AsyncIMAPClient(self.server.host, self.server.port)
+            await client.connect()
+            await client.login('source@gmail.com', 'pwd')
+            if compress:
+                self.assertTrue(await client.enable_compression())
+            await client.select_folder(fake_imap_server.ALL_MAIL, readonly = True)
+            data = await client.fetch_many(batches, imap_utils.GIMAPFetcher.GET_DATA_ONLY)
+            await client.logout()
+            return data
+
+        async def sessions():
+            """ 20 connections at the same time """
+            return await asyncio.gather(*[ session(i % 2 == 0) for i in range(20) ])
+
+        results = asyncio.run(sessions())
+        self.assertEqual(self.server.stats['compress'], 10)
+        for data in results:
+            self.assertEqual(sorted(data), list(range(1, 41)))
+            self.assertEqual(data, results[0])
+        self.assertEqual(results[0][7][imap_utils.GIMAPFetcher.EMAIL_BODY], \
+                         self.account.folders[fake_imap_server.ALL_MAIL].get(7).body)
+
+    def test_literals(self):
+        """
+           synchronizing literals when the server does not announce LITERAL+
+        """
+        async def search():
+            """ gmail search sent as a literal, then a second command on the same connection """
+            client = aio_imap.AsyncIMAPClient(self.server.host, self.server.port)
+            await client.connect()
+            await client.login('source@gmail.com', 'pwd')
+            client._capabilities = tuple(cap for cap in client._capabilities if cap != b'LITERAL+') #pylint:disable=W0212
+            await client.select_folder(fake_imap_server.ALL_MAIL)
+            found = await asyncio.gather(client.search({ 'type' : 'gmail', 'req' : 'label:work' }), \
+                                         client.search({ 'type' : 'imap', 'req' : 'UID 1:3' }))
+            await client.logout()
+            return found
+
+        self.assertEqual(asyncio.run(search()), [[6, 12, 18, 24, 30, 36], [1, 2, 3]])
+
+    def test_batch_fetcher_pipelining(self):
+        """
+           IMAPBatchFetcher splits its batches in pipelined fetches and keeps them through a lost connection
+        """
+        calls = []
+        fetch = aio_imap.AsyncIMAPClient.fetch
+        async def recording_fetch(client, messages, data, modifiers = None):
+            """ record the ids of each FETCH command """
+            calls.append(list(messages))
+            return await fetch(client, messages, data, modifiers)
+
+        expected = self._fetcher('imapclient')
+        expected.select_folder('ALLMAIL')
+        expected = expected.fetch(list(range(1, 41)), imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA)
+
+        fetcher = self._fetcher('asyncio')
+        fetcher.select_folder('ALLMAIL')
+        batch_fetcher = gmvault.IMAPBatchFetcher(fetcher, list(range(1, 41)), {}, \
+                                                 imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA, \
+                                                 default_batch_size = 20, max_batch_size = 20)
+        self.assertEqual(batch_fetcher.nb_pipelined, 4)
+        result = {}
+        with unittest.mock.patch.object(aio_imap.AsyncIMAPClient, 'fetch', recording_fetch):
+            result.update(next(batch_fetcher))
+            self.assertEqual(calls, [ list(range(start, start + 5)) for start in range(1, 21, 5) ])
+
+            # connection lost after 7 messages: only the 13 other ones are fetched again
+            del calls[:]
+            self.server.conf['drop_fetch_after'] = 7
+            for new_data in batch_fetcher:
+                result.update(new_data)
+        fetcher.disconnect()
+
+        self.assertEqual(result, expected)
+        self.assertEqual(list(batch_fetcher.unreturned_ids()), [])
+        self.assertEqual(calls[:4], [ list(range(start, start + 5)) for start in range(21, 41, 5) ])
+        self.assertEqual(calls[4:], [[28, 29, 30, 31], [32, 33, 34, 35], [36, 37, 38, 39], [40]])
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAsyncIMAP)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
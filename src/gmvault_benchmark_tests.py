@@ -0,0 +1,395 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import json
+import shutil
+import socket
+import ssl
+import subprocess
+import datetime
+import imaplib
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import gmv.benchmark as benchmark
+import gmv.credential_utils as credential_utils
+import gmv.fake_imap_server as fake_imap_server
+import gmv.gmvault as gmvault
+import gmv.gmvault_utils as gmvault_utils
+import gmv.imap_utils as imap_utils
+import gmv.mod_imap as mimap
+
+
+class TestFakeGmailServer(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Fake Gmail IMAP server and end to end runs (no Gmail account needed)
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.old_gmvault_dir = os.environ.get('GMVAULT_DIR')
+        os.environ['GMVAULT_DIR'] = os.path.join(self.work_dir, 'conf')
+        self.account = fake_imap_server.FakeGmailAccount(nb_emails = 40, nb_chats = 5, msg_size = 1024)
+        self.server  = fake_imap_server.FakeGmailServer({ 'source@gmail.com' : self.account }).start()
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        self.server.stop()
+        if self.old_gmvault_dir is None:
+            del os.environ['GMVAULT_DIR']
+        else:
+            os.environ['GMVAULT_DIR'] = self.old_gmvault_dir
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def _fetcher(self, login = 'source@gmail.com', readonly = True):
+        """ connected GIMAPFetcher """
+        fetcher = imap_utils.GIMAPFetcher(self.server.host, self.server.port, login, \
+                                          { 'type' : 'passwd', 'value' : 'pwd' }, \
+                                          readonly_folder = readonly, use_ssl = False)
+        fetcher.connect()
+        return fetcher
+
+    def test_gmail_extensions(self):
+        """
+           Folder discovery, searches and Gmail fetch attributes
+        """
+        fetcher = self._fetcher()
+        self.assertEqual(fetcher.get_folder_name('ALLMAIL'), fake_imap_server.ALL_MAIL)
+        self.assertEqual(fetcher.get_folder_name('CHATS'), fake_imap_server.CHATS)
+
+        fetcher.select_folder('ALLMAIL')
+        self.assertEqual(len(fetcher.search({ 'type' : 'imap', 'req' : 'ALL' })), 40)
+        self.assertEqual(fetcher.search({ 'type' : 'gmail', 'req' : 'label:work' }), [6, 12, 18, 24, 30, 36])
+        self.assertEqual(fetcher.search({ 'type' : 'imap', 'req' : 'X-GM-MSGID 1400000000000000007' }), [7])
+
+        data = fetcher.fetch([10], imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA)[10]
+        self.assertEqual(data[imap_utils.GIMAPFetcher.GMAIL_ID], 1400000000000000010)
+        self.assertEqual(set(data[imap_utils.GIMAPFetcher.GMAIL_LABELS]), set([b'projects/gmvault', b'\\Starred']))
+        self.assertTrue(data[imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY].startswith(b'Subject: Synthetic'))
+
+        status = fetcher.get_folder_status()
+        self.assertEqual(status[1:], (40, 41))
+        fetcher.disconnect()
+
+    def test_compression(self):
+        """
+           COMPRESS=DEFLATE: everything after the tagged OK is deflated
+        """
+        sock = socket.create_connection((self.server.host, self.server.port))
+        the_file = sock.makefile('rb')
+        self.assertTrue(the_file.readline().startswith(b'* OK'))
+        sock.sendall(b'a1 LOGIN source@gmail.com pwd\r\n')
+        self.assertTrue(the_file.readline().startswith(b'a1 OK'))
+        sock.sendall(b'a2 COMPRESS DEFLATE\r\n')
+        self.assertEqual(the_file.readline(), b'a2 OK DEFLATE active\r\n')
+
+        compressor, decompressor = zlib.compressobj(6, zlib.DEFLATED, -15), zlib.decompressobj(-15)
+        sock.sendall(compressor.compress(b'a3 NOOP\r\n') + compressor.flush(zlib.Z_SYNC_FLUSH))
+        data = b''
+        while not data.endswith(b'\r\n'):
+            data += decompressor.decompress(sock.recv(4096))
+        self.assertEqual(data, b'a3 OK Success\r\n')
+        sock.close()
+
+    def test_session_cache(self):
+        """
+           a reconnection reuses the capabilities and folder names: no XLIST
+        """
+        fetcher = self._fetcher()
+        fetcher.select_folder('ALLMAIL')
+        nb_commands = self.server.stats['commands']
+        fetcher.reconnect() # LOGOUT, CAPABILITY (sent by imaplib), LOGIN
+        fetcher.connect(go_to_current_folder = True) # CAPABILITY, LOGIN, EXAMINE
+        self.assertEqual(self.server.stats['commands'] - nb_commands, 6)
+        self.assertEqual(fetcher.metrics.get_counter('session_cache_hits'), 2)
+        self.assertEqual(fetcher.get_folder_name('ALLMAIL'), fake_imap_server.ALL_MAIL)
+        self.assertTrue(imap_utils.GIMAPFetcher.GMAIL_EXTENSION in fetcher.capabilities)
+
+        # outdated folder names: the retry reconnects without the cache and finds them again
+        fetcher.localized_folders['ALLMAIL']['loc_dir'], fetcher.current_folder = '[Gmail]/Gone', None
+        self.assertEqual(fetcher.select_folder('ALLMAIL'), fake_imap_server.ALL_MAIL)
+        self.assertEqual(fetcher.metrics.get_counter('session_cache_hits'), 2)
+        fetcher.disconnect()
+
+    @unittest.skipUnless(shutil.which('openssl'), 'needs openssl to create a certificate')
+    def test_tls_resumption(self):
+        """
+           the reconnections resume the TLS session
+        """
+        cert, key = os.path.join(self.work_dir, 'cert.pem'), os.path.join(self.work_dir, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', \
+                        '-nodes', '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=127.0.0.1', \
+                        '-addext', 'subjectAltName=IP:127.0.0.1'], check = True, \
+                       stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+        tls_server = fake_imap_server.FakeGmailServer({ 'source@gmail.com' : self.account }, \
+                                                      ssl_context = server_context).start()
+        old_context = mimap._TLS_CONTEXT #pylint:disable=W0212
+        mimap._TLS_CONTEXT = ssl.create_default_context(cafile = cert) #pylint:disable=W0212
+        try:
+            fetcher = imap_utils.GIMAPFetcher(tls_server.host, tls_server.port, 'source@gmail.com', \
+                                              { 'type' : 'passwd', 'value' : 'pwd' }, use_ssl = True)
+            fetcher.connect()
+            fetcher.select_folder('ALLMAIL')
+            self.assertEqual(len(fetcher.search({ 'type' : 'imap', 'req' : 'ALL' })), 40)
+            fetcher.reconnect()
+            fetcher.reconnect()
+            fetcher.disconnect()
+        finally:
+            mimap._TLS_CONTEXT = old_context #pylint:disable=W0212
+            tls_server.stop()
+        self.assertEqual(fetcher.metrics.get_counter('tls_resumed'), 2)
+        self.assertEqual(tls_server.stats['tls_resumed'], 2)
+
+    def test_oauth2_token_cache(self):
+        """
+           the reconnections reuse the access token until it expires
+        """
+        def store_token(token):
+            """ write the token file """
+            gmv_dir = gmvault_utils.get_home_dir_path()
+            os.makedirs(gmv_dir, exist_ok = True)
+            with open(os.path.join(gmv_dir, 'source@gmail.com.oauth2'), 'w') as the_file:
+                json.dump({ 'access_token' : token, 'refresh_token' : 'refresh', 'validity' : 3600, \
+                            'access_creation' : gmvault_utils.get_utcnow_epoch(), 'type' : 'Bearer' }, the_file)
+
+        helper = credential_utils.CredentialHelper
+        store_token('token1')
+        try:
+            credential = helper.get_oauth2_credential('source@gmail.com')
+            fetcher = imap_utils.GIMAPFetcher(self.server.host, self.server.port, 'source@gmail.com', credential, \
+                                              use_ssl = False)
+            fetcher.connect()
+            store_token('token2')
+            fetcher.reconnect()
+            self.assertTrue('token1' in fetcher.credential['value'])
+
+            helper.forget_oauth2_credential('source@gmail.com')
+            fetcher.reconnect()
+            self.assertTrue('token2' in fetcher.credential['value'])
+            fetcher.disconnect()
+        finally:
+            helper.forget_oauth2_credential('source@gmail.com')
+
+    def test_sync_restore_roundtrip(self):
+        """
+           Sync the fake account then restore it in another one
+        """
+        db_dir = os.path.join(self.work_dir, 'db')
+        syncer = gmvault.GMVaulter(db_dir, self.server.host, self.server.port, 'source@gmail.com', \
+                                   { 'type' : 'passwd', 'value' : 'pwd' }, use_ssl = False)
+        syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' })
+        self.assertEqual(len(syncer.gstorer.get_all_existing_gmail_ids()), 40)
+        self.assertEqual(len(syncer.gstorer.get_all_chats_gmail_ids()), 5)
+
+        restorer = gmvault.GMVaulter(db_dir, self.server.host, self.server.port, 'dest@gmail.com', \
+                                     { 'type' : 'passwd', 'value' : 'pwd' }, \
+                                     read_only_access = False, use_ssl = False)
+        report = restorer.restore()
+        self.assertEqual(report['emails_in_quarantine'], [])
+
+        restored = self.server.accounts['dest@gmail.com'].folders[fake_imap_server.ALL_MAIL]
+        self.assertEqual(len(restored), 45)
+        source = self.account.folders[fake_imap_server.ALL_MAIL]
+        self.assertEqual(sorted(msg.body for msg in restored.messages() if b'gmvault-chats' not in msg.labels), \
+                         sorted(msg.body for msg in source.messages()))
+        restored_labels = set(label for msg in restored.messages() for label in msg.labels)
+        self.assertTrue(b'\\Inbox' in restored_labels)
+        self.assertTrue(b'projects/gmvault' in restored_labels)
+
+    def test_concurrent_phases(self):
+        """
+           The chats are synced in a thread with their own connection while the emails are synced
+        """
+        phase_threads = {}
+        sync_emails, sync_chats = gmvault.GMVaulter._sync_emails, gmvault.GMVaulter._sync_chats
+        def record(name, phase_fn):
+            """ record the thread and connection of a phase """
+            def wrapper(vaulter, *args, **kwargs):
+                phase_threads[name] = (threading.current_thread().name, id(vaulter.src))
+                return phase_fn(vaulter, *args, **kwargs)
+            return wrapper
+        gmvault.GMVaulter._sync_emails = record('emails', sync_emails)
+        gmvault.GMVaulter._sync_chats  = record('chats', sync_chats)
+        try:
+            syncer = gmvault.GMVaulter(os.path.join(self.work_dir, 'db'), self.server.host, self.server.port, \
+                                       'source@gmail.com', { 'type' : 'passwd', 'value' : 'pwd' }, use_ssl = False)
+            syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' })
+        finally:
+            gmvault.GMVaulter._sync_emails, gmvault.GMVaulter._sync_chats = sync_emails, sync_chats
+
+        self.assertEqual(phase_threads['emails'], (threading.current_thread().name, id(syncer.src)))
+        self.assertEqual(phase_threads['chats'][0], 'gmv-chats')
+        self.assertNotEqual(phase_threads['chats'][1], id(syncer.src))
+        self.assertEqual(syncer.metrics.get_counter('emails_stored'), 40)
+        self.assertEqual(syncer.metrics.get_counter('chats_stored'), 5)
+        self.assertTrue(syncer.progress is None)
+
+    def test_watch(self):
+        """
+           sync --watch: the new and changed messages are backed up when IDLE notifies them
+        """
+        syncer = gmvault.GMVaulter(os.path.join(self.work_dir, 'db'), self.server.host, self.server.port, \
+                                   'source@gmail.com', { 'type' : 'passwd', 'value' : 'pwd' }, use_ssl = False)
+        syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' })
+        stop_event = threading.Event()
+        watcher = threading.Thread(target = syncer.watch, kwargs = { 'stop_event' : stop_event })
+        watcher.start()
+        try:
+            time.sleep(0.5)
+            folder = self.account.folders[fake_imap_server.ALL_MAIL]
+            msg = folder.get(7)
+            msg.flags = (b'\\Seen', b'\\Flagged')
+            folder.update(msg)
+            folder.append(self.account.new_message(b'Subject: new\r\n\r\nbody\r\n', (), \
+                                                   datetime.datetime(2015, 3, 1)))
+
+            deadline = time.time() + 20
+            while time.time() < deadline and (syncer.metrics.get_counter('emails_stored') < 41 or \
+                                              syncer.metrics.get_counter('emails_updated') < 1):
+                time.sleep(0.1)
+        finally:
+            stop_event.set()
+            watcher.join(10)
+
+        self.assertFalse(watcher.is_alive())
+        self.assertEqual(syncer.metrics.get_counter('emails_stored'), 41)
+        self.assertEqual(syncer.metrics.get_counter('emails_updated'), 1)
+        self.assertEqual(len(syncer.gstorer.get_all_existing_gmail_ids()), 41)
+        self.assertEqual(set(syncer.gstorer.unbury_metadata(self.account.GM_ID_BASE + 7).flags), \
+                         set(['\\Seen', '\\Flagged']))
+
+    def test_search_cache_threads(self):
+        """
+           the email and chat phases save their searches at the same time: none is lost
+        """
+        syncer = gmvault.GMVaulter(os.path.join(self.work_dir, 'db'), self.server.host, self.server.port, \
+                                   'source@gmail.com', { 'type' : 'passwd', 'value' : 'pwd' }, use_ssl = False)
+        syncer.src.disconnect()
+        def save(phase):
+            """ one phase """
+            for i in range(100):
+                syncer._save_search_cache('%s-%d' % (phase, i % 5), { 'last_used' : i, 'ids' : [i] }) #pylint:disable=W0212
+
+        threads = [ threading.Thread(target = save, args = (phase,)) for phase in ('email', 'chat') ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(syncer._load_search_cache()), \
+                         sorted('%s-%d' % (phase, i) for phase in ('email', 'chat') for i in range(5))) #pylint:disable=W0212
+
+    def _run_watch(self, idle_wait):
+        """
+           sync then watch with GIMAPFetcher.idle_wait replaced by idle_wait(fetcher, ...).
+           Return (syncer, watcher thread, stop_event, errors raised by watch)
+        """
+        syncer = gmvault.GMVaulter(os.path.join(self.work_dir, 'db'), self.server.host, self.server.port, \
+                                   'source@gmail.com', { 'type' : 'passwd', 'value' : 'pwd' }, use_ssl = False)
+        syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' })
+        stop_event, errors = threading.Event(), []
+        def watch():
+            """ watcher thread """
+            try:
+                syncer.watch(stop_event = stop_event)
+            except Exception as err: #pylint:disable=W0703
+                errors.append(err)
+
+        real_idle_wait = imap_utils.GIMAPFetcher.idle_wait
+        def patched_idle_wait(fetcher, *args, **kwargs):
+            """ idle_wait of the test """
+            idle_wait(fetcher)
+            return real_idle_wait(fetcher, *args, **kwargs)
+        imap_utils.GIMAPFetcher.idle_wait = patched_idle_wait
+        self.addCleanup(setattr, imap_utils.GIMAPFetcher, 'idle_wait', real_idle_wait)
+
+        watcher = threading.Thread(target = watch, name = 'gmv-emails')
+        watcher.start()
+        return syncer, watcher, stop_event, errors
+
+    def test_watch_error(self):
+        """
+           sync --watch: an error in one of the watchers stops the other one and is raised
+        """
+        for failing in ('gmv-emails', 'gmv-chats'):
+            def idle_wait(_fetcher, failing = failing):
+                """ the IDLE of the failing watcher fails """
+                if threading.current_thread().name == failing:
+                    raise imaplib.IMAP4.error("IDLE failed")
+
+            _, watcher, stop_event, errors = self._run_watch(idle_wait)
+            watcher.join(20)
+            stop_event.set()
+            self.assertFalse(watcher.is_alive(), failing)
+            self.assertEqual([ str(err) for err in errors ], ["IDLE failed"], failing)
+
+    def test_watch_outage(self):
+        """
+           sync --watch: after a lost connection the watcher reconnects and reconciles
+        """
+        folder = self.account.folders[fake_imap_server.ALL_MAIL]
+        nb_fails = []
+        def idle_wait(_fetcher):
+            """ the email connection is lost once, a message arrives meanwhile """
+            if threading.current_thread().name == 'gmv-emails' and not nb_fails:
+                nb_fails.append(1)
+                folder.append(self.account.new_message(b'Subject: new\r\n\r\nbody\r\n', (), \
+                                                       datetime.datetime(2015, 3, 1)))
+                raise socket.error("connection reset")
+
+        syncer, watcher, stop_event, errors = self._run_watch(idle_wait)
+        try:
+            deadline = time.time() + 20
+            while time.time() < deadline and syncer.metrics.get_counter('emails_stored') < 41:
+                time.sleep(0.1)
+            self.assertTrue(watcher.is_alive())
+        finally:
+            stop_event.set()
+            watcher.join(10)
+
+        self.assertFalse(watcher.is_alive())
+        self.assertEqual(errors, [])
+        self.assertEqual(syncer.metrics.get_counter('watch_outages'), 1)
+        self.assertEqual(syncer.metrics.get_counter('emails_stored'), 41)
+
+    def test_benchmark(self):
+        """
+           The benchmark harness reports every operation
+        """
+        results = benchmark.run_benchmark(nb_emails = 30, msg_size = 512, \
+                                          work_dir = os.path.join(self.work_dir, 'bench'), isolate = False)
+        self.assertEqual([res['operation'] for res in results], list(benchmark.OPERATIONS))
+        for res in results:
+            self.assertFalse('error' in res)
+            self.assertEqual(res['messages'], 30)
+            self.assertTrue(res['msgs_per_sec'] > 0)
+            self.assertTrue(res['peak_rss_mb'] > 0)
+        self.assertTrue('sync' in benchmark.format_results(results))
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFakeGmailServer)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,179 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import gmv.fake_imap_server as fake_imap_server
+import gmv.gmvault_utils as gmvault_utils
+import gmv.imap_utils as imap_utils
+import gmv.mod_imap as mimap
+
+CREDENTIAL = { 'type' : 'passwd', 'value' : 'pwd' }
+
+class ConfOverride(object):
+    """
+       The defaults with some [General] values replaced
+    """
+    def __init__(self, conf, **values):
+        self.conf   = conf
+        self.values = values
+
+    def _value(self, getter, section, option, default = None):
+        """ overridden value or the one of the conf """
+        if section == 'General' and option in self.values:
+            return self.values[option]
+        return getattr(self.conf, getter)(section, option, default)
+
+    def get(self, section, option, default = None):
+        """ get """
+        return self._value('get', section, option, default)
+
+    def getint(self, section, option, default = 0):
+        """ getint """
+        return self._value('getint', section, option, default)
+
+    def getfloat(self, section, option, default = 0):
+        """ getfloat """
+        return self._value('getfloat', section, option, default)
+
+    def get_boolean(self, section, option, default = False):
+        """ get_boolean """
+        return self._value('get_boolean', section, option, default)
+
+    def __getattr__(self, name):
+        return getattr(self.conf, name)
+
+class TestCompression(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       COMPRESS=DEFLATE on both transports and adaptive mode
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.old_gmvault_dir = os.environ.get('GMVAULT_DIR')
+        os.environ['GMVAULT_DIR'] = os.path.join(self.work_dir, 'conf')
+        self.account = fake_imap_server.FakeGmailAccount(nb_emails = 40, msg_size = 4096)
+        self.server  = fake_imap_server.FakeGmailServer({ 'source@gmail.com' : self.account }).start()
+        self.patches = []
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        for patch in self.patches:
+            patch.stop()
+        self.server.stop()
+        if self.old_gmvault_dir is None:
+            del os.environ['GMVAULT_DIR']
+        else:
+            os.environ['GMVAULT_DIR'] = self.old_gmvault_dir
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def _conf(self, **values):
+        """ replace [General] values of the defaults """
+        conf  = ConfOverride(gmvault_utils.get_conf_defaults(), **values)
+        patch = unittest.mock.patch('gmv.imap_utils.gmvault_utils.get_conf_defaults', return_value = conf)
+        patch.start()
+        self.patches.append(patch)
+
+    def _fetcher(self, transport):
+        """ connected GIMAPFetcher in All Mail """
+        fetcher = imap_utils.GIMAPFetcher(self.server.host, self.server.port, 'source@gmail.com', CREDENTIAL, \
+                                          readonly_folder = False, use_ssl = False, transport = transport)
+        fetcher.connect()
+        fetcher.select_folder('ALLMAIL')
+        return fetcher
+
+    def test_pays_off(self):
+        """
+           the compression is kept when it saves more transfer time than its CPU time
+        """
+        stats = mimap.CompressionStats()
+        self.assertEqual(stats.ratio, 1.0)
+        stats.wire_in, stats.payload_in, stats.wire_out, stats.payload_out = 900, 3000, 100, 1000
+        stats.io_time, stats.cpu_time = 1.0, 0.5
+        self.assertEqual((stats.payload, stats.ratio), (4000, 4.0))
+        self.assertTrue(stats.pays_off()) # 3 s saved for 0.5 s of CPU
+        stats.cpu_time = 4.0
+        self.assertFalse(stats.pays_off())
+        stats.cpu_time = 0.1
+        self.assertFalse(stats.pays_off(min_ratio = 5))
+
+    def test_compressed_transports(self):
+        """
+           both transports fetch and append through a compressed connection
+        """
+        self._conf(enable_imap_compression = True, imap_compression_mode = 'always')
+        body = 'Subject: compressed\nFrom: foo@bar.com\n\n' + 'hello ' * 1000
+        for nb_compress, transport in enumerate(imap_utils.GIMAPFetcher.TRANSPORTS, 1):
+            fetcher = self._fetcher(transport)
+            stats   = fetcher.server.compression_stats
+            self.assertEqual(self.server.stats['compress'], nb_compress)
+
+            data = fetcher.fetch(list(range(1, 41)), imap_utils.GIMAPFetcher.GET_ALL_INFO)
+            self.assertEqual(data[7][imap_utils.GIMAPFetcher.EMAIL_BODY], \
+                             self.account.folders[fake_imap_server.ALL_MAIL].get(7).body)
+            uid = fetcher.push_data(fetcher.get_folder_name('ALLMAIL'), body, (), datetime.datetime(2014, 5, 1))
+            self.assertEqual(self.account.folders[fake_imap_server.ALL_MAIL].get(uid).body, \
+                             body.replace('\n', '\r\n').encode('utf-8'))
+            self.assertTrue(stats.payload_in > 40 * 4096)
+            self.assertTrue(stats.wire_out < stats.payload_out)
+
+            fetcher.disconnect()
+            self.assertEqual(fetcher.metrics.get_counter('compress_payload_bytes'), stats.payload)
+            self.assertEqual(fetcher.metrics.get_counter('compress_wire_bytes'), stats.wire_in + stats.wire_out)
+
+    def test_adaptive(self):
+        """
+           auto mode: reconnect without compression when it does not pay off, keep it otherwise
+        """
+        self._conf(enable_imap_compression = True, imap_compression_mode = 'auto', imap_compression_sample_bytes = 1)
+        for transport in imap_utils.GIMAPFetcher.TRANSPORTS:
+            for pays_off in (False, True):
+                patch = unittest.mock.patch('gmv.mod_imap.CompressionStats.pays_off', return_value = pays_off)
+                patch.start()
+                self.patches.append(patch)
+                nb_compress = self.server.stats['compress']
+                fetcher = self._fetcher(transport)
+                self.assertTrue(fetcher.server.compression_stats is not None)
+
+                data = fetcher.fetch(list(range(1, 11)), imap_utils.GIMAPFetcher.GET_ALL_INFO)
+                self.assertEqual(sorted(data), list(range(1, 11)))
+                self.assertEqual(fetcher.compression, pays_off)
+                self.assertEqual(fetcher.server.compression_stats is not None, pays_off)
+                self.assertEqual(fetcher.metrics.get_counter('compression_disabled'), 0 if pays_off else 1)
+
+                # the reconnections keep the decision
+                fetcher.disconnect()
+                fetcher.connect(go_to_current_folder = True)
+                self.assertEqual(fetcher.server.compression_stats is not None, pays_off)
+                self.assertEqual(self.server.stats['compress'], nb_compress + (2 if pays_off else 1))
+                fetcher.disconnect()
+                patch.stop()
+                self.patches.remove(patch)
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCompression)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,189 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+import urllib.request
+
+import gmv.fake_imap_server as fake_imap_server
+import gmv.gmv_cmd as gmv_cmd
+import gmv.gmvault as gmvault
+import gmv.gmvault_daemon as gmvault_daemon
+
+CREDENTIAL = { 'type' : 'passwd', 'value' : 'pwd' }
+
+class TestDaemon(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Multi accounts scheduler against the fake Gmail server
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.old_gmvault_dir = os.environ.get('GMVAULT_DIR')
+        os.environ['GMVAULT_DIR'] = os.path.join(self.work_dir, 'conf')
+        self.server = fake_imap_server.FakeGmailServer({
+                          'foo@gmail.com' : fake_imap_server.FakeGmailAccount(nb_emails = 20, msg_size = 1024),
+                          'bar@gmail.com' : fake_imap_server.FakeGmailAccount(nb_emails = 10, msg_size = 1024) },
+                          auto_create = False).start()
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        self.server.stop()
+        if self.old_gmvault_dir is None:
+            del os.environ['GMVAULT_DIR']
+        else:
+            os.environ['GMVAULT_DIR'] = self.old_gmvault_dir
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def _jobs(self, emails):
+        """ one job per email """
+        return [ gmvault_daemon.AccountJob(email, os.path.join(self.work_dir, email), interval = 3600, \
+                                           sync_type = 'full', host = self.server.host, port = self.server.port) \
+                 for email in emails ]
+
+    @classmethod
+    def _sync(cls, job, credential, metrics):
+        """ sync_fn of the tests (plain tcp) """
+        syncer = gmvault.GMVaulter(job.db_dir, job.host, job.port, job.email, credential, \
+                                   use_ssl = False, metrics = metrics)
+        syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' })
+        syncer.src.disconnect()
+
+    def test_schedule(self):
+        """
+           both accounts synced, the unknown one backs off
+        """
+        jobs = self._jobs(['foo@gmail.com', 'bar@gmail.com', 'unknown@gmail.com'])
+        scheduler = gmvault_daemon.SyncScheduler(jobs, self._sync, lambda job: CREDENTIAL, \
+                                                 max_connections = 2, backoff = 10)
+        self.assertEqual(len(scheduler.run_pending()), 2) # connection budget
+        scheduler.wait()
+        self.assertEqual(len(scheduler.run_pending()), 1)
+        scheduler.wait()
+
+        foo, bar, unknown = jobs
+        for job, nb_emails in ((foo, 20), (bar, 10)):
+            self.assertEqual(job.last_status, 'ok')
+            self.assertEqual(job.last_metrics['counters']['emails_stored'], nb_emails)
+            self.assertTrue(job.next_run > time.time() + 3500)
+        self.assertEqual(unknown.last_status, 'error')
+        self.assertEqual(unknown.nb_failures, 1)
+        self.assertTrue(unknown.next_run < time.time() + 11)
+        self.assertEqual(scheduler.run_pending(), [])
+
+        server = scheduler.serve_status(0)
+        try:
+            url = 'http://127.0.0.1:%d/status' % (server.server_address[1])
+            status = json.loads(urllib.request.urlopen(url).read().decode('utf-8'))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([acc['last_status'] for acc in status['accounts']], ['ok', 'ok', 'error'])
+
+    def _open_sessions(self, timeout = 5):
+        """ nb of sessions still open on the server once the closed ones are finished """
+        deadline = time.monotonic() + timeout
+        while self.server.stats['sessions'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.server.stats['sessions']
+
+    def test_daemon_sync_disconnects(self):
+        """
+           the sync of the daemon uses one connection (max_connections) and logs out, even when the sync fails
+        """
+        init     = gmvault.GMVaulter.__init__
+        vaulters = [] # kept alive: the session must be closed by a logout, not by the garbage collector
+        def plain_init(vaulter, *args, **kwargs):
+            """ plain tcp connection to the fake server """
+            kwargs['use_ssl'] = False
+            init(vaulter, *args, **kwargs)
+            vaulters.append(vaulter)
+
+        job = self._jobs(['foo@gmail.com'])[0]
+        with unittest.mock.patch.object(gmvault.GMVaulter, '__init__', plain_init):
+            gmv_cmd.GMVaultLauncher._daemon_sync(job, CREDENTIAL, None) #pylint:disable=W0212
+            self.assertEqual(self._open_sessions(), 0)
+            self.assertEqual(self.server.stats['max_sessions'], 1)
+
+            with unittest.mock.patch.object(gmvault.GMVaulter, 'sync', side_effect = IOError('disk full')):
+                self.assertRaises(IOError, gmv_cmd.GMVaultLauncher._daemon_sync, job, CREDENTIAL, None) #pylint:disable=W0212
+            self.assertEqual(self._open_sessions(), 0)
+        self.assertEqual(len(vaulters), 2)
+        self.assertEqual(self.server.stats['bodies'], 20) # the first sync ran
+
+    def test_backoff(self):
+        """
+           exponential backoff bounded by max_backoff and interval
+        """
+        job = gmvault_daemon.AccountJob('foo@gmail.com', '/tmp/foo', interval = 500)
+        delays = []
+        for _ in range(6):
+            job.started(0)
+            delays.append(job.failed(0, Exception('down'), 60, 3600))
+        self.assertEqual(delays, [60, 120, 240, 480, 500, 500])
+        job.started(0)
+        job.succeeded(1)
+        self.assertEqual((job.nb_failures, job.next_run), (0, 500))
+
+    def test_token_bucket(self):
+        """
+           bandwidth budget shared by the threads
+        """
+        bucket = gmvault_daemon.TokenBucket(100000)
+        start = time.monotonic()
+        bucket.consume(100000) # the initial burst
+        bucket.consume(20000)
+        self.assertTrue(time.monotonic() - start >= 0.18)
+
+        metrics = gmvault_daemon.BudgetedMetrics(gmvault_daemon.TokenBucket(1000000))
+        metrics.inc('bytes_in', 1100000)
+        self.assertEqual(metrics.get_counter('bytes_in'), 1100000)
+        self.assertEqual(metrics.summary()['stages']['bandwidth_wait']['calls'], 1)
+
+    def test_accounts_file(self):
+        """
+           accounts file parsing
+        """
+        path = os.path.join(self.work_dir, 'accounts.json')
+        with open(path, 'w') as the_file:
+            json.dump({ 'max_connections' : 3, 'accounts' : [
+                          { 'email' : 'foo@gmail.com', 'db_dir' : '/tmp/foo', 'type' : 'full', 'encrypt' : True },
+                          { 'email' : 'bar@gmail.com', 'db_dir' : '/tmp/bar', 'auth' : 'passwd' } ] }, the_file)
+        jobs, settings = gmvault_daemon.load_accounts_file(path)
+        self.assertEqual(settings, { 'max_connections' : 3 })
+        self.assertEqual([job.sync_type for job in jobs], ['full', 'quick'])
+        self.assertEqual(jobs[0].sync_args()['encrypt'], True)
+        self.assertEqual(jobs[1].auth, 'passwd')
+
+        self.assertRaises(gmvault_daemon.DaemonError, gmvault_daemon.AccountJob.from_dict, \
+                          { 'email' : 'foo@gmail.com', 'db_dir' : '/tmp/foo', 'encrpyt' : True })
+        self.assertRaises(gmvault_daemon.DaemonError, gmvault_daemon.load_accounts_file, \
+                          os.path.join(self.work_dir, 'missing.json'))
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDaemon)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,129 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import unittest
+
+import gmv.benchmark as benchmark
+import gmv.gmvault_db as gmvault_db
+import gmv.gmvault_utils as gmvault_utils
+import gmv.metrics_utils as metrics_utils
+
+LATIN1_BODY = 'From: José <jose@example.fr>\r\nSubject: café\r\n' \
+              'Content-Type: text/plain; charset="ISO-8859-1"\r\n\r\ndéjà vu, crème brûlée\r\n'
+
+class TestEncodingDetector(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Tiered encoding detection
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.detector = gmvault_utils.EncodingDetector()
+
+    def test_fast_tiers(self):
+        """
+           ascii and utf-8 are decided without parsing the headers
+        """
+        self.assertEqual(self.detector.decode(b'Subject: hello\r\n\r\nbody'), \
+                         ('Subject: hello\r\n\r\nbody', 'ascii', 'ascii'))
+        body = 'Subject: 日本\r\n\r\ndéjà'.encode('utf-8')
+        self.assertEqual(self.detector.decode(body)[1:], ('utf-8', 'utf-8'))
+        self.assertEqual(self.detector.stats()['chardet'], 0)
+
+    def test_charset_and_domain(self):
+        """
+           the declared charset is honoured and remembered for the sender domain
+        """
+        metrics = metrics_utils.MetricsRegistry()
+        body = LATIN1_BODY.encode('iso-8859-1')
+        self.assertEqual(self.detector.parse_headers(body), (['iso-8859-1'], 'example.fr'))
+        self.assertEqual(self.detector.decode(body, metrics = metrics), (LATIN1_BODY, 'iso-8859-1', 'charset'))
+
+        # same domain without charset parameter
+        undeclared = LATIN1_BODY.replace('; charset="ISO-8859-1"', '')
+        self.assertEqual(self.detector.decode(undeclared.encode('iso-8859-1'), metrics = metrics)[1:], \
+                         ('iso-8859-1', 'domain'))
+        self.assertEqual((metrics.get_counter('encoding_charset'), metrics.get_counter('encoding_domain')), (1, 1))
+
+        # unknown charset and unknown domain: chardet
+        unknown = undeclared.replace('example.fr', 'example.de').replace('text/plain', 'text/plain; charset=foo')
+        self.assertEqual(self.detector.decode(unknown.encode('iso-8859-1'))[2], 'chardet')
+        self.assertEqual(self.detector.stats()['chardet'], 1)
+
+    def test_convert_and_subject(self):
+        """
+           bodies and header fields go through the detector
+        """
+        self.assertEqual(gmvault_utils.convert_to_unicode(LATIN1_BODY.encode('iso-8859-1')), LATIN1_BODY)
+        header_fields = 'Subject: déjà vu\r\nMessage-ID: <1@example.fr>\r\n'.encode('utf-8')
+        header_fields, _, tier = gmvault_utils.ENCODING_DETECTOR.decode(header_fields, charsets = [])
+        self.assertEqual(tier, 'utf-8')
+        self.assertEqual(gmvault_db.GmailStorer.parse_header_fields(header_fields)[:2], ('déjà vu', '1@example.fr'))
+
+class TestHeaderParser(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Single pass parser of the fetched header fields
+    """
+    def test_parse_header_fields(self):
+        """
+           any case, folded values, first non empty value wins
+        """
+        header_fields = 'message-ID:\r\n <folded@example.com>\r\nSUBJECT: a long\r\n\tfolded subject \r\n' \
+                        'X-Gmail-Received: abc123\r\nSubject: second\r\n\r\n'
+        self.assertEqual(gmvault_db.GmailStorer.parse_header_fields(header_fields), \
+                         ('a long\tfolded subject', 'folded@example.com', 'abc123'))
+        self.assertEqual(gmvault_db.GmailStorer.parse_header_fields('Subject: \r\nX-Subject: no\r\n\r\n'), \
+                         (None, None, None))
+        self.assertEqual(gmvault_db.GmailStorer.parse_header_fields('Subject:\r\nsUbJeCt : kept\r\nSubject: no\r\n'), \
+                         ('kept', None, None))
+        # the message id is between the first < and the last >
+        self.assertEqual([ gmvault_db.GmailStorer.parse_header_fields('Message-ID:%s\r\n' % (value))[1] \
+                           for value in (' a <b> c <d> e', ' <x', ' <>', ' x@y ') ], ['b> c <d', '<x', None, 'x@y'])
+
+    def test_encoded_words(self):
+        """
+           RFC 2047 encoded-words of the subject
+        """
+        header_fields = 'Subject: =?UTF-8?B?UmU6IGTDqWrDoA==?=\r\n =?iso-8859-1?q?_vu_=E0?= 10h\r\n\r\n'
+        self.assertEqual(gmvault_db.GmailStorer.parse_header_fields(header_fields)[0], 'Re: déjà vu à 10h')
+        # unknown charset and bad words are kept
+        self.assertEqual(gmvault_db.GmailStorer.decode_header_value('=?foo?q?a?= =?utf-8?q?b?= =?x?'), \
+                         '=?foo?q?a?= b =?x?')
+
+    def test_header_benchmark(self):
+        """
+           the headers benchmark runs every parser on the built-in corpus
+        """
+        corpus  = benchmark.build_header_corpus(60)
+        results = benchmark.run_header_benchmark(corpus, batch_size = 25, rounds = 1)
+        self.assertEqual([ (res['blocks'], res['operation']) for res in results ], \
+                         [ (blocks, parser) for blocks in ('all', 'plain') \
+                           for parser in ('legacy', 'legacy-raw', 'legacy+email', 'current') ])
+        self.assertEqual([ res['messages'] for res in results ], [60] * 4 + [10] * 4)
+        self.assertTrue(all(res['msgs_per_sec'] > 0 for res in results))
+        self.assertEqual([ res['speedup'] for res in results if res['operation'] == 'legacy' ], [1.0, 1.0])
+        self.assertTrue('current' in benchmark.format_header_results(results))
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(TestEncodingDetector), \
+                                unittest.TestLoader().loadTestsFromTestCase(TestHeaderParser)])
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,136 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import unittest
+import os
+import mailbox
+import tempfile
+
+import gmv.gmvault_export as gmvault_export
+import gmv.gmvault_utils as gmvault_utils
+import gmv.test_utils as test_utils
+
+
+class TestGMVaultExport(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Export tests working on a local gmvault-db (no Gmail account needed)
+    """
+
+    def setUp(self): #pylint:disable-msg=C0103
+        """setup"""
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-export-tests')
+        self.db_dir   = '%s/db' % (self.work_dir)
+        self.out_dir  = '%s/out' % (self.work_dir)
+
+        test_utils.create_fake_db(self.db_dir, [
+            test_utils.create_fake_email_info(1001, ['\\Inbox', 'work', 'work/projects', 'friends']),
+            test_utils.create_fake_email_info(1002, ['work'], flags = ()),
+            test_utils.create_fake_email_info(1003, [], flags = (b'\\Seen', b'\\Flagged')),
+        ])
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        """teardown"""
+        gmvault_utils.delete_all_under(self.work_dir, delete_top_dir = True)
+
+    @classmethod
+    def _list_messages(cls, a_dir):
+        """ return {folder: [message paths]} for all the maildir folders under a_dir """
+        result = {}
+        for root, _, files in os.walk(a_dir):
+            if os.path.basename(root) in ('cur', 'new'):
+                result.setdefault(os.path.dirname(root), []).extend(os.path.join(root, f) for f in files)
+        return result
+
+    def test_maildir_export_with_hardlinks(self):
+        """
+           Each message is written once and hardlinked in its other labels
+        """
+        a_mailbox = gmvault_export.OfflineIMAP(self.out_dir, use_hardlinks = True)
+        gmvault_export.GMVaultExporter(self.db_dir, a_mailbox).export()
+        a_mailbox.close()
+
+        messages = self._list_messages(self.out_dir)
+
+        # 1001 in Inbox, work, work.projects, friends. 1002 in work. 1003 in Archived
+        self.assertEqual(sorted(len(files) for files in messages.values()), [1, 1, 1, 1, 2])
+        self.assertEqual(a_mailbox.nb_linked, 3)
+        self.assertTrue(a_mailbox.bytes_saved > 0)
+
+        inodes = set()
+        for files in messages.values():
+            for a_file in files:
+                if os.stat(a_file).st_nlink == 4:
+                    inodes.add(os.stat(a_file).st_ino)
+                    # seen flag is kept in every label
+                    self.assertTrue(a_file.endswith(':2,S'))
+        self.assertEqual(len(inodes), 1)
+
+    def test_maildir_export_identical_with_and_without_hardlinks(self):
+        """
+           The hardlink export has the same layout as the normal export
+        """
+        def layout(use_hardlinks):
+            out_dir = '%s/%s' % (self.out_dir, use_hardlinks)
+            a_mailbox = gmvault_export.OfflineIMAP(out_dir, use_hardlinks = use_hardlinks)
+            gmvault_export.GMVaultExporter(self.db_dir, a_mailbox).export()
+            a_mailbox.close()
+            messages = self._list_messages(out_dir)
+            return sorted((os.path.relpath(folder, out_dir), sorted(open(f, 'rb').read() for f in files)) \
+                          for folder, files in messages.items())
+
+        self.assertEqual(layout(True), layout(False))
+
+    def test_streaming_mbox_export(self):
+        """
+           The streaming mbox writer produces the same mailboxes as MBox
+        """
+        def read_mboxes(export_type):
+            out_dir = '%s/%s' % (self.out_dir, export_type.__name__)
+            a_mailbox = export_type(out_dir)
+            gmvault_export.GMVaultExporter(self.db_dir, a_mailbox).export()
+            a_mailbox.close()
+            result = {}
+            for root, _, files in os.walk(out_dir):
+                for a_file in files:
+                    mbox = mailbox.mbox(os.path.join(root, a_file))
+                    result[os.path.relpath(os.path.join(root, a_file), out_dir)] = \
+                        sorted((msg['Subject'], msg.get_flags(), msg.get_payload()) for msg in mbox)
+            return result
+
+        expected = read_mboxes(gmvault_export.MBox)
+        self.assertTrue('work.sbd/projects' in expected)
+        self.assertEqual(read_mboxes(gmvault_export.StreamingMBox), expected)
+
+    def test_streaming_mbox_format(self):
+        """
+           From lines are escaped and the flags written in Status headers
+        """
+        data = gmvault_export.StreamingMBox.format_message(\
+                  b'Subject: hi\r\nStatus: O\r\n\r\nFrom here\r\nbye', ['\\Seen', '\\Flagged'])
+        self.assertTrue(data.startswith(b'From MAILER-DAEMON '))
+        self.assertTrue(data.endswith(b'Subject: hi\nStatus: R\nX-Status: F\n\n>From here\nbye\n\n'))
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestGMVaultExport)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,320 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import imaplib
+
+import gmv.fake_imap_server as fake_imap_server
+import gmv.gmvault as gmvault
+import gmv.imap_utils as imap_utils
+
+CREDENTIAL = { 'type' : 'passwd', 'value' : 'pwd' }
+
+
+class FakeSource(object):
+    """
+       Minimal GIMAPFetcher answering fetch requests from memory
+    """
+    def __init__(self, bad_ids = (), msg_size = 100, empty_ids = ()):
+        self.bad_ids   = set(bad_ids)
+        self.empty_ids = set(empty_ids)
+        self.msg_size  = msg_size
+        self.nb_fetch  = 0
+
+    def fetch(self, a_ids, a_attributes): #pylint:disable=W0613
+        """ fetch """
+        self.nb_fetch += 1
+        if not isinstance(a_ids, (list, tuple)):
+            a_ids = [a_ids]
+        if self.bad_ids.intersection(a_ids):
+            raise imaplib.IMAP4.error("fetch failed: 'Some messages could not be FETCHed (Failure)'")
+        return dict((the_id, {imap_utils.GIMAPFetcher.GMAIL_ID: the_id, \
+                              imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY: b'x' * self.msg_size}) \
+                    for the_id in a_ids if the_id not in self.empty_ids)
+
+class TestIMAPBatchFetcher(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       IMAPBatchFetcher tests (no Gmail account needed)
+    """
+    @classmethod
+    def _error_report(cls):
+        """ empty error report """
+        return {'empty': [], 'cannot_be_fetched': [], 'emails_in_quarantine': [], 'key_error': []}
+
+    def test_fetch_everything(self):
+        """
+           All ids are returned once and the batch size grows
+        """
+        imap_ids = list(range(1, 5001))
+        fetcher = gmvault.IMAPBatchFetcher(FakeSource(), imap_ids, self._error_report(), None, \
+                                           default_batch_size = 10, max_batch_size = 1000, \
+                                           max_batch_bytes = 10 ** 9)
+        fetched = []
+        for data in fetcher:
+            fetched.extend(data.keys())
+
+        self.assertEqual(sorted(fetched), imap_ids)
+        self.assertTrue(max(fetcher.batch_sizes) > 10)
+        self.assertTrue(max(fetcher.batch_sizes) <= 1000)
+
+    def test_bytes_cap(self):
+        """
+           The batch size is capped by the response size
+        """
+        fetcher = gmvault.IMAPBatchFetcher(FakeSource(msg_size = 1000), list(range(1, 2001)), \
+                                           self._error_report(), None, default_batch_size = 10, \
+                                           max_batch_size = 1000, max_batch_bytes = 20000)
+        for _ in fetcher:
+            pass
+        self.assertTrue(max(fetcher.batch_sizes[1:]) <= 20)
+
+    def test_bisect_bad_id(self):
+        """
+           A faulty id is isolated in a logarithmic number of fetches
+        """
+        src = FakeSource(bad_ids = [377])
+        report = self._error_report()
+        fetcher = gmvault.IMAPBatchFetcher(src, list(range(1, 513)), report, None, \
+                                           default_batch_size = 512, max_batch_size = 512, \
+                                           max_batch_bytes = 10 ** 9)
+        fetched = []
+        for data in fetcher:
+            fetched.extend(data.keys())
+
+        self.assertEqual(len(fetched), 511)
+        self.assertTrue(377 not in fetched)
+        self.assertEqual(report['cannot_be_fetched'], [(377, None)])
+        # the failing batch, 2 halves for each of the 9 levels (256 ids to 1 id)
+        # and the gmail id lookup of the faulty id: the failing batch is never fetched again
+        self.assertEqual(src.nb_fetch, 1 + 2 * 9 + 1)
+
+        src = FakeSource(bad_ids = [3])
+        report = self._error_report()
+        fetcher = gmvault.IMAPBatchFetcher(src, [3], report, None, default_batch_size = 1, \
+                                           max_batch_size = 1, max_batch_bytes = 10 ** 9)
+        self.assertEqual(list(fetcher), [{}])
+        self.assertEqual(report['cannot_be_fetched'], [(3, None)])
+        self.assertEqual(src.nb_fetch, 2)
+
+    def test_position(self):
+        """
+           The cursor position can be checkpointed and restored
+        """
+        imap_ids = list(range(101, 201))
+        fetcher = gmvault.IMAPBatchFetcher(FakeSource(), imap_ids, self._error_report(), None, \
+                                           default_batch_size = 10, max_batch_size = 10, \
+                                           max_batch_bytes = 10 ** 9)
+        self.assertEqual(len(fetcher), 100)
+        next(fetcher)
+        next(fetcher)
+        self.assertEqual(fetcher.checkpoint(), (10, 111))
+        self.assertEqual(len(fetcher), 80)
+
+        position, _ = fetcher.checkpoint()
+        restarted = gmvault.IMAPBatchFetcher(FakeSource(), imap_ids, self._error_report(), None, \
+                                             default_batch_size = 10, max_batch_size = 10, \
+                                             max_batch_bytes = 10 ** 9)
+        restarted.seek(position)
+        fetched = []
+        for data in restarted:
+            fetched.extend(data.keys())
+        self.assertEqual(fetched, imap_ids[10:])
+        self.assertEqual(restarted.checkpoint(), (100, None))
+
+        fetcher.reset()
+        self.assertEqual(sum(len(data) for data in fetcher), 100)
+
+    def test_unreturned_ids(self):
+        """
+           The ids answered without data are reported once everything is fetched
+        """
+        fetcher = gmvault.IMAPBatchFetcher(FakeSource(empty_ids = [3, 250, 999]), list(range(1, 1001)), \
+                                           self._error_report(), None, default_batch_size = 64, \
+                                           max_batch_bytes = 10 ** 9)
+        fetcher.seek(5)
+        for _ in fetcher:
+            pass
+        self.assertEqual(list(fetcher.unreturned_ids()), [250, 999])
+        self.assertEqual(len(fetcher.returned), 125)
+
+    def test_uid_ranges(self):
+        """
+           The ranges of ids done are merged whatever the order they are added in
+        """
+        done = gmvault.UIDRanges([(50, 41), (10, 20)])
+        self.assertEqual(done.ranges, [[10, 20], [41, 50]])
+        done.add(21, 30)
+        done.add(35, 40)
+        self.assertEqual(done.ranges, [[10, 30], [35, 50]])
+        self.assertEqual([ the_id for the_id in range(1, 60) if the_id not in done ], \
+                         list(range(1, 10)) + list(range(31, 35)) + list(range(51, 60)))
+        done.add(5, 100)
+        self.assertEqual((done.ranges, len(done)), ([[5, 100]], 1))
+        for the_id in (5, 50, 100, 200):
+            done.discard(the_id)
+        self.assertEqual(done.ranges, [[6, 49], [51, 99]])
+
+class TestFetchPlan(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Two tier sync against the fake Gmail server
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.account  = fake_imap_server.FakeGmailAccount(nb_emails = 30, msg_size = 512)
+        self.server   = fake_imap_server.FakeGmailServer({ 'foo@gmail.com' : self.account }).start()
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        self.server.stop()
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def _sync(self, interrupt_after = None, batch_size = None, unreturned = (), **sync_args):
+        """
+           full sync. Return the syncer and the (ids, attributes) of its fetch requests
+           interrupt_after: stop the sync at the body fetch following interrupt_after ones
+           batch_size: fixed size of the metadata batches
+           unreturned: ids left out of the fetch responses
+        """
+        if batch_size:
+            conf   = gmvault.gmvault_utils.get_conf_defaults()
+            getint = conf.getint
+            sizes  = { 'nb_messages_per_batch' : batch_size, 'max_messages_per_batch' : batch_size }
+            patch  = unittest.mock.patch.object(conf, 'getint', side_effect = \
+                                                lambda section, option, default = 0: \
+                                                sizes.get(option) or getint(section, option, default))
+            patch.start()
+            self.addCleanup(patch.stop)
+        syncer = gmvault.GMVaulter(os.path.join(self.work_dir, 'db'), self.server.host, self.server.port, \
+                                   'foo@gmail.com', CREDENTIAL, use_ssl = False)
+        requests = []
+        fetch = syncer.src.fetch
+        def recording_fetch(a_ids, a_attributes):
+            if a_attributes == imap_utils.GIMAPFetcher.GET_DATA_ONLY and \
+               interrupt_after is not None and len(self._data_ids(requests)) == interrupt_after:
+                raise KeyboardInterrupt()
+            requests.append((a_ids, a_attributes))
+            data = fetch(a_ids, a_attributes)
+            for the_id in unreturned:
+                data.pop(the_id, None)
+            return data
+        syncer.src.fetch = recording_fetch
+        try:
+            syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' }, emails_only = True, **sync_args)
+        except KeyboardInterrupt:
+            pass
+        syncer.src.disconnect()
+        return syncer, requests
+
+    @classmethod
+    def _data_ids(cls, requests):
+        """ ids whose body has been fetched """
+        return [ a_ids for a_ids, attrs in requests if attrs == imap_utils.GIMAPFetcher.GET_DATA_ONLY ]
+
+    def _progress_path(self):
+        """ path of the email sync progress file """
+        return os.path.join(self.work_dir, 'db', '.info', 'foo@gmail.com_%s' % (gmvault.GMVaulter.EMAIL_SYNC_PROGRESS))
+
+    def test_light_fetch(self):
+        """
+           headers and bodies are only fetched for the messages missing from the db
+        """
+        syncer, _ = self._sync()
+        self.assertEqual(syncer.metrics.get_counter('emails_stored'), 30)
+
+        folder = self.account.folders[fake_imap_server.ALL_MAIL]
+        msg = folder.get(4)
+        msg.labels = (b'\\Inbox', b'Travel')
+        folder.update(msg)
+        new_uid = folder.append(self.account.new_message(b'Subject: new\r\n\r\nbody\r\n', (), \
+                                                         datetime.datetime(2015, 3, 1)))
+
+        syncer, requests = self._sync()
+        self.assertEqual(syncer.metrics.get_counter('emails_updated'), 1)
+        self.assertEqual(syncer.metrics.get_counter('emails_stored'), 1)
+        self.assertEqual(set(syncer.gstorer.unbury_metadata(self.account.GM_ID_BASE + 4).labels), \
+                         set(['\\Inbox', 'Travel']))
+
+        full_ids = [ a_ids for a_ids, attrs in requests if attrs != imap_utils.GIMAPFetcher.GET_FLAGS_LABELS ]
+        self.assertEqual(full_ids, [[new_uid], new_uid])
+        self.assertEqual(sum(len(a_ids) for a_ids, attrs in requests \
+                             if attrs == imap_utils.GIMAPFetcher.GET_FLAGS_LABELS), 31)
+
+    def test_newest_first_resume(self):
+        """
+           the newest emails are synced first and a resumed sync only fetches the ones not synced
+        """
+        # batches of 4: the checkpoint of the batch [18, 15] saves [19, 30] as done
+        _, requests = self._sync(interrupt_after = 12, batch_size = 4, newest_first = True)
+        self.assertEqual(self._data_ids(requests), list(range(30, 18, -1)))
+        with open(self._progress_path()) as the_file:
+            self.assertEqual(json.load(the_file)['done'], [[19, 30]])
+
+        syncer, requests = self._sync(restart = True, newest_first = True)
+        self.assertEqual(self._data_ids(requests), list(range(18, 0, -1)))
+        self.assertEqual(syncer.metrics.get_counter('emails_stored'), 18)
+        with open(self._progress_path()) as the_file:
+            self.assertEqual(json.load(the_file)['done'], [[1, 30]])
+
+        # everything done: a resumed sync (auto mode) only looks at the new emails
+        new_uid = self.account.folders[fake_imap_server.ALL_MAIL].append( \
+                      self.account.new_message(b'Subject: new\r\n\r\nbody\r\n', (), datetime.datetime(2015, 3, 1)))
+        syncer, requests = self._sync(restart = True, newest_first = True)
+        self.assertEqual([ a_ids for a_ids, _ in requests ], [[new_uid], [new_uid], new_uid])
+
+    def test_resume_unreturned(self):
+        """
+           an id the server did not return is not saved as done and a resumed sync fetches it
+        """
+        _, requests = self._sync(interrupt_after = 11, batch_size = 4, unreturned = (25,), newest_first = True)
+        self.assertEqual(self._data_ids(requests), list(range(30, 25, -1)) + list(range(24, 18, -1)))
+        with open(self._progress_path()) as the_file:
+            self.assertEqual(json.load(the_file)['done'], [[19, 24], [26, 30]])
+
+        syncer, requests = self._sync(restart = True, newest_first = True)
+        self.assertEqual(self._data_ids(requests), [25] + list(range(18, 0, -1)))
+        self.assertEqual(syncer.metrics.get_counter('emails_stored'), 19)
+        with open(self._progress_path()) as the_file:
+            self.assertEqual(json.load(the_file)['done'], [[1, 30]])
+
+    def test_resume_last_id(self):
+        """
+           a progress file of an older version (last gmail id only) resumes after the last id
+        """
+        os.makedirs(os.path.join(self.work_dir, 'db', '.info'))
+        with open(self._progress_path(), 'w') as the_file:
+            json.dump({ 'last_id' : self.account.GM_ID_BASE + 11 }, the_file)
+
+        syncer, requests = self._sync(restart = True)
+        self.assertEqual(self._data_ids(requests), list(range(11, 31)))
+        self.assertEqual(syncer.metrics.get_counter('emails_stored'), 20)
+
+def tests():
+    """
+       main test function
+    """
+    for test_class in (TestIMAPBatchFetcher, TestFetchPlan):
+        suite = unittest.TestLoader().loadTestsFromTestCase(test_class)
+        unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
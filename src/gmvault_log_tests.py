@@ -0,0 +1,132 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import unittest
+import signal
+import threading
+
+import logbook
+
+import gmv.log_utils as log_utils
+import gmv.gmvault_utils as gmvault_utils
+
+class TestLogging(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Queued handler and progress records
+    """
+    def test_queued_handler(self):
+        """
+           records are written in order by the background thread, with the args of the call time
+        """
+        test_handler = logbook.TestHandler(level = 'INFO', format_string = '{record.message}')
+        handler = log_utils.QueuedHandler(test_handler)
+        logger  = logbook.Logger('test')
+        metadata = { 'id' : 1 }
+        with handler.applicationbound():
+            for i in range(100):
+                logger.critical("message %d" % (i))
+            logger.info("metadata {}", metadata)
+            logger.debug("not written {}", metadata)
+            metadata['id'] = 2
+            handler.flush()
+        handler.close()
+
+        self.assertEqual(test_handler.formatted_records, ['message %d' % (i) for i in range(100)] + \
+                                                         ["metadata {'id': 1}"])
+
+    def test_queued_handler_signals(self):
+        """
+           records logged by a signal handler interrupting an emit are written (no deadlock),
+           with the information of the logging thread
+        """
+        test_handler = logbook.TestHandler(format_string = '{record.thread_name} {record.message}')
+        handler = log_utils.QueuedHandler(test_handler)
+        logger  = logbook.Logger('test')
+        nb_signals = []
+
+        def on_alarm(_signum, _frame):
+            nb_signals.append(1)
+            logger.critical("signal")
+
+        previous = signal.signal(signal.SIGALRM, on_alarm)
+        try:
+            with handler.applicationbound():
+                signal.setitimer(signal.ITIMER_REAL, 0.0001, 0.0001)
+                for i in range(20000):
+                    logger.critical("message %d" % (i))
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                handler.flush()
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+        handler.close()
+
+        main_name = threading.current_thread().name
+        records   = test_handler.formatted_records
+        self.assertTrue(nb_signals)
+        self.assertEqual(len(records), 20000 + len(nb_signals))
+        self.assertEqual(records.count('%s signal' % (main_name)), len(nb_signals))
+        self.assertEqual([ rec for rec in records if not rec.endswith('signal') ], \
+                         ['%s message %d' % (main_name, i) for i in range(20000)])
+
+    def test_progress_logger(self):
+        """
+           at most one progress record per period
+        """
+        test_handler = logbook.TestHandler(format_string = '{record.message}')
+        timer = gmvault_utils.Timer()
+        timer.start()
+        with test_handler.applicationbound():
+            progress = log_utils.ProgressLogger(logbook.Logger('test'), timer, 1000, 'emails', 'stored', period = 0)
+            progress.update(10)
+            progress = log_utils.ProgressLogger(logbook.Logger('test'), timer, 1000, 'emails', 'stored', period = 3600)
+            for _ in range(999):
+                progress.update()
+
+        self.assertEqual(len(test_handler.formatted_records), 1)
+        self.assertTrue('Processed 10 emails' in test_handler.formatted_records[0])
+        self.assertTrue('990 left to be stored' in test_handler.formatted_records[0])
+        self.assertEqual(progress.done, 999)
+
+    def test_combined_progress(self):
+        """
+           one record for all the phases
+        """
+        test_handler = logbook.TestHandler(format_string = '{record.message}')
+        timer = gmvault_utils.Timer()
+        timer.start()
+        with test_handler.applicationbound():
+            progress = log_utils.CombinedProgress(logbook.Logger('test'), timer, 'stored', period = 0)
+            emails, chats = progress.phase('emails', 100), progress.phase('chats', 20)
+            emails.update(10)
+            chats.update(5)
+
+        self.assertEqual((progress.done, progress.total), (15, 120))
+        self.assertEqual(len(test_handler.formatted_records), 2)
+        self.assertTrue('Processed 10/100 emails, 5/20 chats' in test_handler.formatted_records[1])
+        self.assertTrue('105 left to be stored' in test_handler.formatted_records[1])
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLogging)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
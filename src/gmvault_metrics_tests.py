@@ -0,0 +1,133 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.request
+
+import gmv.fake_imap_server as fake_imap_server
+import gmv.gmvault as gmvault
+import gmv.gmvault_export as gmvault_export
+import gmv.metrics_utils as metrics_utils
+
+
+class TestMetrics(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Metrics registry and its use in sync, restore and export (no Gmail account needed)
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def test_registry(self):
+        """
+           counters, stages, prometheus text and http endpoint
+        """
+        metrics = metrics_utils.MetricsRegistry(operation = 'sync', login = 'foo@gmail.com')
+        metrics.inc('bytes_in', 100)
+        metrics.inc('bytes_in', 50)
+        metrics.observe('search', 0.5)
+        metrics.observe('search', 1.5)
+        with metrics.time('write'):
+            pass
+
+        summary = metrics.summary()
+        self.assertEqual(summary['counters'], { 'bytes_in' : 150 })
+        self.assertEqual(summary['stages']['search']['calls'], 2)
+        self.assertEqual(summary['stages']['search']['seconds'], 2.0)
+        self.assertEqual(summary['stages']['search']['max'], 1.5)
+        self.assertEqual(summary['stages']['write']['calls'], 1)
+
+        text = metrics.to_prometheus()
+        self.assertTrue('gmvault_bytes_in_total{login="foo@gmail.com",operation="sync"} 150\n' in text)
+        self.assertTrue('gmvault_stage_calls_total{login="foo@gmail.com",operation="sync",stage="search"} 2\n' \
+                        in text)
+
+        path = os.path.join(self.work_dir, 'gmvault.prom')
+        metrics.write_textfile(path)
+        with open(path) as the_file:
+            content = the_file.read()
+        # the elapsed gauge moves between two calls, compare the other lines
+        self.assertEqual(content.splitlines()[2:], text.splitlines()[2:])
+        self.assertEqual(os.listdir(self.work_dir), ['gmvault.prom'])
+
+        server = metrics.serve_http(0)
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % (server.server_address[1])
+            body = urllib.request.urlopen(url).read().decode('utf-8')
+            self.assertTrue('gmvault_bytes_in_total' in body)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_run_metrics(self):
+        """
+           sync, restore and export record their stages and save a summary in .info
+        """
+        account = fake_imap_server.FakeGmailAccount(nb_emails = 20, nb_chats = 2, msg_size = 1024)
+        db_dir  = os.path.join(self.work_dir, 'db')
+        with fake_imap_server.FakeGmailServer({ 'source@gmail.com' : account }) as server:
+            syncer = gmvault.GMVaulter(db_dir, server.host, server.port, 'source@gmail.com', \
+                                       { 'type' : 'passwd', 'value' : 'pwd' }, use_ssl = False)
+            syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' })
+
+            summary = syncer.metrics.summary()
+            self.assertEqual(summary['counters']['emails_stored'], 20)
+            self.assertEqual(summary['counters']['chats_stored'], 2)
+            self.assertEqual(summary['stages']['body_fetch']['calls'], 22)
+            self.assertEqual(summary['stages']['write']['calls'], 22)
+            self.assertTrue(summary['stages']['search']['calls'] >= 2)
+            self.assertTrue(summary['counters']['bytes_in'] > 20 * 1024)
+
+            with open('%s/.info/source@gmail.com_sync_metrics.info' % (db_dir)) as the_file:
+                saved = json.load(the_file)
+            self.assertEqual(saved['labels'], { 'login' : 'source@gmail.com', 'operation' : 'sync' })
+            self.assertEqual(saved['counters']['emails_stored'], 20)
+
+            restorer = gmvault.GMVaulter(db_dir, server.host, server.port, 'dest@gmail.com', \
+                                         { 'type' : 'passwd', 'value' : 'pwd' }, \
+                                         read_only_access = False, use_ssl = False)
+            restorer.restore()
+            summary = restorer.metrics.summary()
+            self.assertEqual(summary['stages']['append']['calls'], 22)
+            self.assertTrue(summary['stages']['store']['calls'] > 0)
+            self.assertTrue(summary['stages']['decompress']['calls'] >= 22)
+            self.assertEqual(summary['counters']['bytes_out'], account.total_size())
+
+        mailbox  = gmvault_export.Maildir(os.path.join(self.work_dir, 'export'))
+        exporter = gmvault_export.GMVaultExporter(db_dir, mailbox)
+        exporter.export()
+        mailbox.close()
+        self.assertEqual(exporter.metrics.get_counter('emails_exported'), 20)
+        self.assertEqual(exporter.metrics.get_counter('chats_exported'), 2)
+        self.assertTrue(os.path.exists('%s/.info/export_metrics.info' % (db_dir)))
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMetrics)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,103 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import pstats
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+import gmv.profiler_utils as profiler_utils
+
+def busy_loop(duration):
+    """ burn cpu for duration seconds """
+    end, total = time.time() + duration, 0
+    while time.time() < end:
+        total += sum(range(100))
+    return total
+
+class TestProfiler(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Runtime switchable profiler
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.info_dir = os.path.join(self.work_dir, '.info')
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def test_sampling(self):
+        """
+           collapsed stacks of the main thread
+        """
+        profiler = profiler_utils.SamplingProfiler(self.info_dir, interval = 0.001)
+        self.assertEqual(profiler.toggle(), None)
+        self.assertTrue(profiler.is_running())
+        busy_loop(0.3)
+        path = profiler.toggle()
+        self.assertFalse(profiler.is_running())
+
+        self.assertTrue(path.startswith(self.info_dir) and path.endswith('.collapsed'))
+        self.assertTrue(profiler.nb_samples > 0)
+        with open(path) as the_file:
+            lines = the_file.read().splitlines()
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in lines), profiler.nb_samples)
+        self.assertTrue(any('busy_loop (gmvault_profiler_tests.py' in line.split(';')[-1] for line in lines))
+
+    def test_cprofile_signal(self):
+        """
+           cprofile mode started and stopped with SIGUSR2
+        """
+        if not hasattr(signal, 'SIGUSR2'):
+            self.skipTest('no SIGUSR2 on this platform')
+        profiler = profiler_utils.SamplingProfiler(self.info_dir, mode = profiler_utils.CPROFILE)
+        old_handler = signal.getsignal(signal.SIGUSR2)
+        try:
+            self.assertTrue(profiler_utils.register_toggle_signal(profiler))
+            os.kill(os.getpid(), signal.SIGUSR2)
+            busy_loop(0.05)
+            self.assertTrue(profiler.is_running())
+            os.kill(os.getpid(), signal.SIGUSR2)
+            time.sleep(0.01)
+            self.assertFalse(profiler.is_running())
+        finally:
+            signal.signal(signal.SIGUSR2, old_handler)
+
+        profiles = [ name for name in os.listdir(self.info_dir) if name.endswith('.pstats') ]
+        self.assertEqual(len(profiles), 1)
+        stats = pstats.Stats(os.path.join(self.info_dir, profiles[0]))
+        self.assertTrue(any(func[2] == 'busy_loop' for func in stats.stats))
+
+    def test_bad_mode(self):
+        """
+           unknown mode
+        """
+        self.assertRaises(ValueError, profiler_utils.SamplingProfiler, self.info_dir, mode = 'perf')
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestProfiler)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,188 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import gmv.fake_imap_server as fake_imap_server
+import gmv.gmvault as gmvault
+import gmv.imap_utils as imap_utils
+import gmv.quota_utils as quota_utils
+import gmv.retry_utils as retry_utils
+
+CREDENTIAL = { 'type' : 'passwd', 'value' : 'pwd' }
+
+class FakeClock(object):
+    """ clock whose sleep moves the time forward """
+    def __init__(self, now = 1000000.0):
+        self.now    = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        """ sleep """
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestQuotaPacer(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Pacing against the Gmail quotas
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.old_gmvault_dir = os.environ.get('GMVAULT_DIR')
+        os.environ['GMVAULT_DIR'] = os.path.join(self.work_dir, 'conf')
+        retry_utils.reset_circuit_breakers()
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        if self.old_gmvault_dir is None:
+            del os.environ['GMVAULT_DIR']
+        else:
+            os.environ['GMVAULT_DIR'] = self.old_gmvault_dir
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def _pacer(self, clock, path = None):
+        """ 1000 bytes per hour downloaded, no upload limit """
+        return quota_utils.QuotaPacer({ 'in' : 1000 }, window = 3600, slowdown = 0.5, pause = 0.9, \
+                                      throttle_pause = 600, path = path, clock = clock, sleep = clock.sleep)
+
+    def test_pacing(self):
+        """
+           full speed, then the sustainable rate, then a pause until the oldest bytes leave the window
+        """
+        clock = FakeClock()
+        pacer = self._pacer(clock)
+        self.assertEqual(pacer.pace('in', 400), 0)
+        self.assertEqual(pacer.pace('in', 200), 0)
+        self.assertEqual(pacer.pace('out', 10 ** 9), 0)
+        # 600 > 50% used: 100 bytes at 1000 bytes / 3600 s
+        self.assertEqual(pacer.pace('in', 100), 360)
+        self.assertEqual(pacer.used('in'), 700)
+        # 700 + 300 > 90%: wait for the first bucket (600 bytes) to leave the window
+        start = clock.now
+        waited = pacer.pace('in', 300)
+        self.assertTrue(3600 - 360 <= waited <= 3600 + pacer.BUCKET - 360)
+        self.assertEqual(clock.now, start + waited)
+        self.assertEqual(pacer.used('in'), 400)
+
+    def test_throttled(self):
+        """
+           a throttling answer pauses the transfers, doubling the pause each time until a call goes through
+        """
+        clock = FakeClock()
+        pacer = self._pacer(clock)
+        self.assertTrue(quota_utils.is_throttling("fetch failed: [OVERQUOTA] Account exceeded command or " \
+                                                  "bandwidth limits. (Failure)"))
+        self.assertFalse(quota_utils.is_throttling("fetch failed: Some messages could not be FETCHed"))
+        self.assertEqual([ pacer.throttled() for _ in range(4) ], [600, 1200, 2400, 3600])
+        self.assertEqual(pacer.pause_left(), 3600)
+        self.assertEqual(pacer.pace('out', 10), 3600)
+        pacer.succeeded()
+        self.assertEqual(pacer.throttled(), 600)
+
+    def test_persistence(self):
+        """
+           a new run continues with the window and the pause of the previous one
+        """
+        clock = FakeClock()
+        path  = os.path.join(self.work_dir, 'db', '.info', 'foo_quota.info')
+        pacer = self._pacer(clock, path)
+        pacer.pace('in', 700)
+        pacer.throttled()
+        self.assertTrue(os.path.exists(path))
+
+        clock.now += 60
+        pacer = self._pacer(clock, path)
+        self.assertEqual((pacer.used('in'), pacer.pause_left(), pacer.nb_throttled), (700, 540, 1))
+
+        with open(path, 'w') as the_file:
+            json.dump({ 'version' : 0 }, the_file)
+        self.assertEqual(self._pacer(clock, path).used('in'), 0)
+
+    def test_save_threads(self):
+        """
+           the email and chat phases can save the shared pacer at the same time
+        """
+        clock = FakeClock()
+        path  = os.path.join(self.work_dir, 'db', '.info', 'foo_quota.info')
+        pacer = self._pacer(clock, path)
+        pacer.pace('in', 100)
+
+        def save():
+            for _ in range(50):
+                pacer.save()
+        threads = [ threading.Thread(target = save) for _ in range(8) ]
+        with unittest.mock.patch.object(quota_utils, 'LOG') as log:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(log.method_calls, [])
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['foo_quota.info'])
+        self.assertEqual(self._pacer(clock, path).used('in'), 100)
+
+    def test_fetcher(self):
+        """
+           the fetches and appends are charged to the pacer, a throttling answer pauses before the retry
+           and the state is saved in the .info dir of the db
+        """
+        account = fake_imap_server.FakeGmailAccount(nb_emails = 20, msg_size = 1024)
+        with fake_imap_server.FakeGmailServer({ 'source@gmail.com' : account }) as server, \
+             unittest.mock.patch('gmv.imap_utils.time.sleep') as sleep:
+            db_dir   = os.path.join(self.work_dir, 'db')
+            vaulter  = gmvault.GMVaulter(db_dir, server.host, server.port, 'source@gmail.com', CREDENTIAL, \
+                                         read_only_access = False, use_ssl = False)
+            fetcher  = vaulter.src
+            fetcher.select_folder('ALLMAIL')
+            data = fetcher.fetch(list(range(1, 21)), imap_utils.GIMAPFetcher.GET_ALL_INFO)
+            self.assertEqual(fetcher.pacer.used('in'), fetcher.metrics.get_counter('bytes_in'))
+
+            server.conf['fail_commands']['APPEND'] = '[OVERQUOTA] Account exceeded command or bandwidth limits.'
+            body = 'Subject: throttled\nFrom: foo@bar.com\n\nhello\n'
+            fetcher.push_data(fetcher.get_folder_name('ALLMAIL'), body, (), datetime.datetime(2014, 5, 1))
+            self.assertEqual(fetcher.metrics.get_counter('throttled'), 1)
+            # the reconnection waited for the pause
+            self.assertTrue(max(call[0][0] for call in sleep.call_args_list) > 800)
+            self.assertEqual(fetcher.pacer.used('out'), 2 * len(body))
+            self.assertEqual(fetcher.pacer.nb_throttled, 0)
+
+            vaulter.save_metrics('sync')
+            fetcher.disconnect()
+
+        with open(os.path.join(db_dir, '.info', 'source@gmail.com_quota.info')) as the_file:
+            state = json.load(the_file)
+        self.assertEqual(sum(size for _, size in state['buckets']['in']), fetcher.metrics.get_counter('bytes_in'))
+        self.assertTrue(state['paused_until'] > 0)
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestQuotaPacer)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
@@ -0,0 +1,234 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import unittest
+
+import gmv.collections_utils as collections_utils
+import gmv.fake_imap_server as fake_imap_server
+import gmv.gmvault as gmvault
+import gmv.gmvault_db as gmvault_db
+import gmv.imap_utils as imap_utils
+
+CREDENTIAL = { 'type' : 'passwd', 'value' : 'pwd' }
+
+class TestRecords(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Compact message records, label dictionary and gmail id index
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.old_gmvault_dir = os.environ.get('GMVAULT_DIR')
+        os.environ['GMVAULT_DIR'] = os.path.join(self.work_dir, 'conf')
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        if self.old_gmvault_dir is None:
+            del os.environ['GMVAULT_DIR']
+        else:
+            os.environ['GMVAULT_DIR'] = self.old_gmvault_dir
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def test_id_index(self):
+        """
+           sorted ids, last duplicate wins, lookups and tail
+        """
+        index = collections_utils.GmailIdIndex.from_items([(30, '2012-01'), (10, '2011-12'), (20, '2012-01'), \
+                                                           (10, '2012-02')])
+        self.assertEqual(list(index), [10, 20, 30])
+        self.assertEqual(dict(index.items()), { 10 : '2012-02', 20 : '2012-01', 30 : '2012-01' })
+        self.assertTrue(20 in index)
+        self.assertFalse(25 in index)
+        self.assertRaises(KeyError, index.__getitem__, 25)
+        self.assertEqual((index.find(25), index.index(30)), (-1, 2))
+        self.assertRaises(ValueError, index.index, 25)
+        self.assertEqual(list(index.tail(1).items()), [(20, '2012-01'), (30, '2012-01')])
+        self.assertEqual(len(collections_utils.GmailIdIndex()), 0)
+
+    def test_id_index_memory(self):
+        """
+           an order of magnitude smaller than the former OrderedDict of int => str
+        """
+        def items():
+            """ (gm_id, dir) pairs as read from the .meta paths """
+            for i in range(100000):
+                yield 1400000000000000000 + i, '%d-%02d' % (2004 + i // 12000, 1 + (i // 1000) % 12)
+
+        tracemalloc.start()
+        try:
+            start  = tracemalloc.get_traced_memory()[0]
+            former = collections_utils.OrderedDict(sorted(items(), key = lambda t: t[0]))
+            former_size = tracemalloc.get_traced_memory()[0] - start
+            del former
+
+            start = tracemalloc.get_traced_memory()[0]
+            index = collections_utils.GmailIdIndex.from_items(items())
+            index_size = tracemalloc.get_traced_memory()[0] - start
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(index.nbytes(), 12 * 100000)
+        self.assertTrue(index_size * 10 < former_size, "%d vs %d bytes" % (index_size, former_size))
+
+    def test_message_record(self):
+        """
+           imap response => record => .meta => record
+        """
+        email_info = { imap_utils.GIMAPFetcher.GMAIL_ID : 1400000000000000001,
+                       imap_utils.GIMAPFetcher.GMAIL_THREAD_ID : 1400000000000000000,
+                       imap_utils.GIMAPFetcher.GMAIL_LABELS : ['work', 0, '\\Inbox'],
+                       imap_utils.GIMAPFetcher.IMAP_FLAGS : (b'\\Seen',),
+                       imap_utils.GIMAPFetcher.IMAP_INTERNALDATE : datetime.datetime(2012, 3, 4, 5, 6, 7) }
+        label_dict = gmvault_db.LabelDictionary(reserved_labels_map = {})
+        record = gmvault_db.MessageRecord.from_imap(label_dict, email_info, ['gmvault-chats'], \
+                                                    ('subject', 'id@host', None))
+        self.assertEqual(record.label_ids, (0, 1, 2, 3))
+        self.assertEqual(record.labels, ('work', '0', '\\Inbox', 'gmvault-chats'))
+        self.assertEqual(record.flags, ('\\Seen',))
+        self.assertTrue(isinstance(record.internal_date, int))
+        self.assertFalse(hasattr(record, '__dict__'))
+
+        meta = json.loads(json.dumps(record.to_meta()))
+        self.assertEqual(meta[gmvault_db.GmailStorer.LABELS_K], ['work', '0', '\\Inbox', 'gmvault-chats'])
+        read = gmvault_db.MessageRecord.from_meta(label_dict, meta)
+        self.assertEqual(read, record)
+        self.assertTrue(read.label_ids is record.label_ids) # shared label id tuple
+        self.assertTrue(read.labels is record.labels)
+        self.assertEqual(read[gmvault_db.GmailStorer.INT_DATE_K], datetime.datetime(2012, 3, 4, 5, 6, 7))
+        self.assertEqual(read.get(gmvault_db.GmailStorer.MSGID_K), 'id@host')
+        self.assertEqual(read.get('unknown', 'default'), 'default')
+
+    def test_label_dictionary(self):
+        """
+           ids, precomputed forms and persistence in the .info dir
+        """
+        path = os.path.join(self.work_dir, 'labels.json')
+        label_dict = gmvault_db.LabelDictionary(path, { 'inbox' : 'gmv-inbox' })
+        self.assertEqual(label_dict.ids_of(['Entwürfe', 'INBOX', 'a&b']), (0, 1, 2))
+        self.assertEqual(label_dict.id_of('Entwürfe'), 0)
+
+        entry = label_dict.entry(1)
+        self.assertEqual((entry.lower, entry.restore_name, entry.imap_name, entry.reserved()), \
+                         ('inbox', 'gmv-inbox', 'gmv-inbox', True))
+        self.assertEqual([ entry.imap_name for entry in map(label_dict.entry, (0, 2)) ], ['Entw&APw-rfe', 'a&-b'])
+        self.assertFalse(label_dict.entry(0).reserved())
+
+        label_dict.save()
+        read = gmvault_db.LabelDictionary(path, {})
+        self.assertEqual(len(read), 3)
+        self.assertEqual(read.names((2, 0)), ('a&b', 'Entwürfe'))
+
+        with open(path, 'w') as the_file:
+            the_file.write('{ corrupted')
+        self.assertEqual(len(gmvault_db.LabelDictionary(path, {})), 0)
+
+    def test_label_dictionary_threads(self):
+        """
+           the email and chat watchers add labels and save the dictionary at the same time
+        """
+        path       = os.path.join(self.work_dir, 'labels.json')
+        label_dict = gmvault_db.LabelDictionary(path, {})
+        errors     = []
+        def add_and_save(prefix):
+            """ one watcher """
+            try:
+                for i in range(200):
+                    label_dict.id_of('%s-%d' % (prefix, i))
+                    label_dict.save()
+            except Exception as err: #pylint:disable=W0703
+                errors.append(err)
+
+        threads = [ threading.Thread(target = add_and_save, args = (prefix,)) for prefix in ('email', 'chat') ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(gmvault_db.LabelDictionary(path, {})), 400)
+
+    def test_encryption_cipher_threads(self):
+        """
+           the concurrent phases each get their own cipher (the CTR state is per cipher)
+        """
+        storer = gmvault_db.GmailStorer(os.path.join(self.work_dir, 'db'), encrypt_data = True)
+        with open(os.path.join(storer.get_info_dir(), gmvault_db.GmailStorer.ENCRYPTION_KEY_FILENAME), 'w') as f:
+            f.write('0123456789abcdef')
+        ciphers = {}
+        def get_ciphers(name):
+            """ one phase """
+            ciphers[name] = (storer.get_encryption_cipher(), storer.get_encryption_cipher())
+
+        threads = [ threading.Thread(target = get_ciphers, args = (name,)) for name in ('emails', 'chats') ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        get_ciphers('main')
+        self.assertTrue(all(first is second for first, second in ciphers.values()))
+        self.assertEqual(len(set(id(first) for first, _ in ciphers.values())), 3)
+
+    def test_update_and_clean(self):
+        """
+           second sync: changed flags are updated, emails deleted in Gmail are removed from the db
+        """
+        account = fake_imap_server.FakeGmailAccount(nb_emails = 20, msg_size = 512)
+        server  = fake_imap_server.FakeGmailServer({ 'foo@gmail.com' : account }).start()
+        try:
+            db_dir = os.path.join(self.work_dir, 'db')
+            def sync():
+                syncer = gmvault.GMVaulter(db_dir, server.host, server.port, 'foo@gmail.com', CREDENTIAL, \
+                                           use_ssl = False)
+                syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' }, db_cleaning = True)
+                syncer.src.disconnect()
+                return syncer
+            sync()
+
+            folder = account.folders[fake_imap_server.ALL_MAIL]
+            msg = folder.get(3)
+            msg.flags = (b'\\Seen', b'\\Flagged')
+            folder.update(msg)
+            folder.expunged.add(5)
+
+            syncer = sync()
+            self.assertEqual(syncer.metrics.get_counter('emails_updated'), 1)
+            ids = syncer.gstorer.get_all_existing_gmail_ids()
+            self.assertEqual(len(ids), 19)
+            self.assertFalse(account.GM_ID_BASE + 5 in ids)
+            self.assertEqual(set(syncer.gstorer.unbury_metadata(account.GM_ID_BASE + 3).flags), \
+                             set(['\\Seen', '\\Flagged']))
+
+            label_dict = gmvault_db.LabelDictionary(os.path.join(syncer.gstorer.get_info_dir(), \
+                                                                 gmvault_db.GmailStorer.LABELS_FILENAME), {})
+            self.assertTrue('\\Inbox' in label_dict.names(tuple(range(len(label_dict)))))
+        finally:
+            server.stop()
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRecords)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
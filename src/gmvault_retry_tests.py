@@ -0,0 +1,143 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import imaplib
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import gmv.fake_imap_server as fake_imap_server
+import gmv.imap_utils as imap_utils
+import gmv.retry_utils as retry_utils
+
+CREDENTIAL = { 'type' : 'passwd', 'value' : 'pwd' }
+
+class TestRetry(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Backoff, circuit breaker and resumed fetches
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.work_dir = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.old_gmvault_dir = os.environ.get('GMVAULT_DIR')
+        os.environ['GMVAULT_DIR'] = os.path.join(self.work_dir, 'conf')
+        retry_utils.reset_circuit_breakers()
+        self.account = fake_imap_server.FakeGmailAccount(nb_emails = 40, msg_size = 1024)
+        self.server  = fake_imap_server.FakeGmailServer({ 'source@gmail.com' : self.account }).start()
+        # no real waits between the reconnections
+        self.sleep = unittest.mock.patch('gmv.imap_utils.time.sleep')
+        self.sleep.start()
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        self.sleep.stop()
+        self.server.stop()
+        retry_utils.reset_circuit_breakers()
+        if self.old_gmvault_dir is None:
+            del os.environ['GMVAULT_DIR']
+        else:
+            os.environ['GMVAULT_DIR'] = self.old_gmvault_dir
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+    def _fetcher(self, transport):
+        """ connected GIMAPFetcher in All Mail """
+        fetcher = imap_utils.GIMAPFetcher(self.server.host, self.server.port, 'source@gmail.com', CREDENTIAL, \
+                                          use_ssl = False, transport = transport)
+        fetcher.connect()
+        fetcher.select_folder('ALLMAIL')
+        return fetcher
+
+    def test_backoff(self):
+        """
+           the waits double up to the cap, the jitter draws them in [d/2, d]
+        """
+        lowest  = retry_utils.Backoff(1, 2, cap = 10, rand = lambda: 0.0)
+        highest = retry_utils.Backoff(1, 2, cap = 10, rand = lambda: 1.0)
+        self.assertEqual([ lowest.next_delay() for _ in range(6) ], [0.5, 1, 2, 4, 5, 5])
+        self.assertEqual([ highest.next_delay() for _ in range(6) ], [1, 2, 4, 8, 10, 10])
+        highest.reset()
+        self.assertEqual(highest.next_delay(), 1)
+
+    def test_circuit_breaker(self):
+        """
+           open after threshold failures, half open after the cooldown
+        """
+        now = [0]
+        breaker = retry_utils.CircuitBreaker(threshold = 3, cooldown = 60, clock = lambda: now[0])
+        self.assertEqual([ breaker.failure() for _ in range(3) ], [False, False, True])
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(retry_utils.CircuitOpenError) as ctx:
+            breaker.check()
+        self.assertEqual(ctx.exception.retry_in, 60)
+
+        now[0] = 61
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.check()
+        self.assertTrue(breaker.failure()) # one failure is enough to open it again
+        now[0] = 122
+        breaker.check()
+        breaker.success()
+        self.assertEqual((breaker.state, breaker.failures, breaker.nb_opened), (breaker.CLOSED, 0, 2))
+
+    def test_resume_fetch(self):
+        """
+           after a connection loss in the middle of a FETCH, only the messages not received are fetched again
+        """
+        for transport in imap_utils.GIMAPFetcher.TRANSPORTS:
+            fetcher  = self._fetcher(transport)
+            expected = fetcher.fetch(list(range(1, 41)), imap_utils.GIMAPFetcher.GET_ALL_INFO)
+
+            self.server.stats['fetched'] = 0
+            self.server.conf['drop_fetch_after'] = 15
+            data = fetcher.fetch(list(range(1, 41)), imap_utils.GIMAPFetcher.GET_ALL_INFO)
+
+            self.assertEqual(data, expected)
+            self.assertEqual(self.server.stats['fetched'], 40)
+            self.assertEqual(fetcher.metrics.get_counter('retry_kept_msgs'), 15)
+            self.assertEqual(fetcher.metrics.get_counter('retries'), 1)
+            self.assertEqual(fetcher.total_nb_reconns, 1)
+            self.assertEqual(fetcher.metrics.summary()['stages']['reconnect']['calls'], 1)
+            fetcher.disconnect()
+
+    def test_circuit_open(self):
+        """
+           when the server is gone, the calls fail fast once the breaker is open
+        """
+        fetcher = self._fetcher('imapclient')
+        self.server.stop()
+        fetcher.server._imap.shutdown() #pylint:disable=W0212
+
+        # 1 failed fetch + 3 failed reconnections
+        self.assertRaises(imaplib.IMAP4.abort, fetcher.fetch, [1, 2], imap_utils.GIMAPFetcher.GET_ALL_INFO)
+        self.assertEqual(fetcher.circuit_breaker().state, retry_utils.CircuitBreaker.CLOSED)
+        # the 5th consecutive failure opens it
+        self.assertRaises(retry_utils.CircuitOpenError, fetcher.fetch, [1, 2], imap_utils.GIMAPFetcher.GET_ALL_INFO)
+        nb_reconns = fetcher.total_nb_reconns
+        self.assertRaises(retry_utils.CircuitOpenError, fetcher.search, { 'type' : 'imap', 'req' : 'ALL' })
+        self.assertEqual(fetcher.total_nb_reconns, nb_reconns)
+        self.assertEqual(fetcher.metrics.get_counter('circuit_open'), 3)
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRetry)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()
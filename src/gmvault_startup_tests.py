@@ -0,0 +1,96 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# modules that only the commands needing them may import
+LAZY_MODULES = ['gmv.gmvault', 'gmv.imap_utils', 'gmv.gmvault_export', 'gmv.gmvault_db', 'gmv.credential_utils', \
+                'gmv.gmvault_daemon', 'imapclient', 'chardet', 'urllib.request', 'http.server']
+
+# max time to import gmv.gmv_cmd (best of 3 runs). Override with $GMVAULT_STARTUP_THRESHOLD_MS
+STARTUP_THRESHOLD_MS = int(os.environ.get('GMVAULT_STARTUP_THRESHOLD_MS', 300))
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def import_times(module, env):
+    """
+       Run python -X importtime -c 'import module'. Return { module name : cumulative time in us }
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % (module)], \
+                          cwd = SRC_DIR, env = env, stdout = subprocess.PIPE, stderr = subprocess.PIPE, \
+                          universal_newlines = True, check = True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+class TestStartup(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       gmvault startup time
+    """
+    def setUp(self): #pylint:disable-msg=C0103
+        self.home = tempfile.mkdtemp(prefix = 'gmv-test-')
+        self.env  = dict(os.environ, HOME = self.home)
+        self.env.pop('GMVAULT_DIR', None)
+
+    def tearDown(self): #pylint:disable-msg=C0103
+        shutil.rmtree(self.home, ignore_errors = True)
+
+    def test_lazy_imports(self):
+        """
+           importing gmv_cmd does not load the network, export and encoding stacks
+        """
+        times = import_times('gmv.gmv_cmd', self.env)
+        self.assertTrue('gmv.gmv_cmd' in times)
+        self.assertEqual([ module for module in LAZY_MODULES if module in times ], [])
+
+    def test_import_time(self):
+        """
+           regression threshold on the gmv_cmd import time
+        """
+        best = min(import_times('gmv.gmv_cmd', self.env)['gmv.gmv_cmd'] for _ in range(3)) / 1000.0
+        self.assertTrue(best < STARTUP_THRESHOLD_MS, \
+                        "gmv.gmv_cmd import takes %.1f ms (threshold %d ms)" % (best, STARTUP_THRESHOLD_MS))
+
+    def test_version(self):
+        """
+           --version neither loads the commands nor writes the defaults file
+        """
+        proc = subprocess.run([sys.executable, '-m', 'gmv.gmv_cmd', '--version'], cwd = SRC_DIR, env = self.env, \
+                              stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+        self.assertEqual(proc.returncode, 0)
+        self.assertTrue('Gmvault v' in proc.stdout + proc.stderr)
+        self.assertFalse(os.path.exists(os.path.join(self.home, '.gmvault')))
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestStartup)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+
+    tests()